@@ -1,129 +1,266 @@
 #!/usr/bin/env python3
 import argparse
 import h5py
+from multiprocessing import Process, Queue
 import numpy as np
+import queue
 import sys
+import threading
 import time
 import torch
 
 from ont_fast5_api import fast5_interface
 
-from taiyaki import basecall_helpers, fast5utils, layers
-from taiyaki.cmdargs import FileAbsent, FileExists, NonNegative, Positive
+from taiyaki import basecall_helpers, decoding, fast5utils, layers
+from taiyaki.cmdargs import AutoBool, FileAbsent, FileExists, NonNegative, Positive
 from taiyaki.common_cmdargs import add_common_command_args
 from taiyaki.constants import DEFAULT_ALPHABET
-from taiyaki.cupy_extensions.flipflop import flipflop_make_trans, flipflop_viterbi
 from taiyaki.flipflopfings import extract_mod_weights, nstate_flipflop, path_to_str
 from taiyaki.helpers import (guess_model_stride, load_model, open_file_or_stdout,
                              Progress)
-from taiyaki.maths import med_mad
 from taiyaki.prepare_mapping_funcs import get_per_read_params_dict_from_tsv
 from taiyaki.signal import Signal
 
 
 STITCH_BEFORE_VITERBI = False
+# Number of reads waiting between stages of the pipeline, per reader process
+_QUEUED_READS_PER_JOB = 8
+# Seconds to wait for a read before checking that the reader processes are alive
+_READER_POLL_INTERVAL = 5.0
 
 
 parser = argparse.ArgumentParser(
     description="Basecall reads using a taiyaki model",
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-add_common_command_args(parser, 'alphabet device input_folder input_strand_list limit output quiet recursive version'.split())
+add_common_command_args(parser, 'alphabet device input_folder input_strand_list jobs limit output quiet read_batch_size read_index recursive version'.split())
 
+parser.add_argument("--batch_size", type=Positive(int),
+                    default=basecall_helpers._DEFAULT_BATCH_SIZE,
+                    help="Number of chunks, possibly from several reads, " +
+                         "sent to GPU at once")
 parser.add_argument("--chunk_size", type=Positive(int),
                     default=basecall_helpers._DEFAULT_CHUNK_SIZE,
                     help="Size of signal chunks sent to GPU")
 parser.add_argument("--modified_base_output", action=FileAbsent, default=None,
                     help="Output filename for modified base output.")
-parser.add_argument("--overlap", type=NonNegative(int),
-                    default=basecall_helpers._DEFAULT_OVERLAP,
-                    help="Overlap between signal chunks sent to GPU")
+parser.add_argument("--ordered", default=True, action=AutoBool,
+                    help="Write basecalls in the order reads were found, rather than " +
+                         "as they are completed")
+parser.add_argument("--overlap", type=NonNegative(int), default=None,
+                    help=("Overlap between signal chunks sent to GPU. " +
+                          "Default {}, or when chunks are stitched before " +
+                          "decoding the smallest that does not change the " +
+                          "network output").format(basecall_helpers._DEFAULT_OVERLAP))
 parser.add_argument('--scaling', action=FileExists, default=None,
                     help='Per-read scaling params')
 parser.add_argument("model", action=FileExists,
                     help="Model checkpoint file to use for basecalling")
 
 
-def med_mad_norm(x, dtype='f4'):
-    """ Normalise a numpy array using median and MAD """
-    med, mad = med_mad(x)
-    normed_x = (x - med) / mad
-    return normed_x.astype(dtype)
+def get_signal(read_filename, read_id, read=None):
+    """ Get Signal object from read tuple (as returned by fast5utils.iterate_fast5_reads)
 
-
-def get_signal(read_filename, read_id):
-    """ Get raw signal from read tuple (as returned by fast5utils.iterate_fast5_reads) """
+    If read, an ont_fast5_api read object, is given then the file is not opened.
+    """
     try:
-        with fast5_interface.get_fast5_file(read_filename, 'r') as f5file:
-            read = f5file.get_read(read_id)
-            sig = Signal(read)
-            return sig.current
+        if read is None:
+            with fast5_interface.get_fast5_file(read_filename, 'r') as f5file:
+                read = f5file.get_read(read_id)
+                return Signal(read)
+        return Signal(read)
 
     except Exception as e:
         sys.stderr.write('Unable to obtain signal for {} from {}.\n{}\n'.format(
             read_id, read_filename, repr(e)))
         return None
 
-def process_read(
-        read_filename, read_id, model, chunk_size, overlap, read_params,
-        n_can_state, stride, alphabet, is_cat_mod, mods_fp):
-    signal = get_signal(read_filename, read_id)
-    if signal is None:
-        return None, 0
+def prepare_read(read_filename, read_id, read_params, chunk_size, overlap,
+                 read=None):
+    """ Load signal for a read, normalise it and divide it into chunks
+
+    :returns: tuple (chunks, chunk_starts, chunk_ends, number of samples) as
+        for basecall_helpers.chunk_read, or None if the signal can't be read
+    """
+    sig = get_signal(read_filename, read_id, read)
+    if sig is None:
+        return None
 
     if read_params is None:
-        normed_signal = med_mad_norm(signal)
+        normed_signal = sig.standardised_current()
     else:
-        normed_signal = (signal - read_params['shift']) / read_params['scale']
+        normed_signal = sig.standardised_current(read_params['shift'], read_params['scale'])
 
     chunks, chunk_starts, chunk_ends = basecall_helpers.chunk_read(
         normed_signal, chunk_size, overlap)
+    return chunks, chunk_starts, chunk_ends, sig.trimmed_length
+
+
+def reader_worker(task_queue, read_queue, chunk_size, overlap):
+    """ Reader and normaliser stage of pipeline, run in a separate process.
+
+    Takes tuples (read_filename, list of (index, read_id, read_params)) from
+    task_queue until None is found, opening each file once, and puts
+    (index, read_id, prepare_read result) in read_queue for each read.  If a
+    file fails part way through, the result is None for each of its remaining
+    reads.  None is put in read_queue when finished, even on error.
+    """
+    try:
+        for read_filename, reads in iter(task_queue.get, None):
+            nqueued = 0
+            try:
+                read_ids = [read_id for _, read_id, _ in reads]
+                file_reads = fast5utils.iterate_file_reads(read_filename, read_ids)
+                for (index, read_id, read_params), (_, read) in zip(reads, file_reads):
+                    if read is None:
+                        sys.stderr.write('Unable to obtain read {} from {}.\n'.format(
+                            read_id, read_filename))
+                        result = None
+                    else:
+                        result = prepare_read(read_filename, read_id, read_params,
+                                              chunk_size, overlap, read)
+                    read_queue.put((index, read_id, result))
+                    nqueued += 1
+            except Exception as e:
+                sys.stderr.write('Unable to read from {}.\n{}\n'.format(
+                    read_filename, repr(e)))
+                for index, read_id, _ in reads[nqueued:]:
+                    read_queue.put((index, read_id, None))
+    finally:
+        read_queue.put(None)
+
+
+def get_flipflop_decoder(device):
+    """ Module providing flipflop_make_trans and flipflop_viterbi for device
+
+    Decoding is done by taiyaki.decoding on CPU and by cupy on GPU
+    """
+    if device.type == 'cpu':
+        return decoding
+    from taiyaki.cupy_extensions import flipflop
+    return flipflop
+
+
+def run_batch(batch, model, n_can_state, is_cat_mod, output_mods):
+    """ Run network on a batch of chunks and decode each chunk
+
+    :returns: tuple of tensors with chunks on second axis, to be given to
+        basecall_helpers.ChunkBatcher.add_output
+    """
     with torch.no_grad():
         device = next(model.parameters()).device
-        out = model(torch.tensor(chunks, device=device))
+        out = model(torch.tensor(batch, device=device))
 
+        if STITCH_BEFORE_VITERBI:
+            return (out,)
+
+        decoder = get_flipflop_decoder(device)
+        trans, _, _ = decoder.flipflop_make_trans(out[:,:,:n_can_state])
+        _, _, chunk_best_paths = decoder.flipflop_viterbi(trans)
+        if is_cat_mod and output_mods:
+            return chunk_best_paths, out[:,:,n_can_state:]
+        return (chunk_best_paths,)
+
+
+def finish_read(read_outputs, chunk_starts, chunk_ends, model, n_can_state,
+                stride, is_cat_mod, output_mods):
+    """ Stitch outputs of run_batch for the chunks of a read together
+
+    :returns: tuple (best path as numpy array, modified base scores or None)
+    """
+    with torch.no_grad():
         if STITCH_BEFORE_VITERBI:
             out = basecall_helpers.stitch_chunks(
-                out, chunk_starts, chunk_ends, stride)
-            trans, _, _ = flipflop_make_trans(
+                read_outputs[0], chunk_starts, chunk_ends, stride)
+            decoder = get_flipflop_decoder(out.device)
+            trans, _, _ = decoder.flipflop_make_trans(
                 out.unsqueeze(1)[:,:,:n_can_state])
-            _, _, best_path = flipflop_viterbi(trans)
+            _, _, best_path = decoder.flipflop_viterbi(trans)
         else:
-            trans, _, _ = flipflop_make_trans(out[:,:,:n_can_state])
-            _, _, chunk_best_paths = flipflop_viterbi(trans)
             best_path = basecall_helpers.stitch_chunks(
-                chunk_best_paths, chunk_starts, chunk_ends, stride,
+                read_outputs[0], chunk_starts, chunk_ends, stride,
                 path_stitching=is_cat_mod)
+        best_path = best_path.cpu().numpy()
 
-        if is_cat_mod and mods_fp is not None:
+        mods_scores = None
+        if is_cat_mod and output_mods:
             # output modified base weights for each base call
             if STITCH_BEFORE_VITERBI:
                 mod_weights = out[:,n_can_state:]
             else:
                 mod_weights = basecall_helpers.stitch_chunks(
-                    out[:,:,n_can_state:], chunk_starts, chunk_ends, stride)
+                    read_outputs[1], chunk_starts, chunk_ends, stride)
             mods_scores = extract_mod_weights(
-                mod_weights.detach().cpu().numpy(),
-                best_path.detach().cpu().numpy(),
+                mod_weights.detach().cpu().numpy(), best_path,
                 model.sublayers[-1].can_nmods)
-            mods_fp.create_dataset(
-                'Reads/' + read_id, data=mods_scores,
-                compression="gzip")
 
-        basecall = path_to_str(
-            best_path.cpu().numpy(), alphabet=alphabet)
+    return best_path, mods_scores
+
 
-    return basecall, len(signal)
+class Writer(threading.Thread):
+    """ Writer stage of pipeline, run in a thread.
+
+    Takes tuples (index, read_id, best_path, mods_scores, nsample) from
+    result_queue until None is found, writing basecalls to fh and modified
+    base scores to mods_fp.  best_path is None for reads that failed.  If
+    ordered, reads are written in order of index.
+    """
+
+    def __init__(self, result_queue, fh, mods_fp, alphabet, ordered, progress):
+        super().__init__()
+        self.result_queue = result_queue
+        self.fh = fh
+        self.mods_fp = mods_fp
+        self.alphabet = alphabet
+        self.ordered = ordered
+        self.progress = progress
+        self.nbase, self.ncalled, self.nread, self.nsample = 0, 0, 0, 0
+        self.exception = None
+
+    def write(self, read_id, best_path, mods_scores, nsample):
+        if best_path is not None:
+            basecall = path_to_str(best_path, alphabet=self.alphabet)
+            self.fh.write(">{}\n{}\n".format(read_id, basecall))
+            if mods_scores is not None:
+                self.mods_fp.create_dataset(
+                    'Reads/' + read_id, data=mods_scores,
+                    compression="gzip")
+            self.nbase += len(basecall)
+            self.ncalled += 1
+        self.nread += 1
+        self.nsample += nsample
+        self.progress.step()
+
+    def run(self):
+        waiting = {}
+        next_index = 0
+        try:
+            for index, *result in iter(self.result_queue.get, None):
+                if not self.ordered:
+                    self.write(*result)
+                    continue
+                waiting[index] = result
+                while next_index in waiting:
+                    self.write(*waiting.pop(next_index))
+                    next_index += 1
+        except Exception as e:
+            self.exception = e
+            # Keep emptying queue so device stage is not blocked
+            for _ in iter(self.result_queue.get, None):
+                pass
 
 
 def main():
     args = parser.parse_args()
 
-    assert args.device != 'cpu', "Flipflop basecalling in taiyaki requires a GPU and for cupy to be installed"
+    if args.device != 'cpu' and not torch.cuda.is_available():
+        sys.stderr.write("* No GPU available, basecalling on CPU.\n")
+        args.device = 'cpu'
     device = torch.device(args.device)
     # TODO convert to logging
     sys.stderr.write("* Loading model.\n")
-    model = load_model(args.model).to(device)
+    # Model is moved to device after reader processes have been started
+    model = load_model(args.model)
     is_cat_mod = isinstance(model.sublayers[-1], layers.GlobalNormFlipFlopCatMod)
     do_output_mods = args.modified_base_output is not None
     if do_output_mods and not is_cat_mod:
@@ -133,24 +270,37 @@ def main():
     n_can_states = nstate_flipflop(model.sublayers[-1].nbase)
     stride = guess_model_stride(model)
     chunk_size = args.chunk_size * stride
-    chunk_overlap = args.overlap * stride
+    overlap = args.overlap
+    if overlap is None:
+        #  Viterbi path of each chunk depends on the whole chunk, so only
+        #  the network's context can be used when scores are stitched first
+        overlap = (basecall_helpers.chunk_overlap(model)
+                   if STITCH_BEFORE_VITERBI else basecall_helpers._DEFAULT_OVERLAP)
+    if overlap >= args.chunk_size:
+        sys.stderr.write(("* Overlap of {} blocks must be less than the chunk size of {} " +
+                          "blocks.  Increase --chunk_size or give a smaller --overlap.\n").format(
+                              overlap, args.chunk_size))
+        sys.exit(1)
+    chunk_overlap = overlap * stride
 
     sys.stderr.write("* Initializing reads file search.\n")
     fast5_reads = list(fast5utils.iterate_fast5_reads(args.input_folder,
                                                       limit=args.limit,
                                                       strand_list=args.input_strand_list,
-                                                      recursive=args.recursive))
+                                                      recursive=args.recursive,
+                                                      read_index=args.read_index, jobs=args.jobs))
     sys.stderr.write("* Found {} reads.\n".format(len(fast5_reads)))
 
     if args.scaling is not None:
         sys.stderr.write("* Loading read scaling parameters from {}.\n".format(args.scaling))
-        all_read_params = get_per_read_params_dict_from_tsv(args.scaling)
-        input_read_ids = frozenset(rec[1] for rec in fast5_reads)
-        scaling_read_ids = frozenset(all_read_params.keys())
-        sys.stderr.write("* {} / {} reads have scaling information.\n".format(len(input_read_ids & scaling_read_ids), len(input_read_ids)))
-        fast5_reads = [rec for rec in fast5_reads if rec[1] in scaling_read_ids]
+        per_read_params = get_per_read_params_dict_from_tsv(args.scaling)
+        rows = per_read_params.find(rec[1] for rec in fast5_reads)
+        has_scaling = rows >= 0
+        sys.stderr.write("* {} / {} reads have scaling information.\n".format(np.sum(has_scaling), len(fast5_reads)))
+        fast5_reads = [rec for rec, found in zip(fast5_reads, has_scaling) if found]
+        all_read_params = per_read_params.params[rows[has_scaling]]
     else:
-        all_read_params = {}
+        all_read_params = [None] * len(fast5_reads)
 
     mods_fp = None
     if do_output_mods:
@@ -163,34 +313,93 @@ def main():
             'mod_long_names', data=np.array(mod_long_names, dtype='S'),
             dtype=h5py.special_dtype(vlen=str))
 
-    sys.stderr.write("* Calling reads.\n")
-    nbase, ncalled, nread, nsample = 0, 0, 0, 0
+    # Reader processes are forked before the device is initialised
+    task_queue = Queue()
+    read_queue = Queue(_QUEUED_READS_PER_JOB * args.jobs)
+    readers = [Process(target=reader_worker,
+                       args=(task_queue, read_queue, chunk_size, chunk_overlap))
+               for _ in range(args.jobs)]
+    for reader in readers:
+        reader.start()
+    # Reads from the same file are handed to a reader together
+    for task in fast5utils.batch_file_reads(
+            ((read_filename, (index, read_id, all_read_params[index]))
+             for index, (read_filename, read_id) in enumerate(fast5_reads)),
+            args.read_batch_size):
+        task_queue.put(task)
+    for _ in readers:
+        task_queue.put(None)
+    model = model.to(device)
+
+    sys.stderr.write("* Calling reads using {} reader processes.\n".format(args.jobs))
     t0 = time.time()
     progress = Progress(quiet=args.quiet)
     try:
         with open_file_or_stdout(args.output) as fh:
-            for read_filename, read_id in fast5_reads:
-                read_params = all_read_params[read_id] if read_id in all_read_params else None
-                basecall, read_nsample = process_read(
-                    read_filename, read_id, model, chunk_size, chunk_overlap,
-                    read_params, n_can_states, stride, args.alphabet,
-                    is_cat_mod, mods_fp)
-                if basecall is not None:
-                    fh.write(">{}\n{}\n".format(read_id, basecall))
-                    nbase += len(basecall)
-                    ncalled += 1
-                nread += 1
-                nsample += read_nsample
-                progress.step()
+            result_queue = queue.Queue(_QUEUED_READS_PER_JOB * args.jobs)
+            writer = Writer(result_queue, fh, mods_fp, args.alphabet,
+                            args.ordered, progress)
+            writer.start()
+            try:
+                batcher = basecall_helpers.ChunkBatcher(args.batch_size)
+
+                def run_batches(flush=False):
+                    for batch, provenance in batcher.batches(flush=flush):
+                        batch_outputs = run_batch(batch, model, n_can_states,
+                                                  is_cat_mod, do_output_mods)
+                        for (index, read_id, read_nsample), read_outputs, \
+                                chunk_starts, chunk_ends in batcher.add_output(
+                                    provenance, batch_outputs):
+                            best_path, mods_scores = finish_read(
+                                read_outputs, chunk_starts, chunk_ends, model,
+                                n_can_states, stride, is_cat_mod, do_output_mods)
+                            result_queue.put((index, read_id, best_path,
+                                              mods_scores, read_nsample))
+
+                nfinished = 0
+                while nfinished < args.jobs:
+                    try:
+                        item = read_queue.get(timeout=_READER_POLL_INTERVAL)
+                    except queue.Empty:
+                        #  A reader that exited without finishing will never put
+                        #  its remaining reads or None on the queue
+                        ndead = sum(not reader.is_alive() for reader in readers)
+                        if ndead > nfinished:
+                            raise RuntimeError(
+                                '{} reader processes exited unexpectedly'.format(
+                                    ndead - nfinished))
+                        continue
+                    if item is None:
+                        nfinished += 1
+                        continue
+                    index, read_id, prepared = item
+                    if prepared is None:
+                        result_queue.put((index, read_id, None, None, 0))
+                        continue
+                    chunks, chunk_starts, chunk_ends, read_nsample = prepared
+                    batcher.add_read((index, read_id, read_nsample), chunks,
+                                     chunk_starts, chunk_ends)
+                    run_batches()
+                run_batches(flush=True)
+            finally:
+                #  Writer only finishes when None is found, so it is sent
+                #  even if the device stage fails
+                result_queue.put(None)
+                writer.join()
+            if writer.exception is not None:
+                raise writer.exception
     finally:
+        for reader in readers:
+            reader.terminate()
+            reader.join()
         if mods_fp is not None:
             mods_fp.close()
     total_time = time.time() - t0
 
-    sys.stderr.write("* Called {} reads in {:.2f}s\n".format(nread, int(total_time)))
-    sys.stderr.write("* {:7.2f} kbase / s\n".format(nbase / total_time / 1000.0))
-    sys.stderr.write("* {:7.2f} ksample / s\n".format(nsample / total_time / 1000.0))
-    sys.stderr.write("* {} reads failed.\n".format(nread - ncalled))
+    sys.stderr.write("* Called {} reads in {:.2f}s\n".format(writer.nread, int(total_time)))
+    sys.stderr.write("* {:7.2f} kbase / s\n".format(writer.nbase / total_time / 1000.0))
+    sys.stderr.write("* {:7.2f} ksample / s\n".format(writer.nsample / total_time / 1000.0))
+    sys.stderr.write("* {} reads failed.\n".format(writer.nread - writer.ncalled))
     return
 
 
@@ -1,53 +1,50 @@
 #!/usr/bin/env python3
 import argparse
 import csv
-import numpy as np
+from itertools import chain
 import os
 import sys
 
-from ont_fast5_api import fast5_interface
 from taiyaki.cmdargs import NonNegative
 from taiyaki.common_cmdargs import add_common_command_args
 import taiyaki.fast5utils as fast5utils
 from taiyaki.helpers import open_file_or_stdout
 from taiyaki.iterators import imap_mp
-from taiyaki.maths import med_mad
-from taiyaki.signal import Signal
+from taiyaki.signal import Signal, med_mad_batch
 
 parser = argparse.ArgumentParser()
 
-add_common_command_args(parser, 'input_folder input_strand_list limit output recursive version jobs'.split())
+add_common_command_args(parser, 'input_folder input_strand_list limit output read_batch_size read_index recursive version jobs'.split())
 
 parser.add_argument('--trim', default=(200, 50), nargs=2, type=NonNegative(int),
                     metavar=('beginning', 'end'),
                     help='Number of samples to trim off start and end')
 
 
-def one_read_shift_scale(read_tuple):
+def file_shift_scale(file_batch):
+    """ Shift and scale for a batch of reads from one file, opening it once
 
-    read_filename, read_id = read_tuple
+    :param file_batch: tuple (filename, list of read_ids), as yielded by
+        fast5utils.batch_file_reads
 
-    try:
-        with fast5_interface.get_fast5_file(read_filename, 'r') as f5file:
-            read = f5file.get_read(read_id)
-            sig = Signal(read)
+    :returns: list of tuples (read_id, shift, scale), computed for all
+        reads of the batch at once, with (None, None, None) for each read
+        whose signal cannot be obtained
+    """
+    read_filename, read_ids = file_batch
+    results, signals = [], []
+    for read_id, read in fast5utils.iterate_file_reads(read_filename, read_ids):
+        try:
+            signals.append((read_id, Signal(read)))
+        except Exception as e:
+            sys.stderr.write('Unable to obtain signal for {} from {}.\n{}\n'.format(
+                read_id, read_filename, repr(e)))
+            results.append((None, None, None))
 
-    except Exception as e:
-        sys.stderr.write('Unable to obtain signal for {} from {}.\n{}\n'.format(
-            read_id, read_filename, repr(e)))
-        return (None, None, None)
-
-    else:
-        signal = sig.current
-
-        if len(signal) > 0:
-            shift, scale = med_mad(signal)
-        else:
-            shift, scale = np.NaN, np.NaN
-            # note - if signal trimmed by ub, it could be of length zero by this point for short reads
-            # These are taken out later in the existing code, in the new code we'll take out ub trimming
-
-        return (read_id, shift, scale)
+    shifts, scales = med_mad_batch([sig for _, sig in signals])
+    results.extend((read_id, shift, scale) for (read_id, _), shift, scale
+                   in zip(signals, shifts, scales))
+    return results
 
 
 def main():
@@ -58,16 +55,18 @@ def main():
     fast5_reads = fast5utils.iterate_fast5_reads(args.input_folder,
                                                  limit=args.limit,
                                                  strand_list=args.input_strand_list,
-                                                 recursive=args.recursive)
+                                                 recursive=args.recursive,
+                                                 read_index=args.read_index, jobs=args.jobs)
 
     with open_file_or_stdout(args.output) as tsvfile:
         writer = csv.writer(tsvfile, delimiter='\t', lineterminator='\n')
         # UUID is 32hexdigits and four dashes eg. '43f6a05c-0856-4edc-8cd2-4866d9d60eaa'
         writer.writerow(['UUID', 'trim_start', 'trim_end', 'shift', 'scale'])
 
-        results = imap_mp(one_read_shift_scale, fast5_reads, threads=args.jobs)
+        file_batches = fast5utils.batch_file_reads(fast5_reads, args.read_batch_size)
+        results = imap_mp(file_shift_scale, file_batches, threads=args.jobs)
 
-        for result in results:
+        for result in chain.from_iterable(results):
             if all(result):
                 read_id, shift, scale = result
                 writer.writerow([read_id, trim_start, trim_end, shift, scale])
@@ -1,24 +1,35 @@
 #!/usr/bin/env python3
 import argparse
+from itertools import groupby
 import pysam
 import sys
 
 from taiyaki.bio import reverse_complement
-from taiyaki.cmdargs import proportion, FileExists
+from taiyaki.cmdargs import AutoBool, FileExists, Positive, proportion
 from taiyaki.common_cmdargs import add_common_command_args
-from taiyaki.helpers import fasta_file_to_dict, open_file_or_stdout
+from taiyaki.helpers import open_file_or_stdout
+from taiyaki.iterators import imap_mp
 
 
 parser = argparse.ArgumentParser(
     description='Extract reference sequence for each read from a SAM alignment file',
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-add_common_command_args(parser, ["output"])
+add_common_command_args(parser, ["jobs", "output"])
 
 parser.add_argument('--min_coverage', metavar='proportion', default=0.6, type=proportion,
                     help='Ignore reads with alignments shorter than min_coverage * read length')
+parser.add_argument('--ordered', default=True, action=AutoBool,
+                    help='Output references in the order alignments are found, rather ' +
+                         'than as each region is completed')
 parser.add_argument('--pad', type=int, default=0,
                     help='Number of bases by which to pad reference sequence')
+parser.add_argument('--region_size', type=Positive(int), default=1000000,
+                    help='Length of region of genome processed by each task, for ' +
+                         'indexed BAM files')
+parser.add_argument('--region_alignments', type=Positive(int), default=1000,
+                    help='Maximum number of alignments processed by each task, for ' +
+                         'indexed BAM files.  Regions with more alignments are split')
 parser.add_argument('reference', action=FileExists,
                     help="Genomic references that reads were aligned against")
 parser.add_argument('input', metavar='input.sam', nargs='+',
@@ -28,11 +39,28 @@ STRAND = {0: '+',
           16: '-'}
 
 
-def get_refs(sam, ref_seq_dict, min_coverage=0.6, pad=0):
-    """Read alignments from sam file and return accuracy metrics
+def get_refs(sam, references, min_coverage=0.6, pad=0, region=None):
+    """Read alignments from sam file and yield reference sequence for each read
+
+    :param sam: name of SAM or BAM file
+    :param references: pysam.FastaFile of genomic references
+    :param min_coverage: ignore reads with alignments shorter than
+        min_coverage * read length
+    :param pad: number of bases by which to pad reference sequence
+    :param region: tuple (contig, start, end) of region of genome, in which case
+        only alignments starting in region are used and sam must be indexed, or
+        None to use whole file
+
+    :yields: tuple (read name, fasta record)
     """
-    with pysam.Samfile(sam, 'r') as sf:
-        for read in sf:
+    with pysam.AlignmentFile(sam, 'r') as sf:
+        if region is None:
+            reads = sf
+        else:
+            contig, region_start, region_end = region
+            reads = (read for read in sf.fetch(contig, region_start, region_end)
+                     if read.reference_start >= region_start)
+        for read in reads:
             if read.flag != 0 and read.flag != 16:
                 continue
 
@@ -40,37 +68,134 @@ def get_refs(sam, ref_seq_dict, min_coverage=0.6, pad=0):
             if coverage < min_coverage:
                 continue
 
-            read_ref = ref_seq_dict.get(sf.references[read.reference_id], None)
-            if read_ref is None:
+            contig = sf.references[read.reference_id]
+            if contig not in references:
                 continue
 
             start = max(0, read.reference_start - pad)
-            end = min(len(read_ref), read.reference_end + pad)
+            end = min(references.get_reference_length(contig), read.reference_end + pad)
 
             strand = STRAND[read.flag]
-            read_ref = read_ref.decode() if isinstance(read_ref, bytes) else read_ref
+            read_ref = references.fetch(contig, start, end).upper()
 
-            if strand == "+":
-                read_ref = read_ref[start:end].upper()
-            else:
-                read_ref = reverse_complement(read_ref[start:end].upper())
+            if strand == "-":
+                read_ref = reverse_complement(read_ref)
 
             fasta = ">{}\n{}\n".format(read.qname, read_ref)
 
             yield (read.qname, fasta)
 
 
+def get_refs_for_work_unit(work_unit, reference, min_coverage=0.6, pad=0):
+    """Worker function extracting references for alignments in a region of an
+    indexed BAM file
+
+    :param work_unit: tuple (name of BAM file, region) as given by
+        get_work_units
+    :param reference: name of fasta file of genomic references
+
+    :returns: string of fasta records
+    """
+    sam, region = work_unit
+    with pysam.FastaFile(reference) as references:
+        return ''.join(fasta for _, fasta in get_refs(
+            sam, references, min_coverage, pad, region))
+
+
+def split_work_unit(work_unit, max_alignments):
+    """Worker function splitting a region of an indexed BAM file so that each
+    part has at most max_alignments alignments starting in it
+
+    Alignments starting at the same position are kept together, so a part
+    may have more alignments if more than max_alignments start at one place.
+
+    :param work_unit: tuple (name of BAM file, region) as given by
+        get_work_units
+    :param max_alignments: maximum number of alignments in each part
+
+    :returns: list of work units covering the region, in order
+    """
+    sam, (contig, region_start, region_end) = work_unit
+    starts = [region_start]
+    count = 0
+    last_start = None
+    with pysam.AlignmentFile(sam, 'r') as sf:
+        for read in sf.fetch(contig, region_start, region_end):
+            if read.reference_start < region_start:
+                continue
+            if count >= max_alignments and read.reference_start != last_start:
+                starts.append(read.reference_start)
+                count = 0
+            count += 1
+            last_start = read.reference_start
+    ends = starts[1:] + [region_end]
+    return [(sam, (contig, start, end)) for start, end in zip(starts, ends)]
+
+
+def get_work_units(samfiles, region_size):
+    """Divide alignment files into units of work
+
+    Indexed BAM files are split into regions of each contig, so alignments are
+    in the same order as in the file if work units are processed in order.
+    Other files cannot be split and are given whole, with a region of None.
+
+    :param samfiles: names of SAM or BAM files
+    :param region_size: length of each region
+
+    :returns: list of tuples (file name, (contig, start, end) or None)
+    """
+    work_units = []
+    for sam in samfiles:
+        with pysam.AlignmentFile(sam, 'r') as sf:
+            if not (sf.is_bam and sf.has_index()):
+                work_units.append((sam, None))
+                continue
+            for contig, length in zip(sf.references, sf.lengths):
+                work_units.extend((sam, (contig, start, min(start + region_size, length)))
+                                  for start in range(0, length, region_size))
+    return work_units
+
+
 def main():
     args = parser.parse_args()
 
-    sys.stderr.write("* Loading references (this may take a while for large genomes)\n")
-    references = fasta_file_to_dict(args.reference, allow_N=True)
-
-    sys.stderr.write("* Extracting read references using SAM alignment\n")
+    sys.stderr.write("* Opening indexed references\n")
+    # Builds .fai index if necessary, before workers try to use it
+    pysam.FastaFile(args.reference).close()
+
+    work_units = get_work_units(args.input, args.region_size)
+    sys.stderr.write("* Counting alignments in {} regions of SAM alignment\n".format(
+        len(work_units)))
+    # Regions are split so the fasta returned by each task is of bounded size
+    split_units = []
+    for is_region, units in groupby(work_units, lambda unit: unit[1] is not None):
+        if is_region:
+            for parts in imap_mp(split_work_unit, list(units), threads=args.jobs,
+                                 fix_kwargs={'max_alignments': args.region_alignments}):
+                split_units.extend(parts)
+        else:
+            split_units.extend(units)
+    work_units = split_units
+
+    sys.stderr.write("* Extracting read references from {} regions of SAM alignment\n".format(
+        len(work_units)))
+    kwargs = {'reference': args.reference,
+              'min_coverage': args.min_coverage,
+              'pad': args.pad}
     with open_file_or_stdout(args.output) as fh:
-        for samfile in args.input:
-            for (name, fasta) in get_refs(samfile, references, args.min_coverage, args.pad):
-                fh.write(fasta)
+        for is_region, units in groupby(work_units, lambda unit: unit[1] is not None):
+            if is_region:
+                for fasta in imap_mp(get_refs_for_work_unit, list(units),
+                                     threads=args.jobs, fix_kwargs=kwargs,
+                                     unordered=not args.ordered):
+                    fh.write(fasta)
+                continue
+            # Files that cannot be split are streamed rather than returned
+            # from a worker as a single string
+            with pysam.FastaFile(args.reference) as references:
+                for sam, _ in units:
+                    for _, fasta in get_refs(sam, references, args.min_coverage, args.pad):
+                        fh.write(fasta)
 
 
 if __name__ == '__main__':
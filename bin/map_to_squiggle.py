@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+from itertools import chain
 
 from taiyaki import fast5utils, helpers, squiggle_match
 from taiyaki.cmdargs import (FileExists, Maybe, NonNegative, proportion)
@@ -12,7 +13,7 @@ parser = argparse.ArgumentParser(
     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
 
-add_common_command_args(parser, "limit jobs output recursive version".split())
+add_common_command_args(parser, "limit jobs output read_batch_size read_index recursive version".split())
 
 parser.add_argument('--back_prob', default=1e-15, metavar='probability',
                     type=proportion, help='Probability of backwards move')
@@ -39,13 +40,16 @@ def main():
     fast5_reads = fast5utils.iterate_fast5_reads(args.read_dir,
                                                  limit=args.limit,
                                                  strand_list=args.input_strand_list,
-                                                 recursive=args.recursive)
+                                                 recursive=args.recursive,
+                                                 read_index=args.read_index, jobs=args.jobs)
 
     with helpers.open_file_or_stdout(args.output) as fh:
-        for res in imap_mp(squiggle_match.worker, fast5_reads, threads=args.jobs,
-                        fix_kwargs=helpers.get_kwargs(args, worker_kwarg_names),
-                        unordered=True, init=squiggle_match.init_worker,
-                        initargs=[model, args.references]):
+        file_batches = fast5utils.batch_file_reads(fast5_reads, args.read_batch_size)
+        results = imap_mp(squiggle_match.file_worker, file_batches, threads=args.jobs,
+                          fix_kwargs=helpers.get_kwargs(args, worker_kwarg_names),
+                          unordered=True, init=squiggle_match.init_worker,
+                          initargs=[model, args.references])
+        for res in chain.from_iterable(results):
             if res is None:
                 continue
             read_id, sig, score, path, squiggle, bases = res
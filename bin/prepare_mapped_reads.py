@@ -1,22 +1,43 @@
 #!/usr/bin/env python
 import argparse
-from taiyaki.iterators import imap_mp
+from itertools import chain
+from multiprocessing import Pool
+from taiyaki.iterators import imap_pool
 import os
 import sys
-from taiyaki.cmdargs import FileExists
+from taiyaki.cmdargs import AutoBool, FileExists, Maybe, NonNegative, Positive
 from taiyaki.common_cmdargs import add_common_command_args
-from taiyaki import alphabet, fast5utils, helpers, prepare_mapping_funcs
+from taiyaki import alphabet, basecall_helpers, fast5utils, fasta_index, helpers, prepare_mapping_funcs
 
 
 program_description = "Prepare data for model training and save to hdf5 file by remapping with flip-flop model"
 parser = argparse.ArgumentParser(description=program_description,
                                  formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-add_common_command_args(parser, 'alphabet device input_folder input_strand_list jobs limit overwrite recursive version'.split())
-
+add_common_command_args(parser, 'alphabet device input_folder input_strand_list jobs limit overwrite read_batch_size read_index recursive version'.split())
+
+parser.add_argument('--batch_size', default=basecall_helpers._DEFAULT_BATCH_SIZE,
+                    type=Positive(int),
+                    help='Number of chunks, possibly from several reads, run ' +
+                         'through network at once')
+parser.add_argument('--band_width', default=None, type=Maybe(Positive(int)),
+                    help='Initial width of band of reference positions for banded ' +
+                         'remapping, widened as necessary. None to remap against ' +
+                         'whole reference')
+parser.add_argument('--chunk_size', default=basecall_helpers._DEFAULT_CHUNK_SIZE,
+                    type=Maybe(Positive(int)),
+                    help='Size of signal chunks run through network, in network ' +
+                         'outputs. None to run network on each whole read ' +
+                         'separately')
+parser.add_argument('--low_memory', default=False, action=AutoBool,
+                    help='Store checkpoints rather than full traceback when ' +
+                         'remapping, trading time for memory on long reads')
 parser.add_argument('--mod', nargs=3, metavar=('base', 'canonical', 'name'),
                     default=[], action='append',
                     help='Modified base description')
+parser.add_argument('--overlap', default=basecall_helpers._DEFAULT_OVERLAP,
+                    type=NonNegative(int),
+                    help='Overlap between signal chunks, in network outputs')
 parser.add_argument('input_per_read_params', action=FileExists,
                     help='Input per read parameter .tsv file')
 parser.add_argument('output', help='Output HDF5 file')
@@ -34,6 +55,10 @@ def main():
         if os.path.exists(args.output):
             print("Cowardly refusing to overwrite {}".format(args.output))
             sys.exit(1)
+    if args.chunk_size is not None and args.overlap >= args.chunk_size:
+        print("Overlap of {} must be less than chunk size of {}".format(
+            args.overlap, args.chunk_size))
+        sys.exit(1)
 
     # Create alphabet and check for consistency
     modified_bases = [elt[0] for elt in args.mod]
@@ -56,27 +81,49 @@ def main():
     # Make an iterator that yields all the reads we're interested in.
     fast5_reads = fast5utils.iterate_fast5_reads(
         args.input_folder, limit=args.limit, strand_list=args.input_strand_list,
-        recursive=args.recursive)
-
-    # Set up arguments (kwargs) for the worker function for each read
-    kwargs = helpers.get_kwargs(args, ['device'])
-    kwargs['per_read_params_dict'] = prepare_mapping_funcs.get_per_read_params_dict_from_tsv(
-        args.input_per_read_params)
-    kwargs['references'] = helpers.fasta_file_to_dict(args.references,
-                                                      alphabet=full_alphabet)
-    kwargs['model'] = helpers.load_model(args.model)
-    kwargs['alphabet_info'] = alphabet_info
-
-    # remaps a single read using flip-flip network
-    workerFunction = prepare_mapping_funcs.oneread_remap
-
-    results = imap_mp(workerFunction, fast5_reads, threads=args.jobs,
-                      fix_kwargs=kwargs, unordered=True, chunksize=50)
-
-    # results is an iterable of dicts
-    # each dict is a set of return values from a single read
-    prepare_mapping_funcs.generate_output_from_results(
-        results, args.output, alphabet_info)
+        recursive=args.recursive, read_index=args.read_index, jobs=args.jobs)
+
+    # Load reads, references and per-read parameters in worker processes,
+    # opening each file once for a batch of reads
+    file_batches = fast5utils.batch_file_reads(fast5_reads, args.read_batch_size)
+    prepare_kwargs = {
+        'per_read_params_dict': prepare_mapping_funcs.get_per_read_params_dict_from_tsv(
+            args.input_per_read_params),
+        'references': fasta_index.IndexedFasta(args.references,
+                                               alphabet=full_alphabet)}
+    remap_kwargs = helpers.get_kwargs(args, ['band_width', 'low_memory'])
+    remap_kwargs['alphabet_info'] = alphabet_info
+
+    # Worker pools are created before the model is moved to the device, and
+    # all stages are driven from this thread: it submits file batches, runs
+    # the network on the prepared reads and submits the network outputs
+    with Pool(args.jobs) as prepare_pool, Pool(args.jobs) as remap_pool:
+        prepared_reads = chain.from_iterable(imap_pool(
+            prepare_pool, prepare_mapping_funcs.file_prepare, file_batches,
+            fix_kwargs=prepare_kwargs, max_pending=2 * args.jobs))
+
+        # Network is applied to batches of reads in this process, so the model
+        # is loaded once and a single device serves all the remapping workers
+        model = helpers.load_model(args.model).to(args.device)
+        model_stride = helpers.guess_model_stride(model)
+        chunk_size, overlap = None, 0
+        if args.chunk_size is not None:
+            chunk_size = args.chunk_size * model_stride
+            overlap = args.overlap * model_stride
+        network_results = prepare_mapping_funcs.run_remap_network(
+            prepared_reads, model, model_stride, batch_size=args.batch_size,
+            chunk_size=chunk_size, overlap=overlap)
+
+        # remaps each read using output of flip-flop network
+        remap_kwargs['model_stride'] = model_stride
+        results = imap_pool(
+            remap_pool, prepare_mapping_funcs.oneread_remap_network_output,
+            network_results, fix_kwargs=remap_kwargs, max_pending=4 * args.jobs)
+
+        # results is an iterable of dicts
+        # each dict is a set of return values from a single read
+        prepare_mapping_funcs.generate_output_from_results(
+            results, args.output, alphabet_info)
 
 
 if __name__ == '__main__':
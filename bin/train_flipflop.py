@@ -12,10 +12,10 @@ import time
 import torch
 
 
-from taiyaki import (chunk_selection, ctc, flipflopfings, helpers,
-                     mapped_signal_files, optim)
+from taiyaki import (batch_loader, chunk_selection, ctc, flipflopfings,
+                     helpers, mapped_signal_files, optim)
 from taiyaki import __version__
-from taiyaki.cmdargs import FileExists, FilesExist, Positive
+from taiyaki.cmdargs import AutoBool, FileExists, FilesExist, NonNegative, Positive
 from taiyaki.common_cmdargs import add_common_command_args
 from taiyaki.constants import DOTROWLENGTH
 
@@ -34,6 +34,9 @@ parser.add_argument('--chunk_len_max', default=4000, metavar='samples', type=Pos
                     help='Max length of each chunk in samples (chunk lengths are random between min and max)')
 parser.add_argument('--input_strand_list', default=None, action=FileExists,
                     help='Strand summary file containing column read_id. Filenames in file are ignored.')
+parser.add_argument('--lazy_reads', default=False, action=AutoBool,
+                    help='Read signal and reference from input files when chunks are taken, rather than ' +
+                         'loading all reads into memory. Input files must not change during training')
 parser.add_argument('--lr_cosine_iters', default=40000, metavar='n', type=Positive(float),
                     help='Learning rate decreases from max to min like cosine function over n batches')
 parser.add_argument('--lr_max', default=2.0e-3, metavar='rate',
@@ -44,6 +47,11 @@ parser.add_argument('--lr_min', default=1.0e-4, metavar='rate',
 parser.add_argument('--min_batch_size', default=64, metavar='chunks', type=Positive(int),
                     help='Number of chunks to run in parallel for chunk_len = chunk_len_max.' +
                          'Actual batch size used is (min_batch_size / chunk_len) * chunk_len_max')
+parser.add_argument('--prefetch_batches', default=4, metavar='n', type=Positive(int),
+                    help='Number of batches to prepare ahead of training (only used with --prefetch_workers)')
+parser.add_argument('--prefetch_workers', default=0, metavar='n', type=NonNegative(int),
+                    help='Number of background processes preparing batches. If 0, batches are prepared ' +
+                         'in the training process')
 parser.add_argument('--seed', default=None, metavar='integer', type=Positive(int),
                     help='Set random number seed')
 parser.add_argument('--sharpen', default=1.0, metavar='factor',
@@ -116,7 +124,10 @@ def main():
     if args.limit is not None:
         log.write('* Limiting number of strands to {} per file\n'.format(args.limit))
 
-    read_data, alphabet = load_read_data(args.input, args.limit, log, read_ids)
+    if args.lazy_reads:
+        log.write('* Signal and reference will be read from input files when needed\n')
+    read_data, alphabet = load_read_data(args.input, args.limit, log, read_ids,
+                                         args.lazy_reads)
     if len(read_data) == 0:
         log.write('* No reads remaining for training, exiting.\n')
         exit(1)
@@ -170,8 +181,7 @@ def main():
 
 
 
-    for i in range(args.niteration):
-        lr_scheduler.step()
+    def batch_spec():
         # Chunk length is chosen randomly in the range given but forced to
         # be a multiple of the stride
         batch_chunk_len = (np.random.randint(
@@ -184,39 +194,46 @@ def main():
                                 batch_chunk_len + 0.5)
         # ...but it can't be more than the number of reads.
         batch_size = min(target_batch_size, len(read_data))
+        return batch_size, batch_chunk_len
 
+    # If the logging threshold is 0 then we log all chunks, including those
+    # rejected, so pass the log object into the batch loader
+    if args.chunk_logging_threshold == 0:
+        log_rejected_chunks = chunk_log
+    else:
+        log_rejected_chunks = None
 
-        # If the logging threshold is 0 then we log all chunks, including those
-        # rejected, so pass the log
-        # object into assemble_batch
-        if args.chunk_logging_threshold == 0:
-            log_rejected_chunks = chunk_log
-        else:
-            log_rejected_chunks = None
+    def make_loader():
+        return batch_loader.BatchLoader(
+            read_data, batch_spec, filter_parameters, args, nbase,
+            nworkers=args.prefetch_workers, nprefetch=args.prefetch_batches,
+            log=log, chunk_log=log_rejected_chunks)
+
+    loader = make_loader()
+    if args.prefetch_workers > 0:
+        log.write('* Preparing {} batches ahead using {} processes\n'.format(
+            args.prefetch_batches, args.prefetch_workers))
+
+    for i in range(args.niteration):
+        lr_scheduler.step()
+        batch = loader.next_batch()
         # Chunk_batch is a list of dicts.
-        chunk_batch, batch_rejections = chunk_selection.assemble_batch(
-            read_data, batch_size, batch_chunk_len, filter_parameters, args,
-            log, chunk_log=log_rejected_chunks)
+        chunk_batch = batch.chunk_batch
         total_chunks += len(chunk_batch)
 
         # Update counts of reasons for rejection
-        for k, v in batch_rejections.items():
+        for k, v in batch.rejections.items():
             rejection_dict[k] += v
 
         # Shape of input tensor must be:
         #     (timesteps) x (batch size) x (input channels)
         # in this case:
         #     batch_chunk_len x batch_size x 1
-        stacked_current = np.vstack([d['current'] for d in chunk_batch]).T
-        indata = torch.tensor(
-            stacked_current, device=device, dtype=torch.float32).unsqueeze(2)
+        indata = torch.from_numpy(batch.current).to(device)
         # Sequence input tensor is just a 1D vector, and so is seqlens
-        seqs = torch.tensor(np.concatenate([
-            flipflopfings.flipflop_code(d['sequence'], nbase) for d in chunk_batch]),
-                            device=device, dtype=torch.long)
-        seqlens = torch.tensor([
-            len(d['sequence']) for d in chunk_batch], dtype=torch.long,
-                               device=device)
+        seqs = torch.from_numpy(batch.sequences).to(device)
+        seqlens = torch.from_numpy(batch.sequence_lengths).to(device)
+        del batch
 
         optimizer.zero_grad()
         outputs = network(indata)
@@ -271,20 +288,30 @@ def main():
 
         if args.limit is not None and (i + 1) % args.reload_after_batches == 0:
             # Periodically reload the training data to get a different random subset.
+            # Batches in preparation from the old data are discarded.
+            loader.close()
             read_data = None
             gc.collect()
-            read_data, _ = load_read_data(args.input, args.limit, log, read_ids)
+            read_data, _ = load_read_data(args.input, args.limit, log, read_ids,
+                                          args.lazy_reads)
+            loader = make_loader()
 
+    loader.close()
     helpers.save_model(network, args.output)
 
 
-def load_read_data(input_files, read_limit, log, read_ids):
+def load_read_data(input_files, read_limit, log, read_ids, lazy=False):
+    """Load reads from mapped signal files, returning a tuple
+    (list of Read objects in random order, alphabet).
+    If lazy, the Read objects hold only read attributes and fetch signal and
+    reference from the files when chunks are taken."""
     read_data = []
     for input_file in input_files:
         log.write('* Loading data from {}\n'.format(input_file))
         log.write('* Per read file MD5 {}\n'.format(helpers.file_md5(input_file)))
-        with mapped_signal_files.HDF5(input_file, "r") as per_read_file:
-            read_data += per_read_file.get_multiple_reads(read_ids, max_reads=read_limit)
+        with mapped_signal_files.open_mapped_signal_file(input_file) as per_read_file:
+            read_data += per_read_file.get_multiple_reads(read_ids, max_reads=read_limit,
+                                                          lazy=lazy)
             # read_data now contains a list of reads
             # (each an instance of the Read class defined in mapped_signal_files.py, based on dict)
     random.shuffle(read_data)
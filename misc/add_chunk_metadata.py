@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+# Calculate the metadata used to take chunks from each read in a mapped
+# signal file and save it in the file, so it is not calculated on loading
+import argparse
+import sys
+
+from taiyaki import mapped_signal_files
+from taiyaki.cmdargs import FileExists
+
+
+parser = argparse.ArgumentParser(
+    description='Save chunk metadata in mapped signal file',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('input', action=FileExists,
+                    help='Mapped signal file to add metadata to')
+
+
+def main():
+    args = parser.parse_args()
+    with mapped_signal_files.open_mapped_signal_file(args.input, 'r+') as f:
+        metadata = {}
+        for read_id in f.get_read_ids():
+            metadata[read_id] = f.get_lazy_read(read_id).get_chunk_metadata()
+        f.write_chunk_metadata(metadata)
+    sys.stderr.write('* Saved chunk metadata for {} reads\n'.format(len(metadata)))
+
+
+if __name__ == '__main__':
+    main()
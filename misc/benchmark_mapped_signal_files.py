@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+# Time opening, random access and full scans of mapped signal files,
+# for comparing file layouts
+import argparse
+import numpy as np
+import time
+
+from taiyaki import mapped_signal_files
+from taiyaki.cmdargs import FilesExist, Positive
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark reading mapped signal files',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--nrandom', default=1000, metavar='reads',
+                    type=Positive(int),
+                    help='Number of reads to get in random-access test')
+parser.add_argument('--nchunks', default=1000, metavar='chunks',
+                    type=Positive(int),
+                    help='Number of chunks to take from lazily-loaded reads')
+parser.add_argument('--chunk_len', default=4000, metavar='samples',
+                    type=Positive(int), help='Length of chunks in samples')
+parser.add_argument('--seed', default=1, metavar='integer',
+                    type=Positive(int), help='Random number seed')
+parser.add_argument('input', action=FilesExist, nargs='+',
+                    help='Mapped signal files to benchmark')
+
+
+def benchmark(filename, args):
+    """Return list of (description, seconds) tuples"""
+    results = []
+    t0 = time.time()
+    with mapped_signal_files.open_mapped_signal_file(filename) as f:
+        read_ids = f.get_read_ids()
+        results.append(('open and list {} reads'.format(len(read_ids)),
+                        time.time() - t0))
+
+        sample = np.random.choice(len(read_ids), args.nrandom)
+        t0 = time.time()
+        for n in sample:
+            f.get_read(read_ids[n])
+        results.append(('get {} random reads'.format(args.nrandom),
+                        time.time() - t0))
+
+        t0 = time.time()
+        nsample = 0
+        for read_id in read_ids:
+            nsample += len(f.get_read(read_id)['Dacs'])
+        results.append(('scan {} samples'.format(nsample), time.time() - t0))
+
+        t0 = time.time()
+        lazy_reads = f.get_multiple_reads('all', lazy=True)
+        results.append(('get lazy reads', time.time() - t0))
+
+    t0 = time.time()
+    for n in np.random.choice(len(lazy_reads), args.nchunks):
+        lazy_reads[n].get_chunk_with_sample_length(args.chunk_len)
+    results.append(('take {} chunks from lazy reads'.format(args.nchunks),
+                    time.time() - t0))
+    return results
+
+
+def main():
+    args = parser.parse_args()
+    for filename in args.input:
+        np.random.seed(args.seed)
+        print(filename)
+        for description, seconds in benchmark(filename, args):
+            print('  {:40s} {:8.3f}s'.format(description, seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Time construction and use of Mapping objects for synthetic long reads, as
+# done for each read by prepare_mapped_reads.py
+import argparse
+import numpy as np
+import os
+import tempfile
+import time
+
+from taiyaki import mapping, signal
+from taiyaki.cmdargs import Positive
+
+
+parser = argparse.ArgumentParser(
+    description='Benchmark Mapping methods on synthetic reads',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--nreads', default=10, metavar='reads',
+                    type=Positive(int), help='Number of reads to time')
+parser.add_argument('--nsample', default=500000, metavar='samples',
+                    type=Positive(int), help='Length of each read in samples')
+parser.add_argument('--samples_per_base', default=10, metavar='samples',
+                    type=Positive(int), help='Mean dwell of each base')
+parser.add_argument('--seed', default=1, metavar='integer',
+                    type=Positive(int), help='Random number seed')
+parser.add_argument('--stride', default=5, metavar='samples',
+                    type=Positive(int), help='Stride of remapping path')
+
+
+def synthetic_read(args):
+    """Return (Signal, remapping path, reference) for a random read"""
+    sig = signal.Signal(dacs=np.random.randint(300, 900, size=args.nsample).astype(np.int16))
+    sig.set_trim_absolute(200, 50)
+    npath = (sig.trimmed_length + args.stride - 1) // args.stride
+    nbase = args.nsample // args.samples_per_base
+    path = np.sort(np.random.randint(nbase, size=npath)).astype(np.int32)
+    reference = ''.join(np.random.choice(list('ACGT'), size=nbase))
+    return sig, path, reference
+
+
+def benchmark(args):
+    """Return list of (description, seconds per read) tuples"""
+    timings = {}
+
+    def timed(description, function, *fargs):
+        t0 = time.time()
+        result = function(*fargs)
+        timings[description] = timings.get(description, 0.0) + time.time() - t0
+        return result
+
+    tmpdir = tempfile.mkdtemp()
+    ssv_file = os.path.join(tmpdir, 'mapping.ssv')
+    try:
+        for _ in range(args.nreads):
+            sig, path, reference = synthetic_read(args)
+            remapping = timed('from_remapping_path', mapping.Mapping.from_remapping_path,
+                              sig, path, reference, args.stride)
+            timed('add_integer_reference', remapping.add_integer_reference, 'ACGT')
+            timed('mapping_limits', remapping.mapping_limits)
+            timed('get_reftosignal', remapping.get_reftosignal)
+            timed('to_ssv', remapping.to_ssv, ssv_file)
+    finally:
+        if os.path.exists(ssv_file):
+            os.remove(ssv_file)
+        os.rmdir(tmpdir)
+    return [(description, seconds / args.nreads) for description, seconds in timings.items()]
+
+
+def main():
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+    print('{} reads of {} samples'.format(args.nreads, args.nsample))
+    for description, seconds in benchmark(args):
+        print('  {:40s} {:8.4f}s per read'.format(description, seconds))
+
+
+if __name__ == '__main__':
+    main()
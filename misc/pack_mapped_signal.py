@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+# Convert a mapped signal file to the packed layout, where the data for all
+# reads are concatenated into a few large datasets
+import argparse
+import sys
+
+from taiyaki import mapped_signal_files
+from taiyaki.cmdargs import FileAbsent, FileExists, Positive
+
+
+parser = argparse.ArgumentParser(
+    description='Convert HDF5 mapped-signal file to packed layout',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+parser.add_argument('--buffer_samples', default=10000000, metavar='samples',
+                    type=Positive(int),
+                    help='Number of samples of signal to buffer before writing')
+parser.add_argument('input', action=FileExists,
+                    help='Mapped signal file to read from')
+parser.add_argument('output', action=FileAbsent,
+                    help='Packed mapped signal file to write')
+
+
+def main():
+    args = parser.parse_args()
+    with mapped_signal_files.HDF5(args.input, 'r') as hin, \
+            mapped_signal_files.PackedHDF5(args.output, 'w',
+                                           buffer_samples=args.buffer_samples) as hout:
+        hout.write_version_number()
+        read_ids = hin.get_read_ids()
+        for nread, read_id in enumerate(read_ids):
+            read = hin.get_read(read_id)
+            read.pop('read_id', None)
+            hout.write_read(read_id, read)
+            if (nread + 1) % 1000 == 0:
+                sys.stderr.write('* Copied {} reads\n'.format(nread + 1))
+    sys.stderr.write('* Copied {} reads in total\n'.format(len(read_ids)))
+
+
+if __name__ == '__main__':
+    main()
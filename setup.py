@@ -40,6 +40,11 @@ try:
                                       os.path.join("taiyaki/ctc", "c_cat_mod_flipflop.c")],
                   include_dirs=[np.get_include()],
                   extra_compile_args=["-O3", "-fopenmp", "-std=c99", "-march=native"],
+                  extra_link_args=["-fopenmp"]),
+        Extension("taiyaki.decoding", [os.path.join("taiyaki", "decoding.pyx"),
+                                       os.path.join("taiyaki", "c_decoding.c")],
+                  include_dirs=[np.get_include()],
+                  extra_compile_args=["-O3", "-fopenmp", "-std=c99", "-march=native"],
                   extra_link_args=["-fopenmp"])
     ])
 except ImportError:
@@ -1,3 +1,4 @@
+from collections import deque, OrderedDict
 import numpy as np
 import torch
 
@@ -6,12 +7,50 @@ from taiyaki.helpers import guess_model_stride
 
 _DEFAULT_CHUNK_SIZE = 1000
 _DEFAULT_OVERLAP = 100
+_DEFAULT_BATCH_SIZE = 100
+
+
+def chunk_overlap(model, default=_DEFAULT_OVERLAP):
+    """ Smallest overlap between chunks for which stitched network output
+    is the same as that for the whole read
+
+    Found from the context of the layers of the network (see
+    taiyaki.layers), so is only available for networks whose output depends
+    on a bounded stretch of input.  For others, such as those with recurrent
+    layers, the default is returned.
+
+    :param model: network, made of layers from taiyaki.layers
+    :param default: overlap, in blocks, used when the output of the network
+        depends on the whole chunk
+
+    :returns: overlap in blocks of output, that is in multiples of the
+        stride of the network
+    """
+    try:
+        stride = model.stride
+        before, after = model.context
+    except (AttributeError, NotImplementedError):
+        return default
+    if not np.isfinite(before + after):
+        return default
+    #  Output for the chunks is stitched at the middle of their overlap, so
+    #  the blocks either side of the join need their context within it
+    blocks_before = -(-before // stride)
+    blocks_after = -(-after // stride)
+    return int(max(2 * blocks_before, 2 * blocks_after - 1))
 
 
 def chunk_read(signal, chunk_size, overlap):
-    """ Divide signal into overlapping chunks """
+    """ Divide signal into overlapping chunks
+
+    A signal shorter than chunk_size is padded with zeros at its end to a
+    single chunk of chunk_size, so that it can be batched with the chunks of
+    other reads; stitch_chunks trims the output for the padding.
+    """
     if len(signal) < chunk_size:
-        return signal[:, None, None], np.array([0]), np.array([len(signal)])
+        chunks = np.zeros((chunk_size, 1, 1), dtype='f4')
+        chunks[:len(signal), 0, 0] = signal
+        return chunks, np.array([0]), np.array([len(signal)])
 
     chunk_ends = np.arange(chunk_size, len(signal), chunk_size - overlap, dtype=int)
     chunk_ends = np.concatenate([chunk_ends, [len(signal)]], 0)
@@ -33,7 +72,12 @@ def stitch_chunks(out, chunk_starts, chunk_ends, stride, path_stitching=False):
     nchunks = out.shape[1]
 
     if nchunks == 1:
-        return out[:, 0]
+        #  Output for padding after a short read is removed.  Each block of
+        #  output covers stride samples, the last possibly only partly.
+        end = -(-(chunk_ends[0] - chunk_starts[0]) // stride)
+        if path_stitching:
+            end += 1
+        return out[:end, 0]
     else:
         # first chunk
         start = chunk_starts[0] // stride
@@ -63,13 +107,170 @@ def stitch_chunks(out, chunk_starts, chunk_ends, stride, path_stitching=False):
         return torch.cat(stitched_out, 0)
 
 
+class ChunkBatcher:
+    """ Pack chunks from many reads into batches for the network.
+
+    Chunks of reads added with `add_read` are queued and handed out by
+    `batches` in groups of `batch_size`, so that short reads do not give
+    small batches.  A read's chunks may be split across batches.  Only
+    chunks of the same length are batched together; chunk_read pads reads
+    shorter than the chunk size to a full chunk.  Chunks of any other length,
+    such as whole reads, are batched with chunks of equal length or flushed
+    after `max_wait` further reads have been added.
+
+    Each batch comes with an array giving the provenance of each chunk as
+    (read serial number, index of chunk in read).  Network outputs for a
+    batch are given back with `add_output`, which returns reads once the
+    outputs for all of their chunks are known, ready for `stitch_chunks`.
+    If the network fails for a batch, `drop_reads` gives up on its reads.
+
+    Example:
+        batcher = ChunkBatcher(batch_size)
+        for read_id, chunks, starts, ends in reads:
+            batcher.add_read(read_id, chunks, starts, ends)
+            for batch, provenance in batcher.batches():
+                out = model(torch.tensor(batch))
+                for read_id, (read_out,), starts, ends in batcher.add_output(
+                        provenance, (out,)):
+                    stitched = stitch_chunks(read_out, starts, ends, stride)
+        # ...and the same again with batcher.batches(flush=True)
+    """
+
+    def __init__(self, batch_size=_DEFAULT_BATCH_SIZE, max_wait=None):
+        """
+        :param batch_size: maximum number of chunks in a batch
+        :param max_wait: number of reads that may be added after the first
+            queued chunk of a length before an incomplete batch of chunks of
+            that length is released.  Defaults to batch_size.
+        """
+        self.batch_size = batch_size
+        self.max_wait = batch_size if max_wait is None else max_wait
+        self.nadded = 0
+        #  Chunk length -> [serial of first waiting read, deque of
+        #  (serial, index of first chunk, chunks), number of chunks waiting]
+        self.queued = OrderedDict()
+        #  Serial -> [read_key, chunk_starts, chunk_ends, list of outputs
+        #  for each chunk, number of chunks without output]
+        self.reads = {}
+
+    @property
+    def nreads(self):
+        """ Number of reads added whose outputs are not yet complete """
+        return len(self.reads)
+
+    def add_read(self, read_key, chunks, chunk_starts, chunk_ends):
+        """ Queue chunks of a read, as returned by chunk_read
+
+        :param read_key: object identifying read, returned by add_output
+        :param chunks: array (chunk length x nchunks x 1) of signal chunks
+        """
+        serial = self.nadded
+        self.nadded += 1
+        nchunks = chunks.shape[1]
+        self.reads[serial] = [read_key, chunk_starts, chunk_ends,
+                              [None] * nchunks, nchunks]
+        queue = self.queued.setdefault(chunks.shape[0], [serial, deque(), 0])
+        queue[1].append((serial, 0, chunks))
+        queue[2] += nchunks
+
+    def _take(self, chunk_len):
+        queue = self.queued[chunk_len]
+        waiting = queue[1]
+        batch, provenance = [], []
+        nbatch = 0
+        while waiting and nbatch < self.batch_size:
+            serial, first, chunks = waiting.popleft()
+            n = min(chunks.shape[1], self.batch_size - nbatch)
+            if n < chunks.shape[1]:
+                waiting.appendleft((serial, first + n, chunks[:, n:]))
+            batch.append(chunks[:, :n])
+            provenance.append(np.column_stack([
+                np.full(n, serial), np.arange(first, first + n)]))
+            nbatch += n
+        queue[2] -= nbatch
+        if waiting:
+            queue[0] = waiting[0][0]
+        else:
+            del self.queued[chunk_len]
+        return (np.ascontiguousarray(np.concatenate(batch, axis=1)),
+                np.concatenate(provenance))
+
+    def batches(self, flush=False):
+        """ Generate batches ready to be run through the network
+
+        :param flush: if True, release all queued chunks, giving incomplete
+            batches if necessary
+
+        :yields: tuple (batch, provenance) where batch is a float32 array
+            (chunk length x nchunks x 1) and provenance an int array
+            (nchunks x 2) to be given to add_output
+        """
+        for chunk_len in list(self.queued):
+            while chunk_len in self.queued:
+                first_serial, _, nwaiting = self.queued[chunk_len]
+                if not (flush or nwaiting >= self.batch_size or
+                        self.nadded - first_serial > self.max_wait):
+                    break
+                yield self._take(chunk_len)
+
+    def add_output(self, provenance, outputs):
+        """ Record network outputs for a batch
+
+        :param provenance: array returned with batch by `batches`
+        :param outputs: tuple of tensors or arrays, each of which has
+            chunks of the batch on its second axis
+
+        :returns: list of tuples (read_key, outputs, chunk_starts,
+            chunk_ends) for each read with all chunk outputs now known.
+            Outputs are given for the chunks of the read in order, in the
+            form expected by stitch_chunks.
+        """
+        complete = []
+        for i, (serial, chunk) in enumerate(provenance):
+            read = self.reads.get(serial)
+            if read is None:
+                #  Read was dropped after another of its chunks failed
+                continue
+            read[3][chunk] = tuple(x[:, i] for x in outputs)
+            read[4] -= 1
+            if read[4] == 0:
+                read_key, chunk_starts, chunk_ends, chunk_outputs, _ = \
+                    self.reads.pop(serial)
+                read_outputs = tuple(stack_chunks(x) for x in zip(*chunk_outputs))
+                complete.append((read_key, read_outputs, chunk_starts, chunk_ends))
+        return complete
+
+    def drop_reads(self, provenance):
+        """ Forget reads with chunks in a batch for which the network
+        failed.  Outputs for their other chunks are ignored.
+
+        :param provenance: array returned with batch by `batches`
+
+        :returns: list of read_key of each read dropped
+        """
+        return [self.reads.pop(serial)[0] for serial in np.unique(provenance[:, 0])
+                if serial in self.reads]
+
+
+def stack_chunks(chunk_outputs):
+    """ Stack outputs for individual chunks along the second axis """
+    if isinstance(chunk_outputs[0], torch.Tensor):
+        return torch.stack(chunk_outputs, 1)
+    return np.stack(chunk_outputs, 1)
+
+
 def run_model(
         normed_signal, model, chunk_size=_DEFAULT_CHUNK_SIZE,
-        overlap=_DEFAULT_OVERLAP, max_concur_chunks=None, return_numpy=True):
+        overlap=None, max_concur_chunks=None, return_numpy=True):
     """ Hook for megalodon to run network via taiyaki
+
+    :param overlap: overlap between chunks in blocks, or None for the
+        smallest that does not change the output (see chunk_overlap)
     """
     device = next(model.parameters()).device
     stride = guess_model_stride(model)
+    if overlap is None:
+        overlap = chunk_overlap(model)
     chunk_size *= stride
     overlap *= stride
 
@@ -0,0 +1,235 @@
+# Background preparation of training batches.
+# Chunk sampling, filtering and conversion to arrays is done in worker
+# processes so that it overlaps with the forward / backward pass of the network.
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.util import Finalize
+import numpy as np
+
+from taiyaki import chunk_selection, flipflopfings, mapped_signal_files
+
+
+class _DeferredLog:
+    """Stand-in for helpers.Logger in a worker process: messages are
+    stored and written to the real log by the main process"""
+
+    def __init__(self):
+        self.messages = []
+
+    def write(self, message):
+        self.messages.append(message)
+
+
+class _DeferredChunkLog:
+    """Stand-in for chunk_selection.ChunkLog in a worker process: chunks
+    are stored and written to the real chunk log by the main process"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write_chunk(self, iteration, chunk_dict, status, lossvalue=None):
+        self.chunks.append((iteration, chunk_dict, status, lossvalue))
+
+
+class Batch:
+    """A batch of chunks ready to be turned into network input.
+
+    Attributes:
+        chunk_batch     : list of dicts describing each chunk, as returned by
+                          assemble_batch but with the current and sequence
+                          replaced by their lengths
+        rejections      : dict counting reasons for rejection of chunks
+        current         : float32 array (chunk_len x batch_size x 1)
+        sequences       : int64 array of concatenated flip-flop coded sequences
+        sequence_lengths: int64 array of sequence lengths (batch_size)
+        log_messages    : list of messages to be written to the log
+        rejected_chunks : list of (iteration, chunk_dict, status, loss) tuples
+                          to be written to the chunk log
+    """
+
+    def __init__(self, chunk_batch, rejections, current, sequence, nbase,
+                 log_messages=(), rejected_chunks=()):
+        """
+        :param chunk_batch: list of chunk dicts
+        :param rejections: dict counting reasons for rejection of chunks
+        :param current: array (chunk_len x batch_size) of signal
+        :param sequence: concatenated sequences of chunks, not flip-flop coded
+        :param nbase: number of bases in alphabet
+        """
+        self.rejections = dict(rejections)
+        self.log_messages = list(log_messages)
+        self.rejected_chunks = list(rejected_chunks)
+
+        # Shape of input must be:
+        #     (timesteps) x (batch size) x (input channels)
+        self.current = np.ascontiguousarray(current, dtype=np.float32)[:, :, None]
+        # Sequence input is just a 1D vector, and so is sequence_lengths
+        self.sequence_lengths = np.array(
+            [len(d['sequence']) for d in chunk_batch], dtype=np.int64)
+        sequence_ends = np.cumsum(self.sequence_lengths)
+        self.sequences = np.zeros(len(sequence), dtype=np.int64)
+        for start, end in zip(sequence_ends - self.sequence_lengths, sequence_ends):
+            self.sequences[start:end] = flipflopfings.flipflop_code(
+                sequence[start:end], nbase)
+
+        # The arrays in the chunk dicts are not needed after this
+        self.chunk_batch = []
+        for chunk_dict in chunk_batch:
+            chunk_dict = dict(chunk_dict, current_length=len(chunk_dict['current']),
+                              sequence_length=len(chunk_dict['sequence']))
+            del chunk_dict['current'], chunk_dict['sequence']
+            self.chunk_batch.append(chunk_dict)
+
+    def replay_logs(self, log, chunk_log=None):
+        """Write messages and rejected chunks collected while the batch was
+        being assembled to the log objects of the main process"""
+        if log is not None:
+            for message in self.log_messages:
+                log.write(message)
+        if chunk_log is not None:
+            for iteration, chunk_dict, status, lossvalue in self.rejected_chunks:
+                chunk_log.write_chunk(iteration, chunk_dict, status, lossvalue)
+
+
+def make_batch(sampler, batch_size, chunk_len, filter_parameters, args,
+               nbase, seed=None, log=None, chunk_log=None):
+    """Assemble a batch with a chunk_selection.ChunkSampler and convert it to
+    arrays suitable for training.
+
+    :param seed: if not None, sample using numpy's random number generator
+        seeded with this value, so that the batch does not depend on which
+        process makes it.  The state of the generator is restored afterwards.
+    :param log: object with write method, or None to collect messages in
+        the returned batch.
+    :param chunk_log: ChunkLog object to record rejected chunks, or None.
+
+    :returns: a Batch object
+    """
+    if seed is not None:
+        saved_state = np.random.get_state()
+        np.random.seed(seed)
+    chunk_batch, rejections, current, sequence = sampler.sample_batch(
+        batch_size, chunk_len, filter_parameters, args, log=log,
+        chunk_log=chunk_log)
+    if seed is not None:
+        np.random.set_state(saved_state)
+    return Batch(chunk_batch, rejections, current, sequence, nbase)
+
+
+# Data shared by the worker processes, set by _init_worker
+_worker_state = {}
+
+
+def _init_worker(sampler, filter_parameters, args, nbase, log_rejected_chunks):
+    _worker_state.update(sampler=sampler,
+                         filter_parameters=filter_parameters, args=args,
+                         nbase=nbase, log_rejected_chunks=log_rejected_chunks)
+    # Close files opened by lazily loaded reads when the worker exits
+    # normally.  Files of a terminated worker are released by the system.
+    Finalize(None, mapped_signal_files.close_lazy_files, exitpriority=0)
+
+
+def _worker_make_batch(batch_size, chunk_len, seed):
+    state = _worker_state
+    log = _DeferredLog()
+    chunk_log = _DeferredChunkLog() if state['log_rejected_chunks'] else None
+    batch = make_batch(state['sampler'], batch_size, chunk_len,
+                       state['filter_parameters'], state['args'],
+                       state['nbase'], seed=seed, log=log, chunk_log=chunk_log)
+    batch.log_messages = log.messages
+    if chunk_log is not None:
+        batch.rejected_chunks = chunk_log.chunks
+    return batch
+
+
+class BatchLoader:
+    """Produce training batches, optionally preparing them ahead of time in
+    a pool of worker processes.
+
+    Batch sizes and chunk lengths are generated in the main process by
+    calling `batch_spec` and each batch gets its own random seed drawn from
+    numpy's global generator, so the stream of batches does not depend on
+    the number of workers.  Batches are returned in the order requested.
+
+    Chunks are sampled with a chunk_selection.ChunkSampler, created once for
+    read_data.  Worker processes are forked, so the reads and the sampler
+    are shared with the parent rather than copied.
+
+    Example:
+        with BatchLoader(read_data, spec, filter_parameters, args, nbase,
+                         nworkers=4) as loader:
+            for i in range(niteration):
+                batch = loader.next_batch()
+    """
+
+    def __init__(self, read_data, batch_spec, filter_parameters, args, nbase,
+                 nworkers=0, nprefetch=2, log=None, chunk_log=None):
+        """
+        :param read_data: list of mapped_signal_files.Read objects
+        :param batch_spec: function taking no arguments and returning a
+            tuple (batch_size, chunk_len) for the next batch
+        :param filter_parameters: tuple (median_meandwell, mad_meandwell)
+        :param args: command-line args object used by the chunk filters
+        :param nbase: number of bases in alphabet, used for flip-flop coding
+        :param nworkers: number of worker processes.  If 0, batches are made
+            in the main process when requested.
+        :param nprefetch: number of batches to have in preparation
+        :param log: log object for warnings from chunk sampling
+        :param chunk_log: ChunkLog object to record rejected chunks, or None
+        """
+        self.sampler = chunk_selection.ChunkSampler(read_data)
+        self.batch_spec = batch_spec
+        self.filter_parameters = filter_parameters
+        self.args = args
+        self.nbase = nbase
+        self.nworkers = nworkers
+        self.nprefetch = max(1, nprefetch)
+        self.log = log
+        self.chunk_log = chunk_log
+        self.pending = deque()
+        self.pool = None
+        if nworkers > 0:
+            self.pool = Pool(nworkers, _init_worker,
+                             (self.sampler, filter_parameters, args, nbase,
+                              chunk_log is not None))
+            for _ in range(self.nprefetch):
+                self._submit()
+
+    def _next_task(self):
+        batch_size, chunk_len = self.batch_spec()
+        seed = np.random.randint(np.iinfo(np.int32).max)
+        return batch_size, chunk_len, seed
+
+    def _submit(self):
+        self.pending.append(
+            self.pool.apply_async(_worker_make_batch, self._next_task()))
+
+    def next_batch(self):
+        """Return the next Batch, writing any log messages from its
+        assembly to the log objects given to the constructor"""
+        if self.pool is None:
+            batch_size, chunk_len, seed = self._next_task()
+            return make_batch(self.sampler, batch_size, chunk_len,
+                              self.filter_parameters, self.args, self.nbase,
+                              seed=seed, log=self.log,
+                              chunk_log=self.chunk_log)
+        batch = self.pending.popleft().get()
+        self._submit()
+        batch.replay_logs(self.log, self.chunk_log)
+        return batch
+
+    def close(self):
+        """Stop worker processes, discarding batches in preparation, and
+        close files opened by lazily loaded reads"""
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        self.pending.clear()
+        mapped_signal_files.close_lazy_files()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
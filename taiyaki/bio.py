@@ -7,6 +7,7 @@ from taiyaki.iterators import product, window
 _COMPLEMENT = {'A': 'T', 'T': 'A', 'C': 'G', 'G': 'C', 'X': 'X', 'N': 'N',
                'a': 't', 't': 'a', 'c': 'g', 'g': 'c', 'x': 'x', 'n': 'n',
                '-': '-'}
+_COMPLEMENT_TABLE = str.maketrans(_COMPLEMENT)
 
 
 def reverse_complement(seq, compdict=_COMPLEMENT):
@@ -15,7 +16,12 @@ def reverse_complement(seq, compdict=_COMPLEMENT):
     :param seq: A string of bases.
     :param compdict: A dictionary containing base complements
 
+    :raises: KeyError if seq contains a base without a complement in compdict
+
     :returns: A string of bases.
 
     """
-    return ''.join(compdict[b] for b in seq)[::-1]
+    if not compdict.keys() >= set(seq):
+        raise KeyError(next(b for b in seq if b not in compdict))
+    table = _COMPLEMENT_TABLE if compdict is _COMPLEMENT else str.maketrans(compdict)
+    return seq.translate(table)[::-1]
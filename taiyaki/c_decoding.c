@@ -1,8 +1,10 @@
 #include <assert.h>
 #include <math.h>
+#include <string.h>
 #include "c_decoding.h"
 
 #define BIG_FLOAT 1.e30f
+#define LARGE_VAL 1.e30
 
 
 /**
@@ -286,3 +288,876 @@ void fast_viterbi_blocks(float const * weights, size_t nblock, size_t nbatch, si
     }
 }
 
+
+
+/*
+***************************************
+Flip-flop decoding on (T, N, S) scores
+***************************************
+ */
+
+
+/**  Log of sum of exponentials of strided array
+ *
+ *   @param x       Array
+ *   @param n       Number of elements
+ *   @param stride  Stride between elements
+ *
+ *   @returns log(sum(exp(x)))
+ **/
+static inline float logsumexpf_strided(float const * x, size_t n, size_t stride){
+    float xmax = x[0];
+    for(size_t i=1 ; i < n ; i++){
+        xmax = fmaxf(xmax, x[i * stride]);
+    }
+    float sum = 0.0f;
+    for(size_t i=0 ; i < n ; i++){
+        sum += expf(x[i * stride] - xmax);
+    }
+    return xmax + logf(sum);
+}
+
+
+/**  Forward step of flip-flop normalisation, unnormalised
+ *
+ *   @param scores[S]        Transition scores for block, S = 2 * nbase * (nbase + 1)
+ *   @param fwdprev[2*nbase] Forward scores for previous block
+ *   @param nbase            Number of bases
+ *   @param tmp[2*nbase]     Workspace
+ *   @param fwdcurr[2*nbase] Array[out] to write forward scores
+ **/
+static void flipflop_forward_step(float const * scores, float const * fwdprev, size_t nbase,
+                                  float * tmp, float * fwdcurr){
+    const size_t nstate = nbase + nbase;
+    for(size_t to_base=0 ; to_base < nbase ; to_base++){
+        // To flip, from any state
+        float const * sc = scores + to_base * nstate;
+        for(size_t from_state=0 ; from_state < nstate ; from_state++){
+            tmp[from_state] = fwdprev[from_state] + sc[from_state];
+        }
+        fwdcurr[to_base] = logsumexpf_strided(tmp, nstate, 1);
+    }
+    for(size_t to_base=0 ; to_base < nbase ; to_base++){
+        // To flop, from flip or flop of same base
+        tmp[0] = fwdprev[to_base] + scores[nstate * nbase + to_base];
+        tmp[1] = fwdprev[to_base + nbase] + scores[nstate * nbase + nbase + to_base];
+        fwdcurr[to_base + nbase] = logsumexpf_strided(tmp, 2, 1);
+    }
+}
+
+
+/**  Backward step of flip-flop normalisation, unnormalised
+ *
+ *   @param scores[S]        Transition scores for block, S = 2 * nbase * (nbase + 1)
+ *   @param bwdnext[2*nbase] Backward scores for next block
+ *   @param nbase            Number of bases
+ *   @param tmp[nbase+1]     Workspace
+ *   @param bwdcurr[2*nbase] Array[out] to write backward scores
+ **/
+static void flipflop_backward_step(float const * scores, float const * bwdnext, size_t nbase,
+                                   float * tmp, float * bwdcurr){
+    const size_t nstate = nbase + nbase;
+    for(size_t from_state=0 ; from_state < nstate ; from_state++){
+        for(size_t to_base=0 ; to_base < nbase ; to_base++){
+            // To flip
+            tmp[to_base] = bwdnext[to_base] + scores[to_base * nstate + from_state];
+        }
+        // To flop
+        const size_t to_state = (from_state < nbase) ? from_state + nbase : from_state;
+        tmp[nbase] = bwdnext[to_state] + scores[nstate * nbase + from_state];
+        bwdcurr[from_state] = logsumexpf_strided(tmp, nbase + 1, 1);
+    }
+}
+
+
+/**  Normalise vector of log-scores so they sum to one
+ *
+ *   @param x[n]  Array to normalise in-place
+ *   @param n     Length of array
+ *
+ *   @returns Log of normalisation factor
+ **/
+static float lognormalise(float * x, size_t n){
+    const float fact = logsumexpf_strided(x, n, 1);
+    for(size_t i=0 ; i < n ; i++){
+        x[i] -= fact;
+    }
+    return fact;
+}
+
+
+/**  Forward scores for flip-flop transitions
+ *
+ *   @param scores[T*N*S]          Transition scores, S = 2 * nbase * (nbase + 1)
+ *   @param T                      Number of blocks
+ *   @param N                      Number of chunks in batch
+ *   @param nbase                  Number of bases
+ *   @param fwd[(T+1)*N*2*nbase]   Array[out] to write normalised forward scores
+ *   @param fact[(T+1)*N]          Array[out] to write log normalisation factors
+ **/
+void flipflop_forward(float const * scores, size_t T, size_t N, size_t nbase,
+                      float * fwd, float * fact){
+    assert(NULL != scores);
+    assert(NULL != fwd);
+    assert(NULL != fact);
+    const size_t nstate = nbase + nbase;
+    const size_t S = nstate * (nbase + 1);
+
+#pragma omp parallel for
+    for(size_t n=0 ; n < N ; n++){
+        float tmp[nstate];
+        float * fwdn = fwd + n * nstate;
+        for(size_t st=0 ; st < nstate ; st++){
+            fwdn[st] = -logf(nstate);
+        }
+        fact[n] = logf(nstate);
+        for(size_t t=0 ; t < T ; t++){
+            float * fwdcurr = fwdn + (t + 1) * N * nstate;
+            flipflop_forward_step(scores + (t * N + n) * S, fwdn + t * N * nstate,
+                                  nbase, tmp, fwdcurr);
+            fact[(t + 1) * N + n] = lognormalise(fwdcurr, nstate);
+        }
+    }
+}
+
+
+/**  Backward scores for flip-flop transitions
+ *
+ *   @param scores[T*N*S]          Transition scores, S = 2 * nbase * (nbase + 1)
+ *   @param T                      Number of blocks
+ *   @param N                      Number of chunks in batch
+ *   @param nbase                  Number of bases
+ *   @param bwd[(T+1)*N*2*nbase]   Array[out] to write normalised backward scores
+ *   @param fact[(T+1)*N]          Array[out] to write log normalisation factors
+ **/
+void flipflop_backward(float const * scores, size_t T, size_t N, size_t nbase,
+                       float * bwd, float * fact){
+    assert(NULL != scores);
+    assert(NULL != bwd);
+    assert(NULL != fact);
+    const size_t nstate = nbase + nbase;
+    const size_t S = nstate * (nbase + 1);
+
+#pragma omp parallel for
+    for(size_t n=0 ; n < N ; n++){
+        float tmp[nbase + 1];
+        float * bwdn = bwd + n * nstate;
+        for(size_t st=0 ; st < nstate ; st++){
+            bwdn[T * N * nstate + st] = -logf(nstate);
+        }
+        fact[T * N + n] = logf(nstate);
+        for(size_t t=T ; t > 0 ; t--){
+            float * bwdcurr = bwdn + (t - 1) * N * nstate;
+            flipflop_backward_step(scores + ((t - 1) * N + n) * S, bwdn + t * N * nstate,
+                                   nbase, tmp, bwdcurr);
+            fact[(t - 1) * N + n] = lognormalise(bwdcurr, nstate);
+        }
+    }
+}
+
+
+/**  Posterior scores for flip-flop transitions
+ *
+ *   The posterior score of a transition is the sum of the normalised forward
+ *   score of its source, its transition score and the normalised backward
+ *   score of its destination.  The backward scores are calculated alongside
+ *   the posteriors so only the forward scores of each chunk are stored.
+ *
+ *   @param scores[T*N*S]     Transition scores, S = 2 * nbase * (nbase + 1)
+ *   @param T                 Number of blocks
+ *   @param N                 Number of chunks in batch
+ *   @param nbase             Number of bases
+ *   @param trans[T*N*S]      Array[out] to write posterior scores
+ *   @param fwd_fact[(T+1)*N] Array[out] to write log normalisation factors
+ *                            of forward scores
+ *   @param bwd_fact[(T+1)*N] Array[out] to write log normalisation factors
+ *                            of backward scores
+ *
+ *   @returns 0 on success, -1 if memory could not be allocated
+ **/
+int flipflop_make_trans(float const * scores, size_t T, size_t N, size_t nbase,
+                        float * trans, float * fwd_fact, float * bwd_fact){
+    assert(NULL != scores);
+    assert(NULL != trans);
+    assert(NULL != fwd_fact);
+    assert(NULL != bwd_fact);
+    const size_t nstate = nbase + nbase;
+    const size_t S = nstate * (nbase + 1);
+    int ret = 0;
+
+#pragma omp parallel reduction(min:ret)
+    {
+        //  Per-thread workspace: forward scores for whole chunk and
+        //  backward scores for two blocks
+        float * fwd = malloc((T + 1) * nstate * sizeof(float));
+        float * bwd = malloc(2 * nstate * sizeof(float));
+        float * tmp = malloc(nstate * sizeof(float));
+        if(NULL == fwd || NULL == bwd || NULL == tmp){
+            ret = -1;
+        } else {
+#pragma omp for
+            for(size_t n=0 ; n < N ; n++){
+                for(size_t st=0 ; st < nstate ; st++){
+                    fwd[st] = -logf(nstate);
+                }
+                fwd_fact[n] = logf(nstate);
+                for(size_t t=0 ; t < T ; t++){
+                    float * fwdcurr = fwd + (t + 1) * nstate;
+                    flipflop_forward_step(scores + (t * N + n) * S, fwd + t * nstate,
+                                          nbase, tmp, fwdcurr);
+                    fwd_fact[(t + 1) * N + n] = lognormalise(fwdcurr, nstate);
+                }
+
+                float * bwdnext = bwd;
+                float * bwdcurr = bwd + nstate;
+                for(size_t st=0 ; st < nstate ; st++){
+                    bwdnext[st] = -logf(nstate);
+                }
+                bwd_fact[T * N + n] = logf(nstate);
+                for(size_t t=T ; t > 0 ; t--){
+                    float const * sc = scores + ((t - 1) * N + n) * S;
+                    float const * fwdprev = fwd + (t - 1) * nstate;
+                    float * tr = trans + ((t - 1) * N + n) * S;
+                    for(size_t to_base=0 ; to_base < nbase ; to_base++){
+                        for(size_t from_state=0 ; from_state < nstate ; from_state++){
+                            const size_t idx = to_base * nstate + from_state;
+                            tr[idx] = fwdprev[from_state] + sc[idx] + bwdnext[to_base];
+                        }
+                    }
+                    for(size_t from_state=0 ; from_state < nstate ; from_state++){
+                        const size_t to_state = (from_state < nbase) ? from_state + nbase : from_state;
+                        const size_t idx = nstate * nbase + from_state;
+                        tr[idx] = fwdprev[from_state] + sc[idx] + bwdnext[to_state];
+                    }
+
+                    flipflop_backward_step(sc, bwdnext, nbase, tmp, bwdcurr);
+                    bwd_fact[(t - 1) * N + n] = lognormalise(bwdcurr, nstate);
+                    float * swap = bwdnext;
+                    bwdnext = bwdcurr;
+                    bwdcurr = swap;
+                }
+            }
+        }
+        free(tmp);
+        free(bwd);
+        free(fwd);
+    }
+
+    return ret;
+}
+
+
+/**  Log-partition function of flip-flop transition scores
+ *
+ *   The sum of the log normalisation factors of the forward scores, as
+ *   calculated by flipflop_forward, but only keeping the forward scores of the
+ *   current block.
+ *
+ *   @param scores[T*N*S]  Transition scores, S = 2 * nbase * (nbase + 1)
+ *   @param T              Number of blocks
+ *   @param N              Number of chunks in batch
+ *   @param nbase          Number of bases
+ *   @param logz[N]        Array[out] to write log-partition function of each chunk
+ **/
+void flipflop_logz(float const * scores, size_t T, size_t N, size_t nbase, float * logz){
+    assert(NULL != scores);
+    assert(NULL != logz);
+    const size_t nstate = nbase + nbase;
+    const size_t S = nstate * (nbase + 1);
+
+#pragma omp parallel for
+    for(size_t n=0 ; n < N ; n++){
+        float tmp[nstate];
+        float fwd[nstate + nstate];
+        float * fwdprev = fwd;
+        float * fwdcurr = fwd + nstate;
+        for(size_t st=0 ; st < nstate ; st++){
+            fwdprev[st] = -logf(nstate);
+        }
+        float sum = logf(nstate);
+        for(size_t t=0 ; t < T ; t++){
+            flipflop_forward_step(scores + (t * N + n) * S, fwdprev, nbase, tmp, fwdcurr);
+            sum += lognormalise(fwdcurr, nstate);
+            float * swap = fwdprev;
+            fwdprev = fwdcurr;
+            fwdcurr = swap;
+        }
+        logz[n] = sum;
+    }
+}
+
+
+/**  Log-partition function of flip-flop transition scores and its gradient
+ *
+ *   The gradient of the log-partition function with respect to the score of
+ *   a transition is the posterior probability of the transition, found by
+ *   normalising the posterior scores of flipflop_make_trans for each block.
+ *
+ *   @param scores[T*N*S]  Transition scores, S = 2 * nbase * (nbase + 1)
+ *   @param T              Number of blocks
+ *   @param N              Number of chunks in batch
+ *   @param nbase          Number of bases
+ *   @param logz[N]        Array[out] to write log-partition function of each chunk
+ *   @param grad[T*N*S]    Array[out] to write gradient of logz
+ *
+ *   @returns 0 on success, -1 if memory could not be allocated
+ **/
+int flipflop_logz_grad(float const * scores, size_t T, size_t N, size_t nbase,
+                       float * logz, float * grad){
+    assert(NULL != scores);
+    assert(NULL != logz);
+    assert(NULL != grad);
+    const size_t nstate = nbase + nbase;
+    const size_t S = nstate * (nbase + 1);
+
+    float * fact = malloc(2 * (T + 1) * N * sizeof(float));
+    if(NULL == fact){
+        return -1;
+    }
+    float * fwd_fact = fact;
+    float * bwd_fact = fact + (T + 1) * N;
+    int ret = flipflop_make_trans(scores, T, N, nbase, grad, fwd_fact, bwd_fact);
+    if(0 == ret){
+#pragma omp parallel for
+        for(size_t n=0 ; n < N ; n++){
+            float sum = 0.0f;
+            for(size_t t=0 ; t <= T ; t++){
+                sum += fwd_fact[t * N + n];
+            }
+            logz[n] = sum;
+            for(size_t t=0 ; t < T ; t++){
+                float * gradcurr = grad + (t * N + n) * S;
+                lognormalise(gradcurr, S);
+                for(size_t i=0 ; i < S ; i++){
+                    gradcurr[i] = expf(gradcurr[i]);
+                }
+            }
+        }
+    }
+    free(fact);
+
+    return ret;
+}
+
+
+/**  Viterbi decoding of flip-flop transition scores
+ *
+ *   Ties are broken in favour of the lowest numbered state, as for the GPU
+ *   implementation in taiyaki.cupy_extensions.flipflop.
+ *
+ *   @param scores[T*N*S]              Transition scores, S = 2 * nbase * (nbase + 1)
+ *   @param T                          Number of blocks
+ *   @param N                          Number of chunks in batch
+ *   @param nbase                      Number of bases
+ *   @param fwd[(T+1)*N*2*nbase]       Array[out] to write Viterbi forward scores.
+ *                                     fwd[0, :, :] should be initialised.
+ *   @param traceback[(T+1)*N*2*nbase] Array[out] to write traceback.
+ *   @param path[(T+1)*N]              Array[out] to write best path.  The first
+ *                                     element of each path is not written.
+ **/
+void flipflop_viterbi(float const * scores, size_t T, size_t N, size_t nbase,
+                      float * fwd, int64_t * traceback, int64_t * path){
+    assert(NULL != scores);
+    assert(NULL != fwd);
+    assert(NULL != traceback);
+    assert(NULL != path);
+    const size_t nstate = nbase + nbase;
+    const size_t S = nstate * (nbase + 1);
+
+#pragma omp parallel for
+    for(size_t n=0 ; n < N ; n++){
+        for(size_t t=0 ; t < T ; t++){
+            float const * sc = scores + (t * N + n) * S;
+            float const * fwdprev = fwd + (t * N + n) * nstate;
+            float * fwdcurr = fwd + ((t + 1) * N + n) * nstate;
+            int64_t * tb = traceback + ((t + 1) * N + n) * nstate;
+            for(size_t to_base=0 ; to_base < nbase ; to_base++){
+                // To flip, from any state
+                float const * sc_to = sc + to_base * nstate;
+                float u = sc_to[0] + fwdprev[0];
+                int64_t s = 0;
+                for(size_t from_state=1 ; from_state < nstate ; from_state++){
+                    const float v = sc_to[from_state] + fwdprev[from_state];
+                    if(v > u){
+                        u = v;
+                        s = from_state;
+                    }
+                }
+                fwdcurr[to_base] = u;
+                tb[to_base] = s;
+            }
+            for(size_t to_base=0 ; to_base < nbase ; to_base++){
+                // To flop, from flip or flop of same base
+                const float u = sc[nstate * nbase + to_base] + fwdprev[to_base];
+                const float v = sc[nstate * nbase + nbase + to_base] + fwdprev[to_base + nbase];
+                fwdcurr[to_base + nbase] = fmaxf(u, v);
+                tb[to_base + nbase] = (u > v) ? to_base : to_base + nbase;
+            }
+        }
+
+        //  Traceback
+        int64_t s = argmaxf(fwd + (T * N + n) * nstate, nstate);
+        for(size_t t=T ; t > 0 ; t--){
+            path[t * N + n] = s;
+            s = traceback[(t * N + n) * nstate + s];
+        }
+    }
+}
+
+
+/*
+***********************************************
+Mapping of flip-flop scores to a given sequence
+***********************************************
+ */
+
+
+/**  One block of forward pass of flipflop_map_viterbi
+ *
+ *   @param sc[nparam]          Transition scores for block
+ *   @param step_index[npos-1]  Index of score to step to each position
+ *   @param stay_index[npos]    Index of score to stay at each position
+ *   @param npos                Number of positions in sequence
+ *   @param localpen            Penalty for staying in start or end states
+ *   @param pscore[npos]        Scores of each position for previous block
+ *   @param cscore[npos]        Array[out] to write scores for this block
+ *   @param tb[npos]            Array[out] to write traceback, 1 for a step
+ *   @param start_score         Score of start state, updated in-place
+ **/
+static void map_viterbi_step(float const * sc, int32_t const * step_index,
+                             int32_t const * stay_index, size_t npos, double localpen,
+                             double const * pscore, double * cscore, int8_t * tb,
+                             double * start_score){
+    // First position: stay or leave start state
+    const double stay_first = sc[stay_index[0]];
+    const double leave_start_score = *start_score - localpen;
+    *start_score += fmax(stay_first, -localpen);
+    const double cstay_first = pscore[0] + stay_first;
+    cscore[0] = (*start_score > cstay_first) ? *start_score : cstay_first;
+    tb[0] = leave_start_score > cstay_first;
+
+    // Other positions: stay or step from previous
+    for(size_t m=1 ; m < npos ; m++){
+        const double cstay = pscore[m] + sc[stay_index[m]];
+        const double cstep = pscore[m - 1] + sc[step_index[m - 1]];
+        cscore[m] = (cstep > cstay) ? cstep : cstay;
+        tb[m] = cstay < cstep;
+    }
+}
+
+
+/**  Update end state of flipflop_map_viterbi for one block
+ *
+ *   @param sc[nparam]          Transition scores for block
+ *   @param stay_index[npos]    Index of score to stay at each position
+ *   @param npos                Number of positions in sequence
+ *   @param localpen            Penalty for staying in start or end states
+ *   @param pscore[npos]        Scores of each position for previous block
+ *   @param n                   Index of block
+ *   @param end_score           Score of end state, updated in-place
+ *   @param alignment_end       Block at which end state was entered, updated in-place
+ **/
+static void map_viterbi_end_step(float const * sc, int32_t const * stay_index, size_t npos,
+                                 double localpen, double const * pscore, size_t n,
+                                 double * end_score, size_t * alignment_end){
+    // End state: stay or enter from last position
+    const double remain_in_end_score = *end_score + fmax(sc[stay_index[npos - 1]], -localpen);
+    const double step_into_end_score = pscore[npos - 1] - localpen;
+    if(step_into_end_score > remain_in_end_score){
+        *end_score = step_into_end_score;
+        *alignment_end = n;
+    } else {
+        *end_score = remain_in_end_score;
+    }
+}
+
+
+/**  Find highest scoring path through scores corresponding to a sequence
+ *
+ *   Alignment starts in a "start" state, moves through every position of the
+ *   sequence in turn and finishes in an "end" state.  Staying in the start
+ *   or end states costs `localpen` for each block.  Scores are accumulated
+ *   in double precision, as for flipflop_remap.map_to_crf_viterbi.
+ *
+ *   @param scores[nblock*nparam]  Transition scores for each block
+ *   @param nblock                 Number of blocks
+ *   @param nparam                 Number of transition scores per block
+ *   @param step_index[npos-1]     Index of score to step to each position
+ *                                 from the previous one
+ *   @param stay_index[npos]       Index of score to stay at each position
+ *   @param npos                   Number of positions in sequence
+ *   @param localpen               Penalty for staying in start or end states
+ *   @param score                  [out] Score of best path
+ *   @param path[nblock+1]         Array[out] to write position at each
+ *                                 block, -1 for start or end states
+ *
+ *   @returns 0 on success, -1 if memory could not be allocated
+ **/
+int flipflop_map_viterbi(float const * scores, size_t nblock, size_t nparam,
+                         int32_t const * step_index, int32_t const * stay_index, size_t npos,
+                         double localpen, double * score, int64_t * path){
+    assert(NULL != scores);
+    assert(NULL != step_index);
+    assert(NULL != stay_index);
+    assert(NULL != score);
+    assert(NULL != path);
+    assert(npos > 0);
+
+    double * pscore = malloc(npos * sizeof(double));
+    double * cscore = malloc(npos * sizeof(double));
+    int8_t * traceback = calloc((nblock + 1) * npos, sizeof(int8_t));
+    if(NULL == pscore || NULL == cscore || NULL == traceback){
+        free(traceback);
+        free(cscore);
+        free(pscore);
+        return -1;
+    }
+
+    for(size_t m=0 ; m < npos ; m++){
+        cscore[m] = -LARGE_VAL;
+    }
+    cscore[0] = 0.0;
+    double start_score = 0.0;
+    double end_score = -LARGE_VAL;
+    size_t alignment_end = 0;
+
+    for(size_t n=0 ; n < nblock ; n++){
+        float const * sc = scores + n * nparam;
+        {  // Swap vectors
+            double * tmp = pscore;
+            pscore = cscore;
+            cscore = tmp;
+        }
+        map_viterbi_step(sc, step_index, stay_index, npos, localpen, pscore, cscore,
+                         traceback + (n + 1) * npos, &start_score);
+        map_viterbi_end_step(sc, stay_index, npos, localpen, pscore, n,
+                             &end_score, &alignment_end);
+    }
+
+    for(size_t n=0 ; n <= nblock ; n++){
+        path[n] = -1;
+    }
+    // Traceback starts at end of sequence or in end state
+    int64_t n = (cscore[npos - 1] > end_score) ? nblock : alignment_end;
+    int64_t m = npos - 1;
+    while(n >= 0 && m >= 0){
+        path[n] = m;
+        m -= traceback[n * npos + m];
+        n -= 1;
+    }
+    *score = (end_score > cscore[npos - 1]) ? end_score : cscore[npos - 1];
+
+    free(traceback);
+    free(cscore);
+    free(pscore);
+    return 0;
+}
+
+
+/**  Find highest scoring path through scores corresponding to a sequence,
+ *   using little memory for the traceback
+ *
+ *   As flipflop_map_viterbi but, rather than storing the traceback for every
+ *   block, the scores of every position are stored for every
+ *   `segment_length`th block.  During traceback, each segment of blocks is
+ *   recomputed from the stored scores to recover its traceback.  Paths and
+ *   scores are identical to flipflop_map_viterbi; memory is proportional to
+ *   npos * (nblock / segment_length + segment_length) and the forward pass
+ *   is done twice.
+ *
+ *   @param segment_length  Number of blocks between stored scores, or 0 to
+ *                          choose a length minimising memory
+ *
+ *   See flipflop_map_viterbi for other parameters
+ *
+ *   @returns 0 on success, -1 if memory could not be allocated
+ **/
+int flipflop_map_viterbi_checkpointed(float const * scores, size_t nblock, size_t nparam,
+                                      int32_t const * step_index, int32_t const * stay_index,
+                                      size_t npos, double localpen, size_t segment_length,
+                                      double * score, int64_t * path){
+    assert(NULL != scores);
+    assert(NULL != step_index);
+    assert(NULL != stay_index);
+    assert(NULL != score);
+    assert(NULL != path);
+    assert(npos > 0);
+
+    if(0 == segment_length){
+        //  Checkpoints are doubles, traceback int8
+        segment_length = (size_t)ceil(sqrt(sizeof(double) * (double)nblock));
+    }
+    if(segment_length < 1){
+        segment_length = 1;
+    }
+    const size_t nsegment = (nblock + segment_length - 1) / segment_length;
+
+    double * pscore = malloc(npos * sizeof(double));
+    double * cscore = malloc(npos * sizeof(double));
+    //  Scores at start of each segment, and of start state
+    double * checkpoint = malloc((nsegment + 1) * npos * sizeof(double));
+    double * checkpoint_start = malloc((nsegment + 1) * sizeof(double));
+    //  Traceback for blocks of one segment
+    int8_t * traceback = malloc(segment_length * npos * sizeof(int8_t));
+    if(NULL == pscore || NULL == cscore || NULL == checkpoint || NULL == checkpoint_start ||
+       NULL == traceback){
+        free(traceback);
+        free(checkpoint_start);
+        free(checkpoint);
+        free(cscore);
+        free(pscore);
+        return -1;
+    }
+
+    for(size_t m=0 ; m < npos ; m++){
+        cscore[m] = -LARGE_VAL;
+    }
+    cscore[0] = 0.0;
+    double start_score = 0.0;
+    double end_score = -LARGE_VAL;
+    size_t alignment_end = 0;
+
+    for(size_t n=0 ; n < nblock ; n++){
+        if(0 == n % segment_length){
+            const size_t seg = n / segment_length;
+            memcpy(checkpoint + seg * npos, cscore, npos * sizeof(double));
+            checkpoint_start[seg] = start_score;
+        }
+        float const * sc = scores + n * nparam;
+        {  // Swap vectors
+            double * tmp = pscore;
+            pscore = cscore;
+            cscore = tmp;
+        }
+        //  Traceback discarded on first pass
+        map_viterbi_step(sc, step_index, stay_index, npos, localpen, pscore, cscore,
+                         traceback, &start_score);
+        map_viterbi_end_step(sc, stay_index, npos, localpen, pscore, n,
+                             &end_score, &alignment_end);
+    }
+    *score = (end_score > cscore[npos - 1]) ? end_score : cscore[npos - 1];
+
+    for(size_t n=0 ; n <= nblock ; n++){
+        path[n] = -1;
+    }
+    // Traceback starts at end of sequence or in end state
+    int64_t n = (cscore[npos - 1] > end_score) ? nblock : alignment_end;
+    int64_t m = npos - 1;
+    while(n > 0 && m >= 0){
+        //  Recompute traceback of segment containing blocks leading to n
+        const size_t seg = (n - 1) / segment_length;
+        const size_t seg_start = seg * segment_length;
+        memcpy(cscore, checkpoint + seg * npos, npos * sizeof(double));
+        start_score = checkpoint_start[seg];
+        for(size_t i=seg_start ; i < (size_t)n ; i++){
+            {  // Swap vectors
+                double * tmp = pscore;
+                pscore = cscore;
+                cscore = tmp;
+            }
+            map_viterbi_step(scores + i * nparam, step_index, stay_index, npos, localpen,
+                             pscore, cscore, traceback + (i - seg_start) * npos,
+                             &start_score);
+        }
+        //  Row n of traceback is from block n - 1
+        while(n > (int64_t)seg_start && m >= 0){
+            path[n] = m;
+            m -= traceback[(n - 1 - seg_start) * npos + m];
+            n -= 1;
+        }
+    }
+    if(0 == n && m >= 0){
+        path[0] = m;
+    }
+
+    free(traceback);
+    free(checkpoint_start);
+    free(checkpoint);
+    free(cscore);
+    free(pscore);
+    return 0;
+}
+
+
+/**  Map many reads in parallel with flipflop_map_viterbi
+ *
+ *   @param scores[nbatch]      Array of pointers to transition scores of each read
+ *   @param nblock[nbatch]      Number of blocks for each read
+ *   @param nparam              Number of transition scores per block
+ *   @param step_index[nbatch]  Array of pointers to step indices of each read
+ *   @param stay_index[nbatch]  Array of pointers to stay indices of each read
+ *   @param npos[nbatch]        Number of positions in sequence of each read
+ *   @param nbatch              Number of reads
+ *   @param localpen            Penalty for staying in start or end states
+ *   @param score[nbatch]       Array[out] to write score of best path for each read
+ *   @param path[nbatch]        Array of pointers to arrays[out] to write best
+ *                              path of each read
+ *
+ *   @returns 0 on success, -1 if memory could not be allocated for any read
+ **/
+int flipflop_map_viterbi_batch(float const ** scores, size_t const * nblock, size_t nparam,
+                               int32_t const ** step_index, int32_t const ** stay_index,
+                               size_t const * npos, size_t nbatch, double localpen,
+                               double * score, int64_t ** path){
+    int ret = 0;
+#pragma omp parallel for schedule(dynamic) reduction(min:ret)
+    for(size_t batch=0 ; batch < nbatch ; batch++){
+        const int status = flipflop_map_viterbi(scores[batch], nblock[batch], nparam,
+                                                step_index[batch], stay_index[batch],
+                                                npos[batch], localpen, score + batch,
+                                                path[batch]);
+        ret = (status < ret) ? status : ret;
+    }
+    return ret;
+}
+
+
+//  Traceback value for leaving the start state into the band, see below
+#define BAND_FROM_START 2
+
+/**  Find highest scoring path through scores corresponding to a sequence,
+ *   only considering positions within a band
+ *
+ *   As flipflop_map_viterbi but, for each block n, only positions
+ *   band_start[n] to band_start[n] + band_width - 1 are considered.  Memory
+ *   and time are proportional to nblock * band_width rather than
+ *   nblock * npos.  If the band covers the whole sequence, the result is the
+ *   same as for flipflop_map_viterbi.
+ *
+ *   So that clipping is not limited by the band, the start state may be left
+ *   into the first position of the band, and the end state entered from the
+ *   last position of the band, at every block.  A path doing so skips part
+ *   of the sequence: its first position is greater than 0 or its last
+ *   position less than npos - 1, and the band should be widened.
+ *
+ *   @param scores[nblock*nparam]  Transition scores for each block
+ *   @param nblock                 Number of blocks
+ *   @param nparam                 Number of transition scores per block
+ *   @param step_index[npos-1]     Index of score to step to each position
+ *                                 from the previous one
+ *   @param stay_index[npos]       Index of score to stay at each position
+ *   @param npos                   Number of positions in sequence
+ *   @param band_start[nblock+1]   First position in band for each block,
+ *                                 non-decreasing and at most npos - band_width
+ *   @param band_width             Number of positions in band, at most npos
+ *   @param localpen               Penalty for staying in start or end states
+ *   @param score                  [out] Score of best path
+ *   @param path[nblock+1]         Array[out] to write position at each
+ *                                 block, -1 for start or end states
+ *
+ *   @returns 0 on success, -1 if memory could not be allocated
+ **/
+int flipflop_map_viterbi_banded(float const * scores, size_t nblock, size_t nparam,
+                                int32_t const * step_index, int32_t const * stay_index,
+                                size_t npos, int64_t const * band_start, size_t band_width,
+                                double localpen, double * score, int64_t * path){
+    assert(NULL != scores);
+    assert(NULL != step_index);
+    assert(NULL != stay_index);
+    assert(NULL != band_start);
+    assert(NULL != score);
+    assert(NULL != path);
+    assert(npos > 0);
+    assert(band_width > 0 && band_width <= npos);
+
+    const int64_t W = band_width;
+    const int64_t last = npos - 1;
+    double * pscore = malloc(W * sizeof(double));
+    double * cscore = malloc(W * sizeof(double));
+    int8_t * traceback = calloc((nblock + 1) * W, sizeof(int8_t));
+    if(NULL == pscore || NULL == cscore || NULL == traceback){
+        free(traceback);
+        free(cscore);
+        free(pscore);
+        return -1;
+    }
+
+    for(int64_t k=0 ; k < W ; k++){
+        cscore[k] = -LARGE_VAL;
+    }
+    if(0 == band_start[0]){
+        cscore[0] = 0.0;
+    }
+    double start_score = 0.0;
+    double end_score = -LARGE_VAL;
+    size_t alignment_end = 0;
+    int64_t end_position = last;
+
+    for(size_t n=0 ; n < nblock ; n++){
+        float const * sc = scores + n * nparam;
+        int8_t * tb = traceback + (n + 1) * W;
+        const int64_t plo = band_start[n];
+        const int64_t clo = band_start[n + 1];
+        {  // Swap vectors
+            double * tmp = pscore;
+            pscore = cscore;
+            cscore = tmp;
+        }
+
+        const double stay_first = sc[stay_index[0]];
+        const double leave_start_score = start_score - localpen;
+        start_score += fmax(stay_first, -localpen);
+
+        for(int64_t k=0 ; k < W ; k++){
+            const int64_t m = clo + k;
+            const double prev_stay = (m - plo < W) ? pscore[m - plo] : -LARGE_VAL;
+            const double cstay = prev_stay + sc[stay_index[m]];
+            if(0 == m){
+                // First position: stay or leave start state
+                cscore[k] = (start_score > cstay) ? start_score : cstay;
+                tb[k] = leave_start_score > cstay;
+            } else {
+                // Other positions: stay or step from previous
+                const double prev_step = (m - 1 >= plo && m - 1 - plo < W) ?
+                                         pscore[m - 1 - plo] : -LARGE_VAL;
+                const double cstep = prev_step + sc[step_index[m - 1]];
+                cscore[k] = (cstep > cstay) ? cstep : cstay;
+                tb[k] = cstay < cstep;
+                if(0 == k && start_score > cscore[k]){
+                    // Leave start state into first position of band
+                    cscore[k] = start_score;
+                    tb[k] = BAND_FROM_START;
+                }
+            }
+        }
+
+        // End state: stay or enter from last position of sequence or of band
+        const int64_t prev_hi = plo + W - 1;
+        const double prev_last = (last - plo < W) ? pscore[last - plo] : pscore[W - 1];
+        const double remain_in_end_score = end_score + fmax(sc[stay_index[last]], -localpen);
+        const double step_into_end_score = prev_last - localpen;
+        if(step_into_end_score > remain_in_end_score){
+            end_score = step_into_end_score;
+            alignment_end = n;
+            end_position = (prev_hi < last) ? prev_hi : last;
+        } else {
+            end_score = remain_in_end_score;
+        }
+    }
+
+    for(size_t n=0 ; n <= nblock ; n++){
+        path[n] = -1;
+    }
+    const int64_t final_lo = band_start[nblock];
+    const double final_score = (last - final_lo < W) ? cscore[last - final_lo] : -LARGE_VAL;
+    // Traceback starts at end of sequence or in end state
+    int64_t n = nblock;
+    int64_t m = last;
+    if(final_score <= end_score){
+        n = alignment_end;
+        m = end_position;
+    }
+    while(n >= 0 && m >= 0){
+        path[n] = m;
+        const int64_t k = m - band_start[n];
+        const int8_t move = (k >= 0 && k < W) ? traceback[n * W + k] : 0;
+        m = (BAND_FROM_START == move) ? -1 : m - move;
+        n -= 1;
+    }
+    *score = (end_score > final_score) ? end_score : final_score;
+
+    free(traceback);
+    free(cscore);
+    free(pscore);
+    return 0;
+}
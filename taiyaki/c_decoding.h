@@ -3,3 +3,31 @@
 
 void fast_viterbi_blocks(float const * weights, size_t nblock, size_t nbatch, size_t nparam, size_t nbase,
                          float stay_pen, float skip_pen, float local_pen, float * score, int32_t * seq);
+
+void flipflop_forward(float const * scores, size_t T, size_t N, size_t nbase,
+                      float * fwd, float * fact);
+void flipflop_backward(float const * scores, size_t T, size_t N, size_t nbase,
+                       float * bwd, float * fact);
+int flipflop_make_trans(float const * scores, size_t T, size_t N, size_t nbase,
+                        float * trans, float * fwd_fact, float * bwd_fact);
+void flipflop_logz(float const * scores, size_t T, size_t N, size_t nbase, float * logz);
+int flipflop_logz_grad(float const * scores, size_t T, size_t N, size_t nbase,
+                       float * logz, float * grad);
+void flipflop_viterbi(float const * scores, size_t T, size_t N, size_t nbase,
+                      float * fwd, int64_t * traceback, int64_t * path);
+
+int flipflop_map_viterbi(float const * scores, size_t nblock, size_t nparam,
+                         int32_t const * step_index, int32_t const * stay_index, size_t npos,
+                         double localpen, double * score, int64_t * path);
+int flipflop_map_viterbi_batch(float const ** scores, size_t const * nblock, size_t nparam,
+                               int32_t const ** step_index, int32_t const ** stay_index,
+                               size_t const * npos, size_t nbatch, double localpen,
+                               double * score, int64_t ** path);
+int flipflop_map_viterbi_banded(float const * scores, size_t nblock, size_t nparam,
+                                int32_t const * step_index, int32_t const * stay_index,
+                                size_t npos, int64_t const * band_start, size_t band_width,
+                                double localpen, double * score, int64_t * path);
+int flipflop_map_viterbi_checkpointed(float const * scores, size_t nblock, size_t nparam,
+                                      int32_t const * step_index, int32_t const * stay_index,
+                                      size_t npos, double localpen, size_t segment_length,
+                                      double * score, int64_t * path);
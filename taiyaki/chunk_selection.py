@@ -1,6 +1,6 @@
 # Functions to select and filter chunks for training.
 # Data structures are based on the read dictionary defined in mapped_signal_files.py
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import os
 import numpy as np
 from taiyaki.maths import med_mad
@@ -173,6 +173,270 @@ def assemble_batch(read_data, batch_size, chunk_len, filter_parameters, args, lo
                          chunk_len_means_sequence_len=chunk_len_means_sequence_len)
 
 
+class ChunkSampler:
+    """Sample batches of chunks from a list of reads using array operations.
+
+    Only the mapped region and scalings of each read are held by the
+    sampler, taken from the read's ChunkMetadata, so the arrays of lazily
+    loaded reads stay in the file.  All attempts for a batch are drawn and
+    filtered together: Ref_to_signal is fetched for the reads drawn, and
+    the signal and reference only for the slices of accepted chunks.
+
+    The Ref_to_signal arrays of the cache_reads most recently drawn reads
+    are kept, concatenated, so that reads drawn again are not fetched again
+    and the concatenation is extended rather than rebuilt for each batch.
+
+    Chunks are selected and filtered exactly as by assemble_batch, with
+    chunk_len giving the length in samples, although the random numbers
+    are drawn in a different order.
+    """
+
+    def __init__(self, read_data, cache_reads=5000):
+        """
+        :param read_data: list of Read objects as defined in mapped_signal_files.py
+        :param cache_reads: maximum number of reads whose Ref_to_signal is
+            kept between batches
+        """
+        self.read_data = read_data
+        self.cache_reads = cache_reads
+        nread = len(read_data)
+        regions = np.array([read.get_mapped_dacs_region() for read in read_data],
+                           dtype=np.int64).reshape(nread, 2)
+        self.mapped_start, self.mapped_end = regions.T
+        self.scalings = np.array([
+            [read['offset'], read['range'] / read['digitisation'],
+             read['shift_frompA'], read['scale_frompA']] for read in read_data]).reshape(nread, 4)
+
+        # Cached reads, least recently drawn first, and the location of
+        # each read's Ref_to_signal in the concatenation.  Locations in
+        # Ref_to_signal (-1 to len(dacs)) are shifted by signal_offset so
+        # that the concatenation is increasing and can be searched.  Reads
+        # dropped from the cache leave gaps, removed when they fill half of
+        # the arrays.
+        self._cached = OrderedDict()
+        self._map_offset = np.zeros(nread, dtype=np.int64)
+        self._map_length = np.zeros(nread, dtype=np.int64)
+        self._signal_offset = np.zeros(nread, dtype=np.int64)
+        self._signal_keys = np.zeros(0, dtype=np.int64)
+        self._is_slip = np.zeros(0, dtype=bool)
+        self._nkeys = 0
+        self._ncached_keys = 0
+
+    def _compact_cache(self):
+        """Remove gaps left by reads dropped from the cache.  Locations
+        remain increasing, so signal offsets are unchanged."""
+        cached = np.array(list(self._cached), dtype=np.int64)
+        cached = cached[np.argsort(self._map_offset[cached])]
+        lengths = self._map_length[cached]
+        new_offset = np.cumsum(lengths) - lengths
+        keep = (np.arange(lengths.sum()) +
+                np.repeat(self._map_offset[cached] - new_offset, lengths))
+        self._nkeys = len(keep)
+        self._signal_keys[:self._nkeys] = self._signal_keys[keep]
+        self._is_slip[:self._nkeys] = self._is_slip[keep]
+        self._map_offset[cached] = new_offset
+
+    def _cache_maps(self, drawn):
+        """Make sure that the Ref_to_signal arrays of reads are in the
+        cache, dropping the least recently drawn reads to make room
+
+        :param drawn: array of distinct read numbers
+        """
+        missing = []
+        for n in drawn.tolist():
+            if n in self._cached:
+                self._cached.move_to_end(n)
+            else:
+                missing.append(n)
+        if len(missing) == 0:
+            return
+        ndrop = min(len(self._cached) + len(missing) - self.cache_reads,
+                    len(self._cached) - len(drawn) + len(missing))
+        for _ in range(ndrop):
+            n, _ = self._cached.popitem(last=False)
+            self._ncached_keys -= self._map_length[n]
+        if 2 * self._ncached_keys < self._nkeys:
+            self._compact_cache()
+
+        ref_to_signal = [self.read_data[n]['Ref_to_signal'] for n in missing]
+        lengths = np.array([len(r) for r in ref_to_signal], dtype=np.int64)
+        last_location = np.array([r[-1] for r in ref_to_signal], dtype=np.int64)
+        last_key = self._signal_keys[self._nkeys - 1] if self._nkeys > 0 else -1
+        self._signal_offset[missing] = (last_key + 2 + np.cumsum(last_location + 2) -
+                                        last_location - 2)
+        self._map_offset[missing] = self._nkeys + np.cumsum(lengths) - lengths
+        self._map_length[missing] = lengths
+
+        nkeys = self._nkeys + lengths.sum()
+        if nkeys > len(self._signal_keys):
+            size = max(nkeys, 2 * len(self._signal_keys))
+            signal_keys = np.empty(size, dtype=np.int64)
+            signal_keys[:self._nkeys] = self._signal_keys[:self._nkeys]
+            is_slip = np.empty(size, dtype=bool)
+            is_slip[:self._nkeys] = self._is_slip[:self._nkeys]
+            self._signal_keys, self._is_slip = signal_keys, is_slip
+        for n, r in zip(missing, ref_to_signal):
+            start, end = self._map_offset[n], self._map_offset[n] + len(r)
+            self._signal_keys[start:end] = r
+            self._signal_keys[start:end] += self._signal_offset[n]
+            self._is_slip[start:end] = False
+            self._is_slip[start + self.read_data[n].get_chunk_metadata().slip_locations] = True
+            self._cached[n] = None
+        self._nkeys = nkeys
+        self._ncached_keys += lengths.sum()
+
+    def _map_chunks(self, read_numbers, starts, chunk_len):
+        """Reference locations of the ends of chunks, as from
+        Read.get_reference_locations, whether either end is at a slip and
+        the maximum dwell within each chunk.
+
+        The Ref_to_signal arrays of the reads drawn are taken from the
+        cache, so the chunks of all reads are handled together.  All chunks
+        must lie within the mapped region of their read.
+
+        :returns: tuple (ref_starts, ref_ends, slips, max_dwells)
+        """
+        self._cache_maps(np.unique(read_numbers))
+        map_offset = self._map_offset[read_numbers]
+        signal_offset = self._signal_offset[read_numbers]
+        signal_keys = self._signal_keys[:self._nkeys]
+
+        ref_starts = np.searchsorted(signal_keys, starts + signal_offset) - map_offset
+        ref_ends = np.searchsorted(signal_keys, starts + chunk_len + signal_offset) - map_offset
+        past_end = starts + chunk_len >= self.mapped_end[read_numbers]
+        ref_ends[past_end] = self._map_length[read_numbers][past_end] - 1
+        slips = (self._is_slip[map_offset + ref_starts] |
+                 self._is_slip[map_offset + ref_ends])
+
+        # Dwells within chunk are between consecutive locations in
+        # Ref_to_signal[ref_start:ref_end]; gather them into one array and
+        # reduce each segment
+        max_dwells = np.ones(len(read_numbers), dtype=np.int64)
+        ndwells = ref_ends - ref_starts - 1
+        has_dwells = np.flatnonzero(ndwells > 0)
+        if len(has_dwells) > 0:
+            ndwells = ndwells[has_dwells]
+            segment_ends = np.cumsum(ndwells)
+            first_dwell = map_offset[has_dwells] + ref_starts[has_dwells]
+            positions = (np.arange(segment_ends[-1]) +
+                         np.repeat(first_dwell - segment_ends + ndwells, ndwells))
+            max_dwells[has_dwells] = np.maximum.reduceat(
+                signal_keys[positions + 1] - signal_keys[positions],
+                segment_ends - ndwells)
+        return ref_starts, ref_ends, slips, max_dwells
+
+    def sample_batch(self, batch_size, chunk_len, filter_parameters, args,
+                     log=None, chunk_log=None, fraction_of_fails_allowed=0.5,
+                     log_accepted_chunks=False, TINY=0.00000001):
+        """Assemble a batch of chunks with chunk_len samples.
+
+        Up to (batch_size / fraction_of_fails_allowed) attempts are drawn
+        at once and filtered; the first batch_size that pass are used.
+
+        Returns tuple (chunklist, rejection_dict, current, sequence)
+
+        where current is a float32 array (chunk_len x number of chunks)
+        containing the standardised signal for each chunk and sequence is
+        the concatenation of the reference sequences of the chunks.
+        chunklist and rejection_dict are as returned by assemble_batch;
+        the current and sequence of each chunk in chunklist are views of
+        these arrays.
+
+        See docstring for sample_chunks for other parameters.
+        """
+        nreads = len(self.read_data)
+        maximum_attempts_allowed = int(batch_size / fraction_of_fails_allowed)
+        read_numbers = np.random.randint(nreads, size=maximum_attempts_allowed)
+        spare_length = (self.mapped_end[read_numbers] -
+                        self.mapped_start[read_numbers] - chunk_len)
+        starts = (self.mapped_start[read_numbers] +
+                  np.random.randint(np.maximum(spare_length, 1)))
+        ref_starts = np.zeros(maximum_attempts_allowed, dtype=np.int64)
+        ref_ends = np.zeros(maximum_attempts_allowed, dtype=np.int64)
+        slips = np.zeros(maximum_attempts_allowed, dtype=bool)
+        max_dwells = np.ones(maximum_attempts_allowed, dtype=np.int64)
+        long_enough = np.flatnonzero(spare_length >= 0)
+        if len(long_enough) > 0:
+            (ref_starts[long_enough], ref_ends[long_enough], slips[long_enough],
+             max_dwells[long_enough]) = self._map_chunks(
+                 read_numbers[long_enough], starts[long_enough], chunk_len)
+        seqlens = ref_ends - ref_starts
+
+        # Reasons for rejection, in the order they are checked by chunk_filter
+        status = np.full(maximum_attempts_allowed, 'pass', dtype=object)
+        rejected = np.zeros(maximum_attempts_allowed, dtype=bool)
+        tests = [('tooshort', spare_length < 0),
+                 ('emptysequence', seqlens == 0),
+                 ('slip', slips)]
+        if filter_parameters is not None:
+            median_meandwell, mad_meandwell = filter_parameters
+            mean_dwells = chunk_len / (seqlens + TINY)
+            tests += [('meandwell', np.abs(mean_dwells - median_meandwell) >
+                       args.filter_mean_dwell * mad_meandwell),
+                      ('maxdwell', max_dwells > args.filter_max_dwell * median_meandwell)]
+        for reason, fails in tests:
+            status[fails & ~rejected] = reason
+            rejected |= fails
+
+        # Stop after batch_size chunks have passed
+        passed = np.flatnonzero(~rejected)[:batch_size]
+        if len(passed) == batch_size:
+            attempts = passed[-1] + 1
+        else:
+            attempts = maximum_attempts_allowed
+        count_dict = defaultdict(lambda: 0)
+        for reason, count in zip(*np.unique(status[:attempts], return_counts=True)):
+            count_dict[reason] = count
+
+        # Fill buffers for signal and sequence of accepted chunks
+        current = np.empty((chunk_len, len(passed)), dtype=np.float32)
+        for j, n in enumerate(passed):
+            current[:, j] = self.read_data[read_numbers[n]]._get_slice(
+                'Dacs', starts[n], starts[n] + chunk_len)
+        offset, range_over_digitisation, shift, scale = self.scalings[read_numbers[passed]].T
+        current += offset.astype(np.float32)
+        current *= (range_over_digitisation / scale).astype(np.float32)
+        current -= (shift / scale).astype(np.float32)
+
+        seq_ends = np.cumsum(seqlens[passed])
+        seq_starts = seq_ends - seqlens[passed]
+        sequence = np.concatenate([np.zeros(0, dtype=np.int16)] + [
+            self.read_data[read_numbers[n]]._get_slice('Reference', ref_starts[n], ref_ends[n])
+            for n in passed])
+
+        chunklist = []
+        for j, n in enumerate(passed):
+            chunkdict = {'current': current[:, j],
+                         'sequence': sequence[seq_starts[j]:seq_ends[j]],
+                         'max_dwell': max_dwells[n],
+                         'start_sample': starts[n]}
+            read = self.read_data[read_numbers[n]]
+            if 'read_id' in read:
+                chunkdict['read_id'] = read['read_id']
+            chunklist.append(chunkdict)
+
+        if chunk_log is not None:
+            for n in range(attempts):
+                if status[n] == 'pass' and not log_accepted_chunks:
+                    continue
+                read = self.read_data[read_numbers[n]]
+                chunkdict = {'read_id': read.get('read_id')}
+                if status[n] != 'tooshort':
+                    chunkdict.update(start_sample=starts[n], current_length=chunk_len,
+                                     sequence_length=seqlens[n], max_dwell=max_dwells[n])
+                chunk_log.write_chunk(-1, chunkdict, status[n])
+
+        if len(passed) < batch_size and log is not None:
+            log.write('* Warning: only {} chunks passed tests after {} attempts.\n'.format(
+                len(passed), attempts))
+            log.write('* Summary:')
+            for k, v in count_dict.items():
+                log.write(' {}:{}'.format(k, v))
+            log.write('\n')
+
+        return chunklist, count_dict, current, sequence
+
+
 class ChunkLog:
     """Handles saving of chunk metadata to file"""
 
@@ -209,6 +473,8 @@ class ChunkLog:
             for k in ['current', 'sequence']:
                 if k in chunk_dict:
                     self.dumpfile.write('{}\t'.format(len(chunk_dict[k])))
+                elif k + '_length' in chunk_dict:
+                    self.dumpfile.write('{}\t'.format(chunk_dict[k + '_length']))
                 else:
                     self.dumpfile.write('-1\t')
             if 'max_dwell' in chunk_dict:
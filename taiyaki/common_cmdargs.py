@@ -3,7 +3,7 @@
 from taiyaki.cmdargs import (AutoBool, DeviceAction, FileAbsent, FileExists,
                              Maybe, NonNegative, ParseToNamedTuple, Positive,
                              display_version_and_exit)
-from taiyaki.constants import DEFAULT_ALPHABET
+from taiyaki.constants import DEFAULT_ALPHABET, READ_BATCH_SIZE
 from taiyaki import __version__
 
 
@@ -85,6 +85,17 @@ def add_common_command_args(parser, arglist):
         parser.add_argument('--quiet', default=False, action=AutoBool,
                             help="Don't print progress information to stdout")
 
+    if 'read_batch_size' in arglist:
+        parser.add_argument('--read_batch_size', default=READ_BATCH_SIZE, metavar='n',
+                            type=Positive(int),
+                            help='Maximum number of reads from the same fast5 file ' +
+                            'handled by a worker at once')
+
+    if 'read_index' in arglist:
+        parser.add_argument('--read_index', default=None, metavar='filename',
+                            help='Index of reads in fast5 files, created or updated ' +
+                            'as necessary and reused by later runs')
+
     if 'recursive' in arglist:
         parser.add_argument('--recursive', default=True, action=AutoBool,
                             help='Search for fast5s recursively within ' +
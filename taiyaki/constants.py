@@ -3,6 +3,8 @@ DEFAULT_NBASE = len(DEFAULT_ALPHABET)
 
 DOTROWLENGTH=50   #Length of a row of dots (polka) in training output
 
+READ_BATCH_SIZE = 50  # Maximum number of reads from a fast5 file given to a worker at once
+
 SMALL_VAL = 1e-10
 LARGE_VAL = 1e30
 LARGE_LOG_VAL = 50000.0
@@ -22,6 +22,16 @@ static inline size_t nstate_to_nbase(size_t ntrans_state){
     return (size_t) round(nbase_d);
 }
 
+static inline size_t max_seqlen(int32_t const * seqlen, size_t nbatch){
+    size_t maxlen = 0;
+    for(size_t batch=0 ; batch < nbatch ; batch++){
+        if((size_t)seqlen[batch] > maxlen){
+            maxlen = seqlen[batch];
+        }
+    }
+    return maxlen;
+}
+
 
 /*
 ******************************
@@ -117,6 +127,46 @@ float cm_flipflop_forward(float const * logprob, size_t nblk, size_t ldp,
 }
 
 
+float cm_flipflop_forward_score(float const * logprob, size_t nblk, size_t ldp,
+                                int32_t const * seq, size_t nseqpos,
+                                float sharpfact, float * work, size_t nbase,
+                                int32_t const * mod_cats,
+                                int32_t const * can_mods_offsets,
+                                float const * mod_cat_weights,
+                                float mod_weight){
+    //  As cm_flipflop_forward but only keeping the latest two rows of the
+    //  forward matrix, in a workspace of 2 * nseqpos floats
+    assert(nseqpos > 0);
+    assert(NULL != logprob);
+    assert(NULL != seq);
+    assert(NULL != work);
+
+    float * fwdprev = work;
+    float * fwdcurr = work + nseqpos;
+
+    //  Point prior  -- must start in stay at beginning of sequence
+    for(size_t pos=0 ; pos < nseqpos ; pos++){
+        fwdprev[pos] = -LARGE_VAL;
+    }
+    fwdprev[0] = 0.0;
+
+    for(size_t blk=0 ; blk < nblk ; blk++){
+        float const * logprobcurr = logprob + blk * ldp;
+
+        cm_flipflop_forward_step(logprobcurr, fwdprev, seq, nseqpos,
+                                 fwdcurr, sharpfact, nbase, mod_cats,
+                                 can_mods_offsets, mod_cat_weights,
+                                 mod_weight);
+        float * tmp = fwdprev;
+        fwdprev = fwdcurr;
+        fwdcurr = tmp;
+    }
+
+    // Final score is sum of final state + its stay
+    return fwdprev[nseqpos - 1];
+}
+
+
 void cm_flipflop_backward_step(float const * logprob, float const * bwdprev,
                                int32_t const * seq, size_t nseqpos,
                                float * bwdcurr, float sharpfact,
@@ -202,6 +252,46 @@ float cm_flipflop_backward(float const * logprob, size_t nblk, size_t ldp,
 }
 
 
+float cm_flipflop_backward_score(float const * logprob, size_t nblk, size_t ldp,
+                                 int32_t const * seq, size_t nseqpos,
+                                 float sharpfact, float * work, size_t nbase,
+                                 int32_t const * mod_cats,
+                                 int32_t const * can_mods_offsets,
+                                 float const * mod_cat_weights,
+                                 float mod_weight){
+    //  As cm_flipflop_backward but only keeping the latest two rows of the
+    //  backward matrix, in a workspace of 2 * nseqpos floats
+    assert(nseqpos > 0);
+    assert(NULL != logprob);
+    assert(NULL != seq);
+    assert(NULL != work);
+
+    float * bwdprev = work;
+    float * bwdcurr = work + nseqpos;
+
+    //  Point prior -- must have ended in either final stay or state
+    for(size_t pos=0 ; pos < nseqpos ; pos++){
+        bwdprev[pos] = -LARGE_VAL;
+    }
+    // Final stay
+    bwdprev[nseqpos - 1] = 0.0;
+
+    for(size_t blk=nblk ; blk > 0 ; blk--){
+        float const * logprobcurr = logprob + (blk - 1) * ldp;
+
+        cm_flipflop_backward_step(logprobcurr, bwdprev, seq, nseqpos,
+                                  bwdcurr, sharpfact, nbase, mod_cats,
+                                  can_mods_offsets, mod_cat_weights,
+                                  mod_weight);
+        float * tmp = bwdprev;
+        bwdprev = bwdcurr;
+        bwdcurr = tmp;
+    }
+
+    return bwdprev[0];
+}
+
+
 void cat_mod_flipflop_cost(float const * logprob, size_t nstate, size_t nblk,
                            size_t nbatch, int32_t const * seqs,
                            int32_t const * seqlen, int32_t const * mod_cats,
@@ -217,23 +307,31 @@ void cat_mod_flipflop_cost(float const * logprob, size_t nstate, size_t nblk,
         seqidx[idx] = seqidx[idx - 1] + seqlen[idx - 1];
     }
 
-#pragma omp parallel for
-    for(size_t batch=0 ; batch < nbatch ; batch++){
-         if(0 == seqlen[batch]){
-             score[batch] = 0.0;
-             continue;
-         }
-
-        const size_t batch_offset = batch * nstate;
-        float * fwd = calloc((1 + nblk) * seqlen[batch], sizeof(float));
-        score[batch] =
-            cm_flipflop_forward(logprob + batch_offset, nblk, ldp,
-                                seqs + seqidx[batch], seqlen[batch],
-                                sharpfact, fwd, nbase,
-                                mod_cats + seqidx[batch],
-                                can_mods_offsets, mod_cat_weights,
-                                mod_weight);
-        free(fwd);
+#pragma omp parallel
+    {
+        //  Workspace for each thread, reused for all the sequences it scores
+        float * work = malloc(2 * max_seqlen(seqlen, nbatch) * sizeof(float));
+#pragma omp for
+        for(size_t batch=0 ; batch < nbatch ; batch++){
+            if(0 == seqlen[batch]){
+                score[batch] = 0.0;
+                continue;
+            }
+            if(NULL == work){
+                score[batch] = NAN;
+                continue;
+            }
+
+            const size_t batch_offset = batch * nstate;
+            score[batch] =
+                cm_flipflop_forward_score(logprob + batch_offset, nblk, ldp,
+                                          seqs + seqidx[batch], seqlen[batch],
+                                          sharpfact, work, nbase,
+                                          mod_cats + seqidx[batch],
+                                          can_mods_offsets, mod_cat_weights,
+                                          mod_weight);
+        }
+        free(work);
     }
 }
 
@@ -264,21 +362,30 @@ void cm_flipflop_scores_bwd(float const * logprob, size_t nstate,
         seqidx[idx] = seqidx[idx - 1] + seqlen[idx - 1];
     }
 
-#pragma omp parallel for
-    for(size_t batch=0 ; batch < nbatch ; batch++){
-         if(0 == seqlen[batch]){
-             score[batch] = 0.0;
-             continue;
-         }
-        const size_t offset = batch * nstate;
-        float * bwd = calloc((1 + nblk) * seqlen[batch], sizeof(float));
-        score[batch] =
-          cm_flipflop_backward(logprob + offset, nblk, ldp,
-                               seqs + seqidx[batch], seqlen[batch],
-                               sharpfact, bwd, nbase,
-                               mod_cats + seqidx[batch], can_mods_offsets,
-                               mod_cat_weights, mod_weight);
-        free(bwd);
+#pragma omp parallel
+    {
+        //  Workspace for each thread, reused for all the sequences it scores
+        float * work = malloc(2 * max_seqlen(seqlen, nbatch) * sizeof(float));
+#pragma omp for
+        for(size_t batch=0 ; batch < nbatch ; batch++){
+            if(0 == seqlen[batch]){
+                score[batch] = 0.0;
+                continue;
+            }
+            if(NULL == work){
+                score[batch] = NAN;
+                continue;
+            }
+
+            const size_t offset = batch * nstate;
+            score[batch] =
+              cm_flipflop_backward_score(logprob + offset, nblk, ldp,
+                                         seqs + seqidx[batch], seqlen[batch],
+                                         sharpfact, work, nbase,
+                                         mod_cats + seqidx[batch], can_mods_offsets,
+                                         mod_cat_weights, mod_weight);
+        }
+        free(work);
     }
 }
 
@@ -341,7 +448,7 @@ void cat_mod_flipflop_grad(float const * logprob, size_t nstate, size_t nblk,
                            int32_t const * seqlen, int32_t const * mod_cats,
                            int32_t const * can_mods_offsets,
                            float const * mod_cat_weights, float mod_weight,
-                           float sharpfact, float * grad){
+                           float sharpfact, float * score, float * grad){
     const size_t ldp = nbatch * nstate;
     const size_t nbase = nstate_to_nbase(nstate - can_mods_offsets[4]);
     size_t seqidx[nbatch];
@@ -350,50 +457,81 @@ void cat_mod_flipflop_grad(float const * logprob, size_t nstate, size_t nblk,
         seqidx[idx] = seqidx[idx - 1] + seqlen[idx - 1];
     }
 
-#pragma omp parallel for
-    for(size_t batch=0 ; batch < nbatch ; batch++){
-        const size_t batch_offset = batch * nstate;
-        if(0 == seqlen[batch]){
-            for(size_t blk=0 ; blk < nblk ; blk++){
-                memset(grad + batch_offset + blk * ldp, 0,
-                       nstate * sizeof(float));
+#pragma omp parallel
+    {
+        //  Workspace for each thread, reused for all the sequences it
+        //  handles: the forward matrix plus two rows of the backward matrix
+        const size_t maxlen = max_seqlen(seqlen, nbatch);
+        float * work = malloc((nblk + 3) * maxlen * sizeof(float));
+#pragma omp for
+        for(size_t batch=0 ; batch < nbatch ; batch++){
+            const size_t batch_offset = batch * nstate;
+            if(0 == seqlen[batch]){
+                score[batch] = 0.0;
+                for(size_t blk=0 ; blk < nblk ; blk++){
+                    memset(grad + batch_offset + blk * ldp, 0,
+                           nstate * sizeof(float));
+                }
+                continue;
             }
-            continue;
-        }
-        const int32_t nseqpos = seqlen[batch];
-        int32_t const * seq = seqs + seqidx[batch];
-        int32_t const * mod_cat = mod_cats + seqidx[batch];
-        float * fwd = calloc((nblk + 1) * nseqpos, sizeof(float));
-        float * bwd = calloc((nblk + 1) * nseqpos, sizeof(float));
-        cm_flipflop_forward(logprob + batch_offset, nblk, ldp, seq,
-                            nseqpos, sharpfact, fwd, nbase, mod_cat,
-                            can_mods_offsets, mod_cat_weights, mod_weight);
-        cm_flipflop_backward(logprob + batch_offset, nblk, ldp, seq,
-                             nseqpos, sharpfact, bwd, nbase, mod_cat,
-                             can_mods_offsets, mod_cat_weights, mod_weight);
-
-        // Normalised transition matrix
-        for(size_t blk=0 ; blk < nblk ; blk++){
-            float const * fwdcurr = fwd + blk * nseqpos;
-            float const * bwdcurr = bwd + blk * nseqpos;
-            float const * bwdnext = bwd + blk * nseqpos + nseqpos;
-            float const * logprobcurr = logprob + batch_offset + blk * ldp;
-            float * gradcurr = grad + batch_offset + blk * ldp;
-
-            //  Recalculate close to position to reduce numerical error
-            float fact = fwdcurr[0] + bwdcurr[0];
-            for(size_t pos=1; pos < nseqpos ; pos++){
-                fact = logsumexpf(fact, fwdcurr[pos] + bwdcurr[pos], sharpfact);
+            if(NULL == work){
+                //  Propagate memory error
+                score[batch] = NAN;
+                for(size_t blk=0 ; blk < nblk ; blk++){
+                    for(size_t st=0 ; st < nstate ; st++){
+                        grad[batch_offset + blk * ldp + st] = NAN;
+                    }
+                }
+                continue;
+            }
+            const int32_t nseqpos = seqlen[batch];
+            int32_t const * seq = seqs + seqidx[batch];
+            int32_t const * mod_cat = mod_cats + seqidx[batch];
+            float * fwd = work;
+            float * bwdcurr = work + (nblk + 1) * nseqpos;
+            float * bwdnext = bwdcurr + nseqpos;
+            score[batch] =
+                cm_flipflop_forward(logprob + batch_offset, nblk, ldp, seq,
+                                    nseqpos, sharpfact, fwd, nbase, mod_cat,
+                                    can_mods_offsets, mod_cat_weights,
+                                    mod_weight);
+
+            //  The backward matrix is not stored: each row is calculated
+            //  from the following one while the gradient is accumulated.
+            //  Point prior -- must have ended in either final stay or state
+            for(size_t pos=0 ; pos < nseqpos ; pos++){
+                bwdnext[pos] = -LARGE_VAL;
             }
+            bwdnext[nseqpos - 1] = 0.0;
+
+            // Normalised transition matrix
+            for(size_t blk=nblk ; blk > 0 ; blk--){
+                float const * fwdcurr = fwd + (blk - 1) * nseqpos;
+                float const * logprobcurr = logprob + batch_offset + (blk - 1) * ldp;
+                float * gradcurr = grad + batch_offset + (blk - 1) * ldp;
+
+                cm_flipflop_backward_step(logprobcurr, bwdnext, seq, nseqpos,
+                                          bwdcurr, sharpfact, nbase, mod_cat,
+                                          can_mods_offsets, mod_cat_weights,
+                                          mod_weight);
+
+                //  Recalculate close to position to reduce numerical error
+                float fact = fwdcurr[0] + bwdcurr[0];
+                for(size_t pos=1; pos < nseqpos ; pos++){
+                    fact = logsumexpf(fact, fwdcurr[pos] + bwdcurr[pos], sharpfact);
+                }
+
+                cm_flipflop_grad_step(fwdcurr, bwdnext, logprobcurr, seq, nseqpos,
+                                      mod_cat, can_mods_offsets, mod_cat_weights,
+                                      mod_weight, gradcurr, nstate, fact,
+                                      sharpfact);
 
-            cm_flipflop_grad_step(fwdcurr, bwdnext, logprobcurr, seq, nseqpos,
-                                  mod_cat, can_mods_offsets, mod_cat_weights,
-                                  mod_weight, gradcurr, nstate, fact,
-                                  sharpfact);
+                float * tmp = bwdnext;
+                bwdnext = bwdcurr;
+                bwdcurr = tmp;
+            }
         }
-
-        free(bwd);
-        free(fwd);
+        free(work);
     }
 }
 
@@ -533,6 +671,7 @@ int main(int argc, char * argv[]){
     const size_t nstate = 45;
     const size_t nbatch = 2;
     float score[2] = {0.0f};
+    float score2[2] = {0.0f};
     const float DELTA = 1e-2f;
     const float sharpfact = (argc > 1) ? atof(argv[1]) : 1.0f;
     const size_t msize = nblk * nstate * nbatch;
@@ -560,7 +699,7 @@ int main(int argc, char * argv[]){
     cat_mod_flipflop_grad(test_logprob1, nstate, nblk, nbatch, test_seq1,
                           test_seqlen1, test_mod1, test_can_mod_offsets,
                           test_mod_cat_weights, test_mod_weight,
-                          sharpfact, grad);
+                          sharpfact, score2, grad);
     float maxdelta = 0.0;
     for(size_t blk=0 ; blk < nblk ; blk++){
         const size_t offset = blk * nbatch * nstate;
@@ -19,6 +19,16 @@ static inline size_t nstate_to_nbase(size_t ntrans_state){
     return (size_t) round(nbase_d);
 }
 
+static inline size_t max_seqlen(int32_t const * seqlen, size_t nbatch){
+    size_t maxlen = 0;
+    for(size_t batch=0 ; batch < nbatch ; batch++){
+        if((size_t)seqlen[batch] > maxlen){
+            maxlen = seqlen[batch];
+        }
+    }
+    return maxlen;
+}
+
 
 /*
 ******************************
@@ -94,6 +104,40 @@ float crf_flipflop_forward(float const * logprob, size_t nblk, size_t ldp,
 }
 
 
+float crf_flipflop_forward_score(float const * logprob, size_t nblk, size_t ldp,
+                                 int32_t const * seq, size_t nseqpos,
+                                 float sharpfact, float * work, size_t nbase){
+    //  As crf_flipflop_forward but only keeping the latest two rows of the
+    //  forward matrix, in a workspace of 2 * nseqpos floats
+    assert(nseqpos > 0);
+    assert(NULL != logprob);
+    assert(NULL != seq);
+    assert(NULL != work);
+
+    float * fwdprev = work;
+    float * fwdcurr = work + nseqpos;
+
+    //  Point prior  -- must start in stay at beginning of sequence
+    for(size_t pos=0 ; pos < nseqpos ; pos++){
+        fwdprev[pos] = -LARGE_VAL;
+    }
+    fwdprev[0] = 0.0;
+
+    for(size_t blk=0 ; blk < nblk ; blk++){
+        float const * logprobcurr = logprob + blk * ldp;
+
+        crf_flipflop_forward_step(logprobcurr, fwdprev, seq, nseqpos,
+                                  fwdcurr, sharpfact, nbase);
+        float * tmp = fwdprev;
+        fwdprev = fwdcurr;
+        fwdcurr = tmp;
+    }
+
+    // Final score is sum of final state + its stay
+    return fwdprev[nseqpos - 1];
+}
+
+
 void crf_flipflop_backward_step(float const * logprob, float const * bwdprev,
                                 int32_t const * seq, size_t nseqpos,
                                 float * bwdcurr, float sharpfact,
@@ -159,6 +203,40 @@ float crf_flipflop_backward(float const * logprob, size_t nblk, size_t ldp,
 }
 
 
+float crf_flipflop_backward_score(float const * logprob, size_t nblk, size_t ldp,
+                                  int32_t const * seq, size_t nseqpos,
+                                  float sharpfact, float * work, size_t nbase){
+    //  As crf_flipflop_backward but only keeping the latest two rows of the
+    //  backward matrix, in a workspace of 2 * nseqpos floats
+    assert(nseqpos > 0);
+    assert(NULL != logprob);
+    assert(NULL != seq);
+    assert(NULL != work);
+
+    float * bwdprev = work;
+    float * bwdcurr = work + nseqpos;
+
+    //  Point prior -- must have ended in either final stay or state
+    for(size_t pos=0 ; pos < nseqpos ; pos++){
+        bwdprev[pos] = -LARGE_VAL;
+    }
+    // Final stay
+    bwdprev[nseqpos - 1] = 0.0;
+
+    for(size_t blk=nblk ; blk > 0 ; blk--){
+        float const * logprobcurr = logprob + (blk - 1) * ldp;
+
+        crf_flipflop_backward_step(logprobcurr, bwdprev, seq, nseqpos,
+                                   bwdcurr, sharpfact, nbase);
+        float * tmp = bwdprev;
+        bwdprev = bwdcurr;
+        bwdcurr = tmp;
+    }
+
+    return bwdprev[0];
+}
+
+
 void crf_flipflop_cost(float const * logprob, size_t ntrans_state, size_t nblk,
                        size_t nbatch, int32_t const * seqs,
                        int32_t const * seqlen, float sharpfact, float * score){
@@ -170,25 +248,28 @@ void crf_flipflop_cost(float const * logprob, size_t ntrans_state, size_t nblk,
         seqidx[idx] = seqidx[idx - 1] + seqlen[idx - 1];
     }
 
-#pragma omp parallel for
-    for(size_t batch=0 ; batch < nbatch ; batch++){
-         if(0 == seqlen[batch]){
-             score[batch] = 0.0;
-             continue;
-         }
-
-        const size_t batch_offset = batch * ntrans_state;
-        float * fwd = calloc((1 + nblk) * seqlen[batch], sizeof(float));
-        if(NULL == fwd){
-            free(fwd);
-            score[batch] = NAN;
-            continue;
+#pragma omp parallel
+    {
+        //  Workspace for each thread, reused for all the sequences it scores
+        float * work = malloc(2 * max_seqlen(seqlen, nbatch) * sizeof(float));
+#pragma omp for
+        for(size_t batch=0 ; batch < nbatch ; batch++){
+            if(0 == seqlen[batch]){
+                score[batch] = 0.0;
+                continue;
+            }
+            if(NULL == work){
+                score[batch] = NAN;
+                continue;
+            }
+
+            const size_t batch_offset = batch * ntrans_state;
+            score[batch] =
+              crf_flipflop_forward_score(logprob + batch_offset, nblk, ldp,
+                                         seqs + seqidx[batch], seqlen[batch],
+                                         sharpfact, work, nbase);
         }
-        score[batch] =
-          crf_flipflop_forward(logprob + batch_offset, nblk, ldp,
-                               seqs + seqidx[batch], seqlen[batch],
-                               sharpfact, fwd, nbase);
-        free(fwd);
+        free(work);
     }
 }
 
@@ -214,24 +295,28 @@ void crf_flipflop_scores_bwd(float const * logprob, size_t ntrans_state,
         seqidx[idx] = seqidx[idx - 1] + seqlen[idx - 1];
     }
 
-#pragma omp parallel for
-    for(size_t batch=0 ; batch < nbatch ; batch++){
-         if(0 == seqlen[batch]){
-             score[batch] = 0.0;
-             continue;
-         }
-        const size_t offset = batch * ntrans_state;
-        float * bwd = calloc((1 + nblk) * seqlen[batch], sizeof(float));
-        if(NULL == bwd){
-            free(bwd);
-            score[batch] = NAN;
-            continue;
+#pragma omp parallel
+    {
+        //  Workspace for each thread, reused for all the sequences it scores
+        float * work = malloc(2 * max_seqlen(seqlen, nbatch) * sizeof(float));
+#pragma omp for
+        for(size_t batch=0 ; batch < nbatch ; batch++){
+            if(0 == seqlen[batch]){
+                score[batch] = 0.0;
+                continue;
+            }
+            if(NULL == work){
+                score[batch] = NAN;
+                continue;
+            }
+
+            const size_t offset = batch * ntrans_state;
+            score[batch] =
+              crf_flipflop_backward_score(logprob + offset, nblk, ldp,
+                                          seqs + seqidx[batch], seqlen[batch],
+                                          sharpfact, work, nbase);
         }
-        score[batch] =
-          crf_flipflop_backward(logprob + offset, nblk, ldp,
-                                seqs + seqidx[batch], seqlen[batch],
-                                sharpfact, bwd, nbase);
-        free(bwd);
+        free(work);
     }
 }
 
@@ -282,54 +367,74 @@ void crf_flipflop_grad(float const * logprob, size_t ntrans_state, size_t nblk,
         seqidx[idx] = seqidx[idx - 1] + seqlen[idx - 1];
     }
 
-#pragma omp parallel for
-    for(size_t batch=0 ; batch < nbatch ; batch++){
-        const size_t batch_offset = batch * ntrans_state;
-        if(0 == seqlen[batch]){
-            for(size_t blk=0 ; blk < nblk ; blk++){
-                memset(grad + batch_offset + blk * ldp, 0,
-                       ntrans_state * sizeof(float));
+#pragma omp parallel
+    {
+        //  Workspace for each thread, reused for all the sequences it
+        //  handles: the forward matrix plus two rows of the backward matrix
+        const size_t maxlen = max_seqlen(seqlen, nbatch);
+        float * work = malloc((nblk + 3) * maxlen * sizeof(float));
+#pragma omp for
+        for(size_t batch=0 ; batch < nbatch ; batch++){
+            const size_t batch_offset = batch * ntrans_state;
+            if(0 == seqlen[batch]){
+                score[batch] = 0.0;
+                for(size_t blk=0 ; blk < nblk ; blk++){
+                    memset(grad + batch_offset + blk * ldp, 0,
+                           ntrans_state * sizeof(float));
+                }
+                continue;
             }
-            continue;
-        }
-        const size_t nseqpos = seqlen[batch];
-        int32_t const * seq = seqs + seqidx[batch];
-        float * fwd = calloc((nblk + 1) * nseqpos, sizeof(float));
-        float * bwd = calloc((nblk + 1) * nseqpos, sizeof(float));
-        if(NULL == fwd || NULL == bwd){
-            free(fwd);
-            free(bwd);
-            // TODO set grad values to NAN in order to propogate memory error
-            continue;
-        }
-        score[batch] =
-            crf_flipflop_forward(logprob + batch_offset, nblk, ldp, seq,
-                                 nseqpos, sharpfact, fwd, nbase);
-        // TODO compute backwards while computing gradient to reduce memory
-        // footprint
-        crf_flipflop_backward(logprob + batch_offset, nblk, ldp, seq,
-                              nseqpos, sharpfact, bwd, nbase);
-
-        // Normalised transition matrix
-        for(size_t blk=0 ; blk < nblk ; blk++){
-            float const * fwdcurr = fwd + blk * nseqpos;
-            float const * bwdcurr = bwd + blk * nseqpos;
-            float const * bwdnext = bwd + blk * nseqpos + nseqpos;
-            float const * logprobcurr = logprob + batch_offset + blk * ldp;
-            float * gradcurr = grad + batch_offset + blk * ldp;
-
-            //  Recalculate close to position to reduce numerical error
-            float fact = fwdcurr[0] + bwdcurr[0];
-            for(size_t pos=1; pos < nseqpos ; pos++){
-                fact = logsumexpf(fact, fwdcurr[pos] + bwdcurr[pos], sharpfact);
+            if(NULL == work){
+                //  Propagate memory error
+                score[batch] = NAN;
+                for(size_t blk=0 ; blk < nblk ; blk++){
+                    for(size_t st=0 ; st < ntrans_state ; st++){
+                        grad[batch_offset + blk * ldp + st] = NAN;
+                    }
+                }
+                continue;
             }
+            const size_t nseqpos = seqlen[batch];
+            int32_t const * seq = seqs + seqidx[batch];
+            float * fwd = work;
+            float * bwdcurr = work + (nblk + 1) * nseqpos;
+            float * bwdnext = bwdcurr + nseqpos;
+            score[batch] =
+                crf_flipflop_forward(logprob + batch_offset, nblk, ldp, seq,
+                                     nseqpos, sharpfact, fwd, nbase);
+
+            //  The backward matrix is not stored: each row is calculated
+            //  from the following one while the gradient is accumulated.
+            //  Point prior -- must have ended in either final stay or state
+            for(size_t pos=0 ; pos < nseqpos ; pos++){
+                bwdnext[pos] = -LARGE_VAL;
+            }
+            bwdnext[nseqpos - 1] = 0.0;
 
-            crf_flipflop_grad_step(fwdcurr, bwdnext, logprobcurr, seq, nseqpos,
-                                   gradcurr, ntrans_state, fact, sharpfact);
-        }
+            // Normalised transition matrix
+            for(size_t blk=nblk ; blk > 0 ; blk--){
+                float const * fwdcurr = fwd + (blk - 1) * nseqpos;
+                float const * logprobcurr = logprob + batch_offset + (blk - 1) * ldp;
+                float * gradcurr = grad + batch_offset + (blk - 1) * ldp;
+
+                crf_flipflop_backward_step(logprobcurr, bwdnext, seq, nseqpos,
+                                           bwdcurr, sharpfact, nbase);
+
+                //  Recalculate close to position to reduce numerical error
+                float fact = fwdcurr[0] + bwdcurr[0];
+                for(size_t pos=1; pos < nseqpos ; pos++){
+                    fact = logsumexpf(fact, fwdcurr[pos] + bwdcurr[pos], sharpfact);
+                }
 
-        free(bwd);
-        free(fwd);
+                crf_flipflop_grad_step(fwdcurr, bwdnext, logprobcurr, seq, nseqpos,
+                                       gradcurr, ntrans_state, fact, sharpfact);
+
+                float * tmp = bwdnext;
+                bwdnext = bwdcurr;
+                bwdcurr = tmp;
+            }
+        }
+        free(work);
     }
 }
 
@@ -5,6 +5,8 @@ cimport numpy as np
 
 import torch
 
+from taiyaki.tensor_bridge import cpu_array, output_tensor
+
 
 def nstate_to_nbase(size_t nstate):
     """Convert number of flip-flop states to number of bases and check for valid states number.
@@ -17,6 +19,12 @@ def nstate_to_nbase(size_t nstate):
     return nbase
 
 
+#  Inputs may be torch tensors or numpy arrays.  They are passed to the C
+#  functions without copying if already contiguous on the CPU and of the
+#  right type, and the C functions run without holding the GIL so losses
+#  can be calculated concurrently from several threads.  Costs and gradients
+#  are returned as CPU tensors.
+
 ##########################################
 ###### Standard flip-flop functions ######
 ##########################################
@@ -24,64 +32,75 @@ def nstate_to_nbase(size_t nstate):
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def crf_flipflop_cost(np.ndarray[np.float32_t, ndim=3, mode="c"] logprob,
-                      np.ndarray[np.int32_t, ndim=1, mode="c"] seqs,
-                      np.ndarray[np.int32_t, ndim=1, mode="c"] seqlen,
-                      sharpfact):
+def crf_flipflop_cost(logprob, seqs, seqlen, sharpfact):
     """
     :param logprob: Tensor containing log probabilities
     :param seqs: Vector containing flip-flop coded sequences (see flipflopfings.flipflop_code()), concatenated
     :param seqlen: Length of each sequence
     """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] lp = cpu_array(logprob)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] seqs_arr = cpu_array(seqs, np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] seqlen_arr = cpu_array(seqlen, np.int32)
     cdef size_t nblk, nbatch, nstate
-    nblk, nbatch, nstate = logprob.shape[0], logprob.shape[1], logprob.shape[2]
+    nblk, nbatch, nstate = lp.shape[0], lp.shape[1], lp.shape[2]
     # conversion checks that nstates converts to a valid number of bases
     nstate_to_nbase(nstate)
 
-    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs = np.zeros(
-        (nbatch,), dtype=np.float32)
-    libctc.crf_flipflop_cost(&logprob[0, 0, 0], nstate, nblk, nbatch, &seqs[0],
-                             &seqlen[0], sharpfact, &costs[0])
-    assert np.all(costs <= 0.), (
-        "Error: costs must be negative, got {}").format(costs)
-    return -costs / nblk
+    costs, costs_t = output_tensor((nbatch,))
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs_arr = costs_t
+    cdef float sf = float(sharpfact)
+    with nogil:
+        libctc.crf_flipflop_cost(&lp[0, 0, 0], nstate, nblk, nbatch,
+                                 &seqs_arr[0], &seqlen_arr[0], sf, &costs_arr[0])
+    assert np.all(costs_arr <= 0.), (
+        "Error: costs must be negative, got {}").format(costs_arr)
+    np.divide(costs_arr, -float(nblk), out=costs_arr)
+    return costs
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def crf_flipflop_grad(np.ndarray[np.float32_t, ndim=3, mode="c"] logprob,
-                      np.ndarray[np.int32_t, ndim=1, mode="c"] seqs,
-                      np.ndarray[np.int32_t, ndim=1, mode="c"] seqlen,
-                      sharpfact):
-    """
+def crf_flipflop_grad(logprob, seqs, seqlen, sharpfact, costs=None, grads=None):
+    """Cost and its gradient, calculated together in a single pass
+
     :param logprob: Tensor containing log probabilities
     :param seqs: Vector containing flip-flop coded sequences (see flipflopfings.flipflop_code()), concatenated
     :param seqlen: Length of each sequence
+    :param costs: contiguous CPU float32 tensor to write costs into, or None
+    :param grads: contiguous CPU float32 tensor, the same shape as logprob,
+        to write gradients into, or None
+
+    :returns: tuple (costs, grads) as for crf_flipflop_cost, and gradient of
+        costs with respect to logprob
     """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] lp = cpu_array(logprob)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] seqs_arr = cpu_array(seqs, np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] seqlen_arr = cpu_array(seqlen, np.int32)
     cdef size_t nblk, nbatch, nstate
-    nblk, nbatch, nstate = logprob.shape[0], logprob.shape[1], logprob.shape[2]
+    nblk, nbatch, nstate = lp.shape[0], lp.shape[1], lp.shape[2]
     # conversion checks that nstates converts to a valid number of bases
     nstate_to_nbase(nstate)
 
-    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs = np.zeros(
-        (nbatch,), dtype=np.float32)
-    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] grads = np.zeros_like(
-        logprob, dtype=np.float32)
-    libctc.crf_flipflop_grad(&logprob[0, 0, 0], nstate, nblk, nbatch, &seqs[0],
-                             &seqlen[0], sharpfact, &costs[0], &grads[0, 0, 0])
-    return -costs / nblk, -grads / nblk
+    costs, costs_t = output_tensor((nbatch,), out=costs)
+    grads, grads_t = output_tensor((nblk, nbatch, nstate), out=grads)
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs_arr = costs_t
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] grads_arr = grads_t
+    cdef float sf = float(sharpfact)
+    with nogil:
+        libctc.crf_flipflop_grad(&lp[0, 0, 0], nstate, nblk, nbatch,
+                                 &seqs_arr[0], &seqlen_arr[0], sf,
+                                 &costs_arr[0], &grads_arr[0, 0, 0])
+    np.divide(costs_arr, -float(nblk), out=costs_arr)
+    np.divide(grads_arr, -float(nblk), out=grads_arr)
+    return costs, grads
 
 
 class FlipFlopCRF(torch.autograd.Function):
     @staticmethod
     def forward(ctx, logprob, seqs, seqlen, sharpfact):
-        lp = logprob.detach().cpu().numpy().astype(np.float32)
-        seqs = seqs.cpu().numpy().astype(np.int32)
-        seqlen = seqlen.cpu().numpy().astype(np.int32)
-        sharpfact = float(sharpfact)
-        cost, grads = crf_flipflop_grad(lp, seqs, seqlen, sharpfact)
-        ctx.save_for_backward(torch.tensor(grads, device=logprob.device))
-        return torch.tensor(cost, device=logprob.device)
+        cost, grads = crf_flipflop_grad(logprob, seqs, seqlen, sharpfact)
+        ctx.save_for_backward(grads.to(logprob.device))
+        return cost.to(logprob.device)
 
     @staticmethod
     def backward(ctx, output_grads):
@@ -98,103 +117,141 @@ crf_flipflop_loss = FlipFlopCRF.apply
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def cat_mod_flipflop_cost(
-        np.ndarray[np.float32_t, ndim=3, mode="c"] logprob,
-        np.ndarray[np.int32_t, ndim=1, mode="c"] seqs,
-        np.ndarray[np.int32_t, ndim=1, mode="c"] seqlen,
-        np.ndarray[np.int32_t, ndim=1, mode="c"] mod_cats,
-        np.ndarray[np.int32_t, ndim=1, mode="c"] can_mods_offsets,
-        np.ndarray[np.float32_t, ndim=1, mode="c"] mod_cat_weights,
-        mod_weight, sharpfact):
+def cat_mod_flipflop_cost(logprob, seqs, seqlen, mod_cats, can_mods_offsets,
+                          mod_cat_weights, mod_weight, sharpfact):
     """
     :param logprob: Tensor containing log probabilities
     :param seqs: A vector containing sequences, concatenated
     :param mod_cats: A vector containing mod categories, concatenated
     :param seqlen: Length of each sequence
     """
-    assert np.all(logprob[:,:,-can_mods_offsets[4]:] <= 0), (
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] lp = cpu_array(logprob)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] seqs_arr = cpu_array(seqs, np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] seqlen_arr = cpu_array(seqlen, np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] mod_cats_arr = cpu_array(mod_cats, np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] offsets_arr = cpu_array(
+        can_mods_offsets, np.int32)
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] weights_arr = cpu_array(
+        mod_cat_weights)
+    assert np.all(lp[:,:,-offsets_arr[4]:] <= 0), (
         'Error: Some modified base log probs are positive.')
     cdef size_t nblk, nbatch, nstate
-    nblk, nbatch, nstate = logprob.shape[0], logprob.shape[1], logprob.shape[2]
+    nblk, nbatch, nstate = lp.shape[0], lp.shape[1], lp.shape[2]
     # conversion checks that nstates converts to a valid number of bases
-    nstate_to_nbase(nstate - can_mods_offsets[4])
+    nstate_to_nbase(nstate - offsets_arr[4])
 
-    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs = np.zeros(
-        (nbatch,), dtype=np.float32)
-    libctc.cat_mod_flipflop_cost(
-        &logprob[0, 0, 0], nstate, nblk, nbatch, &seqs[0], &seqlen[0],
-        &mod_cats[0], &can_mods_offsets[0], &mod_cat_weights[0], mod_weight,
-        sharpfact, &costs[0])
-    assert np.all(costs <= 0.), ("Error: costs must be negative, " +
-                                 "got {}").format(costs)
-    return -costs / nblk
+    costs, costs_t = output_tensor((nbatch,))
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs_arr = costs_t
+    cdef float mw = float(mod_weight), sf = float(sharpfact)
+    with nogil:
+        libctc.cat_mod_flipflop_cost(
+            &lp[0, 0, 0], nstate, nblk, nbatch, &seqs_arr[0], &seqlen_arr[0],
+            &mod_cats_arr[0], &offsets_arr[0], &weights_arr[0], mw, sf,
+            &costs_arr[0])
+    assert np.all(costs_arr <= 0.), ("Error: costs must be negative, " +
+                                     "got {}").format(costs_arr)
+    np.divide(costs_arr, -float(nblk), out=costs_arr)
+    return costs
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def cat_mod_flipflop_grad(
-        np.ndarray[np.float32_t, ndim=3, mode="c"] logprob,
-        np.ndarray[np.int32_t, ndim=1, mode="c"] seqs,
-        np.ndarray[np.int32_t, ndim=1, mode="c"] seqlen,
-        np.ndarray[np.int32_t, ndim=1, mode="c"] mod_cats,
-        np.ndarray[np.int32_t, ndim=1, mode="c"] can_mods_offsets,
-        np.ndarray[np.float32_t, ndim=1, mode="c"] mod_cat_weights,
-        mod_weight, sharpfact):
-    """
+def cat_mod_flipflop_grad(logprob, seqs, seqlen, mod_cats, can_mods_offsets,
+                          mod_cat_weights, mod_weight, sharpfact, costs=None,
+                          grads=None):
+    """Cost and its gradient, calculated together in a single pass
+
     :param logprob: Tensor containing log probabilities
     :param seqs: A vector containing sequences, concatenated
     :param mod_cats: A vector containing mod categories, concatenated
     :param seqlen: Length of each sequence
+    :param costs: contiguous CPU float32 tensor to write costs into, or None
+    :param grads: contiguous CPU float32 tensor, the same shape as logprob,
+        to write gradients into, or None
+
+    :returns: tuple (costs, grads) where costs are as returned by
+        cat_mod_flipflop_cost and grads is the gradient of the costs with
+        respect to logprob
     """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] lp = cpu_array(logprob)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] seqs_arr = cpu_array(seqs, np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] seqlen_arr = cpu_array(seqlen, np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] mod_cats_arr = cpu_array(mod_cats, np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] offsets_arr = cpu_array(
+        can_mods_offsets, np.int32)
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] weights_arr = cpu_array(
+        mod_cat_weights)
+    assert np.all(lp[:,:,-offsets_arr[4]:] <= 0), (
+        'Error: Some modified base log probs are positive.')
     cdef size_t nblk, nbatch, nstate
-    nblk, nbatch, nstate = logprob.shape[0], logprob.shape[1], logprob.shape[2]
+    nblk, nbatch, nstate = lp.shape[0], lp.shape[1], lp.shape[2]
     # conversion checks that nstates converts to a valid number of bases
-    nstate_to_nbase(nstate - can_mods_offsets[4])
+    nstate_to_nbase(nstate - offsets_arr[4])
 
-    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] grads = np.zeros_like(
-        logprob, dtype=np.float32)
-    libctc.cat_mod_flipflop_grad(
-        &logprob[0, 0, 0], nstate, nblk, nbatch, &seqs[0], &seqlen[0],
-        &mod_cats[0], &can_mods_offsets[0], &mod_cat_weights[0], mod_weight,
-        sharpfact, &grads[0, 0, 0])
-    return -grads / nblk
+    costs, costs_t = output_tensor((nbatch,), out=costs)
+    grads, grads_t = output_tensor((nblk, nbatch, nstate), out=grads)
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs_arr = costs_t
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] grads_arr = grads_t
+    cdef float mw = float(mod_weight), sf = float(sharpfact)
+    with nogil:
+        libctc.cat_mod_flipflop_grad(
+            &lp[0, 0, 0], nstate, nblk, nbatch, &seqs_arr[0], &seqlen_arr[0],
+            &mod_cats_arr[0], &offsets_arr[0], &weights_arr[0], mw, sf,
+            &costs_arr[0], &grads_arr[0, 0, 0])
+    assert np.all(costs_arr <= 0.), ("Error: costs must be negative, " +
+                                     "got {}").format(costs_arr)
+    np.divide(costs_arr, -float(nblk), out=costs_arr)
+    np.divide(grads_arr, -float(nblk), out=grads_arr)
+    return costs, grads
 
 
 class CatModFlipFlop(torch.autograd.Function):
+    """Pytorch autograd function wrapping cat_mod_flipflop_grad
+
+    The cost and gradient are calculated together in forward and the
+    gradient kept for backward, so the dynamic programming is only done once
+    per call.
+    """
     @staticmethod
     def forward(ctx, logprob, seqs, seqlen, mod_cats, can_mods_offsets,
                 mod_cat_weights, mod_weight, sharpfact):
-        ctx.save_for_backward(
-            logprob, seqs, seqlen, mod_cats, torch.tensor(can_mods_offsets),
-            torch.tensor(mod_cat_weights), mod_weight, torch.tensor(sharpfact))
-        lp = np.ascontiguousarray(
-            logprob.detach().cpu().numpy().astype(np.float32))
-        seqs = seqs.cpu().numpy().astype(np.int32)
-        seqlen = seqlen.cpu().numpy().astype(np.int32)
-        mod_cats = mod_cats.cpu().numpy().astype(np.int32)
-        mod_weight, sharpfact = map(float, (mod_weight, sharpfact))
-        cost = cat_mod_flipflop_cost(
-            lp, seqs, seqlen, mod_cats, can_mods_offsets, mod_cat_weights,
-            mod_weight, sharpfact)
-        return torch.tensor(cost, device=logprob.device)
+        cost, grads = cat_mod_flipflop_grad(
+            logprob, seqs, seqlen, mod_cats, can_mods_offsets,
+            mod_cat_weights, mod_weight, sharpfact)
+        ctx.save_for_backward(grads.to(logprob.device))
+        return cost.to(logprob.device)
 
     @staticmethod
     def backward(ctx, output_grads):
-        (logprob, seqs, seqlen, mod_cats, can_mods_offsets,
-         mod_cat_weights, mod_weight, sharpfact) = ctx.saved_tensors
-        lp = np.ascontiguousarray(
-            logprob.detach().cpu().numpy().astype(np.float32))
-        seqs = seqs.cpu().numpy().astype(np.int32)
-        seqlen = seqlen.cpu().numpy().astype(np.int32)
-        mod_cats = mod_cats.cpu().numpy().astype(np.int32)
-        can_mods_offsets = can_mods_offsets.cpu().numpy().astype(np.int32)
-        mod_cat_weights = mod_cat_weights.cpu().numpy().astype(np.float32)
-        mod_weight, sharpfact = map(float, (mod_weight, sharpfact))
-        grads = cat_mod_flipflop_grad(
-            lp, seqs, seqlen, mod_cats, can_mods_offsets, mod_cat_weights,
-            mod_weight, sharpfact)
+        grads, = ctx.saved_tensors
         output_grads = output_grads.unsqueeze(1)
-        return (torch.tensor(grads, device=logprob.device) * output_grads,
+        return (grads * output_grads,
                 None, None, None, None, None, None, None)
 
-cat_mod_flipflop_loss = CatModFlipFlop.apply
+
+def cat_mod_flipflop_loss(logprob, seqs, seqlen, mod_cats, can_mods_offsets,
+                          mod_cat_weights, mod_weight, sharpfact):
+    """Categorical modification flip-flop loss of each sequence
+
+    When gradients are not required, for example when evaluating a model
+    inside a `torch.no_grad()` block, only the cost is calculated.
+
+    :param logprob: Tensor containing log probabilities
+    :param seqs: Tensor containing sequences, concatenated
+    :param seqlen: Tensor containing length of each sequence
+    :param mod_cats: Tensor containing mod categories, concatenated
+    :param can_mods_offsets: Offset of modified categories of each base
+    :param mod_cat_weights: Weight of each modified category
+    :param mod_weight: Weight of modified base part of loss
+    :param sharpfact: Sharpening factor
+
+    :returns: Tensor containing cost of each sequence
+    """
+    if torch.is_grad_enabled() and logprob.requires_grad:
+        return CatModFlipFlop.apply(logprob, seqs, seqlen, mod_cats,
+                                    can_mods_offsets, mod_cat_weights,
+                                    mod_weight, sharpfact)
+    cost = cat_mod_flipflop_cost(logprob, seqs, seqlen, mod_cats,
+                                 can_mods_offsets, mod_cat_weights,
+                                 mod_weight, sharpfact)
+    return cost.to(logprob.device)
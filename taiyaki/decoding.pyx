@@ -0,0 +1,431 @@
+# CPU implementations of the flip-flop decoding functions in
+# taiyaki.cupy_extensions.flipflop, taking and returning torch tensors of
+# the same shapes, and of the mapping of flip-flop scores to a sequence used
+# by taiyaki.flipflop_remap.  Computation is parallelised using OpenMP.
+cimport libdecoding
+import cython
+from libc.stdint cimport int32_t, int64_t
+from libc.stdlib cimport malloc, free
+import numpy as np
+cimport numpy as np
+
+import torch
+
+from taiyaki import flipflopfings
+from taiyaki.tensor_bridge import cpu_array, output_tensor
+
+
+def _scores_array(scores):
+    """ Contiguous float32 numpy array sharing memory with scores if possible
+    """
+    assert scores.device.type == 'cpu', 'Scores must be on CPU'
+    assert scores.dim() == 3, 'Scores must be a (T, N, S) tensor'
+    return cpu_array(scores)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def flipflop_fwd(scores):
+    """ Normalised forward scores for flip-flop transitions
+
+    :param scores: (T, N, S) tensor of transition scores
+
+    :returns: tuple (fwd, fact) of (T + 1, N, 2 * nbase) normalised forward
+        scores and (T + 1, N, 1) log normalisation factors
+    """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] sc = _scores_array(scores)
+    cdef size_t T, N, S, nbase
+    T, N, S = sc.shape[0], sc.shape[1], sc.shape[2]
+    nbase = flipflopfings.nbase_flipflop(S)
+
+    fwd = torch.zeros((T + 1, N, 2 * nbase), dtype=torch.float32)
+    fact = torch.zeros((T + 1, N, 1), dtype=torch.float32)
+    if N == 0:
+        return fwd, fact
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] fwd_arr = fwd.numpy()
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] fact_arr = fact.numpy()
+    with nogil:
+        libdecoding.flipflop_forward(&sc[0, 0, 0], T, N, nbase,
+                                     &fwd_arr[0, 0, 0], &fact_arr[0, 0, 0])
+    return fwd, fact
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def flipflop_bwd(scores):
+    """ Normalised backward scores for flip-flop transitions
+
+    :param scores: (T, N, S) tensor of transition scores
+
+    :returns: tuple (bwd, fact) of (T + 1, N, 2 * nbase) normalised backward
+        scores and (T + 1, N, 1) log normalisation factors
+    """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] sc = _scores_array(scores)
+    cdef size_t T, N, S, nbase
+    T, N, S = sc.shape[0], sc.shape[1], sc.shape[2]
+    nbase = flipflopfings.nbase_flipflop(S)
+
+    bwd = torch.zeros((T + 1, N, 2 * nbase), dtype=torch.float32)
+    fact = torch.zeros((T + 1, N, 1), dtype=torch.float32)
+    if N == 0:
+        return bwd, fact
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] bwd_arr = bwd.numpy()
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] fact_arr = fact.numpy()
+    with nogil:
+        libdecoding.flipflop_backward(&sc[0, 0, 0], T, N, nbase,
+                                      &bwd_arr[0, 0, 0], &fact_arr[0, 0, 0])
+    return bwd, fact
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def flipflop_make_trans(scores):
+    """ Posterior scores for flip-flop transitions
+
+    :param scores: (T, N, S) tensor of transition scores
+
+    :returns: tuple (trans, fwd_fact, bwd_fact) of (T, N, S) posterior scores
+        and (T + 1, N, 1) log normalisation factors of the forward and
+        backward scores
+    """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] sc = _scores_array(scores)
+    cdef size_t T, N, S, nbase
+    T, N, S = sc.shape[0], sc.shape[1], sc.shape[2]
+    nbase = flipflopfings.nbase_flipflop(S)
+
+    trans = torch.zeros((T, N, S), dtype=torch.float32)
+    fwd_fact = torch.zeros((T + 1, N, 1), dtype=torch.float32)
+    bwd_fact = torch.zeros((T + 1, N, 1), dtype=torch.float32)
+    if N == 0:
+        return trans, fwd_fact, bwd_fact
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] trans_arr = trans.numpy()
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] fwd_fact_arr = fwd_fact.numpy()
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] bwd_fact_arr = bwd_fact.numpy()
+    cdef int ret
+    with nogil:
+        ret = libdecoding.flipflop_make_trans(
+            &sc[0, 0, 0], T, N, nbase, &trans_arr[0, 0, 0],
+            &fwd_fact_arr[0, 0, 0], &bwd_fact_arr[0, 0, 0])
+    if ret != 0:
+        raise MemoryError('Failed to allocate workspace for flip-flop posteriors')
+    return trans, fwd_fact, bwd_fact
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def flipflop_logz(scores):
+    """ Log-partition function of flip-flop transition scores
+
+    :param scores: (T, N, S) tensor of transition scores
+
+    :returns: (N,) tensor containing log-partition function of each chunk
+    """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] sc = _scores_array(scores)
+    cdef size_t T, N, S, nbase
+    T, N, S = sc.shape[0], sc.shape[1], sc.shape[2]
+    nbase = flipflopfings.nbase_flipflop(S)
+
+    logz, logz_t = output_tensor((N,))
+    if N == 0:
+        return logz
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] logz_arr = logz_t
+    with nogil:
+        libdecoding.flipflop_logz(&sc[0, 0, 0], T, N, nbase, &logz_arr[0])
+    return logz
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def flipflop_logz_grad(scores):
+    """ Log-partition function of flip-flop transition scores and its gradient
+
+    :param scores: (T, N, S) tensor of transition scores
+
+    :returns: tuple (logz, grad) of (N,) log-partition function of each chunk
+        and (T, N, S) gradient of logz with respect to scores, the posterior
+        probability of each transition
+    """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] sc = _scores_array(scores)
+    cdef size_t T, N, S, nbase
+    T, N, S = sc.shape[0], sc.shape[1], sc.shape[2]
+    nbase = flipflopfings.nbase_flipflop(S)
+
+    logz, logz_t = output_tensor((N,))
+    grad, grad_t = output_tensor((T, N, S))
+    if N == 0:
+        return logz, grad
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] logz_arr = logz_t
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] grad_arr = grad_t
+    cdef int ret
+    with nogil:
+        ret = libdecoding.flipflop_logz_grad(&sc[0, 0, 0], T, N, nbase,
+                                             &logz_arr[0], &grad_arr[0, 0, 0])
+    if ret != 0:
+        raise MemoryError('Failed to allocate workspace for flip-flop posteriors')
+    return logz, grad
+
+
+class LogZ(torch.autograd.Function):
+    """ Log-partition function of flip-flop transition scores, with the
+    gradient calculated alongside it in forward and kept for backward
+    """
+    @staticmethod
+    def forward(ctx, scores):
+        logz, grad = flipflop_logz_grad(scores)
+        ctx.save_for_backward(grad.to(scores.dtype))
+        return logz.to(scores.dtype)
+
+    @staticmethod
+    def backward(ctx, g):
+        grad, = ctx.saved_tensors
+        return grad * g[:, None]
+
+
+def logz(scores):
+    """ Log-partition function of flip-flop transition scores
+
+    Only the forward calculation is done when gradients are not required,
+    for example inside a `torch.no_grad()` block.
+
+    :param scores: (T, N, S) tensor of transition scores
+
+    :returns: (N,) tensor containing log-partition function of each chunk
+    """
+    if torch.is_grad_enabled() and scores.requires_grad:
+        return LogZ.apply(scores)
+    return flipflop_logz(scores).to(scores.dtype)
+
+
+def global_norm(scores):
+    """ CPU version of taiyaki.cupy_extensions.flipflop.global_norm, giving
+    the same results as taiyaki.layers.global_norm_flipflop
+
+    :param scores: (T, N, S) tensor of transition scores
+
+    :returns: (T, N, S) tensor of globally normalised scores
+    """
+    return scores - logz(scores)[:, None] / len(scores)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def flipflop_viterbi(scores):
+    """ Viterbi decoding of flip-flop transition scores
+
+    :param scores: (T, N, S) tensor of transition scores
+
+    :returns: tuple (fwd, traceback, best_path) of (T + 1, N, 2 * nbase)
+        Viterbi scores, (T + 1, N, 2 * nbase) traceback and (T + 1, N) best
+        path through flip-flop states
+    """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] sc = _scores_array(scores)
+    cdef size_t T, N, S, nbase
+    T, N, S = sc.shape[0], sc.shape[1], sc.shape[2]
+    nbase = flipflopfings.nbase_flipflop(S)
+
+    fwd = torch.zeros((T + 1, N, 2 * nbase), dtype=torch.float32)
+    traceback = torch.zeros((T + 1, N, 2 * nbase), dtype=torch.long)
+    best_path = torch.zeros((T + 1, N), dtype=torch.long)
+    if N == 0:
+        return fwd, traceback, best_path
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] fwd_arr = fwd.numpy()
+    cdef np.ndarray[np.int64_t, ndim=3, mode="c"] tb_arr = traceback.numpy()
+    cdef np.ndarray[np.int64_t, ndim=2, mode="c"] path_arr = best_path.numpy()
+    with nogil:
+        libdecoding.flipflop_viterbi(&sc[0, 0, 0], T, N, nbase, &fwd_arr[0, 0, 0],
+                                     &tb_arr[0, 0, 0], &path_arr[0, 0])
+    return fwd, traceback, best_path
+
+
+def _mapping_arrays(scores, step_index, stay_index):
+    """ Check and convert arguments of map_to_crf_viterbi """
+    scores = np.ascontiguousarray(scores, dtype=np.float32)
+    step_index = np.ascontiguousarray(step_index, dtype=np.int32)
+    stay_index = np.ascontiguousarray(stay_index, dtype=np.int32)
+    assert scores.ndim == 2, 'Scores must be a 2D array'
+    assert len(stay_index) > 0, 'Sequence to map to must not be empty'
+    assert len(step_index) == len(stay_index) - 1
+    for index in step_index, stay_index:
+        assert np.all((index >= 0) & (index < scores.shape[1])), \
+            'Index of scores out of range'
+    return scores, step_index, stay_index
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def map_to_crf_viterbi(scores, step_index, stay_index, double localpen):
+    """ Compiled version of flipflop_remap.map_to_crf_viterbi
+
+    :param scores: a 2D array of CRF transition scores (log-space), converted
+        to float32 if necessary
+    :param step_index: index of scores to use to step to the next sequence position
+    :param stay_index: index of scores to use to stay at the same sequence position
+    :param localpen: score for skipping over signal at the start or end of the alignment
+
+    :returns: score of best path, best path
+    """
+    cdef np.ndarray[np.float32_t, ndim=2, mode="c"] sc
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] step
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] stay
+    sc, step, stay = _mapping_arrays(scores, step_index, stay_index)
+    cdef size_t nblock = sc.shape[0], nparam = sc.shape[1], npos = stay.shape[0]
+
+    cdef np.ndarray[np.int64_t, ndim=1, mode="c"] path = np.empty(nblock + 1, dtype=np.int64)
+    cdef double score
+    cdef int ret
+    #  Pointers to empty arrays are never dereferenced
+    cdef float * sc_ptr = <float *>sc.data
+    cdef int32_t * step_ptr = <int32_t *>step.data
+    with nogil:
+        ret = libdecoding.flipflop_map_viterbi(sc_ptr, nblock, nparam, step_ptr,
+                                               &stay[0], npos, localpen, &score, &path[0])
+    if ret != 0:
+        raise MemoryError('Failed to allocate traceback for mapping')
+    return score, path
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def map_to_crf_viterbi_checkpointed(scores, step_index, stay_index, double localpen,
+                                    size_t segment_length=0):
+    """ As map_to_crf_viterbi, with identical results, but storing scores at
+    checkpoints rather than the whole traceback.  The traceback is recomputed
+    for one segment between checkpoints at a time.
+
+    :param segment_length: number of blocks between checkpoints, or 0 for
+        about sqrt(8 * len(scores)), which minimises memory
+
+    See map_to_crf_viterbi for other parameters and return values
+    """
+    cdef np.ndarray[np.float32_t, ndim=2, mode="c"] sc
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] step
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] stay
+    sc, step, stay = _mapping_arrays(scores, step_index, stay_index)
+    cdef size_t nblock = sc.shape[0], nparam = sc.shape[1], npos = stay.shape[0]
+
+    cdef np.ndarray[np.int64_t, ndim=1, mode="c"] path = np.empty(nblock + 1, dtype=np.int64)
+    cdef double score
+    cdef int ret
+    #  Pointers to empty arrays are never dereferenced
+    cdef float * sc_ptr = <float *>sc.data
+    cdef int32_t * step_ptr = <int32_t *>step.data
+    with nogil:
+        ret = libdecoding.flipflop_map_viterbi_checkpointed(
+            sc_ptr, nblock, nparam, step_ptr, &stay[0], npos, localpen,
+            segment_length, &score, &path[0])
+    if ret != 0:
+        raise MemoryError('Failed to allocate checkpoints for mapping')
+    return score, path
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def map_to_crf_viterbi_banded(scores, step_index, stay_index, band_start,
+                              size_t band_width, double localpen):
+    """ Compiled version of flipflop_remap.map_to_crf_viterbi, only
+    considering sequence positions within a band
+
+    The start state may be left into the first position of the band, and the
+    end state entered from the last, at every block; a path doing so skips
+    part of the sequence, see flipflop_remap.path_touches_band_edge.
+
+    :param scores: a 2D array of CRF transition scores (log-space), converted
+        to float32 if necessary
+    :param step_index: index of scores to use to step to the next sequence position
+    :param stay_index: index of scores to use to stay at the same sequence position
+    :param band_start: first position of band for each block, an array of
+        length 1 more than scores that is non-decreasing and at most
+        len(stay_index) - band_width
+    :param band_width: number of positions in band
+    :param localpen: score for skipping over signal at the start or end of the alignment
+
+    :returns: score of best path, best path
+    """
+    cdef np.ndarray[np.float32_t, ndim=2, mode="c"] sc
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] step
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] stay
+    sc, step, stay = _mapping_arrays(scores, step_index, stay_index)
+    cdef size_t nblock = sc.shape[0], nparam = sc.shape[1], npos = stay.shape[0]
+    cdef np.ndarray[np.int64_t, ndim=1, mode="c"] band = np.ascontiguousarray(
+        band_start, dtype=np.int64)
+    assert 0 < band_width <= npos, 'Band width must be between 1 and length of sequence'
+    assert len(band) == nblock + 1, 'Band must have one more element than scores'
+    assert band[0] >= 0 and band[nblock] <= npos - band_width, 'Band out of range'
+    assert np.all(np.diff(band) >= 0), 'Start of band must be non-decreasing'
+
+    cdef np.ndarray[np.int64_t, ndim=1, mode="c"] path = np.empty(nblock + 1, dtype=np.int64)
+    cdef double score
+    cdef int ret
+    #  Pointers to empty arrays are never dereferenced
+    cdef float * sc_ptr = <float *>sc.data
+    cdef int32_t * step_ptr = <int32_t *>step.data
+    cdef const int64_t * band_ptr = <const int64_t *>band.data
+    with nogil:
+        ret = libdecoding.flipflop_map_viterbi_banded(
+            sc_ptr, nblock, nparam, step_ptr, &stay[0], npos, band_ptr,
+            band_width, localpen, &score, &path[0])
+    if ret != 0:
+        raise MemoryError('Failed to allocate traceback for mapping')
+    return score, path
+
+
+def map_to_crf_viterbi_batch(scores, step_index, stay_index, double localpen):
+    """ Map many reads in parallel with map_to_crf_viterbi
+
+    :param scores: list of 2D arrays of CRF transition scores, all with the
+        same number of columns
+    :param step_index: list of step indices for each read
+    :param stay_index: list of stay indices for each read
+    :param localpen: score for skipping over signal at the start or end of the alignment
+
+    :returns: list of tuples (score of best path, best path) for each read
+    """
+    cdef size_t nbatch = len(scores)
+    assert len(step_index) == nbatch and len(stay_index) == nbatch
+    if nbatch == 0:
+        return []
+    arrays = [_mapping_arrays(*args) for args in zip(scores, step_index, stay_index)]
+    cdef size_t nparam = arrays[0][0].shape[1]
+    assert all(sc.shape[1] == nparam for sc, _, _ in arrays), \
+        'All scores must have the same number of columns'
+    paths = [np.empty(len(sc) + 1, dtype=np.int64) for sc, _, _ in arrays]
+    cdef np.ndarray[np.float64_t, ndim=1, mode="c"] score = np.empty(nbatch, dtype=np.float64)
+
+    cdef const float ** sc_ptrs = <const float **>malloc(nbatch * sizeof(float *))
+    cdef const int32_t ** step_ptrs = <const int32_t **>malloc(nbatch * sizeof(int32_t *))
+    cdef const int32_t ** stay_ptrs = <const int32_t **>malloc(nbatch * sizeof(int32_t *))
+    cdef int64_t ** path_ptrs = <int64_t **>malloc(nbatch * sizeof(int64_t *))
+    cdef size_t * nblock = <size_t *>malloc(nbatch * sizeof(size_t))
+    cdef size_t * npos = <size_t *>malloc(nbatch * sizeof(size_t))
+    cdef np.ndarray arr
+    cdef size_t i
+    cdef int ret = -1
+    try:
+        if (sc_ptrs == NULL or step_ptrs == NULL or stay_ptrs == NULL or
+                path_ptrs == NULL or nblock == NULL or npos == NULL):
+            raise MemoryError('Failed to allocate arrays for batch mapping')
+        for i in range(nbatch):
+            arr = arrays[i][0]
+            sc_ptrs[i] = <const float *>arr.data
+            nblock[i] = arr.shape[0]
+            arr = arrays[i][1]
+            step_ptrs[i] = <const int32_t *>arr.data
+            arr = arrays[i][2]
+            stay_ptrs[i] = <const int32_t *>arr.data
+            npos[i] = arr.shape[0]
+            arr = paths[i]
+            path_ptrs[i] = <int64_t *>arr.data
+        with nogil:
+            ret = libdecoding.flipflop_map_viterbi_batch(
+                sc_ptrs, nblock, nparam, step_ptrs, stay_ptrs, npos, nbatch,
+                localpen, &score[0], path_ptrs)
+    finally:
+        free(npos)
+        free(nblock)
+        free(path_ptrs)
+        free(stay_ptrs)
+        free(step_ptrs)
+        free(sc_ptrs)
+    if ret != 0:
+        raise MemoryError('Failed to allocate traceback for mapping')
+    return list(zip(score.tolist(), paths))
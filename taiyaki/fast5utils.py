@@ -5,7 +5,9 @@ import os
 import sys
 import ont_fast5_api.conversion_tools.conversion_utils
 import ont_fast5_api.fast5_interface
+from taiyaki.constants import READ_BATCH_SIZE
 from taiyaki.fileio import readtsv
+from taiyaki.iterators import imap_mp
 
 ##########################################################
 #
@@ -41,9 +43,12 @@ def iterate_files_reads_unpaired(filepaths, read_ids, limit=None, verbose=0):
     """Iterate over lists of filepaths and read_ids, looking in all the files
     given and returning only those read_ids in the read_ids list.
     read_ids may be None: in that case get all the reads in the files.
+    read_ids is converted to a set, so each check is O(1).
 
     yields a tuple (filepath, read_id) at each step.
     yields a maximum of limit tuples in total."""
+    if read_ids is not None:
+        read_ids = set(read_ids)
     nyielded = 0
     for filepath in filepaths:
         if not os.path.exists(filepath):
@@ -63,8 +68,15 @@ def iterate_files_reads_unpaired(filepaths, read_ids, limit=None, verbose=0):
                     return  # ends iterator
 
 
-def iterate_fast5_reads(path,
-                        strand_list=None, limit=None, verbose=0, recursive=False):
+def get_fast5_filepaths(path, recursive=False):
+    """Return list of fast5 files in directory path, or [path] if path is a file"""
+    if os.path.isdir(path):
+        return ont_fast5_api.conversion_tools.conversion_utils.get_fast5_file_list(path, recursive=recursive)
+    return [path]
+
+
+def iterate_fast5_reads(path, strand_list=None, limit=None, verbose=0,
+                        recursive=False, read_index=None, jobs=1):
     """Return iterator yielding reads in a directory of fast5 files or a single fast5 file.
 
     Each read is specified by a tuple (filepath, read_id)
@@ -91,8 +103,14 @@ def iterate_fast5_reads(path,
     :param limit: Limit number of reads to consider
     :param verbose   : an integer. verbose=0 prints no progress messages, verbose=1
                        prints a message for every file read. Verbose =2 prints the
-                       list of files before starting as well.
+                       list of files before starting as well.  With read_index,
+                       reads not in the strand list are filtered out by the
+                       index and so are not reported as skipped.
     :param recursive: Search path recursively for fast5 files.
+    :param read_index: Filename of a Fast5ReadIndex, created or updated as
+                       necessary.  If given, reads are found and filtered using
+                       the index, and only new or changed files are opened.
+    :param jobs: Number of processes used to update read_index.
 
     Example usage:
 
@@ -122,6 +140,24 @@ def iterate_fast5_reads(path,
         if filepaths is not None:
             filepaths = [os.path.join(path, x) for x in filepaths]
 
+    if read_index is not None:
+        # Case (C) if filenames and read_ids both come from the strandlist
+        paired = (filepaths is not None) and (read_ids is not None)
+        if filepaths is None:
+            filepaths = get_fast5_filepaths(path, recursive)
+        index = Fast5ReadIndex.load(read_index)
+        nchanged = index.update(filepaths, jobs=jobs)
+        if nchanged > 0:
+            index.save(read_index)
+        if verbose > 0:
+            print("Read index", read_index, "updated for", nchanged, "files")
+        for filepath, read_id in index.iterate_reads(filepaths, read_ids,
+                                                     paired=paired, limit=limit):
+            if verbose > 0:
+                print("Reading", read_id, "from", filepath)
+            yield filepath, read_id
+        return
+
     if (filepaths is not None) and (read_ids is not None):
         # This is the case (C) above. Both filenames and read_ids come from the strandlist
         # and we therefore know which read_id goes with which file
@@ -131,15 +167,233 @@ def iterate_fast5_reads(path,
 
     if filepaths is None:
         # Filenames not supplied by strand list, so we get them from the path
-        if os.path.isdir(path):
-            filepaths = ont_fast5_api.conversion_tools.conversion_utils.get_fast5_file_list(path, recursive=recursive)
-        else:
-            filepaths = [path]
+        filepaths = get_fast5_filepaths(path, recursive)
 
     for y in iterate_files_reads_unpaired(filepaths, read_ids, limit, verbose):
         yield y
 
 
+def batch_file_reads(read_tuples, batch_size=READ_BATCH_SIZE):
+    """Group reads from the same file into batches, so that each file can be
+    opened once for many reads.
+
+    Consecutive tuples (filepath, read_id), as yielded by iterate_fast5_reads,
+    with the same filepath are grouped together; reads are in the same order
+    as they were given.
+
+    param read_tuples: iterable of tuples (filepath, read_id)
+    param batch_size: maximum number of reads in a batch
+
+    yields a tuple (filepath, list of read_ids) at each step
+    """
+    filepath, read_ids = None, []
+    for read_filepath, read_id in read_tuples:
+        if read_ids and (read_filepath != filepath or len(read_ids) >= batch_size):
+            yield filepath, read_ids
+            read_ids = []
+        filepath = read_filepath
+        read_ids.append(read_id)
+    if read_ids:
+        yield filepath, read_ids
+
+
+def iterate_file_reads(filepath, read_ids):
+    """Open a fast5 file once and yield its reads
+
+    param filepath: fast5 file
+    param read_ids: list of read_ids in file
+
+    yields a tuple (read_id, ont_fast5_api read object) for each read_id,
+    with the read object None if the read could not be obtained from the file.
+    Errors are left for the caller to report.
+    """
+    try:
+        f5file = ont_fast5_api.fast5_interface.get_fast5_file(filepath, 'r')
+    except Exception:
+        for read_id in read_ids:
+            yield read_id, None
+        return
+    with f5file:
+        for read_id in read_ids:
+            try:
+                read = f5file.get_read(read_id)
+            except Exception:
+                read = None
+            yield read_id, read
+
+
+##########################################################
+#
+#
+# PERSISTENT INDEX OF READS IN FAST5 FILES
+#
+#
+##########################################################
+
+
+READ_INDEX_FIELDS = ['filepath', 'mtime', 'size', 'read_id', 'group', 'siglen']
+
+
+def file_stat(filepath):
+    """Return tuple (modification time in ns, size in bytes) identifying the
+    version of a file, or None if the file does not exist"""
+    try:
+        st = os.stat(filepath)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+def scan_fast5_file(filepath):
+    """Find the reads in a fast5 file
+
+    param filepath: absolute path of fast5 file
+
+    returns: tuple (filepath, file_stat of file, list of tuples (read_id,
+             HDF5 group of read, length of signal)), with the list None if
+             the file could not be read
+    """
+    stat = file_stat(filepath)
+    try:
+        reads = []
+        with ont_fast5_api.fast5_interface.get_fast5_file(filepath, 'r') as f5file:
+            for read_id in f5file.get_read_ids():
+                read = f5file.get_read(read_id)
+                siglen = read.handle[read.raw_dataset_name].shape[0]
+                reads.append((read_id, read.handle.name, siglen))
+    except Exception as e:
+        sys.stderr.write('Failed to index reads in {}, skipping\n{}\n'.format(filepath, repr(e)))
+        reads = None
+    return filepath, stat, reads
+
+
+class Fast5ReadIndex(object):
+    """Index of the reads in a collection of fast5 files, saved between runs
+
+    Maps each read_id to the file containing it, the HDF5 group of the read
+    within the file and the length of its signal.  The modification time and
+    size of each file are recorded, so only files that are new or have changed
+    are opened when the index is updated.
+
+    Example usage:
+
+    index = Fast5ReadIndex.load('read_index.tsv')
+    if index.update(filepaths, jobs=8) > 0:
+        index.save('read_index.tsv')
+    filepath, group, siglen = index.reads[read_id]
+    """
+
+    def __init__(self):
+        #  Absolute path of file -> (file_stat, list of read_ids in file)
+        self.files = {}
+        #  read_id -> (absolute path of file, group, signal length)
+        self.reads = {}
+
+    def __len__(self):
+        return len(self.reads)
+
+    def __contains__(self, read_id):
+        return read_id in self.reads
+
+    @classmethod
+    def load(cls, filename):
+        """Load index saved by save(), or return an empty index if filename
+        does not exist"""
+        index = cls()
+        if not os.path.exists(filename):
+            return index
+        with open(filename, 'r') as fh:
+            header = fh.readline().rstrip('\n').split('\t')
+            assert header == READ_INDEX_FIELDS, \
+                'Read index {} has unexpected fields {}'.format(filename, header)
+            for line in fh:
+                filepath, mtime, size, read_id, group, siglen = line.rstrip('\n').split('\t')
+                if filepath not in index.files:
+                    index.files[filepath] = ((int(mtime), int(size)), [])
+                if read_id:
+                    index.files[filepath][1].append(read_id)
+                    index.reads[read_id] = (filepath, group, int(siglen))
+        return index
+
+    def save(self, filename):
+        """Save index as a tsv file with one row per read, and a row with an
+        empty read_id for each file containing no reads"""
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as fh:
+            fh.write('\t'.join(READ_INDEX_FIELDS) + '\n')
+            for filepath, ((mtime, size), read_ids) in self.files.items():
+                rows = [(read_id,) + self.reads[read_id][1:] for read_id in read_ids]
+                for read_id, group, siglen in rows or [('', '', -1)]:
+                    fh.write('{}\t{}\t{}\t{}\t{}\t{}\n'.format(
+                        filepath, mtime, size, read_id, group, siglen))
+        os.replace(tmpname, filename)
+
+    def _remove_file(self, filepath):
+        _, read_ids = self.files.pop(filepath)
+        for read_id in read_ids:
+            if self.reads.get(read_id, (None,))[0] == filepath:
+                del self.reads[read_id]
+
+    def update(self, filepaths, jobs=1):
+        """Bring index up to date for files, scanning files that are not in
+        the index or have changed since they were indexed
+
+        param filepaths: paths of fast5 files
+        param jobs: number of processes to use for scanning files
+
+        returns: number of files whose entries in the index changed
+        """
+        to_scan = []
+        nchanged = 0
+        for filepath in map(os.path.abspath, filepaths):
+            stat = file_stat(filepath)
+            if filepath in self.files:
+                if self.files[filepath][0] == stat:
+                    continue
+                self._remove_file(filepath)
+                nchanged += 1
+            if stat is None:
+                sys.stderr.write('File {} does not exist, skipping\n'.format(filepath))
+                continue
+            to_scan.append(filepath)
+
+        for filepath, stat, reads in imap_mp(scan_fast5_file, to_scan, threads=jobs,
+                                             unordered=True, chunksize=10):
+            if reads is None:
+                continue
+            self.files[filepath] = (stat, [read_id for read_id, _, _ in reads])
+            for read_id, group, siglen in reads:
+                self.reads[read_id] = (filepath, group, siglen)
+            nchanged += 1
+        return nchanged
+
+    def iterate_reads(self, filepaths, read_ids=None, paired=False, limit=None):
+        """Iterate over reads in files, in the order they are found in each file
+
+        param filepaths: paths of fast5 files, which should have been given to update()
+        param read_ids: if not None, only yield reads with these read_ids
+        param paired: if True, read_ids[i] is the only read in filepaths[i] to yield
+        param limit: maximum number of tuples to yield
+
+        yields a tuple (filepath, read_id) at each step
+        """
+        if paired:
+            pairs = ((os.path.abspath(filepath), read_id)
+                     for filepath, read_id in zip(filepaths, read_ids))
+            pairs = (pair for pair in pairs if self.reads.get(pair[1], (None,))[0] == pair[0])
+        else:
+            if read_ids is not None:
+                read_ids = set(read_ids)
+            pairs = ((filepath, read_id)
+                     for filepath in map(os.path.abspath, filepaths)
+                     for read_id in self.files.get(filepath, (None, []))[1]
+                     if read_ids is None or read_id in read_ids)
+        for nyielded, pair in enumerate(pairs):
+            if limit is not None and nyielded >= limit:
+                return
+            yield pair
+
+
 ##########################################################
 #
 #
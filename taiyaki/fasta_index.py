@@ -0,0 +1,158 @@
+""" Indexed access to records of fasta files
+
+An index of the byte range of the sequence of each record is built once and
+saved next to the fasta file as a sorted numpy array.  Processes open the
+index as a memory map and read sequences from the fasta file as they are
+requested, so memory use does not grow with the size of the fasta file and
+many worker processes can share one index.
+"""
+from collections.abc import Mapping
+import numpy as np
+import os
+import re
+import sys
+
+from taiyaki.constants import DEFAULT_ALPHABET
+
+
+INDEX_SUFFIX = '.index.npy'
+
+
+def build_fasta_index(fasta_file_name):
+    """Find the byte range of the sequence of each record in a fasta file
+
+    Records are named by the first word of their header line, as for
+    Bio.SeqIO.  If several records have the same name, the last is indexed.
+
+    :param fasta_file_name: name of fasta file
+
+    :returns: structured array with fields name, start and end, sorted by name
+    """
+    names, starts, ends = [], [], []
+    offset = 0
+    with open(fasta_file_name, 'rb') as fh:
+        for line in fh:
+            if line.startswith(b'>'):
+                if names:
+                    ends.append(offset)
+                header = line[1:].split()
+                names.append(header[0] if header else b'')
+                starts.append(offset + len(line))
+            offset += len(line)
+    if names:
+        ends.append(offset)
+
+    width = max(1, max(map(len, names), default=1))
+    index = np.empty(len(names), dtype=[('name', 'S{}'.format(width)),
+                                        ('start', 'i8'), ('end', 'i8')])
+    index['name'] = names
+    index['start'] = starts
+    index['end'] = ends
+    #  Unique names, taking last record with each name
+    _, last = np.unique(index['name'][::-1], return_index=True)
+    return index[len(index) - 1 - last]
+
+
+def load_fasta_index(fasta_file_name, index_file_name=None):
+    """Open index of fasta file, building and saving it if it does not exist
+    or is older than the fasta file
+
+    :param fasta_file_name: name of fasta file
+    :param index_file_name: name of index file, defaults to name of fasta file
+        with INDEX_SUFFIX appended
+
+    :returns: tuple (index as returned by build_fasta_index, name of index file
+        or None if the index could not be saved)
+    """
+    if index_file_name is None:
+        index_file_name = fasta_file_name + INDEX_SUFFIX
+    if (os.path.exists(index_file_name) and
+            os.path.getmtime(index_file_name) >= os.path.getmtime(fasta_file_name)):
+        return np.load(index_file_name, mmap_mode='r'), index_file_name
+
+    index = build_fasta_index(fasta_file_name)
+    try:
+        with open(index_file_name, 'wb') as fh:
+            np.save(fh, index)
+    except OSError as e:
+        sys.stderr.write('Failed to save index of {} to {}, keeping index in memory.\n{}\n'.format(
+            fasta_file_name, index_file_name, repr(e)))
+        return index, None
+    return np.load(index_file_name, mmap_mode='r'), index_file_name
+
+
+class IndexedFasta(Mapping):
+    """Dictionary-like access to the sequences of a fasta file by record name
+
+    Behaves like the dictionary returned by helpers.fasta_file_to_dict, but
+    sequences are read from the file on demand.  Empty sequences, and ones
+    containing characters outside the alphabet unless allow_N is True, are
+    not found on lookup, although their names are still included when
+    iterating over the store.
+
+    Pickling only stores the names of the files, so the store can be given to
+    worker processes cheaply; each process opens the files when first used.
+    """
+
+    def __init__(self, fasta_file_name, allow_N=False, alphabet=DEFAULT_ALPHABET,
+                 index_file_name=None):
+        """
+        :param fasta_file_name: name of fasta file
+        :param allow_N: allow sequences containing characters outside alphabet
+        :param alphabet: string of allowed characters
+        :param index_file_name: name of index file, see load_fasta_index
+        """
+        self.fasta_file_name = fasta_file_name
+        self.allow_N = allow_N
+        self.has_nonalphabet = re.compile('[^{}]'.format(alphabet))
+        self._index, self.index_file_name = load_fasta_index(
+            fasta_file_name, index_file_name)
+        self._fh = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_fh'] = None
+        if self.index_file_name is not None:
+            state['_index'] = None
+        return state
+
+    @property
+    def index(self):
+        if self._index is None:
+            self._index = np.load(self.index_file_name, mmap_mode='r')
+        return self._index
+
+    def _find(self, name):
+        """Position of record in index, or None if not present"""
+        key = name.encode() if isinstance(name, str) else name
+        names = self.index['name']
+        i = np.searchsorted(names, key)
+        if i < len(names) and names[i] == key:
+            return i
+        return None
+
+    def __getitem__(self, name):
+        i = self._find(name)
+        if i is None:
+            raise KeyError(name)
+        if self._fh is None:
+            self._fh = open(self.fasta_file_name, 'rb')
+        start, end = int(self.index['start'][i]), int(self.index['end'][i])
+        self._fh.seek(start)
+        refseq = b''.join(self._fh.read(end - start).split()).decode()
+        if len(refseq) == 0:
+            raise KeyError(name)
+        if not self.allow_N and self.has_nonalphabet.search(refseq) is not None:
+            raise KeyError(name)
+        return refseq
+
+    def __iter__(self):
+        return (name.decode() for name in self.index['name'])
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
@@ -1,11 +1,142 @@
 import numpy as np
-from taiyaki import flipflopfings
+from taiyaki import decoding, flipflopfings
 from taiyaki.constants import DEFAULT_ALPHABET, LARGE_VAL
 
 
-def map_to_crf_viterbi(scores, step_index, stay_index, localpen=LARGE_VAL):
+#  Initial width of band for banded mapping
+DEFAULT_BAND_WIDTH = 500
+
+
+def map_to_crf_viterbi(scores, step_index, stay_index, localpen=LARGE_VAL,
+                       low_memory=False):
     """Find highest scoring path corresponding to a given label sequence
 
+    Compiled implementation, see map_to_crf_viterbi_numpy for details.
+    Scores are converted to float32.
+
+    :param low_memory: if True, store scores at checkpoints and recompute the
+        traceback between them, rather than storing the whole traceback.
+        Memory is O(sqrt(N) * M) rather than O(N * M) at the cost of a second
+        forward pass; the path is the same.
+
+    :returns: score of best path, best path
+    """
+    if low_memory:
+        return decoding.map_to_crf_viterbi_checkpointed(
+            scores, step_index, stay_index, localpen)
+    return decoding.map_to_crf_viterbi(scores, step_index, stay_index, localpen)
+
+
+def linear_band_start(nblock, npos, band_width, band_centre=None):
+    """First sequence position in band around a guess of the alignment
+
+    :param nblock: number of blocks of scores
+    :param npos: length of sequence
+    :param band_width: number of positions in band, at most npos
+    :param band_centre: guess of sequence position at each of the nblock + 1
+        blocks, or None to interpolate linearly from the start of the
+        sequence at the first block to the end at the last
+
+    :returns: int64 array of length nblock + 1 for map_to_crf_viterbi_banded
+    """
+    if band_centre is None:
+        band_centre = np.linspace(0, npos - 1, nblock + 1)
+    band_centre = np.maximum.accumulate(np.asarray(band_centre, dtype=float))
+    band_start = np.rint(band_centre).astype(np.int64) - band_width // 2
+    return np.clip(band_start, 0, npos - band_width)
+
+
+def path_touches_band_edge(path, band_start, band_width, npos):
+    """Whether a path lies on the edge of a band, other than at the start or
+    end of the sequence, so may have been constrained by the band
+
+    A banded path may also leave the start state into the first position of
+    the band, or enter the end state from the last, skipping part of the
+    sequence where the band cut off a transition to or from the start or end
+    states, see decoding.map_to_crf_viterbi_banded.
+
+    :param path: path through sequence positions, -1 for start or end states
+    :param band_start: first position of band for each block
+    :param band_width: number of positions in band
+    :param npos: length of sequence
+
+    :returns: bool
+    """
+    in_sequence = path[path >= 0]
+    if len(in_sequence) > 0 and (in_sequence[0] > 0 or in_sequence[-1] < npos - 1):
+        return True
+    band_end = band_start + band_width - 1
+    on_lower = (path == band_start) & (band_start > 0)
+    on_upper = (path == band_end) & (band_end < npos - 1)
+    return bool(np.any(on_lower | on_upper))
+
+
+def path_band_centre(path, npos):
+    """Guess of sequence position at each block from a path, for recentring a
+    band on it
+
+    :param path: path through sequence positions, -1 for start or end states
+    :param npos: length of sequence
+
+    :returns: float array of same length as path, 0 for blocks in the start
+        state and npos - 1 for blocks in the end state
+    """
+    in_sequence = np.flatnonzero(path >= 0)
+    if len(in_sequence) == 0:
+        return None
+    centre = np.asarray(path, dtype=float)
+    centre[:in_sequence[0]] = 0
+    centre[in_sequence[-1] + 1:] = npos - 1
+    return centre
+
+
+def map_to_crf_viterbi_banded(scores, step_index, stay_index, localpen=LARGE_VAL,
+                              band_width=DEFAULT_BAND_WIDTH, band_centre=None,
+                              low_memory=False):
+    """Find highest scoring path corresponding to a given label sequence,
+    only considering a band of sequence positions around a guess of the path
+
+    The band is doubled in width and recentred on the best path, and the path
+    found again, until the best path does not touch the edge of the band and
+    doubling the band no longer improves its score.  A single band that is not
+    touched is not enough: when the start or end of the signal is clipped, or
+    the speed of the strand varies, the best path may lie well away from the
+    initial guess and the band only contain a worse path.  Memory and time are
+    proportional to the number of blocks times the final width of the band,
+    rather than to the length of the sequence.  See map_to_crf_viterbi for
+    parameters.
+
+    :param band_width: initial number of sequence positions in band
+    :param band_centre: guess of sequence position at each of the
+        len(scores) + 1 blocks, e.g. from a coarse mapping, or None for
+        linear interpolation along the sequence
+    :param low_memory: use low-memory traceback if the band is widened to
+        the whole sequence
+
+    :returns: score of best path, best path
+    """
+    nblock, npos = len(scores), len(stay_index)
+    best = None
+    while band_width < npos:
+        band_start = linear_band_start(nblock, npos, band_width, band_centre)
+        score, path = decoding.map_to_crf_viterbi_banded(
+            scores, step_index, stay_index, band_start, band_width, localpen)
+        if not path_touches_band_edge(path, band_start, band_width, npos):
+            #  Band contains the previous best path, so score cannot decrease
+            if best is not None and score <= best[0]:
+                return best
+            best = score, path
+        band_width *= 2
+        band_centre = path_band_centre(path, npos)
+    return map_to_crf_viterbi(scores, step_index, stay_index, localpen,
+                              low_memory=low_memory)
+
+
+def map_to_crf_viterbi_numpy(scores, step_index, stay_index, localpen=LARGE_VAL):
+    """Find highest scoring path corresponding to a given label sequence
+
+    Reference implementation of map_to_crf_viterbi using numpy
+
     :param scores: a 2D array of CRF transition scores (log-space)
     :param step_index: index of scores to use to step to the next sequence position,
         corresponding to diagonal moves in the alignment matrix, e.g. for a flipflop
@@ -71,7 +202,7 @@ def map_to_crf_viterbi(scores, step_index, stay_index, localpen=LARGE_VAL):
 
     while n >= 0 and m >= 0:
         path[n] = m
-        move = traceback[n, m]
+        move = int(traceback[n, m])
         m -= move
         n -= 1
 
@@ -79,7 +210,8 @@ def map_to_crf_viterbi(scores, step_index, stay_index, localpen=LARGE_VAL):
 
 
 def flipflop_remap(transition_scores, sequence, alphabet=DEFAULT_ALPHABET,
-                   localpen=LARGE_VAL):
+                   localpen=LARGE_VAL, band_width=None, band_centre=None,
+                   low_memory=False):
     """Finds the best alignment between a matrix of flipflip transition scores and a sequence
 
     Returns the score calculated for the best path, and an array of sequence positions
@@ -106,9 +238,50 @@ def flipflop_remap(transition_scores, sequence, alphabet=DEFAULT_ALPHABET,
     :param sequence: reference sequence to map to
     :param alphabet: alphabet of length nbase from which the sequence in drawn
     :param localpen: score for staying in the start or end states
+    :param band_width: if not None, initial width of band of sequence positions
+        to consider at each block, see map_to_crf_viterbi_banded
+    :param band_centre: guess of sequence position at each block for banded
+        mapping, or None to interpolate linearly
+    :param low_memory: store checkpoints rather than the whole traceback,
+        see map_to_crf_viterbi
 
     :returns: alignment score, array of sequence positions of length T + 1
     """
+    step_index, stay_index = flipflop_indices(sequence, alphabet)
+    if band_width is not None:
+        return map_to_crf_viterbi_banded(transition_scores, step_index, stay_index,
+                                         localpen=localpen, band_width=band_width,
+                                         band_centre=band_centre, low_memory=low_memory)
+    return map_to_crf_viterbi(transition_scores, step_index, stay_index, localpen=localpen,
+                              low_memory=low_memory)
+
+
+def flipflop_remap_batch(transition_scores, sequences, alphabet=DEFAULT_ALPHABET,
+                         localpen=LARGE_VAL):
+    """Map many reads with flipflop_remap, in parallel
+
+    :param transition_scores: list of arrays of network outputs of shape (T, K)
+        where K = 2 * nbase * (nbase + 1)
+    :param sequences: list of reference sequences to map to
+    :param alphabet: alphabet of length nbase from which the sequences are drawn
+    :param localpen: score for staying in the start or end states
+
+    :returns: list of (alignment score, array of sequence positions) for each read
+    """
+    indices = [flipflop_indices(sequence, alphabet) for sequence in sequences]
+    step_index, stay_index = zip(*indices) if indices else ((), ())
+    return decoding.map_to_crf_viterbi_batch(transition_scores, step_index,
+                                             stay_index, localpen)
+
+
+def flipflop_indices(sequence, alphabet=DEFAULT_ALPHABET):
+    """Indices of flip-flop transition scores for moves along a sequence
+
+    :param sequence: reference sequence to map to
+    :param alphabet: alphabet of length nbase from which the sequence in drawn
+
+    :returns: tuple (step_index, stay_index) for map_to_crf_viterbi
+    """
     nbase = len(alphabet)
     bases = np.array([alphabet.find(b) for b in sequence])
     flops = flipflopfings.flopmask(bases)
@@ -118,4 +291,4 @@ def flipflop_remap(transition_scores, sequence, alphabet=DEFAULT_ALPHABET,
     to_base = np.maximum(bases, nbase * flops)[1:]
     step_index = from_base + 2 * nbase * to_base
 
-    return map_to_crf_viterbi(transition_scores, step_index, stay_index, localpen=localpen)
+    return step_index, stay_index
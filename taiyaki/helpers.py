@@ -1,5 +1,5 @@
 from Bio import SeqIO
-from collections import Mapping, Sequence
+from collections.abc import Mapping, Sequence
 import hashlib
 import imp
 import numpy as np
@@ -46,8 +46,15 @@ def load_model(model_file, params_file=None, **model_kwargs):
 
 
 def guess_model_stride(net, input_shape=(720, 1, 1)):
-    """ Infer the stride of a pytorch network by running it on some test input.
+    """ Stride of a pytorch network
+
+    Taken from the layers of the network where they describe themselves (see
+    taiyaki.layers), otherwise inferred by running it on some test input.
     """
+    try:
+        return int(net.stride)
+    except (AttributeError, NotImplementedError):
+        pass
     net_device = next(net.parameters()).device
     out = net(torch.zeros(input_shape).to(net_device))
     return int(round(input_shape[0] / out.size()[0]))
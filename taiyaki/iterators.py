@@ -362,3 +362,31 @@ def imap_mp(
             yield r
         pool.close()
         pool.join()
+
+
+def imap_pool(pool, function, args, fix_kwargs=__NotGiven(), max_pending=1):
+    """Map a function over an iterable using an existing pool, submitting the
+    work from the calling thread
+
+    Unlike :func:`imap_mp`, the argument iterable is consumed by the thread
+    iterating over the results rather than by a helper thread of the pool, so
+    work done while generating the arguments (for example, running a network)
+    happens in the caller and any exceptions it raises propagate normally.
+
+    :param pool: multiprocessing.Pool to apply function in
+    :param function: the function to apply, must be pickalable
+    :param args: iterable of argument values of function to map over
+    :param fix_kwargs: keyword arguments to hold fixed
+    :param max_pending: maximum number of submitted tasks whose results have
+        not yet been yielded
+
+    :yields: results of function, in the same order as args
+    """
+    kwds = {} if isinstance(fix_kwargs, __NotGiven) else fix_kwargs
+    pending = deque()
+    for arg in args:
+        pending.append(pool.apply_async(function, (arg,), kwds))
+        while pending and (len(pending) >= max_pending or pending[0].ready()):
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
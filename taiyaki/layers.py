@@ -71,6 +71,63 @@ def reverse(x):
     return x.index_select(0, inv_idx)
 
 
+#  Layers describe themselves analytically, without running the network:
+#
+#      output_shape(input_shape)  Shape of output for input of shape
+#                                 (time, batch, features)
+#      stride                     Number of input samples per output block
+#      context                    Tuple (before, after) of the number of input
+#                                 samples before and after those of its own
+#                                 stride that a block of output depends on;
+#                                 np.inf if unbounded, as for recurrent layers
+#      flops(input_shape)         Estimate of floating point operations in a
+#                                 forward pass
+#      activation_memory(input_shape)
+#                                 Estimate of bytes of activations held for
+#                                 the backward pass
+#
+#  Block t of the output is aligned with input samples
+#  [t * stride, (t + 1) * stride)
+
+_ACTIVATION_BYTES = np.dtype(taiyaki_dtype).itemsize
+
+
+def _nblock(input_shape):
+    """Number of positions in time and batch of input"""
+    return int(np.prod(input_shape[:-1]))
+
+
+def _nbytes(shape):
+    """Bytes of activations of given shape"""
+    return _ACTIVATION_BYTES * int(np.prod(shape))
+
+
+def _pointwise_shape(input_shape, size):
+    return tuple(input_shape[:-1]) + (size,)
+
+
+def _common_stride(layers):
+    strides = set(layer.stride for layer in layers)
+    if len(strides) != 1:
+        raise ValueError('Sublayers have different strides {}'.format(strides))
+    return strides.pop()
+
+
+def _widest_context(layers):
+    return tuple(max(c) for c in zip(*(layer.context for layer in layers)))
+
+
+def receptive_field(layer):
+    """Number of input samples that a block of output of a layer depends on
+
+    :param layer: layer, or network of layers, from this module
+
+    :returns: int, or np.inf if the output depends on the whole input
+    """
+    before, after = layer.context
+    return before + layer.stride + after
+
+
 class Reverse(nn.Module):
     def __init__(self, layer):
         super().__init__()
@@ -79,6 +136,25 @@ class Reverse(nn.Module):
     def forward(self, x):
         return reverse(self.layer(reverse(x)))
 
+    def output_shape(self, input_shape):
+        return self.layer.output_shape(input_shape)
+
+    @property
+    def stride(self):
+        return self.layer.stride
+
+    @property
+    def context(self):
+        before, after = self.layer.context
+        return after, before
+
+    def flops(self, input_shape):
+        return self.layer.flops(input_shape)
+
+    def activation_memory(self, input_shape):
+        return (self.layer.activation_memory(input_shape) +
+                _nbytes(input_shape) + _nbytes(self.output_shape(input_shape)))
+
     def json(self, params=False):
         return OrderedDict([('type', "reverse"),
                             ('sublayers', self.layer.json(params))])
@@ -92,6 +168,21 @@ class Residual(nn.Module):
     def forward(self, x):
         return x + self.layer(x)
 
+    stride = 1
+
+    def output_shape(self, input_shape):
+        return tuple(input_shape)
+
+    @property
+    def context(self):
+        return self.layer.context
+
+    def flops(self, input_shape):
+        return self.layer.flops(input_shape) + int(np.prod(input_shape))
+
+    def activation_memory(self, input_shape):
+        return self.layer.activation_memory(input_shape) + _nbytes(input_shape)
+
     def json(self, params=False):
         return OrderedDict([('type', "Residual"),
                             ('sublayers', self.layer.json(params))])
@@ -108,6 +199,22 @@ class GatedResidual(nn.Module):
         y = self.layer(x)
         return gate * x + (1 - gate) * y
 
+    stride = 1
+
+    def output_shape(self, input_shape):
+        return tuple(input_shape)
+
+    @property
+    def context(self):
+        return self.layer.context
+
+    def flops(self, input_shape):
+        return self.layer.flops(input_shape) + 3 * int(np.prod(input_shape))
+
+    def activation_memory(self, input_shape):
+        return (self.layer.activation_memory(input_shape) +
+                3 * _nbytes(input_shape))
+
     def json(self, params=False):
         res = OrderedDict([('type', "GatedResidual"),
                            ('sublayers', self.layer.json(params))])
@@ -144,6 +251,18 @@ class FeedForward(nn.Module):
     def forward(self, x):
         return self.activation(self.linear(x))
 
+    stride = 1
+    context = (0, 0)
+
+    def output_shape(self, input_shape):
+        return _pointwise_shape(input_shape, self.size)
+
+    def flops(self, input_shape):
+        return _nblock(input_shape) * 2 * (self.insize + 1) * self.size
+
+    def activation_memory(self, input_shape):
+        return 2 * _nbytes(self.output_shape(input_shape))
+
     def json(self, params=False):
         res = OrderedDict([('type', "feed-forward"),
                            ('activation', self.activation.__name__),
@@ -184,6 +303,18 @@ class Softmax(nn.Module):
     def forward(self, x):
         return self.activation(self.linear(x))
 
+    stride = 1
+    context = (0, 0)
+
+    def output_shape(self, input_shape):
+        return _pointwise_shape(input_shape, self.size)
+
+    def flops(self, input_shape):
+        return _nblock(input_shape) * 2 * (self.insize + 2) * self.size
+
+    def activation_memory(self, input_shape):
+        return 2 * _nbytes(self.output_shape(input_shape))
+
     def json(self, params=False):
         res = OrderedDict([('type', "softmax"),
                            ('size', self.size),
@@ -226,6 +357,19 @@ class CudnnGru(nn.Module):
         y, hy = self.cudnn_gru.forward(x)
         return y
 
+    stride = 1
+    context = (np.inf, 0)
+
+    def output_shape(self, input_shape):
+        return _pointwise_shape(input_shape, self.size)
+
+    def flops(self, input_shape):
+        #  Three gates, each from input and previous output
+        return _nblock(input_shape) * 6 * (self.insize + self.size + 2) * self.size
+
+    def activation_memory(self, input_shape):
+        return 4 * _nbytes(self.output_shape(input_shape))
+
     def json(self, params=False):
         res = OrderedDict([('type', "CudnnGru"),
                            ('activation', "tanh"),
@@ -301,6 +445,19 @@ class Lstm(nn.Module):
         y, hy = self.lstm.forward(x)
         return y
 
+    stride = 1
+    context = (np.inf, 0)
+
+    def output_shape(self, input_shape):
+        return _pointwise_shape(input_shape, self.size)
+
+    def flops(self, input_shape):
+        #  Four gates, each from input and previous output
+        return _nblock(input_shape) * 8 * (self.insize + self.size + 2) * self.size
+
+    def activation_memory(self, input_shape):
+        return 6 * _nbytes(self.output_shape(input_shape))
+
     def json(self, params=False):
         res = OrderedDict([('type', "LSTM"),
                            ('activation', "tanh"),
@@ -362,6 +519,19 @@ class GruMod(nn.Module):
         y, hy = self.cudnn_gru.forward(x)
         return y
 
+    stride = 1
+    context = (np.inf, 0)
+
+    def output_shape(self, input_shape):
+        return _pointwise_shape(input_shape, self.size)
+
+    def flops(self, input_shape):
+        #  Three gates, each from input and previous output
+        return _nblock(input_shape) * 6 * (self.insize + self.size + 2) * self.size
+
+    def activation_memory(self, input_shape):
+        return 4 * _nbytes(self.output_shape(input_shape))
+
     def json(self, params=False):
         res = OrderedDict([('type', "GruMod"),
                            ('activation', "tanh"),
@@ -389,7 +559,7 @@ class Convolution(nn.Module):
     """1D convolution over the first dimension
 
     Takes input of shape [time, batch, features] and produces output of shape
-    [ceil((time + padding) / stride), batch, features]
+    [(time + padding - winlen) // stride + 1, batch, features]
 
     :param insize: number of features on input
     :param size: number of output features
@@ -426,6 +596,23 @@ class Convolution(nn.Module):
         out = self.activation(self.conv(self.pad(x)))
         return out.permute(2, 0, 1)
 
+    def output_shape(self, input_shape):
+        length = (input_shape[0] + sum(self.padding) - self.winlen) // self.stride + 1
+        return (length,) + tuple(input_shape[1:-1]) + (self.size,)
+
+    @property
+    def context(self):
+        before = self.padding[0]
+        return max(0, before), max(0, self.winlen - self.stride - before)
+
+    def flops(self, input_shape):
+        return (_nblock(self.output_shape(input_shape)) * 2 *
+                (self.winlen * self.insize + 1) * self.size)
+
+    def activation_memory(self, input_shape):
+        padded_shape = (input_shape[0] + sum(self.padding),) + tuple(input_shape[1:])
+        return _nbytes(padded_shape) + 2 * _nbytes(self.output_shape(input_shape))
+
     def json(self, params=False):
         res = OrderedDict([("type", "convolution"),
                            ("insize", self.insize),
@@ -449,6 +636,25 @@ class Parallel(nn.Module):
         ys = [layer(x) for layer in self.sublayers]
         return torch.cat(ys, 2)
 
+    def output_shape(self, input_shape):
+        shapes = [layer.output_shape(input_shape) for layer in self.sublayers]
+        return shapes[0][:-1] + (sum(shape[-1] for shape in shapes),)
+
+    @property
+    def stride(self):
+        return _common_stride(self.sublayers)
+
+    @property
+    def context(self):
+        return _widest_context(self.sublayers)
+
+    def flops(self, input_shape):
+        return sum(layer.flops(input_shape) for layer in self.sublayers)
+
+    def activation_memory(self, input_shape):
+        return (sum(layer.activation_memory(input_shape) for layer in self.sublayers) +
+                _nbytes(self.output_shape(input_shape)))
+
     def json(self, params=False):
         return OrderedDict([('type', "parallel"),
                             ('sublayers', [layer.json(params)
@@ -471,6 +677,24 @@ class Product(nn.Module):
             ys *= layer(x)
         return ys
 
+    def output_shape(self, input_shape):
+        return self.sublayers[0].output_shape(input_shape)
+
+    @property
+    def stride(self):
+        return _common_stride(self.sublayers)
+
+    @property
+    def context(self):
+        return _widest_context(self.sublayers)
+
+    def flops(self, input_shape):
+        nproduct = (len(self.sublayers) - 1) * int(np.prod(self.output_shape(input_shape)))
+        return sum(layer.flops(input_shape) for layer in self.sublayers) + nproduct
+
+    def activation_memory(self, input_shape):
+        return sum(layer.activation_memory(input_shape) for layer in self.sublayers)
+
     def json(self, params=False):
         return OrderedDict([('type', "Product"),
                             ('sublayers', [layer.json(params)
@@ -487,6 +711,43 @@ class Serial(nn.Module):
             x = layer(x)
         return x
 
+    def output_shape(self, input_shape):
+        for layer in self.sublayers:
+            input_shape = layer.output_shape(input_shape)
+        return input_shape
+
+    @property
+    def stride(self):
+        stride = 1
+        for layer in self.sublayers:
+            stride *= layer.stride
+        return stride
+
+    @property
+    def context(self):
+        #  Context of each layer is in units of the stride of those before it
+        before, after, stride = 0, 0, 1
+        for layer in self.sublayers:
+            layer_before, layer_after = layer.context
+            before += stride * layer_before
+            after += stride * layer_after
+            stride *= layer.stride
+        return before, after
+
+    def flops(self, input_shape):
+        total = 0
+        for layer in self.sublayers:
+            total += layer.flops(input_shape)
+            input_shape = layer.output_shape(input_shape)
+        return total
+
+    def activation_memory(self, input_shape):
+        total = 0
+        for layer in self.sublayers:
+            total += layer.activation_memory(input_shape)
+            input_shape = layer.output_shape(input_shape)
+        return total
+
     def json(self, params=False):
         return OrderedDict([
             ('type', "serial"),
@@ -504,6 +765,25 @@ class SoftChoice(nn.Module):
         ys = [p * layer(x) for p, layer in zip(ps, self.sublayers)]
         return torch.stack(ys).sum(0)
 
+    def output_shape(self, input_shape):
+        return self.sublayers[0].output_shape(input_shape)
+
+    @property
+    def stride(self):
+        return _common_stride(self.sublayers)
+
+    @property
+    def context(self):
+        return _widest_context(self.sublayers)
+
+    def flops(self, input_shape):
+        nchoice = 2 * len(self.sublayers) * int(np.prod(self.output_shape(input_shape)))
+        return sum(layer.flops(input_shape) for layer in self.sublayers) + nchoice
+
+    def activation_memory(self, input_shape):
+        nchoice = 2 * len(self.sublayers) * _nbytes(self.output_shape(input_shape))
+        return sum(layer.activation_memory(input_shape) for layer in self.sublayers) + nchoice
+
     def json(self, params=False):
         res = OrderedDict([('type', "softchoice"),
                            ('sublayers', [layer.json(params) for layer in self.sublayers])])
@@ -528,6 +808,18 @@ class Identity(nn.Module):
     def forward(self, x):
         return x
 
+    stride = 1
+    context = (0, 0)
+
+    def output_shape(self, input_shape):
+        return tuple(input_shape)
+
+    def flops(self, input_shape):
+        return 0
+
+    def activation_memory(self, input_shape):
+        return 0
+
 
 class Studentise(nn.Module):
     """ Normal all features in batch
@@ -548,6 +840,19 @@ class Studentise(nn.Module):
         v = x.view(-1, features).var(0, unbiased=False)
         return (x - m) / torch.sqrt(v + self.epsilon)
 
+    #  Normalisation is over the whole input
+    stride = 1
+    context = (np.inf, np.inf)
+
+    def output_shape(self, input_shape):
+        return tuple(input_shape)
+
+    def flops(self, input_shape):
+        return 5 * int(np.prod(input_shape))
+
+    def activation_memory(self, input_shape):
+        return 2 * _nbytes(input_shape)
+
 
 class DeltaSample(nn.Module):
     """ Returns difference between neighbouring features
@@ -563,6 +868,18 @@ class DeltaSample(nn.Module):
         padding = torch.zeros_like(x[:1])
         return torch.cat((output, padding), dim=0)
 
+    stride = 1
+    context = (0, 1)
+
+    def output_shape(self, input_shape):
+        return tuple(input_shape)
+
+    def flops(self, input_shape):
+        return int(np.prod(input_shape))
+
+    def activation_memory(self, input_shape):
+        return 2 * _nbytes(input_shape)
+
 
 class Window(nn.Module):
     """  Create a sliding window over input
@@ -591,6 +908,22 @@ class Window(nn.Module):
         xs = [padded_x[i:length + i] for i in range(self.w)]
         return torch.cat(xs, x.ndimension() - 1)
 
+    stride = 1
+
+    def output_shape(self, input_shape):
+        return _pointwise_shape(input_shape, self.w * input_shape[-1])
+
+    @property
+    def context(self):
+        return self.w // 2, self.w // 2
+
+    def flops(self, input_shape):
+        return 0
+
+    def activation_memory(self, input_shape):
+        padded_shape = (input_shape[0] + 2 * (self.w // 2),) + tuple(input_shape[1:])
+        return _nbytes(padded_shape) + _nbytes(self.output_shape(input_shape))
+
 
 def birnn(forward, backward):
     """  Creates a bidirectional RNN from two RNNs
@@ -643,6 +976,20 @@ def global_norm_flipflop(scores):
     return scores - logZ / T
 
 
+def _use_compiled_global_norm(x, never_use_compiled=False):
+    """ Whether global normalisation of x can use the compiled CPU kernels
+    of taiyaki.decoding rather than global_norm_flipflop
+    """
+    if never_use_compiled or x.is_cuda:
+        return False
+
+    try:
+        from . import decoding
+        return True
+    except ImportError:
+        return False
+
+
 class GlobalNormFlipFlop(nn.Module):
     def __init__(self, insize, nbase, has_bias=True, _never_use_cupy=False):
         super().__init__()
@@ -688,15 +1035,35 @@ class GlobalNormFlipFlop(nn.Module):
         except ImportError:
             return False
 
+    def _use_compiled(self, x):
+        return _use_compiled_global_norm(x, getattr(self, '_never_use_cupy', False))
+
     def forward(self, x):
         y = 5.0 * activation.tanh(self.linear(x))
 
         if self._use_cupy(x):
             from .cupy_extensions import flipflop
             return flipflop.global_norm(y)
+        elif self._use_compiled(x):
+            from . import decoding
+            return decoding.global_norm(y)
         else:
             return global_norm_flipflop(y)
 
+    #  Global normalisation subtracts the same value from all scores of a
+    #  block, which does not change decoding, so is not counted as context
+    stride = 1
+    context = (0, 0)
+
+    def output_shape(self, input_shape):
+        return _pointwise_shape(input_shape, self.size)
+
+    def flops(self, input_shape):
+        return _nblock(input_shape) * 2 * (self.insize + 4) * self.size
+
+    def activation_memory(self, input_shape):
+        return 3 * _nbytes(self.output_shape(input_shape))
+
 
 class GlobalNormFlipFlopCatMod(nn.Module):
     """ Flip-flop layer with additional modified base output stream
@@ -704,7 +1071,8 @@ class GlobalNormFlipFlopCatMod(nn.Module):
     :param insize: Size of input to layer (should be 1)
     :param alphabet_info: `taiyaki.alphabet.AlphabetInfo` instance
     :param has_bias: Whether layer has bias
-    :param _never_use_cupy: Force use of CPU implementation of flip-flop loss
+    :param _never_use_cupy: Force use of pytorch implementation of flip-flop
+        normalisation, rather than the cupy or compiled CPU kernels
 
     Attributes (can_nmods, output_alphabet and modified_base_long_names) define
     a modified base model and their names and structure is stable.
@@ -849,6 +1217,9 @@ class GlobalNormFlipFlopCatMod(nn.Module):
         except ImportError:
             return False
 
+    def _use_compiled(self, x):
+        return _use_compiled_global_norm(x, self._never_use_cupy)
+
     def get_softmax_cat_mods(self, cat_mod_scores):
         """ Get categorical modified base tensors
 
@@ -881,6 +1252,9 @@ class GlobalNormFlipFlopCatMod(nn.Module):
         if self._use_cupy(x):
             from .cupy_extensions import flipflop
             norm_trans_scores = flipflop.global_norm(trans_scores)
+        elif self._use_compiled(x):
+            from . import decoding
+            norm_trans_scores = decoding.global_norm(trans_scores)
         else:
             norm_trans_scores = global_norm_flipflop(trans_scores)
 
@@ -892,6 +1266,20 @@ class GlobalNormFlipFlopCatMod(nn.Module):
 
         return torch.cat((norm_trans_scores, cat_mod_scores), dim=2)
 
+    #  See GlobalNormFlipFlop for context
+    stride = 1
+    context = (0, 0)
+
+    def output_shape(self, input_shape):
+        return _pointwise_shape(
+            input_shape, self.ntrans_states + self.ncan_base + self.nmod_base)
+
+    def flops(self, input_shape):
+        return _nblock(input_shape) * 2 * (self.insize + 4) * self.size
+
+    def activation_memory(self, input_shape):
+        return 3 * _nbytes(self.output_shape(input_shape))
+
 
 class TimeLinear(nn.Module):
     """  Basic feedforward layer over time dimension
@@ -923,6 +1311,22 @@ class TimeLinear(nn.Module):
         y = self.activation(self.linear(xp))
         return y.permute(2, 0, 1)
 
+    context = (np.inf, np.inf)
+
+    @property
+    def stride(self):
+        raise NotImplementedError(
+            'Output of TimeLinear is not aligned in time with its input')
+
+    def output_shape(self, input_shape):
+        return (self.size,) + tuple(input_shape[1:])
+
+    def flops(self, input_shape):
+        return int(np.prod(input_shape[1:])) * 2 * (self.insize + 1) * self.size
+
+    def activation_memory(self, input_shape):
+        return 2 * _nbytes(self.output_shape(input_shape))
+
     def json(self, params=False):
         res = OrderedDict([('type', "TimeLinear"),
                            ('activation', self.activation.__name__),
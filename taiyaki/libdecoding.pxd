@@ -1,4 +1,32 @@
-from libc.stdint cimport int32_t
+from libc.stdint cimport int32_t, int64_t
 cdef extern from "c_decoding.h":
     void fast_viterbi_blocks(const float * weights, size_t nblock, size_t nbatch, size_t nparam, size_t nbase,
                              float stay_pen, float skip_pen, float local_pen, float * score, int32_t * path)
+
+cdef extern from "c_decoding.h" nogil:
+    void flipflop_forward(const float * scores, size_t T, size_t N, size_t nbase,
+                          float * fwd, float * fact)
+    void flipflop_backward(const float * scores, size_t T, size_t N, size_t nbase,
+                           float * bwd, float * fact)
+    int flipflop_make_trans(const float * scores, size_t T, size_t N, size_t nbase,
+                            float * trans, float * fwd_fact, float * bwd_fact)
+    void flipflop_logz(const float * scores, size_t T, size_t N, size_t nbase, float * logz)
+    int flipflop_logz_grad(const float * scores, size_t T, size_t N, size_t nbase,
+                           float * logz, float * grad)
+    void flipflop_viterbi(const float * scores, size_t T, size_t N, size_t nbase,
+                          float * fwd, int64_t * traceback, int64_t * path)
+    int flipflop_map_viterbi(const float * scores, size_t nblock, size_t nparam,
+                             const int32_t * step_index, const int32_t * stay_index, size_t npos,
+                             double localpen, double * score, int64_t * path)
+    int flipflop_map_viterbi_batch(const float ** scores, const size_t * nblock, size_t nparam,
+                                   const int32_t ** step_index, const int32_t ** stay_index,
+                                   const size_t * npos, size_t nbatch, double localpen,
+                                   double * score, int64_t ** path)
+    int flipflop_map_viterbi_banded(const float * scores, size_t nblock, size_t nparam,
+                                    const int32_t * step_index, const int32_t * stay_index,
+                                    size_t npos, const int64_t * band_start, size_t band_width,
+                                    double localpen, double * score, int64_t * path)
+    int flipflop_map_viterbi_checkpointed(const float * scores, size_t nblock, size_t nparam,
+                                          const int32_t * step_index, const int32_t * stay_index,
+                                          size_t npos, double localpen, size_t segment_length,
+                                          double * score, int64_t * path)
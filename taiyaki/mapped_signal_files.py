@@ -1,15 +1,21 @@
 # Defines an abstract class used to read and write per-read "chunk" files
-# and a derived class using HDF5 in the simplest way possible
+# and derived classes using HDF5: one in the simplest way possible and one
+# with the data from all reads packed together.
 # The base class provides a prototype for other file formats.
 # If the class interface is fixed, we can swap to other classes
 # (for example, Per_read_Fast5 or Per_read_SQLite)
 #
 
 from abc import ABC, abstractmethod
+from collections.abc import ItemsView, KeysView, ValuesView
 import h5py
 import numpy as np
+import os
 import random
 
+from taiyaki.maths import in_sorted
+from taiyaki.signal import dacs_to_current
+
 _version = 7
 
 class Read(dict):
@@ -57,6 +63,16 @@ class Read(dict):
 
     def __init__(self, d):
         self.update(d)
+        self.chunk_metadata = None
+
+    def _get_slice(self, name, start, end):
+        """Return self[name][start:end].  Derived classes that do not hold
+        all arrays in memory may override this to read only the slice."""
+        return self[name][start:end]
+
+    def get_dacs_length(self):
+        """Return length of signal"""
+        return len(self['Dacs'])
 
     @staticmethod
     def _typecheck(name, x, target_type):
@@ -137,23 +153,51 @@ class Read(dict):
             return "pass"
         return return_string
 
+    def get_chunk_metadata(self):
+        """Return ChunkMetadata for the read, calculating it the first time
+        it is needed.  The arrays of the read must not be changed after
+        this."""
+        if self.chunk_metadata is None:
+            self.chunk_metadata = ChunkMetadata.from_read(self)
+        return self.chunk_metadata
+
     def get_mapped_reference_region(self):
         """Return tuple (start,end_exc) so that
         read_dict['Reference'][start:end_exc] is the mapped region
         of the reference"""
-        daclen = len(self['Dacs'])
-        r = self['Ref_to_signal']
-        mappedlocations = np.where((r >= 0) & (r < daclen))[0]  # Locations in the ref that are mapped
-        return np.min(mappedlocations), np.max(mappedlocations) + 1  # +1 to make it exclusive
+        return self.get_chunk_metadata().mapped_reference_region
 
     def get_mapped_dacs_region(self):
         """Return tuple (start,end_exc) so that
         read_dict['Dacs'][start:end_exc] is the mapped region
         of the signal"""
-        r = self['Ref_to_signal']
-        daclen = len(self['Dacs'])
-        r = r[(r >= 0) & (r < daclen)]  # Locations in the signal (not the end points -1, daclen ) that are mapped to
-        return np.min(r), np.max(r) + 1  # +1 to make it exclusive
+        return self.get_chunk_metadata().mapped_dacs_region
+
+    def get_max_dwell(self, ref_region):
+        """Return the maximum dwell, in samples, between consecutive
+        locations in Ref_to_signal[start:end_exc], or 1 if there are none.
+
+        param: ref_region : tuple (start, end_exc) of reference locations
+        """
+        start, end = ref_region
+        if end - start < 2:
+            return 1
+        # Dwells are np.diff(Ref_to_signal)[start:end - 1]; use maxima of the
+        # whole blocks of dwells in the region and look at the parts of
+        # blocks at each end.
+        block_size = ChunkMetadata.block_size
+        first_block = -(-start // block_size)
+        end_block = (end - 1) // block_size
+        if first_block >= end_block:
+            return np.max(np.diff(self._get_slice('Ref_to_signal', start, end)))
+        max_dwell = np.max(self.get_chunk_metadata().block_max_dwell[first_block:end_block])
+        if start < first_block * block_size:
+            max_dwell = max(max_dwell, np.max(np.diff(self._get_slice(
+                'Ref_to_signal', start, first_block * block_size + 1))))
+        if end_block * block_size < end - 1:
+            max_dwell = max(max_dwell, np.max(np.diff(self._get_slice(
+                'Ref_to_signal', end_block * block_size, end))))
+        return max_dwell
 
     def get_reference_locations(self, signal_location_vector):
         """Return reference locations that go with given signal locations.
@@ -190,26 +234,17 @@ class Read(dict):
             dacs = self['Dacs']
         else:
             a, b = region
-            dacs = self['Dacs'][a:b]
+            dacs = self._get_slice('Dacs', a, b)
 
-        current = (dacs + self['offset']) * self['range'] / self['digitisation']
-        return (current - self['shift_frompA']) / self['scale_frompA']
+        return dacs_to_current(dacs, self['offset'], self['range'], self['digitisation'],
+                               shift=self['shift_frompA'], scale=self['scale_frompA'])
 
     def check_for_slip_at_refloc(self, refloc):
         """Return True if there is a slip at reference location refloc.
         This means that the signal location at refloc is the same as
         the signal location that goes with either the previous base
         or the next one."""
-        r = self['Ref_to_signal']
-        sigloc = r[refloc]
-        # print("reftosig[",refloc-1,"-",refloc+1,"]=",r[refloc-1:refloc+2])
-        if refloc < len(r) - 1:
-            if r[refloc + 1] == sigloc:
-                return True
-        if refloc > 1:
-            if r[refloc - 1] == sigloc:
-                return True
-        return False
+        return self.get_chunk_metadata().is_slip(refloc)
 
     def _get_chunk(self, dacs_region, ref_region, verbose=False):
         """
@@ -243,14 +278,8 @@ class Read(dict):
             returndict = {'rejected': 'emptysignal'}
         else:
             current = self.get_standardised_current(dacs_region)
-            reference = self['Reference'][ref_region[0]:ref_region[1]]
-            dwells = np.diff(self['Ref_to_signal'][ref_region[0]:ref_region[1]])
-            # If the ref_region has length 1, then the diff has length zero and the
-            # line to get maxdwell fails. So we need to check length
-            if len(dwells) > 0:
-                maxdwell = np.max(dwells)
-            else:
-                maxdwell = 1
+            reference = self._get_slice('Reference', ref_region[0], ref_region[1])
+            maxdwell = self.get_max_dwell(ref_region)
             returndict = {'current': current,
                           'sequence': reference,
                           'max_dwell': maxdwell,
@@ -319,14 +348,234 @@ class Read(dict):
                 return {'rejected':'tooshort','read_id':self.get('read_id')}
             refstart = start_base + mapped_reference_region[0]
         refend_exc = refstart + chunk_bases
-        dacstart = self['Ref_to_signal'][refstart]
-        dacsend_exc = self['Ref_to_signal'][refend_exc]
+        dacstart, dacsend_exc = self._get_slice('Ref_to_signal', refstart, refend_exc + 1)[[0, -1]]
         #print("get_chunk_with_sequence_length(): ref region",refstart,refend_exc)
         #print("                                  sig region",dacstart,dacsend_exc)
 
         return self._get_chunk((dacstart, dacsend_exc), (refstart, refend_exc))
 
 
+# HDF5 files opened read-only by LazyRead objects, keyed by filename, with
+# the datasets used so far.  h5py file objects must not be shared between
+# processes, so the process id is recorded and files are reopened in a
+# forked child.  Files stay open until close_lazy_files() is called.
+_lazy_files = {}
+
+
+def _get_lazy_dataset(filename, path):
+    pid = os.getpid()
+    h5, opened_by, datasets = _lazy_files.get(filename, (None, None, None))
+    if h5 is None or opened_by != pid:
+        h5 = h5py.File(filename, 'r')
+        datasets = {}
+        _lazy_files[filename] = (h5, pid, datasets)
+    if path not in datasets:
+        datasets[path] = h5[path]
+    return datasets[path]
+
+
+def close_lazy_files():
+    """Close the HDF5 files opened by LazyRead objects in this process.
+
+    LazyRead objects remain usable afterwards: files are reopened when
+    next needed.  Files inherited from a parent process are forgotten
+    without being closed, since the parent may still be using them.
+    """
+    pid = os.getpid()
+    for h5, opened_by, _ in _lazy_files.values():
+        if opened_by == pid:
+            h5.close()
+    _lazy_files.clear()
+
+
+class ChunkMetadata:
+    """Summary of a read used when taking chunks from it, so that the
+    checks on a chunk do not need to look at the whole of Ref_to_signal.
+
+    Attributes:
+        mapped_dacs_region      : tuple (start, end_exc), see
+                                  Read.get_mapped_dacs_region()
+        mapped_reference_region : tuple (start, end_exc), see
+                                  Read.get_mapped_reference_region()
+        slip_locations          : sorted int64 array of locations in
+                                  Ref_to_signal where there is a slip (see
+                                  Read.check_for_slip_at_refloc())
+        block_max_dwell         : int32 array of maximum dwells in each
+                                  block of block_size dwells
+
+    Ref_to_signal is itself the cumulative sum of the dwells, so the mean
+    dwell over any region is found from its ends.
+    """
+    block_size = 64
+
+    def __init__(self, mapped_dacs_region, mapped_reference_region,
+                 slip_locations, block_max_dwell):
+        self.mapped_dacs_region = mapped_dacs_region
+        self.mapped_reference_region = mapped_reference_region
+        self.slip_locations = slip_locations
+        self.block_max_dwell = block_max_dwell
+
+    def is_slip(self, refloc):
+        """Whether there is a slip at a location, or array of locations, in
+        Ref_to_signal"""
+        return in_sorted(self.slip_locations, refloc)
+
+    @classmethod
+    def from_read(cls, read):
+        """Calculate metadata from a Read object"""
+        r = read['Ref_to_signal']
+        daclen = read.get_dacs_length()
+        is_mapped = (r >= 0) & (r < daclen)
+        # Locations in the ref that are mapped
+        mappedlocations = np.flatnonzero(is_mapped)
+        mapped_reference_region = (mappedlocations[0], mappedlocations[-1] + 1)
+        # Locations in the signal (not the end points -1, daclen) that are mapped to
+        mapped_signal = r[is_mapped]
+        mapped_dacs_region = (np.min(mapped_signal), np.max(mapped_signal) + 1)
+
+        # A slip at refloc if the signal location is the same as at the next
+        # reference location or, for refloc > 1, the previous one.
+        stays = np.flatnonzero(r[1:] == r[:-1])
+        slip_locations = np.union1d(stays, stays[stays > 0] + 1).astype(np.int64)
+
+        dwells = np.diff(r)
+        nblock = len(dwells) // cls.block_size
+        block_max_dwell = np.max(
+            dwells[:nblock * cls.block_size].reshape(nblock, cls.block_size),
+            axis=1, initial=np.iinfo(np.int32).min).astype(np.int32)
+        return cls(mapped_dacs_region, mapped_reference_region, slip_locations,
+                   block_max_dwell)
+
+
+_chunk_metadata_dtype = np.dtype([
+    ('read_id', h5py.string_dtype()),
+    ('mapped_dacs_start', np.int64), ('mapped_dacs_end', np.int64),
+    ('mapped_reference_start', np.int64), ('mapped_reference_end', np.int64),
+    ('slip_start', np.int64), ('slip_length', np.int64),
+    ('block_start', np.int64), ('block_length', np.int64)])
+
+
+def _write_chunk_metadata(h5, metadata):
+    """Write dictionary of ChunkMetadata objects, keyed by read_id, to the
+    group ChunkMetadata of an HDF5 file, replacing any already there."""
+    if 'ChunkMetadata' in h5:
+        del h5['ChunkMetadata']
+    group = h5.create_group('ChunkMetadata')
+    table = np.zeros(len(metadata), dtype=_chunk_metadata_dtype)
+    table['read_id'] = list(metadata.keys())
+    values = list(metadata.values())
+    for k, f in (('mapped_dacs', lambda m: m.mapped_dacs_region),
+                 ('mapped_reference', lambda m: m.mapped_reference_region)):
+        regions = np.array([f(m) for m in values], dtype=np.int64).reshape(-1, 2)
+        table[k + '_start'], table[k + '_end'] = regions.T
+    slips = [m.slip_locations for m in values]
+    for k, arrays in (('slip', slips), ('block', [m.block_max_dwell for m in values])):
+        lengths = np.array([len(x) for x in arrays], dtype=np.int64)
+        table[k + '_start'] = np.cumsum(lengths) - lengths
+        table[k + '_length'] = lengths
+    group.create_dataset('Index', data=table)
+    group.create_dataset('SlipLocations', data=np.concatenate(
+        [np.zeros(0, dtype=np.int64)] + slips))
+    group.create_dataset('BlockMaxDwell', data=np.concatenate(
+        [np.zeros(0, dtype=np.int32)] + [m.block_max_dwell for m in values]))
+
+
+def _read_chunk_metadata(h5):
+    """Return dictionary of ChunkMetadata objects, keyed by read_id, from
+    the group ChunkMetadata of an HDF5 file, or an empty dict if there is
+    no such group."""
+    if 'ChunkMetadata' not in h5:
+        return {}
+    group = h5['ChunkMetadata']
+    table = group['Index'][()]
+    slip_locations = group['SlipLocations'][()]
+    block_max_dwell = group['BlockMaxDwell'][()]
+    metadata = {}
+    for row in table:
+        metadata[_to_str(row['read_id'])] = ChunkMetadata(
+            (row['mapped_dacs_start'], row['mapped_dacs_end']),
+            (row['mapped_reference_start'], row['mapped_reference_end']),
+            slip_locations[row['slip_start']:row['slip_start'] + row['slip_length']],
+            block_max_dwell[row['block_start']:row['block_start'] + row['block_length']])
+    return metadata
+
+
+class LazyRead(Read):
+    """A Read whose arrays (Dacs, Reference, Ref_to_signal) are left in
+    the HDF5 file until needed.
+
+    Only the attributes of the read (scalings, read_id, ...) are held in the
+    dictionary.  Indexing the read with the name of an array reads the whole
+    array from the file; chunk functions read only the slices they need.
+
+    The arrays behave as items of the read: they are listed by keys(),
+    found by `in` and get(), and loaded by items(), values() and copies
+    such as dict(read).  Only the attributes are pickled.
+
+    The file is reopened, read-only, the first time it is used in each
+    process so LazyRead objects may be shared with worker processes.
+    """
+
+    def __init__(self, d, filename, path):
+        """
+        :param d: dictionary of read attributes
+        :param filename: HDF5 file containing the read
+        :param path: path within the file of the group containing the arrays
+        """
+        super().__init__(d)
+        self.filename = filename
+        self.path = path
+        self._arrays = None
+
+    def _dataset(self, name):
+        return _get_lazy_dataset(self.filename, self.path + '/' + name)
+
+    def _array_names(self):
+        """Return names of arrays held in the file but not in the dictionary"""
+        if self._arrays is None:
+            self._arrays = list(_get_lazy_dataset(self.filename, self.path).keys())
+        return [name for name in self._arrays if not dict.__contains__(self, name)]
+
+    def __contains__(self, name):
+        return dict.__contains__(self, name) or name in self._array_names()
+
+    def __iter__(self):
+        yield from dict.__iter__(self)
+        yield from self._array_names()
+
+    def __len__(self):
+        return dict.__len__(self) + len(self._array_names())
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    def keys(self):
+        return KeysView(self)
+
+    def items(self):
+        return ItemsView(self)
+
+    def values(self):
+        return ValuesView(self)
+
+    def __reduce__(self):
+        # Pickle the attributes only, not arrays loaded from the file
+        return (self.__class__.__new__, (self.__class__,), self.__dict__,
+                None, iter(dict.items(self)))
+
+    def __missing__(self, name):
+        try:
+            return self._dataset(name)[()]
+        except KeyError:
+            raise KeyError(name)
+
+    def _get_slice(self, name, start, end):
+        return self._dataset(name)[start:end]
+
+    def get_dacs_length(self):
+        return self._dataset('Dacs').shape[0]
+
+
 class AbstractMappedSignalFile(ABC):
     """Abstract base class for files containing mapped reads.
     Methods specified as abstractnethod must be overridden
@@ -377,6 +626,25 @@ class AbstractMappedSignalFile(ABC):
         """Return a read object containing all elements of the read."""
         pass
 
+    def get_chunk_metadata(self):
+        """Return dictionary of ChunkMetadata objects saved in the file,
+        keyed by read_id.  Derived classes that can save metadata should
+        override this function: by default there is none."""
+        return {}
+
+    def write_chunk_metadata(self, metadata):
+        """Save dictionary of ChunkMetadata objects, keyed by read_id, in the
+        file, replacing any already saved.  Derived classes that can store
+        metadata should override this function."""
+        raise NotImplementedError(
+            '{} cannot store chunk metadata'.format(type(self).__name__))
+
+    def get_lazy_read(self, read_id):
+        """Return a read object that loads its arrays when they are needed.
+        Derived classes that can do this should override this function: by
+        default the whole read is loaded."""
+        return self.get_read(read_id)
+
     @abstractmethod
     def get_read_ids(self):
         """Return list of read ids, or empty list if none present"""
@@ -399,13 +667,17 @@ class AbstractMappedSignalFile(ABC):
 
     # This function is not abstract because it can be left as-is.
     # But it may be overridden if there are speed gains to be had
-    def get_multiple_reads(self, read_id_list, return_list=True, max_reads=None):
+    def get_multiple_reads(self, read_id_list, return_list=True, max_reads=None,
+                           lazy=False):
         """Get dictionary where keys are read ids from the list
         and values are the read objects. If read_id_list=="all" then get
         them all.
         If return_list, then return a list of read objects where the read_ids
         are incorporated in the dicts.
         If not, then a dict of dicts where the keys are the read_ids.
+        If lazy, then the read objects are those returned by get_lazy_read(),
+        which may not hold the signal and reference in memory.
+        Chunk metadata saved in the file is attached to the read objects.
         If a read_id in the list is not present in the file, then just skip.
         Don't raise an exception."""
         read_ids_in_file = self.get_read_ids()
@@ -415,11 +687,23 @@ class AbstractMappedSignalFile(ABC):
             read_ids_used = set(read_id_list).intersection(read_ids_in_file)
         if max_reads is not None and max_reads < len(read_ids_used):
             read_ids_used = random.sample(list(read_ids_used), max_reads)  # choose a random subset
+        saved_metadata = self.get_chunk_metadata()
+
+        def get_read(read_id):
+            read = self.get_lazy_read(read_id) if lazy else self.get_read(read_id)
+            read.chunk_metadata = saved_metadata.get(read_id)
+            return read
+
         if return_list:
-            # Make a new read object containing the read_id as well as other items, for each read id in the list
-            return [Read({**self.get_read(read_id), 'read_id': read_id}) for read_id in read_ids_used]
+            # Incorporate the read_id in each read object
+            reads = []
+            for read_id in read_ids_used:
+                read = get_read(read_id)
+                read['read_id'] = read_id
+                reads.append(read)
+            return reads
         else:
-            return {read_id: self.get_read(read_id) for read_id in read_ids_used}
+            return {read_id: get_read(read_id) for read_id in read_ids_used}
 
     def check_read(self, read_id):
         """Check a read in the currently open file, returning "pass" or a report
@@ -475,6 +759,7 @@ class HDF5(AbstractMappedSignalFile):
     """
 
     def __init__(self, filename, mode):
+        self.filename = filename
         self.hdf5 = h5py.File(filename, mode)
 
     def close(self):
@@ -494,6 +779,18 @@ class HDF5(AbstractMappedSignalFile):
             d[k] = v
         return Read(d)
 
+    def get_lazy_read(self, read_id):
+        """Return a LazyRead object holding only the attributes of the read.
+        The file must not be modified while the read is in use."""
+        path = self._get_read_path(read_id)
+        return LazyRead(dict(self.hdf5[path].attrs.items()), self.filename, path)
+
+    def get_chunk_metadata(self):
+        return _read_chunk_metadata(self.hdf5)
+
+    def write_chunk_metadata(self, metadata):
+        _write_chunk_metadata(self.hdf5, metadata)
+
     def get_read_ids(self):
         """Return list of read ids, or empty list if none present"""
         try:
@@ -515,3 +812,260 @@ class HDF5(AbstractMappedSignalFile):
 
     def write_version_number(self, version_number=_version):
         self.hdf5.attrs['version'] = version_number
+
+
+_packed_version = 8
+
+
+class PackedLazyRead(LazyRead):
+    """A LazyRead for reads stored in a PackedHDF5 file, where the arrays
+    of the read are slices of datasets shared by all reads."""
+
+    def __init__(self, d, filename, path, extents):
+        """
+        :param d: dictionary of read attributes
+        :param filename: HDF5 file containing the read
+        :param path: path within the file of the group containing the
+            concatenated arrays
+        :param extents: dictionary mapping array name to a tuple
+            (start, length) giving the location of the read's data
+        """
+        super().__init__(d, filename, path)
+        self.extents = extents
+        self._arrays = list(extents.keys())
+
+    def __missing__(self, name):
+        if name not in self.extents:
+            raise KeyError(name)
+        return self._get_slice(name, 0, self.extents[name][1])
+
+    def _get_slice(self, name, start, end):
+        offset, length = self.extents[name]
+        start, end, _ = slice(start, end).indices(length)
+        return self._dataset(name)[offset + start:offset + max(start, end)]
+
+    def get_dacs_length(self):
+        return self.extents['Dacs'][1]
+
+
+class PackedHDF5(AbstractMappedSignalFile):
+    """A file storing mapped reads in HDF5 with the arrays of all reads
+    concatenated, so that opening the file and getting reads does not
+    involve a group and several datasets per read.
+
+      file--|---Reads--|--Dacs           (int16, all reads concatenated)
+            |          |--Reference      (int16, all reads concatenated)
+            |          |--Ref_to_signal  (int32, all reads concatenated)
+            |          |--Index          (table with row per read: read_id,
+            |          |                  start and length of each array)
+            |          |--Attributes     (table with row per read, column
+            |                             per scalar item in the read)
+            version (8)
+            layout ('packed')
+
+    The index and attribute tables are held in memory while the file is
+    open.  Reads written are buffered and appended to the datasets, and
+    their rows to the tables, in blocks; all reads written must have the
+    same set of attributes.
+    """
+    layout = 'packed'
+    # Size of HDF5 chunks for concatenated arrays
+    chunk_size = 65536
+    # Size of HDF5 chunks, in rows, for index and attribute tables
+    table_chunk_size = 1024
+    array_names = ('Dacs', 'Reference', 'Ref_to_signal')
+    index_dtype = np.dtype([('read_id', h5py.string_dtype()),
+                            ('Dacs_start', np.int64), ('Dacs_length', np.int64),
+                            ('Reference_start', np.int64), ('Reference_length', np.int64),
+                            ('Ref_to_signal_start', np.int64), ('Ref_to_signal_length', np.int64)])
+
+    def __init__(self, filename, mode, buffer_samples=10000000):
+        """Open file in read-only mode (mode="r"), create a new file
+        (mode="w") or append to an existing one, creating it if necessary
+        (mode="a").
+
+        :param buffer_samples: reads written are buffered until their total
+            signal length exceeds this
+        """
+        self.filename = filename
+        self.buffer_samples = buffer_samples
+        self.hdf5 = h5py.File(filename, mode)
+        self.buffer = []
+        self.buffered_samples = 0
+        self.datasets = {}
+        if 'Reads' in self.hdf5:
+            reads = self.hdf5['Reads']
+            self.index = reads['Index'][()].astype(self.index_dtype)
+            # Strings are read as objects and must be marked as strings
+            # again to be written back
+            attributes = reads['Attributes'][()]
+            self.attributes = attributes.astype([
+                (k, h5py.string_dtype() if attributes.dtype[k] == object
+                 else attributes.dtype[k]) for k in attributes.dtype.names])
+        else:
+            self.index = np.zeros(0, dtype=self.index_dtype)
+            self.attributes = None
+        self.read_numbers = {_to_str(read_id): n
+                             for n, read_id in enumerate(self.index['read_id'])}
+
+    def close(self):
+        if self.hdf5.mode != 'r':
+            self._flush()
+        self.hdf5.close()
+
+    def _read_attributes(self, read_number):
+        row = self.attributes[read_number]
+        return {k: _to_str(row[k]) for k in self.attributes.dtype.names}
+
+    def _extents(self, read_number):
+        row = self.index[read_number]
+        return {k: (row[k + '_start'], row[k + '_length']) for k in self.array_names}
+
+    def _read_number(self, read_id):
+        """Position of read in index, writing it to the file first if it is
+        still buffered"""
+        read_number = self.read_numbers[read_id]
+        if read_number >= len(self.index):
+            self._flush()
+        return read_number
+
+    def get_read(self, read_id):
+        """Return a read object (see class definition above)."""
+        read_number = self._read_number(read_id)
+        d = self._read_attributes(read_number)
+        for k, (start, length) in self._extents(read_number).items():
+            if k not in self.datasets:
+                self.datasets[k] = self.hdf5['Reads'][k]
+            d[k] = self.datasets[k][start:start + length]
+        d['read_id'] = read_id
+        return Read(d)
+
+    def get_lazy_read(self, read_id):
+        """Return a PackedLazyRead object holding only the attributes of the
+        read.  The file must not be modified while the read is in use."""
+        read_number = self._read_number(read_id)
+        d = self._read_attributes(read_number)
+        d['read_id'] = read_id
+        return PackedLazyRead(d, self.filename, 'Reads',
+                              self._extents(read_number))
+
+    def get_read_ids(self):
+        """Return list of read ids, or empty list if none present"""
+        return list(self.read_numbers.keys())
+
+    def get_chunk_metadata(self):
+        return _read_chunk_metadata(self.hdf5)
+
+    def write_chunk_metadata(self, metadata):
+        _write_chunk_metadata(self.hdf5, metadata)
+
+    def get_version_number(self):
+        return self.hdf5.attrs['version']
+
+    def _attributes_dtype(self, read):
+        """Numpy dtype for attribute table, with a column for each scalar
+        item in the read"""
+        columns = []
+        for k in sorted(read.keys()):
+            v = read[k]
+            if k == 'read_id' or isinstance(v, np.ndarray):
+                continue
+            if isinstance(v, str):
+                columns.append((k, h5py.string_dtype()))
+            else:
+                columns.append((k, np.array(v).dtype))
+        return np.dtype(columns)
+
+    def write_read(self, read_id, read):
+        """Write a read to the appropriate place in the file, starting from a read object"""
+        assert read_id not in self.read_numbers, \
+            'Read {} already in file'.format(read_id)
+        if self.attributes is None:
+            self.attributes = np.zeros(0, dtype=self._attributes_dtype(read))
+        assert self._attributes_dtype(read).names == self.attributes.dtype.names, \
+            'Attributes of read {} differ from those of reads already in file'.format(read_id)
+        self.read_numbers[read_id] = len(self.read_numbers)
+        self.buffer.append((read_id, read))
+        self.buffered_samples += len(read['Dacs'])
+        if self.buffered_samples >= self.buffer_samples:
+            self._flush()
+
+    def _flush(self):
+        """Append buffered reads to datasets in file"""
+        if len(self.buffer) == 0:
+            return
+        reads = self.hdf5.require_group('Reads')
+
+        new_index = np.zeros(len(self.buffer), dtype=self.index_dtype)
+        new_index['read_id'] = [read_id for read_id, _ in self.buffer]
+        for k in self.array_names:
+            arrays = [read[k] for _, read in self.buffer]
+            lengths = np.array([len(x) for x in arrays], dtype=np.int64)
+            if k in reads:
+                dataset = reads[k]
+            else:
+                dataset = reads.create_dataset(
+                    k, shape=(0,), maxshape=(None,), chunks=(self.chunk_size,),
+                    dtype=Read.read_data[k].split('_')[1])
+            old_length = len(dataset)
+            new_index[k + '_start'] = old_length + np.cumsum(lengths) - lengths
+            new_index[k + '_length'] = lengths
+            dataset.resize((old_length + np.sum(lengths),))
+            dataset[old_length:] = np.concatenate(arrays)
+
+        new_attributes = np.zeros(len(self.buffer), dtype=self.attributes.dtype)
+        for n, (_, read) in enumerate(self.buffer):
+            for k in self.attributes.dtype.names:
+                new_attributes[n][k] = read[k]
+
+        self.index = np.concatenate([self.index, new_index])
+        self.attributes = np.concatenate([self.attributes, new_attributes])
+        self._append_rows(reads, 'Index', self.index, new_index)
+        self._append_rows(reads, 'Attributes', self.attributes, new_attributes)
+        self.buffer = []
+        self.buffered_samples = 0
+
+    def _append_rows(self, reads, name, table, new_rows):
+        """Append new rows to a table in the file, creating it from the
+        whole table if necessary"""
+        if name in reads and reads[name].maxshape != (None,):
+            # Table cannot be resized, so replace it once
+            del reads[name]
+        if name not in reads:
+            reads.create_dataset(name, data=table, maxshape=(None,),
+                                 chunks=(self.table_chunk_size,))
+            return
+        dataset = reads[name]
+        old_length = len(dataset)
+        dataset.resize((old_length + len(new_rows),))
+        dataset[old_length:] = new_rows
+
+    def write_version_number(self, version_number=_packed_version):
+        self.hdf5.attrs['version'] = version_number
+        self.hdf5.attrs['layout'] = self.layout
+
+
+def _to_str(x):
+    """Strings from HDF5 tables may be returned as bytes"""
+    if isinstance(x, bytes):
+        return x.decode()
+    return x
+
+
+def open_mapped_signal_file(filename, mode='r', layout=None):
+    """Open a mapped signal file with the class appropriate to its layout.
+
+    :param filename: file to open
+    :param mode: mode to open file in, as for the classes
+    :param layout: layout of a file being created, PackedHDF5.layout
+        ('packed') for PackedHDF5 or None for HDF5.  Ignored for an existing
+        file, whose layout is found from the file.
+
+    :returns: PackedHDF5 or HDF5 object
+    """
+    if mode in ('r', 'r+') or (mode == 'a' and os.path.exists(filename)):
+        with h5py.File(filename, 'r') as h5:
+            layout = h5.attrs.get('layout')
+    if _to_str(layout) == PackedHDF5.layout:
+        return PackedHDF5(filename, mode)
+    return HDF5(filename, mode)
@@ -77,13 +77,10 @@ class Mapping:
                  where self.signal.untrimmed_dacs[startsample:endsample_exc]
                  is the region that is included in the mapping.
         """
-        firstmapped, lastmapped = -1, -1
-        for untrimmed_dacloc, refloc in enumerate(self.signalpos_to_refpos):
-            if refloc >= 0:
-                if firstmapped < 0:
-                    firstmapped = untrimmed_dacloc
-                lastmapped = untrimmed_dacloc
-        if firstmapped >= 0:  # If we have found any mapped locations
+        mapped = np.asarray(self.signalpos_to_refpos) >= 0
+        if mapped.any():  # If we have found any mapped locations
+            firstmapped = int(np.argmax(mapped))
+            lastmapped = len(mapped) - 1 - int(np.argmax(mapped[::-1]))
             startloc = firstmapped + mapping_margin
             endloc = lastmapped + 1 - mapping_margin
             if startloc <= endloc - 1:
@@ -199,9 +196,27 @@ class Mapping:
         return ref_to_sig
 
     def add_integer_reference(self, alphabet):
-        self.integer_reference = np.array([
-            alphabet.index(i) for i in self.reference], dtype=np.int16)
-        return
+        """Set self.integer_reference, the position in alphabet of each base
+        of the reference, using a lookup table indexed by character code
+
+        param: alphabet : str or list of single characters
+
+        Raises ValueError if the reference contains a character that is not
+        in alphabet
+        """
+        charcodes = np.frombuffer(self.reference.encode('utf-32-le'), dtype=np.uint32)
+        bases = [(code, ord(base)) for code, base in enumerate(alphabet) if len(base) == 1]
+        ncharcode = 1 + max([charcodes.max(initial=0)] + [charcode for _, charcode in bases])
+        encoding = np.full(ncharcode, -1, dtype=np.int16)
+        #  First occurrence of a base in alphabet takes precedence, as for index
+        for code, charcode in reversed(bases):
+            encoding[charcode] = code
+        integer_reference = encoding[charcodes]
+        unknown = np.flatnonzero(integer_reference < 0)
+        if len(unknown) > 0:
+            raise ValueError('Reference contains {!r}, which is not in alphabet {!r}'.format(
+                self.reference[unknown[0]], alphabet))
+        self.integer_reference = integer_reference
 
     def get_read_dictionary(self, shift, scale, read_id, check=True):
         """Return a read dictionary of the sort specified in mapped_signal_files.Read.
@@ -241,8 +256,9 @@ class Mapping:
         the reference on the end, starting with a #"""
         with open(filename, "w") as f:
             f.write("dac signal dactoref\n")
-            for dac, refpos in zip(self.signal.untrimmed_dacs, self.signalpos_to_refpos):
-                sig = (dac + self.signal.offset) * self.signal.range / self.signal.digitisation
-                f.write(str(dac) + " " + str(sig) + " " + str(refpos) + "\n")
+            f.writelines(map("{} {} {}\n".format,
+                             self.signal.untrimmed_dacs.tolist(),
+                             self.signal.untrimmed_current.tolist(),
+                             np.asarray(self.signalpos_to_refpos).tolist()))
             if appendRef:
                 f.write("#" + self.reference)
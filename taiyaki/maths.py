@@ -45,6 +45,125 @@ def mad(data, factor=None, axis=None, keepdims=False):
     return dmad
 
 
+def med_mad_dacs(dacs, offset=0.0, pa_range=1.0, digitisation=1.0, factor=None):
+    """Compute the median and MAD of the current of a read exactly from its
+    integer DACs, in time linear in the length of the read
+
+    The result is identical to med_mad(current) where
+    current = (dacs + offset) * pa_range / digitisation, as for Signal.current,
+    but the DACs are counted rather than the current being sorted.
+
+    :param dacs: A 1D :class:`ndarray` of integers
+    :param offset, pa_range, digitisation: Parameters converting DACs to pA
+    :param factor: Factor to scale MAD by, see med_mad
+
+    :returns: a tuple containing the median and MAD of the current
+    """
+    dmed, dmad = med_mad_dacs_batch([dacs], [offset], [pa_range], [digitisation],
+                                    factor=factor)
+    return dmed[0], dmad[0]
+
+
+def med_mad_dacs_batch(dacs_list, offset, pa_range, digitisation, factor=None):
+    """Compute the median and MAD of the current of many reads, see med_mad_dacs
+
+    The DACs of each read are counted over the range of values of that read
+    only, and the counts for all reads are kept end to end in a single array,
+    so time and memory are the same as counting each read separately.
+
+    :param dacs_list: A list of 1D :class:`ndarray` of integers, one per read
+    :param offset, pa_range, digitisation: Parameters converting DACs to pA for
+        each read, as arrays or scalars
+    :param factor: Factor to scale MAD by, see med_mad
+
+    :returns: a tuple containing arrays of the median and MAD for each read,
+        NaN for empty reads
+    """
+    if factor is None:
+        factor = 1.4826
+    nread = len(dacs_list)
+    offset, pa_range, digitisation = (np.broadcast_to(np.asarray(x, dtype=float), (nread,))
+                                      for x in (offset, pa_range, digitisation))
+    lengths = np.array([len(dacs) for dacs in dacs_list], dtype=int)
+    dmed = np.full(nread, np.nan)
+    dmad = np.full(nread, np.nan)
+    used = np.flatnonzero(lengths > 0)
+    if len(used) == 0:
+        return dmed, dmad
+
+    offset, pa_range, digitisation = offset[used], pa_range[used], digitisation[used]
+    lengths = lengths[used]
+
+    def to_current(dacs):
+        return (dacs + offset) * pa_range / digitisation
+
+    def starts_of(sizes):
+        return np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    values = np.concatenate([dacs_list[i] for i in used]).astype(np.int64)
+    first = starts_of(lengths)
+    lowest = np.minimum.reduceat(values, first)
+    nvalue = np.maximum.reduceat(values, first) - lowest + 1
+
+    #  Counts of each DAC value of each read, reads end to end.  Elements of
+    #  read i are at positions first[i] onwards of the cumulative counts.
+    value_start = starts_of(nvalue)
+    values += np.repeat(value_start - lowest, lengths)
+    counts = np.bincount(values, minlength=nvalue.sum())
+    cumcounts = np.cumsum(counts)
+
+    #  Positions of the two middle elements, equal for reads of odd length
+    k = np.stack([(lengths - 1) // 2, lengths // 2])
+
+    #  Median: find DAC value at middle positions
+    middle = np.stack([np.searchsorted(cumcounts, first + kk, side='right')
+                       for kk in k]) - value_start + lowest
+    middle_current = to_current(middle)
+    read_med = (middle_current[0] + middle_current[1]) / 2
+
+    #  MAD: count DACs by twice their deviation from median, so deviations are integers
+    twice_med = middle[0] + middle[1]
+    ndeviation = 2 * nvalue - 1
+    deviation_start = starts_of(ndeviation)
+    value_read = np.repeat(np.arange(len(used)), nvalue)
+    value_dacs = np.arange(len(counts)) - value_start[value_read] + lowest[value_read]
+    deviation = np.abs(2 * value_dacs - twice_med[value_read])
+    dev_counts = np.bincount(deviation_start[value_read] + deviation,
+                             weights=counts, minlength=ndeviation.sum())
+    dev_cumcounts = np.cumsum(dev_counts)
+
+    def count_of(dacs, valid):
+        column = dacs - lowest
+        valid = valid & (column >= 0) & (column < nvalue)
+        return np.where(valid, counts[value_start + np.clip(column, 0, nvalue - 1)], 0)
+
+    mid_dev = []
+    for kk in k:
+        position = first + kk
+        level_index = np.searchsorted(dev_cumcounts, position, side='right')
+        level = level_index - deviation_start
+        #  Count before this level is that of all earlier reads if level is 0
+        position = position - np.where(level_index > 0,
+                                       dev_cumcounts[np.maximum(level_index - 1, 0)], 0)
+        #  DACs at this deviation below and above the median, and their
+        #  deviations in pA, which may differ by rounding error
+        valid = (twice_med - level) % 2 == 0
+        below, above = (twice_med - level) // 2, (twice_med + level) // 2
+        nbelow = count_of(below, valid)
+        nabove = count_of(above, valid & (level > 0))
+        dev_below = np.abs(to_current(below) - read_med)
+        dev_above = np.abs(to_current(above) - read_med)
+        below_first = (nbelow > 0) & ((nabove == 0) | (dev_below <= dev_above))
+        nfirst = np.where(below_first, nbelow, nabove)
+        dev_first = np.where(below_first, dev_below, dev_above)
+        dev_second = np.where(below_first, dev_above, dev_below)
+        mid_dev.append(np.where(position < nfirst, dev_first, dev_second))
+
+    dmed[used] = read_med
+    dmad[used] = factor * ((mid_dev[0] + mid_dev[1]) / 2)
+    return dmed, dmad
+
+
 def studentise(x, axis=None):
     """  Studentise a numpy array along a given axis
     :param x: A :class:`ndaray`
@@ -118,3 +237,18 @@ def rle(x, tol=0):
     runlength = np.ediff1d(starts, to_end=last_runlength)
 
     return (x[starts], runlength)
+
+
+def in_sorted(sorted_values, x):
+    """  Whether elements of x are in a sorted array, found by binary search
+
+    :param sorted_values: 1D array sorted in increasing order
+    :param x: value or array of values to look for
+
+    :returns: bool, or bool array with same shape as x
+    """
+    sorted_values = np.asarray(sorted_values)
+    if len(sorted_values) == 0:
+        return np.zeros(np.shape(x), dtype=bool)[()]
+    i = np.searchsorted(sorted_values, x)
+    return sorted_values[np.minimum(i, len(sorted_values) - 1)] == x
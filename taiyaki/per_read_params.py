@@ -0,0 +1,268 @@
+""" Columnar store of per-read parameters
+
+The per-read parameter .tsv (columns UUID, trim_start, trim_end, shift and
+scale, as written by generate_per_read_params.py) is parsed once into a
+structured array with one row per read, and an open-addressing hash table
+giving the row of each read id.  Both are saved next to the .tsv file as
+numpy arrays and later opened as memory maps, so starting up is quick and
+worker processes share the same pages rather than each holding a copy.
+"""
+from bz2 import BZ2File as bzopen
+from collections.abc import Mapping
+from gzip import open as gzopen
+import numpy as np
+import os
+import sys
+
+
+PARAMS_SUFFIX = '.params.npy'
+HASH_SUFFIX = '.hash.npy'
+PARAM_FIELDS = ('trim_start', 'trim_end', 'shift', 'scale')
+
+_FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+_FNV_PRIME = np.uint64(0x100000001b3)
+_UINT64_MASK = 0xffffffffffffffff
+
+
+def _tsv_header(tsv_file_name):
+    """Column names of a tsv file, which may be compressed"""
+    opener = {'.gz': gzopen, '.bz2': bzopen}.get(os.path.splitext(tsv_file_name)[1], open)
+    with opener(tsv_file_name, 'rt') as fh:
+        return fh.readline().rstrip('\n').split('\t')
+
+
+def hash_read_ids(read_ids):
+    """FNV-1a hash of each of an array of read ids
+
+    :param read_ids: array of read ids as bytes (dtype S)
+
+    :returns: :class:`ndarray` of uint64
+    """
+    read_ids = np.ascontiguousarray(read_ids, dtype=bytes)
+    width = read_ids.dtype.itemsize
+    chars = read_ids.view(np.uint8).reshape(len(read_ids), width)
+    hashes = np.full(len(read_ids), _FNV_OFFSET)
+    with np.errstate(over='ignore'):
+        for i in range(width):
+            #  Padding at end of shorter ids does not contribute
+            c = chars[:, i]
+            hashes = np.where(c != 0, (hashes ^ c) * _FNV_PRIME, hashes)
+    return hashes
+
+
+def build_hash_table(read_ids):
+    """Open addressing hash table, with linear probing, of distinct read ids
+
+    :param read_ids: array of distinct read ids as bytes (dtype S)
+
+    :returns: :class:`ndarray` of int64 whose length is a power of two at
+        least twice the number of read ids, containing the position of each
+        read id in read_ids at or after the slot given by its hash, and -1
+        for empty slots
+    """
+    nslot = 1 << max(1, int(2 * len(read_ids) - 1).bit_length())
+    mask = np.uint64(nslot - 1)
+    table = np.full(nslot, -1, dtype=np.int64)
+
+    pending = np.arange(len(read_ids))
+    slot = (hash_read_ids(read_ids) & mask).astype(np.int64)
+    while len(pending) > 0:
+        #  Each empty slot is claimed by the first pending read wanting it
+        empty = table[slot] == -1
+        _, first = np.unique(slot[empty], return_index=True)
+        claimed = np.flatnonzero(empty)[first]
+        table[slot[claimed]] = pending[claimed]
+        waiting = np.ones(len(pending), dtype=bool)
+        waiting[claimed] = False
+        pending = pending[waiting]
+        slot = (slot[waiting] + 1) & (nslot - 1)
+    return table
+
+
+def read_per_read_params_tsv(tsv_file_name):
+    """Parse per-read parameter .tsv into a structured array
+
+    If a read id occurs more than once, the last row for it is kept.
+
+    :param tsv_file_name: name of .tsv file, which may be compressed
+
+    :returns: structured array with fields read_id (bytes), trim_start,
+        trim_end, shift and scale
+    """
+    header = _tsv_header(tsv_file_name)
+    columns = ('UUID',) + PARAM_FIELDS
+    missing = set(columns) - set(header)
+    if missing:
+        raise KeyError('File {} does not contain requested required fields {}'.format(
+            tsv_file_name, sorted(missing)))
+    table = np.loadtxt(tsv_file_name, dtype=str, delimiter='\t', skiprows=1,
+                       usecols=[header.index(c) for c in columns], ndmin=2,
+                       comments=None)
+    read_ids = np.char.encode(table[:, 0])
+
+    #  Distinct read ids, taking last row with each read id
+    _, last = np.unique(read_ids[::-1], return_index=True)
+    keep = np.sort(len(read_ids) - 1 - last)
+
+    width = max(1, read_ids.dtype.itemsize)
+    params = np.empty(len(keep), dtype=[('read_id', 'S{}'.format(width)),
+                                        ('trim_start', 'i8'), ('trim_end', 'i8'),
+                                        ('shift', 'f8'), ('scale', 'f8')])
+    params['read_id'] = read_ids[keep]
+    for i, field in enumerate(PARAM_FIELDS, 1):
+        params[field] = table[keep, i].astype(params.dtype[field])
+    return params
+
+
+def load_per_read_params(tsv_file_name, cache_prefix=None):
+    """Open cached per-read parameters, parsing the .tsv and saving the cache
+    if it does not exist or is older than the .tsv
+
+    :param tsv_file_name: name of .tsv file
+    :param cache_prefix: prefix of names of cache files, to which
+        PARAMS_SUFFIX and HASH_SUFFIX are appended.  Defaults to tsv_file_name
+
+    :returns: tuple (params as returned by read_per_read_params_tsv, hash table
+        as returned by build_hash_table, cache_prefix or None if the cache
+        could not be saved)
+    """
+    if cache_prefix is None:
+        cache_prefix = tsv_file_name
+    params_file_name = cache_prefix + PARAMS_SUFFIX
+    hash_file_name = cache_prefix + HASH_SUFFIX
+    tsv_mtime = os.path.getmtime(tsv_file_name)
+    if all(os.path.exists(f) and os.path.getmtime(f) >= tsv_mtime
+           for f in (params_file_name, hash_file_name)):
+        return (np.load(params_file_name, mmap_mode='r'),
+                np.load(hash_file_name, mmap_mode='r'), cache_prefix)
+
+    params = read_per_read_params_tsv(tsv_file_name)
+    table = build_hash_table(params['read_id'])
+    try:
+        for file_name, data in (params_file_name, params), (hash_file_name, table):
+            tmp_file_name = file_name + '.tmp'
+            with open(tmp_file_name, 'wb') as fh:
+                np.save(fh, data)
+            os.replace(tmp_file_name, file_name)
+    except OSError as e:
+        sys.stderr.write('Failed to save cache of {} to {}, keeping parameters in memory.\n{}\n'.format(
+            tsv_file_name, cache_prefix, repr(e)))
+        return params, table, None
+    return (np.load(params_file_name, mmap_mode='r'),
+            np.load(hash_file_name, mmap_mode='r'), cache_prefix)
+
+
+class PerReadParams(Mapping):
+    """Dictionary-like access to per-read parameters by read id
+
+    Behaves like the dictionary of dictionaries previously returned by
+    prepare_mapping_funcs.get_per_read_params_dict_from_tsv: looking up a
+    read id gives a dictionary with keys trim_start, trim_end, shift and
+    scale.  The columns are also available as arrays through the params
+    attribute, and many read ids can be looked up at once with find.
+
+    Pickling only stores the names of the cache files, so the store can be
+    given to worker processes cheaply; each process maps the files when first
+    used.
+    """
+
+    def __init__(self, tsv_file_name, cache_prefix=None):
+        """
+        :param tsv_file_name: name of per-read parameter .tsv file
+        :param cache_prefix: prefix of cache file names, see load_per_read_params
+        """
+        self.tsv_file_name = tsv_file_name
+        self._params, self._table, self.cache_prefix = load_per_read_params(
+            tsv_file_name, cache_prefix)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.cache_prefix is not None:
+            state['_params'] = None
+            state['_table'] = None
+        return state
+
+    @property
+    def params(self):
+        """Structured array of parameters, see read_per_read_params_tsv"""
+        if self._params is None:
+            self._params = np.load(self.cache_prefix + PARAMS_SUFFIX, mmap_mode='r')
+        return self._params
+
+    @property
+    def table(self):
+        """Hash table of read ids, see build_hash_table"""
+        if self._table is None:
+            self._table = np.load(self.cache_prefix + HASH_SUFFIX, mmap_mode='r')
+        return self._table
+
+    def find(self, read_ids):
+        """Rows of params for many read ids at once
+
+        :param read_ids: iterable of read ids, as str or bytes
+
+        :returns: :class:`ndarray` of int64 giving row of each read id in
+            params, or -1 if the read id is not present
+        """
+        keys = np.array([read_id.encode() if isinstance(read_id, str) else read_id
+                         for read_id in read_ids], dtype=bytes)
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        if len(keys) == 0 or len(self.params) == 0:
+            return rows
+        table = self.table
+        mask = len(table) - 1
+        known = self.params['read_id']
+
+        pending = np.arange(len(keys))
+        slot = (hash_read_ids(keys) & np.uint64(mask)).astype(np.int64)
+        while len(pending) > 0:
+            row = table[slot]
+            empty = row == -1
+            match = ~empty
+            match[match] = known[row[match]] == keys[pending[match]]
+            rows[pending[match]] = row[match]
+            probing = ~(empty | match)
+            pending = pending[probing]
+            slot = (slot[probing] + 1) & mask
+        return rows
+
+    def _find(self, read_id):
+        """Row of read id in params, or None if not present
+
+        Same as find but for a single read id, avoiding array overheads
+        """
+        if len(self.params) == 0:
+            return None
+        key = read_id.encode() if isinstance(read_id, str) else read_id
+        hashval = int(_FNV_OFFSET)
+        for c in key:
+            if c != 0:
+                hashval = ((hashval ^ c) * int(_FNV_PRIME)) & _UINT64_MASK
+
+        table = self.table
+        mask = len(table) - 1
+        known = self.params['read_id']
+        slot = hashval & mask
+        while True:
+            row = table[slot]
+            if row == -1:
+                return None
+            if known[row] == key:
+                return row
+            slot = (slot + 1) & mask
+
+    def __getitem__(self, read_id):
+        row = self._find(read_id)
+        if row is None:
+            raise KeyError(read_id)
+        record = self.params[row]
+        return {field: record[field] for field in PARAM_FIELDS}
+
+    def __contains__(self, read_id):
+        return self._find(read_id) is not None
+
+    def __iter__(self):
+        return (read_id.decode() for read_id in self.params['read_id'])
+
+    def __len__(self):
+        return len(self.params)
@@ -3,9 +3,9 @@ import numpy as np
 import sys
 from ont_fast5_api import fast5_interface
 import torch
-from taiyaki import flipflop_remap, helpers, mapping, mapped_signal_files, signal
+from taiyaki import basecall_helpers, fast5utils, flipflop_remap, helpers, mapping, mapped_signal_files, signal
 from taiyaki.config import taiyaki_dtype
-from taiyaki.fileio import readtsv
+from taiyaki.per_read_params import PerReadParams
 
 
 READ_ID_INFO_NOT_FOUND_ERR_TEXT = 'No information for read id found in file.'
@@ -15,31 +15,54 @@ REMAP_ERR_TEXT = 'Failure applying basecall network to remap read.'
 REMAP_SUCCESS_TEXT = ''
 
 
-def oneread_remap(read_tuple, references, model, device, per_read_params_dict,
-                  alphabet_info):
-    """ Worker function for remapping reads using flip-flop model on raw signal
+def oneread_prepare(read_tuple, references, per_read_params_dict):
+    """ Worker function loading a read, its reference and its per-read parameters,
+    the first stage of remapping
     :param read_tuple                 : read, identified by a tuple (filepath, read_id)
-    :param references                 :dict mapping fast5 filenames to reference strings
-    :param model                      :pytorch model (the torch data structure, not a filename)
-    :param device                     :integer specifying which GPU to use for remapping, or 'cpu' to use CPU
+    :param references                 :dict or fasta_index.IndexedFasta mapping read ids to reference strings
     :param per_read_params_dict       :dictionary where keys are UUIDs, values are dicts containing keys
                                          trim_start trim_end shift scale
-    :param alphabet_info              : AlphabetInfo object for basecalling
 
-    :returns: tuple of dictionary as specified in mapped_signal_files.Read class
-              and a message string indicating an error if one occured
+    :returns: tuple of (trimmed Signal object, reference, per-read parameters, read_id),
+              or None if an error occured, and a message string indicating the error
     """
     filename, read_id = read_tuple
     try:
         with fast5_interface.get_fast5_file(filename, 'r') as f5file:
             read = f5file.get_read(read_id)
-            sig = signal.Signal(read)
+            return prepare_read(read_id, read, references, per_read_params_dict)
     except Exception:
         return None, READ_ID_INFO_NOT_FOUND_ERR_TEXT
 
-    if read_id in references:
-        read_ref = references[read_id]
-    else:
+
+def file_prepare(file_batch, references, per_read_params_dict):
+    """ Worker function doing oneread_prepare for a batch of reads from one
+    file, opening the file once
+    :param file_batch                 : tuple (filepath, list of read_ids) as yielded by
+                                         fast5utils.batch_file_reads
+    :param references, per_read_params_dict : see oneread_prepare
+
+    :returns: list of results of oneread_prepare for each read
+    """
+    filename, read_ids = file_batch
+    return [prepare_read(read_id, read, references, per_read_params_dict)
+            for read_id, read in fast5utils.iterate_file_reads(filename, read_ids)]
+
+
+def prepare_read(read_id, read, references, per_read_params_dict):
+    """ Load a read from an ont_fast5_api read object, see oneread_prepare
+    :param read_id                    : read_id of read
+    :param read                       : ont_fast5_api read object, or None if read could not be found
+
+    :returns: as for oneread_prepare
+    """
+    try:
+        sig = signal.Signal(read)
+    except Exception:
+        return None, READ_ID_INFO_NOT_FOUND_ERR_TEXT
+
+    read_ref = references.get(read_id)
+    if read_ref is None:
         return None, NO_REF_FOUND_ERR_TEXT
 
     try:
@@ -49,32 +72,107 @@ def oneread_remap(read_tuple, references, model, device, per_read_params_dict,
 
     sig.set_trim_absolute(read_params_dict['trim_start'], read_params_dict['trim_end'])
 
-    try:
-        torch.set_num_threads(1)  # Prevents torch doing its own parallelisation on top of our imap_map
-        # Standardise (i.e. shift/scale so that approximately mean =0, std=1)
-        signalArray = (sig.current - read_params_dict['shift']) / read_params_dict['scale']
-        # Make signal into 3D tensor with shape [siglength,1,1] and move to appropriate device (GPU  number or CPU)
-        signalTensor = torch.tensor(signalArray[:, np.newaxis, np.newaxis].astype(taiyaki_dtype) , device=device)
-        # The model must live on the same device
-        modelOnDevice = model.to(device)
-        # Apply the network to the signal, generating transition weight matrix, and put it back into a numpy array
-        with torch.no_grad():
-            transweights = modelOnDevice(signalTensor).cpu().numpy()
-    except Exception:
-        return None, REMAP_ERR_TEXT
+    return (sig, read_ref, read_params_dict, read_id), REMAP_SUCCESS_TEXT
+
+
+def standardised_current(sig, read_params_dict):
+    """ Standardise (i.e. shift/scale so that approximately mean =0, std=1) the
+    trimmed current of a read
+    :param sig             : Signal object
+    :param read_params_dict: dict containing keys shift scale
+
+    :returns: np array of taiyaki_dtype
+    """
+    return sig.standardised_current(read_params_dict['shift'], read_params_dict['scale'],
+                                    dtype=taiyaki_dtype)
+
+
+def run_remap_network(prepared_reads, model, model_stride,
+                      batch_size=basecall_helpers._DEFAULT_BATCH_SIZE,
+                      chunk_size=None, overlap=0):
+    """ Inference stage of remapping, applying the network to batches of reads
+    The model is applied in the process calling this function, so a single copy
+    on a single device serves all the workers doing the remapping itself.
+
+    Reads are divided into chunks, and chunks from several reads of equal length
+    are run through the network together, see basecall_helpers.ChunkBatcher.  The
+    network outputs for each read are stitched back together.  If the network
+    fails for a batch, for example running out of memory on the device, each
+    read with a chunk in the batch fails with REMAP_ERR_TEXT.
+    :param prepared_reads : iterable of results of oneread_prepare
+    :param model          : pytorch model, already on the device to use
+    :param model_stride   : stride of model
+    :param batch_size     : maximum number of chunks to run through network at once
+    :param chunk_size     : length of chunks in samples, or None to run the network
+                            on each whole read
+    :param overlap        : overlap between chunks in samples
+
+    :yields: tuple of (tuple of (Signal, reference, per-read parameters, read_id,
+             np array of transition weights) or None if an error occured,
+             message string) for oneread_remap_network_output
+    """
+    device = next(model.parameters()).device
+    batcher = basecall_helpers.ChunkBatcher(batch_size)
+
+    def run_batches(flush=False):
+        for batch, provenance in batcher.batches(flush=flush):
+            try:
+                with torch.no_grad():
+                    out = model(torch.tensor(batch, device=device))
+            except Exception:
+                for _ in batcher.drop_reads(provenance):
+                    yield None, REMAP_ERR_TEXT
+                continue
+            for prepared, (read_out,), chunk_starts, chunk_ends in batcher.add_output(
+                    provenance, (out,)):
+                transweights = basecall_helpers.stitch_chunks(
+                    read_out, chunk_starts, chunk_ends, model_stride)
+                yield prepared + (transweights.cpu().numpy(),), REMAP_SUCCESS_TEXT
+
+    for prepared, mesg in prepared_reads:
+        if prepared is None:
+            yield None, mesg
+            continue
+        sig, _, read_params_dict, _ = prepared
+        signalArray = standardised_current(sig, read_params_dict)
+        read_chunk_size = len(signalArray) if chunk_size is None else chunk_size
+        batcher.add_read(prepared, *basecall_helpers.chunk_read(
+            signalArray, read_chunk_size, overlap))
+        yield from run_batches()
+    yield from run_batches(flush=True)
+
+
+def oneread_remap_network_output(network_result, alphabet_info, model_stride,
+                                 band_width=None, low_memory=False):
+    """ Worker function remapping a read using the output of a flip-flop network,
+    the final stage of remapping
+    :param network_result             : tuple of result of run_remap_network
+                                         for read and message string
+    :param alphabet_info              : AlphabetInfo object for basecalling
+    :param model_stride               : stride of model
+    :param band_width                 : initial width of band for banded remapping,
+                                         or None to remap against whole reference
+    :param low_memory                 : use checkpointed traceback for remapping
+
+    :returns: tuple of dictionary as specified in mapped_signal_files.Read class
+              and a message string indicating an error if one occured
+    """
+    remap_input, mesg = network_result
+    if remap_input is None:
+        return None, mesg
+    sig, read_ref, read_params_dict, read_id, transweights = remap_input
 
-    # Extra dimensions introduced by np.newaxis above removed by np.squeeze
-    can_read_ref = alphabet_info.collapse_sequence(read_ref)
-    remappingscore, path = flipflop_remap.flipflop_remap(
-        np.squeeze(transweights), can_read_ref,
-        alphabet=alphabet_info.can_bases, localpen=0.0)
     # read_ref comes out as a bytes object, so we need to convert to str
     # localpen=0.0 does local alignment
+    can_read_ref = alphabet_info.collapse_sequence(read_ref)
+    remappingscore, path = flipflop_remap.flipflop_remap(
+        transweights, can_read_ref,
+        alphabet=alphabet_info.can_bases, localpen=0.0, band_width=band_width,
+        low_memory=low_memory)
 
     # flipflop_remap() establishes a mapping between the network outputs and the reference.
     # What we need is a mapping between the signal and the reference.
     # To resolve this we need to know the stride of the model (how many samples for each network output)
-    model_stride = helpers.guess_model_stride(model)
     remapping = mapping.Mapping.from_remapping_path(
         sig, path, read_ref, model_stride)
     remapping.add_integer_reference(alphabet_info.alphabet)
@@ -84,6 +182,51 @@ def oneread_remap(read_tuple, references, model, device, per_read_params_dict,
                                          read_id), REMAP_SUCCESS_TEXT
 
 
+def oneread_remap(read_tuple, references, model, device, per_read_params_dict,
+                  alphabet_info, band_width=None, low_memory=False):
+    """ Worker function for remapping reads using flip-flop model on raw signal
+    Applies the network to each read separately; prepare_mapped_reads.py uses
+    the pipeline oneread_prepare -> run_remap_network -> oneread_remap_network_output
+    instead.
+    :param read_tuple                 : read, identified by a tuple (filepath, read_id)
+    :param references                 :dict or fasta_index.IndexedFasta mapping read ids to reference strings
+    :param model                      :pytorch model (the torch data structure, not a filename)
+    :param device                     :integer specifying which GPU to use for remapping, or 'cpu' to use CPU
+    :param per_read_params_dict       :dictionary where keys are UUIDs, values are dicts containing keys
+                                         trim_start trim_end shift scale
+    :param alphabet_info              : AlphabetInfo object for basecalling
+    :param band_width                 : initial width of band for banded remapping,
+                                         or None to remap against whole reference
+    :param low_memory                 : use checkpointed traceback for remapping
+
+    :returns: tuple of dictionary as specified in mapped_signal_files.Read class
+              and a message string indicating an error if one occured
+    """
+    prepared, mesg = oneread_prepare(read_tuple, references, per_read_params_dict)
+    if prepared is None:
+        return None, mesg
+    sig, _, read_params_dict, _ = prepared
+
+    try:
+        torch.set_num_threads(1)  # Prevents torch doing its own parallelisation on top of our imap_map
+        signalArray = standardised_current(sig, read_params_dict)
+        # Make signal into 3D tensor with shape [siglength,1,1] and move to appropriate device (GPU  number or CPU)
+        signalTensor = torch.tensor(signalArray[:, np.newaxis, np.newaxis], device=device)
+        # The model must live on the same device
+        modelOnDevice = model.to(device)
+        # Apply the network to the signal, generating transition weight matrix, and put it back into a numpy array
+        with torch.no_grad():
+            transweights = modelOnDevice(signalTensor).cpu().numpy()
+    except Exception:
+        return None, REMAP_ERR_TEXT
+
+    # Extra dimensions introduced by np.newaxis above removed by np.squeeze
+    model_stride = helpers.guess_model_stride(model)
+    return oneread_remap_network_output(
+        (prepared + (np.squeeze(transweights),), mesg), alphabet_info,
+        model_stride, band_width=band_width, low_memory=low_memory)
+
+
 def generate_output_from_results(results, output, alphabet_info):
     """
     Given an iterable of dictionaries, each representing the results of mapping
@@ -118,20 +261,14 @@ def generate_output_from_results(results, output, alphabet_info):
 
 
 def get_per_read_params_dict_from_tsv(input_file):
-    """Load per read parameter .tsv into a np array and parse into a dictionary
+    """Load per read parameter .tsv into a dictionary-like columnar store,
+    caching it next to the .tsv for quick loading by later runs
     :param input_file     :   filename including path for the tsv file
-    :returns:                 dictionary with keys being UUIDs, values being named
-                              tuple('per_read_params', 'trim_start trim_end shift scale')"""
+    :returns:                 per_read_params.PerReadParams, behaving as a dictionary
+                              with keys being UUIDs, values being dictionaries with
+                              keys trim_start trim_end shift scale"""
     try:
-        per_read_params_array = readtsv(input_file, ['UUID', 'trim_start', 'trim_end', 'shift', 'scale'])
+        return PerReadParams(input_file)
     except Exception as e:
         sys.stderr.write('Failed to get per-read parameters from {}.\n{}\n'.format(input_file, repr(e)))
         return None
-
-    per_read_params_dict = {}
-    for row in per_read_params_array:
-        per_read_params_dict[row[0]] = {'trim_start': row[1],
-                                        'trim_end': row[2],
-                                        'shift': row[3],
-                                        'scale': row[4]}
-    return per_read_params_dict
@@ -1,6 +1,54 @@
 # Defines class to represent a signal - used in chunkifying
 
+import numpy as np
+
 from taiyaki import fast5utils
+from taiyaki.config import taiyaki_dtype
+from taiyaki.maths import med_mad_dacs, med_mad_dacs_batch
+
+
+#  Number of samples converted at once, so temporary arrays stay in cache
+_BLOCK_SIZE = 65536
+
+
+def dacs_to_current(dacs, offset, pa_range, digitisation, shift=None, scale=None,
+                    out=None, dtype=np.float64):
+    """Convert DACs to current in pA, optionally standardising it, in one pass
+
+    The current (dacs + offset) * pa_range / digitisation, and then
+    (current - shift) / scale if shift and scale are given, is evaluated in
+    double precision over blocks of samples and written to the output, so no
+    temporary arrays as long as the signal are made and the result is the same
+    as evaluating the expression directly and converting to dtype.
+
+    :param dacs: 1D :class:`ndarray` of integer DACs
+    :param offset, pa_range, digitisation: Parameters converting DACs to pA
+    :param shift, scale: Parameters to standardise the current, or None
+    :param out: 1D :class:`ndarray` of same length as dacs to write result to,
+        or None to allocate one
+    :param dtype: dtype of array allocated if out is None
+
+    :returns: out, or newly allocated array
+    """
+    if out is None:
+        out = np.empty(len(dacs), dtype=dtype)
+    elif out.shape != (len(dacs),):
+        raise ValueError('Output buffer has shape {} but signal has length {}'.format(
+            out.shape, len(dacs)))
+    standardise = shift is not None and scale is not None
+
+    block = np.empty(min(len(dacs), _BLOCK_SIZE), dtype=np.float64)
+    for start in range(0, len(dacs), _BLOCK_SIZE):
+        end = min(start + _BLOCK_SIZE, len(dacs))
+        x = block[:end - start]
+        np.add(dacs[start:end], offset, out=x)
+        x *= pa_range
+        x /= digitisation
+        if standardise:
+            x -= shift
+            x /= scale
+        out[start:end] = x
+    return out
 
 
 class Signal:
@@ -80,20 +128,71 @@ class Signal:
 
     @property
     def dacs(self):
-        """dac numbers, trimmed according to trimming parameters"""
-        return self.untrimmed_dacs[self.signalstart:self.signalend_exc].copy()
+        """dac numbers, trimmed according to trimming parameters
+
+        This is a read-only view of untrimmed_dacs, not a copy.
+        """
+        dacs = self.untrimmed_dacs[self.signalstart:self.signalend_exc]
+        dacs.flags.writeable = False
+        return dacs
 
     @property
     def untrimmed_current(self):
         """Signal measured in pA, untrimmed"""
-        return (self.untrimmed_dacs + self.offset) * self.range / self.digitisation
+        return dacs_to_current(self.untrimmed_dacs, self.offset, self.range,
+                               self.digitisation)
 
     @property
     def current(self):
         """Signal measured in pA, trimmed according to trimming parameters"""
-        return (self.dacs + self.offset) * self.range / self.digitisation
+        return dacs_to_current(self.dacs, self.offset, self.range, self.digitisation)
+
+    def standardised_current(self, shift=None, scale=None, out=None,
+                             dtype=taiyaki_dtype):
+        """Trimmed current standardised as (current - shift) / scale
+
+        Equal to ((self.current - shift) / scale).astype(dtype), computed in
+        a single pass without full length temporary arrays.
+
+        :param shift, scale: Parameters in pA.  If either is None, the median
+            and MAD of the current are used instead
+        :param out: 1D :class:`ndarray` of length trimmed_length to write
+            result to, or None to allocate one
+        :param dtype: dtype of array allocated if out is None
+
+        :returns: out, or newly allocated array
+        """
+        if shift is None or scale is None:
+            shift, scale = self.med_mad()
+        return dacs_to_current(self.dacs, self.offset, self.range, self.digitisation,
+                               shift=shift, scale=scale, out=out, dtype=dtype)
 
     @property
     def trimmed_length(self):
         """Trimmed length of the signal in samples"""
         return self.signalend_exc - self.signalstart
+
+    def med_mad(self, factor=None):
+        """Median and MAD of trimmed current, identical to maths.med_mad(self.current)
+        but computed by counting the integer DACs rather than sorting the current
+
+        :param factor: Factor to scale MAD by, see maths.med_mad
+
+        :returns: tuple (median, MAD) in pA
+        """
+        return med_mad_dacs(self.dacs, self.offset, self.range, self.digitisation,
+                            factor=factor)
+
+
+def med_mad_batch(signals, factor=None):
+    """Median and MAD of trimmed current of many signals at once, see Signal.med_mad
+
+    :param signals: list of Signal objects
+    :param factor: Factor to scale MAD by, see maths.med_mad
+
+    :returns: tuple of arrays (medians, MADs) in pA, NaN for empty signals
+    """
+    return med_mad_dacs_batch(
+        [sig.dacs for sig in signals],
+        [sig.offset for sig in signals], [sig.range for sig in signals],
+        [sig.digitisation for sig in signals], factor=factor)
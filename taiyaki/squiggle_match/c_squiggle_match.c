@@ -548,7 +548,8 @@ float squiggle_match_posterior(float const * signal, size_t nsample, float const
 
 
 void squiggle_match_grad(float const * signal, int32_t const * siglen, size_t nbatch,
-                         float const * params, size_t npos, float prob_back, float * grad){
+                         float const * params, size_t npos, float prob_back, float * score,
+                         float * grad){
     size_t sigidx[nbatch];
     sigidx[0] = 0;
     for(size_t idx=1 ; idx < nbatch ; idx++){
@@ -568,8 +569,8 @@ void squiggle_match_grad(float const * signal, int32_t const * siglen, size_t nb
         for(size_t pos=0 ; pos < npos ; pos++){
             scale[pos] = expf(params[param_offset + pos * ldp + 1]);
         }
-        squiggle_match_forward(signal + signal_offset, nsample, params + param_offset,
-                               ldp, scale, npos, prob_back, fwd);
+        score[batch] = squiggle_match_forward(signal + signal_offset, nsample, params + param_offset,
+                                              ldp, scale, npos, prob_back, fwd);
         squiggle_match_backward(signal + signal_offset, nsample, params + param_offset,
                                 ldp, scale, npos, prob_back, bwd);
 
@@ -695,7 +696,7 @@ int main(void){
 
 
     float * grad = calloc(msize, sizeof(float));
-    squiggle_match_grad(test_signal, test_siglen, nbatch, test_param, npos, prob_back, grad);
+    squiggle_match_grad(test_signal, test_siglen, nbatch, test_param, npos, prob_back, score, grad);
     float maxdelta = 0.0;
     for(size_t pos=0 ; pos < npos ; pos++){
         const size_t offset = pos * nbatch *nparam;
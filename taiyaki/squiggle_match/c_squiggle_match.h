@@ -3,7 +3,8 @@
 void squiggle_match_cost(float const * signal, int32_t const * siglen, size_t nbatch,
                          float const * params, size_t npos, float prob_back, float * score);
 void squiggle_match_grad(float const * signal, int32_t const * siglen, size_t nbatch,
-                         float const * params, size_t npos, float prob_back, float * grad);
+                         float const * params, size_t npos, float prob_back, float * score,
+                         float * grad);
 void squiggle_match_viterbi_path(float const * signal, int32_t const * siglen, size_t nbatch,
                                  float const * params, size_t npos, float prob_back, float localpen,
                                  float minscore, int32_t * path, float * score);
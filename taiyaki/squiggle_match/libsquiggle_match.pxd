@@ -1,9 +1,10 @@
 from libc.stdint cimport int32_t
-cdef extern from "c_squiggle_match.h":
+cdef extern from "c_squiggle_match.h" nogil:
     void squiggle_match_cost(const float * signal, const int32_t * siglen, size_t nbatch,
                              const float * params, size_t npos, float prob_back, float * score)
     void squiggle_match_grad(const float * signal, const int32_t * siglen, size_t nbatch,
-                             const float * params, size_t npos, float prob_back, float * grad)
+                             const float * params, size_t npos, float prob_back, float * score,
+                             float * grad)
     void squiggle_match_viterbi_path(const float * signal, const int32_t * siglen,
                                      size_t nbatch, const float * params, size_t npos,
                                      float prob_back, float localpen, float minscore,
@@ -7,9 +7,10 @@ import os
 import sys
 
 from ont_fast5_api import fast5_interface
-from taiyaki import config, helpers
+from taiyaki import config, fast5utils, helpers
 from taiyaki.maths import mad
 from taiyaki.constants import DEFAULT_ALPHABET, LARGE_LOG_VAL
+from taiyaki.tensor_bridge import cpu_array, output_tensor
 
 import torch
 
@@ -22,12 +23,15 @@ _cartesian_tetrahedron = np.array([[1.0, 0.0, -1.0 / np.sqrt(2.0)],
                                   dtype=config.taiyaki_dtype)
 
 
+#  Inputs may be torch tensors or numpy arrays.  They are passed to the C
+#  functions without copying if already contiguous on the CPU and of the
+#  right type, and the C functions run without holding the GIL.  Costs and
+#  gradients are returned as CPU tensors.
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def squiggle_match_cost(np.ndarray[np.float32_t, ndim=3, mode="c"] params,
-                        np.ndarray[np.float32_t, ndim=1, mode="c"] signal,
-                        np.ndarray[np.int32_t, ndim=1, mode="c"] siglen,
-                        back_prob):
+def squiggle_match_cost(params, signal, siglen, back_prob):
     """Forward scores of matching observed signals to predicted squiggles
 
     :param params: A [length, batch, 3] numpy array of predicted squiggle parameters.
@@ -36,48 +40,64 @@ def squiggle_match_cost(np.ndarray[np.float32_t, ndim=3, mode="c"] params,
     :param seqlen: Length of each signal
     :param back_prob: Probably of entering the backsampling state
     """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] params_arr = cpu_array(params)
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] signal_arr = cpu_array(signal)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] siglen_arr = cpu_array(siglen, np.int32)
     cdef size_t npos, nbatch
-    npos, nbatch = params.shape[0], params.shape[1]
-
-    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs = np.zeros((nbatch,), dtype=np.float32)
-    libsquiggle_match.squiggle_match_cost(&signal[0], &siglen[0], nbatch,
-                                          &params[0, 0, 0], npos, back_prob,
-                                          &costs[0])
+    npos, nbatch = params_arr.shape[0], params_arr.shape[1]
 
-    return -costs
+    costs, costs_t = output_tensor((nbatch,))
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs_arr = costs_t
+    cdef float prob_back = float(back_prob)
+    with nogil:
+        libsquiggle_match.squiggle_match_cost(&signal_arr[0], &siglen_arr[0], nbatch,
+                                              &params_arr[0, 0, 0], npos, prob_back,
+                                              &costs_arr[0])
+    np.negative(costs_arr, out=costs_arr)
+    return costs
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def squiggle_match_grad(np.ndarray[np.float32_t, ndim=3, mode="c"] params,
-                        np.ndarray[np.float32_t, ndim=1, mode="c"] signal,
-                        np.ndarray[np.int32_t, ndim=1, mode="c"] siglen,
-                        back_prob):
-    """Gradient of forward scores of matching observed signals to predicted squiggles
+def squiggle_match_grad(params, signal, siglen, back_prob, costs=None, grads=None):
+    """Forward scores of matching observed signals to predicted squiggles and
+    their gradient, calculated together in a single pass
 
     :param params: A [length, batch, 3] numpy array of predicted squiggle parameters.
         The 3 features are predicted level, spread and movement rate
     :param signal: A vector containing observed signals, concatenated
     :param seqlen: Length of each signal
     :param back_prob: Probably of entering the backsampling state
-    """
-    cdef size_t nblk, nbatch, nstate
-    npos, nbatch = params.shape[0], params.shape[1]
-
-    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] grads = np.zeros_like(params, dtype=np.float32)
-    libsquiggle_match.squiggle_match_grad(&signal[0], &siglen[0], nbatch,
-                                          &params[0, 0, 0], npos, back_prob,
-                                          &grads[0, 0, 0])
+    :param costs: contiguous CPU float32 tensor to write costs into, or None
+    :param grads: contiguous CPU float32 tensor, the same shape as params,
+        to write gradients into, or None
 
-    return -grads
+    :returns: tuple (costs, grads) where costs are as returned by
+        squiggle_match_cost and grads is their gradient with respect to params
+    """
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] params_arr = cpu_array(params)
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] signal_arr = cpu_array(signal)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] siglen_arr = cpu_array(siglen, np.int32)
+    cdef size_t npos, nbatch
+    npos, nbatch = params_arr.shape[0], params_arr.shape[1]
+
+    costs, costs_t = output_tensor((nbatch,), out=costs)
+    grads, grads_t = output_tensor((npos, nbatch, params_arr.shape[2]), out=grads)
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs_arr = costs_t
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] grads_arr = grads_t
+    cdef float prob_back = float(back_prob)
+    with nogil:
+        libsquiggle_match.squiggle_match_grad(&signal_arr[0], &siglen_arr[0], nbatch,
+                                              &params_arr[0, 0, 0], npos, prob_back,
+                                              &costs_arr[0], &grads_arr[0, 0, 0])
+    np.negative(costs_arr, out=costs_arr)
+    np.negative(grads_arr, out=grads_arr)
+    return costs, grads
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def squiggle_match_path(np.ndarray[np.float32_t, ndim=3, mode="c"] params,
-                        np.ndarray[np.float32_t, ndim=1, mode="c"] signal,
-                        np.ndarray[np.int32_t, ndim=1, mode="c"] siglen,
-                        back_prob, localpen, minscore):
+def squiggle_match_path(params, signal, siglen, back_prob, localpen, minscore):
     """Viterbi scores and paths of matching observed signals to predicted squiggles
 
     :param params: A [length, batch, 3] numpy array of predicted squiggle parameters.
@@ -86,17 +106,22 @@ def squiggle_match_path(np.ndarray[np.float32_t, ndim=3, mode="c"] params,
     :param seqlen: Length of each signal
     :param back_prob: Probably of entering the backsampling state
     """
-    cdef size_t nblk, nbatch, nstate
-    npos, nbatch = params.shape[0], params.shape[1]
-    localpen = localpen if localpen is not None else LARGE_LOG_VAL
-    minscore = minscore if minscore is not None else LARGE_LOG_VAL
+    cdef np.ndarray[np.float32_t, ndim=3, mode="c"] params_arr = cpu_array(params)
+    cdef np.ndarray[np.float32_t, ndim=1, mode="c"] signal_arr = cpu_array(signal)
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] siglen_arr = cpu_array(siglen, np.int32)
+    cdef size_t npos, nbatch
+    npos, nbatch = params_arr.shape[0], params_arr.shape[1]
+    cdef float prob_back = float(back_prob)
+    cdef float lpen = localpen if localpen is not None else LARGE_LOG_VAL
+    cdef float mscore = minscore if minscore is not None else LARGE_LOG_VAL
 
     cdef np.ndarray[np.float32_t, ndim=1, mode="c"] costs = np.zeros((nbatch,), dtype=np.float32)
-    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] paths = np.zeros_like(signal, dtype=np.int32)
-    libsquiggle_match.squiggle_match_viterbi_path(&signal[0], &siglen[0], nbatch,
-                                                  &params[0, 0, 0], npos,
-                                                  back_prob, localpen, minscore,
-                                                  &paths[0], &costs[0])
+    cdef np.ndarray[np.int32_t, ndim=1, mode="c"] paths = np.zeros_like(signal_arr, dtype=np.int32)
+    with nogil:
+        libsquiggle_match.squiggle_match_viterbi_path(&signal_arr[0], &siglen_arr[0], nbatch,
+                                                      &params_arr[0, 0, 0], npos,
+                                                      prob_back, lpen, mscore,
+                                                      &paths[0], &costs[0])
 
     return -costs, paths
 
@@ -132,9 +157,7 @@ def init_worker(model, reference_file):
 
 def worker(fast5_read_tuple, trim, back_prob, localpen, minscore):
     fast5_name, read_id = fast5_read_tuple
-    if read_id in references:
-       refseq = references[read_id]
-    else:
+    if read_id not in references:
         sys.stderr.write('Reference not found for {}\n'.format(read_id))
         return None
 
@@ -146,6 +169,38 @@ def worker(fast5_read_tuple, trim, back_prob, localpen, minscore):
         sys.stderr.write('Error reading {}\n'.format(read_id))
         return None
 
+    return match_read(read_id, signal, trim, back_prob, localpen, minscore)
+
+
+def file_worker(file_batch, trim, back_prob, localpen, minscore):
+    """Apply worker to a batch of reads from one fast5 file, opening it once
+
+    :param file_batch: tuple (filename, list of read_ids), as yielded by
+        fast5utils.batch_file_reads
+
+    :returns: list of results of worker for each read
+    """
+    fast5_name, read_ids = file_batch
+    results = []
+    for read_id, read in fast5utils.iterate_file_reads(fast5_name, read_ids):
+        if read_id not in references:
+            sys.stderr.write('Reference not found for {}\n'.format(read_id))
+            results.append(None)
+            continue
+        try:
+            signal = read.get_raw_data()
+        except:
+            sys.stderr.write('Error reading {}\n'.format(read_id))
+            results.append(None)
+            continue
+        results.append(match_read(read_id, signal, trim, back_prob, localpen,
+                                  minscore))
+    return results
+
+
+def match_read(read_id, signal, trim, back_prob, localpen, minscore):
+    refseq = references[read_id]
+
     signal = helpers.trim_array(signal, *trim)
     assert len(signal) > 0
 
@@ -166,30 +221,37 @@ def worker(fast5_read_tuple, trim, back_prob, localpen, minscore):
 
 
 class SquiggleMatch(torch.autograd.Function):
-    """Pytorch autograd function wrapping squiggle_match_cost"""
+    """Pytorch autograd function wrapping squiggle_match_grad
+
+    The cost and gradient are calculated together in forward and the gradient
+    kept for backward, so the dynamic programming is only done once per call.
+    """
     @staticmethod
     def forward(ctx, params, signal, siglen, back_prob):
-        ctx.save_for_backward(params, signal, siglen, torch.tensor(back_prob))
-        params = np.ascontiguousarray(params.detach().cpu().numpy().astype(np.float32))
-        signal = np.ascontiguousarray(signal.detach().cpu().numpy().astype(np.float32))
-        siglen = np.ascontiguousarray(siglen.detach().cpu().numpy().astype(np.int32))
-        back_prob = float(back_prob)
-        cost = squiggle_match_cost(params, signal, siglen, back_prob)
-        return torch.tensor(cost)
+        cost, grad = squiggle_match_grad(params, signal, siglen, back_prob)
+        ctx.save_for_backward(grad.to(dtype=params.dtype, device=params.device))
+        return cost
 
     @staticmethod
     def backward(ctx, output_grads):
-        params, signal, siglen, back_prob = ctx.saved_tensors
-        device = params.device
-        dtype = params.dtype
-        params = np.ascontiguousarray(params.detach().cpu().numpy().astype(np.float32))
-        signal = np.ascontiguousarray(signal.detach().cpu().numpy().astype(np.float32))
-        siglen = np.ascontiguousarray(siglen.detach().cpu().numpy().astype(np.int32))
-        back_prob = float(back_prob)
-        grad = squiggle_match_grad(params, signal, siglen, back_prob)
-        grad = torch.tensor(grad, dtype=dtype, device=device)
-        output_grads = output_grads.unsqueeze(1).to(device)
+        grad, = ctx.saved_tensors
+        output_grads = output_grads.unsqueeze(1).to(grad.device)
         return grad * output_grads, None, None, None
 
 
-squiggle_match_loss = SquiggleMatch.apply
+def squiggle_match_loss(params, signal, siglen, back_prob):
+    """Cost of matching each observed signal to its predicted squiggle
+
+    When gradients are not required, for example when evaluating a model
+    inside a `torch.no_grad()` block, only the cost is calculated.
+
+    :param params: A [length, batch, 3] tensor of predicted squiggle parameters
+    :param signal: Tensor containing observed signals, concatenated
+    :param siglen: Tensor containing length of each signal
+    :param back_prob: Probability of entering the backsampling state
+
+    :returns: Tensor containing cost of each signal
+    """
+    if torch.is_grad_enabled() and params.requires_grad:
+        return SquiggleMatch.apply(params, signal, siglen, back_prob)
+    return squiggle_match_cost(params, signal, siglen, back_prob)
@@ -0,0 +1,51 @@
+""" Passing torch tensors to and from compiled code
+
+The compiled extensions (taiyaki.ctc, taiyaki.squiggle_match and
+taiyaki.decoding) work on pointers to contiguous CPU arrays.  Inputs that are
+already contiguous CPU tensors of the right type are passed by sharing their
+memory rather than copied, and outputs are written directly into torch
+tensors through numpy arrays sharing their memory.
+"""
+import numpy as np
+import torch
+
+
+def cpu_array(x, dtype=np.float32):
+    """Contiguous numpy array on the CPU containing the values of x
+
+    No copy is made if x is a contiguous CPU tensor or array of the requested
+    type: the array returned shares memory with x.
+
+    :param x: :class:`torch.Tensor`, :class:`ndarray` or array-like
+    :param dtype: numpy type of array returned
+
+    :returns: C-contiguous :class:`ndarray` of type dtype
+    """
+    if isinstance(x, torch.Tensor):
+        x = x.detach()
+        if x.device.type != 'cpu':
+            x = x.cpu()
+        x = x.numpy()
+    return np.ascontiguousarray(x, dtype=dtype)
+
+
+def output_tensor(shape, dtype=torch.float32, out=None):
+    """CPU tensor for compiled code to write into, and a numpy array sharing
+    its memory
+
+    :param shape: shape of tensor
+    :param dtype: torch type of tensor
+    :param out: a contiguous CPU tensor of the given shape and type to reuse,
+        or None to allocate a new, uninitialised, tensor
+
+    :returns: tuple (tensor, :class:`ndarray`)
+    """
+    shape = tuple(shape)
+    if out is None:
+        out = torch.empty(shape, dtype=dtype)
+    elif (out.device.type != 'cpu' or out.dtype != dtype or
+          tuple(out.shape) != shape or not out.is_contiguous()):
+        raise ValueError(
+            'Output must be a contiguous CPU tensor of type {} and shape {}, got {} {} on {}'.format(
+                dtype, shape, out.dtype, tuple(out.shape), out.device))
+    return out, out.detach().numpy()
@@ -0,0 +1,139 @@
+import unittest
+import numpy as np
+import torch
+
+from taiyaki import basecall_helpers, layers
+
+
+class ChunkBatcherTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        rng = np.random.RandomState(0xdeadbeef)
+        self.chunk_size = 100
+        self.overlap = 20
+        self.stride = 2
+        lengths = list(2 * rng.randint(15, 500, size=25)) + [50, 50, 50]
+        self.signals = [rng.normal(size=n).astype('f4') for n in lengths]
+
+    def run_batched(self, batch_size, max_wait=None, fail_batch=None):
+        """ 'Network' sums pairs of samples, giving stride 2, and fails for
+        batch number fail_batch
+        """
+        batcher = basecall_helpers.ChunkBatcher(batch_size, max_wait)
+        results = {}
+        self.failed_provenance = None
+        nbatch = 0
+
+        def run_batches(flush=False):
+            nonlocal nbatch
+            for batch, provenance in batcher.batches(flush=flush):
+                self.assertLessEqual(batch.shape[1], batch_size)
+                self.assertEqual(len(provenance), batch.shape[1])
+                nbatch += 1
+                if nbatch - 1 == fail_batch:
+                    self.failed_provenance = provenance
+                    for i in batcher.drop_reads(provenance):
+                        self.assertNotIn(i, results)
+                        results[i] = None
+                    continue
+                out = torch.tensor(batch[::2] + batch[1::2])
+                for i, (read_out,), starts, ends in batcher.add_output(
+                        provenance, (out,)):
+                    results[i] = basecall_helpers.stitch_chunks(
+                        read_out, starts, ends, self.stride).numpy()
+
+        for i, signal in enumerate(self.signals):
+            chunks, starts, ends = basecall_helpers.chunk_read(
+                signal, self.chunk_size, self.overlap)
+            batcher.add_read(i, chunks, starts, ends)
+            run_batches()
+        run_batches(flush=True)
+        self.assertEqual(batcher.nreads, 0)
+        return results
+
+    def test_batched_outputs_match_per_read(self):
+        for batch_size in 1, 3, 16, 1000:
+            results = self.run_batched(batch_size)
+            self.assertEqual(len(results), len(self.signals))
+            for i, signal in enumerate(self.signals):
+                chunks, starts, ends = basecall_helpers.chunk_read(
+                    signal, self.chunk_size, self.overlap)
+                out = torch.tensor(chunks[::2] + chunks[1::2])
+                expected = basecall_helpers.stitch_chunks(
+                    out, starts, ends, self.stride).numpy()
+                np.testing.assert_array_equal(results[i], expected)
+
+    def test_failed_batch_drops_its_reads(self):
+        expected = self.run_batched(16)
+        results = self.run_batched(16, fail_batch=3)
+        self.assertEqual(len(results), len(self.signals))
+        dropped = set(self.failed_provenance[:, 0])
+        self.assertGreater(len(dropped), 1)
+        for i in range(len(self.signals)):
+            if i in dropped:
+                self.assertIsNone(results[i])
+            else:
+                np.testing.assert_array_equal(results[i], expected[i])
+
+    def test_short_reads_batched_with_full_chunks(self):
+        batcher = basecall_helpers.ChunkBatcher(4)
+        for i, n in enumerate([50, 150, 99]):
+            batcher.add_read(i, *basecall_helpers.chunk_read(
+                np.ones(n, dtype='f4'), 100, 20))
+        batches = list(batcher.batches())
+        self.assertEqual(len(batches), 1)
+        batch, provenance = batches[0]
+        self.assertEqual(batch.shape, (100, 4, 1))
+        out = torch.tensor(batch[::2] + batch[1::2])
+        lengths = {i: len(basecall_helpers.stitch_chunks(read_out, starts, ends, 2))
+                   for i, (read_out,), starts, ends in batcher.add_output(provenance, (out,))}
+        self.assertEqual(lengths, {0: 25, 1: 75, 2: 50})
+
+    def test_short_reads_released_after_max_wait(self):
+        batcher = basecall_helpers.ChunkBatcher(10, max_wait=2)
+        # Chunks of a length other than the chunk size, as for whole reads
+        batcher.add_read('short', np.zeros((50, 1, 1), dtype='f4'),
+                         np.array([0]), np.array([50]))
+        self.assertEqual(len(list(batcher.batches())), 0)
+        for i in range(2):
+            batcher.add_read(i, *basecall_helpers.chunk_read(
+                np.zeros(150, dtype='f4'), 100, 20))
+        self.assertEqual(len(list(batcher.batches())), 1)
+        self.assertEqual(len(list(batcher.batches(flush=True))), 1)
+
+
+
+class ChunkOverlapTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        torch.manual_seed(0xdeadbeef)
+        self.model = layers.Serial([
+            layers.Convolution(1, 4, 5, stride=2),
+            layers.Window(3),
+            layers.Convolution(12, 4, 4, pad=(1, 2)),
+            layers.FeedForward(4, 3)])
+        self.signal = np.random.RandomState(1).normal(size=1000).astype('f4')
+
+    def test_recurrent_uses_default(self):
+        model = layers.Serial([layers.Convolution(1, 4, 5, stride=2),
+                               layers.GruMod(4, 4)])
+        self.assertEqual(basecall_helpers.chunk_overlap(model), 100)
+        self.assertEqual(basecall_helpers.chunk_overlap(model, default=7), 7)
+
+    def test_stitched_output_matches_whole_read(self):
+        overlap = basecall_helpers.chunk_overlap(self.model)
+        self.assertEqual(overlap, 7)
+        with torch.no_grad():
+            expected = self.model(torch.tensor(self.signal[:, None, None]))[:, 0]
+        out = basecall_helpers.run_model(self.signal, self.model, chunk_size=50)
+        np.testing.assert_allclose(out, expected.numpy(), rtol=1e-5, atol=1e-6)
+        #  A smaller overlap changes the output
+        out = basecall_helpers.run_model(self.signal, self.model, chunk_size=50,
+                                         overlap=overlap - 1)
+        self.assertFalse(np.allclose(out, expected.numpy(), rtol=1e-5, atol=1e-6))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import argparse
+import unittest
+import numpy as np
+
+from taiyaki import batch_loader, mapped_signal_files
+
+
+def make_read(read_id, nbases, rng):
+    """A read with random dwells and a mapping covering the whole signal"""
+    dwells = rng.randint(1, 20, size=nbases)
+    ref_to_signal = np.concatenate([[0], np.cumsum(dwells)]).astype(np.int32)
+    return mapped_signal_files.Read({
+        'shift_frompA': 90.0, 'scale_frompA': 15.0,
+        'range': 1400.0, 'offset': 10.0, 'digitisation': 8192.0,
+        'Dacs': rng.randint(200, 900, size=ref_to_signal[-1]).astype(np.int16),
+        'Ref_to_signal': ref_to_signal,
+        'Reference': rng.randint(4, size=nbases).astype(np.int16),
+        'read_id': read_id})
+
+
+class BatchLoaderTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        rng = np.random.RandomState(0xdeadbeef)
+        self.read_data = [make_read('read_{}'.format(i), 500, rng)
+                          for i in range(20)]
+        self.args = argparse.Namespace(filter_mean_dwell=3.0,
+                                       filter_max_dwell=10.0)
+
+    def batches(self, nworkers, nbatch=5):
+        np.random.seed(1)
+        spec = lambda: (np.random.randint(4, 9), np.random.randint(200, 400))
+        with batch_loader.BatchLoader(self.read_data, spec, (10.0, 3.0),
+                                      self.args, 4, nworkers=nworkers,
+                                      nprefetch=3) as loader:
+            return [loader.next_batch() for _ in range(nbatch)]
+
+    def test_batch_shapes(self):
+        for batch in self.batches(0):
+            nchunk = len(batch.chunk_batch)
+            self.assertEqual(batch.current.ndim, 3)
+            self.assertEqual(batch.current.shape[1:], (nchunk, 1))
+            self.assertEqual(batch.current.dtype, np.float32)
+            self.assertEqual(len(batch.sequence_lengths), nchunk)
+            self.assertEqual(len(batch.sequences),
+                             np.sum(batch.sequence_lengths))
+
+    def test_workers_give_same_batches(self):
+        for serial, parallel in zip(self.batches(0), self.batches(2)):
+            np.testing.assert_array_equal(serial.current, parallel.current)
+            np.testing.assert_array_equal(serial.sequences, parallel.sequences)
+            self.assertEqual(serial.rejections, parallel.rejections)
+
+
+if __name__ == '__main__':
+    unittest.main()
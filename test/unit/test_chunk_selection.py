@@ -0,0 +1,152 @@
+import argparse
+import unittest
+import numpy as np
+
+from taiyaki import chunk_selection, mapped_signal_files
+
+
+def make_read(read_id, nbases, rng):
+    """A read with random dwells, including stays, and unmapped regions at
+    each end of the reference"""
+    dwells = rng.randint(0, 25, size=nbases - 20)
+    mapped = 50 + np.concatenate([[0], np.cumsum(dwells)])
+    daclen = mapped[-1] + 70
+    ref_to_signal = np.concatenate([np.full(10, -1), mapped,
+                                    np.full(10, daclen)]).astype(np.int32)
+    return mapped_signal_files.Read({
+        'shift_frompA': 90.0, 'scale_frompA': 15.0,
+        'range': 1400.0, 'offset': 10.0, 'digitisation': 8192.0,
+        'Dacs': rng.randint(200, 900, size=daclen).astype(np.int16),
+        'Ref_to_signal': ref_to_signal,
+        'Reference': rng.randint(4, size=nbases).astype(np.int16),
+        'read_id': read_id})
+
+
+class RecordingRead(mapped_signal_files.Read):
+    """Read recording which arrays have been fetched whole or in slices"""
+
+    def __init__(self, d):
+        super().__init__(d)
+        self.fetched = set()
+        self.sliced = set()
+
+    def __getitem__(self, key):
+        if key in ('Dacs', 'Reference', 'Ref_to_signal'):
+            self.fetched.add(key)
+        return super().__getitem__(key)
+
+    def _get_slice(self, name, start, end):
+        self.sliced.add(name)
+        return dict.__getitem__(self, name)[start:end]
+
+
+class RecordingChunkLog:
+
+    def __init__(self):
+        self.chunks = []
+
+    def write_chunk(self, iteration, chunk_dict, status, lossvalue=None):
+        self.chunks.append((chunk_dict, status))
+
+
+class ChunkSamplerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        rng = np.random.RandomState(0xdeadbeef)
+        self.read_data = [make_read('read_{}'.format(i), rng.randint(30, 400), rng)
+                          for i in range(30)]
+        self.reads_by_id = {read['read_id']: read for read in self.read_data}
+        self.sampler = chunk_selection.ChunkSampler(self.read_data)
+        self.args = argparse.Namespace(filter_mean_dwell=1.0,
+                                       filter_max_dwell=2.0)
+        self.filter_parameters = (12.0, 2.0)
+
+    def test_accepted_chunks_match_read_chunks(self):
+        np.random.seed(1)
+        chunk_len = 500
+        chunks, rejections, current, sequence = self.sampler.sample_batch(
+            200, chunk_len, self.filter_parameters, self.args)
+        self.assertGreater(len(chunks), 0)
+        self.assertEqual(current.shape, (chunk_len, len(chunks)))
+        self.assertEqual(len(sequence), sum(len(c['sequence']) for c in chunks))
+        for chunk in chunks:
+            read = self.reads_by_id[chunk['read_id']]
+            start = chunk['start_sample'] - read.get_mapped_dacs_region()[0]
+            expected = read.get_chunk_with_sample_length(chunk_len, start)
+            self.assertNotIn('rejected', expected)
+            np.testing.assert_allclose(chunk['current'], expected['current'],
+                                       rtol=1e-5, atol=1e-5)
+            np.testing.assert_array_equal(chunk['sequence'], expected['sequence'])
+            self.assertEqual(chunk['max_dwell'], expected['max_dwell'])
+
+    def test_rejections_match_chunk_filter(self):
+        np.random.seed(2)
+        chunk_len = 400
+        chunk_log = RecordingChunkLog()
+        chunks, rejections, _, _ = self.sampler.sample_batch(
+            100, chunk_len, self.filter_parameters, self.args,
+            chunk_log=chunk_log, log_accepted_chunks=True)
+        self.assertEqual(len(chunk_log.chunks), sum(rejections.values()))
+        self.assertEqual(rejections['pass'], len(chunks))
+        self.assertGreater(len(rejections), 2)
+        for chunk_dict, status in chunk_log.chunks:
+            read = self.reads_by_id[chunk_dict['read_id']]
+            if status == 'tooshort':
+                spare = np.diff(read.get_mapped_dacs_region())[0] - chunk_len
+                self.assertLess(spare, 0)
+                continue
+            start = chunk_dict['start_sample'] - read.get_mapped_dacs_region()[0]
+            expected = read.get_chunk_with_sample_length(chunk_len, start)
+            self.assertEqual(status, chunk_selection.chunk_filter(
+                expected, self.args, self.filter_parameters))
+
+    def test_arrays_fetched_only_for_drawn_reads(self):
+        read_data = []
+        for read in self.read_data:
+            recording_read = RecordingRead(read)
+            recording_read.chunk_metadata = read.get_chunk_metadata()
+            read_data.append(recording_read)
+        sampler = chunk_selection.ChunkSampler(read_data)
+        self.assertTrue(all(len(read.fetched) == 0 and len(read.sliced) == 0
+                            for read in read_data))
+
+        np.random.seed(3)
+        chunks, _, _, _ = sampler.sample_batch(3, 400, self.filter_parameters, self.args)
+        accepted = set(chunk['read_id'] for chunk in chunks)
+        self.assertGreater(len(accepted), 0)
+        self.assertLess(sum(len(read.fetched) > 0 for read in read_data), len(read_data))
+        for read in read_data:
+            self.assertTrue(read.fetched <= {'Ref_to_signal'})
+            self.assertEqual(read.sliced == {'Dacs', 'Reference'},
+                             read['read_id'] in accepted)
+
+    def test_cached_maps_not_fetched_again(self):
+        read_data = [RecordingRead(read) for read in self.read_data]
+        sampler = chunk_selection.ChunkSampler(read_data)
+        np.random.seed(4)
+        sampler.sample_batch(50, 400, self.filter_parameters, self.args)
+        for read in read_data:
+            read.fetched.clear()
+        # All reads fit in the cache, so none is fetched for a second batch
+        sampler.sample_batch(50, 400, self.filter_parameters, self.args)
+        self.assertTrue(all(len(read.fetched) == 0 for read in read_data))
+
+    def test_small_cache_gives_same_batches(self):
+        small_cache_sampler = chunk_selection.ChunkSampler(self.read_data, cache_reads=4)
+        for seed in range(10):
+            batches = []
+            for sampler in self.sampler, small_cache_sampler:
+                np.random.seed(seed)
+                batches.append(sampler.sample_batch(
+                    20, 300, self.filter_parameters, self.args))
+            (chunks, rejections, current, sequence), expected = batches[1], batches[0]
+            self.assertEqual(rejections, expected[1])
+            np.testing.assert_array_equal(current, expected[2])
+            np.testing.assert_array_equal(sequence, expected[3])
+            self.assertEqual([c['max_dwell'] for c in chunks],
+                             [c['max_dwell'] for c in expected[0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch
+import unittest
+
+from taiyaki import ctc
+
+
+class CtcTest(unittest.TestCase):
+    """Flip-flop losses and gradients against finite differences"""
+    NBASE = 4
+    NBLK = 12
+    SEQLEN = np.array([4, 0, 6], dtype=np.int32)
+    SEQS = np.array([0, 4, 1, 2,
+                     3, 7, 3, 0, 1, 5], dtype=np.int32)
+    #  Modified base categories: one extra category for C (1)
+    CAN_MODS_OFFSETS = np.array([0, 1, 3, 4, 5], dtype=np.int32)
+    MOD_CAT_WEIGHTS = np.array([1.0, 1.0, 2.0, 1.0, 1.0], dtype=np.float32)
+    MOD_CATS = np.array([0, 0, 1, 0,
+                         0, 0, 0, 0, 1, 0], dtype=np.int32)
+    DELTA = 1e-2
+
+    def setUp(self):
+        rng = np.random.RandomState(0xdeadbeef)
+        nstate = 2 * self.NBASE * (self.NBASE + 1)
+        nbatch = len(self.SEQLEN)
+        self.logprob = np.log(rng.dirichlet(np.ones(nstate), size=(self.NBLK, nbatch))).astype(np.float32)
+        nmod = self.CAN_MODS_OFFSETS[-1]
+        self.mod_logprob = np.ascontiguousarray(np.concatenate([
+            self.logprob,
+            np.log(rng.dirichlet(np.ones(nmod), size=(self.NBLK, nbatch))).astype(np.float32)], axis=2))
+
+    def check_gradient(self, cost_fn, grad, logprob):
+        rng = np.random.RandomState(1)
+        for _ in range(50):
+            blk, batch, state = (rng.randint(n) for n in logprob.shape)
+            lp = logprob.copy()
+            lp[blk, batch, state] += self.DELTA
+            fplus = cost_fn(lp)[batch]
+            lp[blk, batch, state] -= 2 * self.DELTA
+            fminus = cost_fn(lp)[batch]
+            self.assertAlmostEqual(grad[blk, batch, state],
+                                   (fplus - fminus) / (2 * self.DELTA), places=3)
+
+    def test_crf_flipflop_grad(self):
+        def cost_fn(lp):
+            return ctc.crf_flipflop_cost(lp, self.SEQS, self.SEQLEN, 1.0).numpy()
+
+        cost, grad = ctc.crf_flipflop_grad(self.logprob, self.SEQS, self.SEQLEN, 1.0)
+        np.testing.assert_allclose(cost.numpy(), cost_fn(self.logprob), rtol=1e-6)
+        self.assertTrue(torch.all(grad[:, 1] == 0))
+        self.check_gradient(cost_fn, grad.numpy(), self.logprob)
+
+    def test_cat_mod_flipflop_grad(self):
+        def cost_fn(lp):
+            return ctc.cat_mod_flipflop_cost(
+                lp, self.SEQS, self.SEQLEN, self.MOD_CATS, self.CAN_MODS_OFFSETS,
+                self.MOD_CAT_WEIGHTS, 1.0, 1.0).numpy()
+
+        cost, grad = ctc.cat_mod_flipflop_grad(
+            self.mod_logprob, self.SEQS, self.SEQLEN, self.MOD_CATS,
+            self.CAN_MODS_OFFSETS, self.MOD_CAT_WEIGHTS, 1.0, 1.0)
+        np.testing.assert_allclose(cost.numpy(), cost_fn(self.mod_logprob), rtol=1e-6)
+        self.assertTrue(torch.all(grad[:, 1] == 0))
+        self.check_gradient(cost_fn, grad.numpy(), self.mod_logprob)
+
+    def test_cat_mod_flipflop_loss(self):
+        cost, grad = ctc.cat_mod_flipflop_grad(
+            self.mod_logprob, self.SEQS, self.SEQLEN, self.MOD_CATS,
+            self.CAN_MODS_OFFSETS, self.MOD_CAT_WEIGHTS, 1.0, 1.0)
+        cost, grad = cost.numpy(), grad.numpy()
+        weights = np.array([1.0, 2.0, 3.0], dtype=np.float32)
+
+        def loss_fn(logprob):
+            return ctc.cat_mod_flipflop_loss(
+                logprob, torch.tensor(self.SEQS), torch.tensor(self.SEQLEN),
+                torch.tensor(self.MOD_CATS), self.CAN_MODS_OFFSETS,
+                self.MOD_CAT_WEIGHTS, 1.0, 1.0)
+
+        logprob = torch.tensor(self.mod_logprob, requires_grad=True)
+        loss = loss_fn(logprob)
+        (loss * torch.tensor(weights)).sum().backward()
+        np.testing.assert_array_equal(loss.detach().numpy(), cost)
+        np.testing.assert_allclose(logprob.grad.numpy(),
+                                   grad * weights[:, None], rtol=1e-6)
+
+        with torch.no_grad():
+            loss = loss_fn(logprob)
+        self.assertFalse(loss.requires_grad)
+        np.testing.assert_array_equal(loss.numpy(), cost)
+
+    def test_crf_flipflop_grad_into_tensors(self):
+        cost, grad = ctc.crf_flipflop_grad(self.logprob, self.SEQS, self.SEQLEN, 1.0)
+        costs = torch.full(cost.shape, np.nan)
+        grads = torch.full(grad.shape, np.nan)
+        logprob = torch.tensor(self.logprob)
+        result = ctc.crf_flipflop_grad(logprob, torch.tensor(self.SEQS),
+                                       torch.tensor(self.SEQLEN), 1.0,
+                                       costs=costs, grads=grads)
+        self.assertIs(result[0], costs)
+        self.assertIs(result[1], grads)
+        self.assertTrue(torch.equal(costs, cost))
+        self.assertTrue(torch.equal(grads, grad))
+        with self.assertRaises(ValueError):
+            ctc.crf_flipflop_grad(logprob, self.SEQS, self.SEQLEN, 1.0,
+                                  grads=grads[:-1])
+
+    def test_concurrent_losses(self):
+        cost = ctc.crf_flipflop_cost(self.logprob, self.SEQS, self.SEQLEN, 1.0)
+        with ThreadPoolExecutor(4) as executor:
+            costs = list(executor.map(
+                lambda _: ctc.crf_flipflop_cost(self.logprob, self.SEQS, self.SEQLEN, 1.0),
+                range(8)))
+        for c in costs:
+            self.assertTrue(torch.equal(c, cost))
+
+
+if __name__ == '__main__':
+    unittest.main()
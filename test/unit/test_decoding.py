@@ -0,0 +1,114 @@
+import unittest
+import numpy as np
+import torch
+
+from taiyaki import decoding
+
+
+def flipflop_transitions(nbase):
+    """ List of (from state, to state, index of score) for flip-flop model """
+    transitions = [(from_state, to_base, to_base * 2 * nbase + from_state)
+                   for to_base in range(nbase) for from_state in range(2 * nbase)]
+    for from_state in range(2 * nbase):
+        to_state = from_state + nbase if from_state < nbase else from_state
+        transitions.append((from_state, to_state, 2 * nbase * nbase + from_state))
+    return transitions
+
+
+def reference_trans(scores, nbase):
+    """ Posteriors of transitions by explicit forward-backward with torch """
+    T, N, S = scores.shape
+    frm, to, idx = map(torch.tensor, zip(*flipflop_transitions(nbase)))
+    init = torch.full((N, 2 * nbase), -np.log(2.0 * nbase))
+    fwd = [init]
+    for t in range(T):
+        x = fwd[-1][:, frm] + scores[t][:, idx]
+        new = torch.stack([torch.logsumexp(x[:, to == st], 1)
+                           for st in range(2 * nbase)], 1)
+        fwd.append(new - torch.logsumexp(new, 1, keepdim=True))
+    bwd = [init]
+    for t in range(T - 1, -1, -1):
+        x = bwd[0][:, to] + scores[t][:, idx]
+        new = torch.stack([torch.logsumexp(x[:, frm == st], 1)
+                           for st in range(2 * nbase)], 1)
+        bwd.insert(0, new - torch.logsumexp(new, 1, keepdim=True))
+    trans = torch.zeros_like(scores)
+    for t in range(T):
+        trans[t][:, idx] = fwd[t][:, frm] + scores[t][:, idx] + bwd[t + 1][:, to]
+    return trans
+
+
+def reference_viterbi_score(scores, path, nbase):
+    """ Score of path through flip-flop states """
+    lookup = {(f, t): i for f, t, i in flipflop_transitions(nbase)}
+    return sum(scores[t, lookup[(path[t], path[t + 1])]] for t in range(len(path) - 1))
+
+
+class FlipFlopDecodingTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        torch.manual_seed(0xdeadbeef)
+        self.nbase = 4
+        self.scores = 2.0 * torch.randn(20, 6, 2 * self.nbase * (self.nbase + 1))
+
+    def test_make_trans_matches_reference(self):
+        trans, fwd_fact, bwd_fact = decoding.flipflop_make_trans(self.scores)
+        expected = reference_trans(self.scores, self.nbase)
+        np.testing.assert_allclose(trans.numpy(), expected.numpy(), atol=1e-4)
+        #  Total normalisation of forwards and backwards agree
+        np.testing.assert_allclose(fwd_fact.sum(0).numpy(),
+                                   bwd_fact.sum(0).numpy(), rtol=1e-4)
+
+    def test_fwd_and_bwd_match_make_trans(self):
+        _, fwd_fact, bwd_fact = decoding.flipflop_make_trans(self.scores)
+        fwd, fact = decoding.flipflop_fwd(self.scores)
+        np.testing.assert_allclose(fact.numpy(), fwd_fact.numpy(), atol=1e-5)
+        np.testing.assert_allclose(torch.logsumexp(fwd, 2).numpy(), 0.0, atol=1e-5)
+        bwd, fact = decoding.flipflop_bwd(self.scores)
+        np.testing.assert_allclose(fact.numpy(), bwd_fact.numpy(), atol=1e-5)
+
+    def test_logz_grad_is_posterior(self):
+        trans, fwd_fact, _ = decoding.flipflop_make_trans(self.scores)
+        logz, grad = decoding.flipflop_logz_grad(self.scores)
+        np.testing.assert_allclose(logz.numpy(), fwd_fact.sum(0)[:, 0].numpy(), rtol=1e-6)
+        np.testing.assert_allclose(decoding.flipflop_logz(self.scores).numpy(),
+                                   logz.numpy(), rtol=1e-6)
+        np.testing.assert_allclose(grad.numpy(), trans.softmax(2).numpy(), atol=1e-6)
+
+    def test_global_norm_matches_layers(self):
+        from taiyaki.layers import global_norm_flipflop
+        weights = torch.randn(self.scores.shape)
+        x1 = self.scores.clone().requires_grad_()
+        (decoding.global_norm(x1) * weights).sum().backward()
+        x2 = self.scores.clone().requires_grad_()
+        (global_norm_flipflop(x2) * weights).sum().backward()
+        np.testing.assert_allclose(x1.grad.numpy(), x2.grad.numpy(), atol=1e-5)
+        with torch.no_grad():
+            np.testing.assert_allclose(decoding.global_norm(self.scores).numpy(),
+                                       global_norm_flipflop(self.scores).numpy(),
+                                       atol=1e-5)
+
+    def test_viterbi_path_is_best(self):
+        fwd, traceback, best_path = decoding.flipflop_viterbi(self.scores)
+        rng = np.random.RandomState(1)
+        for n in range(self.scores.shape[1]):
+            path = best_path[:, n].numpy()
+            #  Initial state is not recorded in path
+            self.assertEqual(path[0], 0)
+            path[0] = traceback[1, n, path[1]]
+            scores = self.scores[:, n].numpy()
+            best = reference_viterbi_score(scores, path, self.nbase)
+            self.assertAlmostEqual(best, fwd[-1, n].max().item(), places=4)
+            #  Perturbing the path cannot improve the score
+            lookup = {(f, t) for f, t, _ in flipflop_transitions(self.nbase)}
+            for _ in range(50):
+                alt = path.copy()
+                alt[rng.randint(len(alt))] = rng.randint(2 * self.nbase)
+                if all((alt[t], alt[t + 1]) in lookup for t in range(len(alt) - 1)):
+                    self.assertLessEqual(
+                        reference_viterbi_score(scores, alt, self.nbase), best + 1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
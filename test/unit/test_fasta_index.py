@@ -0,0 +1,80 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from . import DATA_DIR
+from taiyaki import fasta_index, helpers
+
+
+class IndexedFastaTest(unittest.TestCase):
+    FASTA = '\n'.join([
+        '>read1 some description',
+        'ACGTACGTAC',
+        'GTAC',
+        '>read2',
+        'ACGTNNACGT',
+        '>empty',
+        '>read3',
+        'TTTT',
+        'GGGG',
+        'CC',
+        '',
+        '>read1',
+        'CCCCCC',
+        '>read4',
+        'AAAA']) + '\n'
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fasta_file = os.path.join(self.tmpdir, 'references.fasta')
+        with open(self.fasta_file, 'w') as fh:
+            fh.write(self.FASTA)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_matches_dict(self, fasta_file, **kwargs):
+        expected = helpers.fasta_file_to_dict(fasta_file, **kwargs)
+        references = fasta_index.IndexedFasta(fasta_file, **kwargs)
+        found = {k: references[k] for k in references if k in references}
+        self.assertEqual(found, expected)
+        self.assertNotIn('no_such_read', references)
+        references.close()
+
+    def test_matches_fasta_file_to_dict(self):
+        for allow_N in False, True:
+            self.check_matches_dict(self.fasta_file, allow_N=allow_N)
+
+    def test_matches_fasta_file_to_dict_on_test_data(self):
+        fasta_file = os.path.join(self.tmpdir, 'per_read_references.fasta')
+        shutil.copy(os.path.join(DATA_DIR, 'per_read_references.fasta'), fasta_file)
+        self.check_matches_dict(fasta_file)
+
+    def test_index_reused_and_rebuilt(self):
+        references = fasta_index.IndexedFasta(self.fasta_file)
+        index_file = self.fasta_file + fasta_index.INDEX_SUFFIX
+        self.assertEqual(references.index_file_name, index_file)
+        self.assertTrue(os.path.exists(index_file))
+        mtime = os.path.getmtime(index_file)
+        fasta_index.IndexedFasta(self.fasta_file)
+        self.assertEqual(os.path.getmtime(index_file), mtime)
+
+        with open(self.fasta_file, 'a') as fh:
+            fh.write('>read5\nGATTACA\n')
+        os.utime(self.fasta_file, (mtime + 10, mtime + 10))
+        references = fasta_index.IndexedFasta(self.fasta_file)
+        self.assertEqual(references['read5'], 'GATTACA')
+
+    def test_pickle_does_not_contain_index(self):
+        references = fasta_index.IndexedFasta(self.fasta_file)
+        self.assertEqual(references['read3'], 'TTTTGGGGCC')
+        unpickled = pickle.loads(pickle.dumps(references))
+        self.assertIsNone(unpickled._index)
+        self.assertEqual(unpickled['read3'], 'TTTTGGGGCC')
+        self.assertEqual(unpickled['read1'], 'CCCCCC')
+
+
+if __name__ == '__main__':
+    unittest.main()
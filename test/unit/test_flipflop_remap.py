@@ -78,3 +78,130 @@ class TestFlipFlopMapping(unittest.TestCase):
         score2, path2 = flipflop_remap.map_to_crf_viterbi(log_transitions, step_index, stay_index, localpen=-0.5)
         self.assertEqual(score, score2)
         self.assertEqual(path.tolist(), path2.tolist())
+
+    def test_compiled_mapping_matches_numpy(self):
+        """Test compiled and batched mapping give the same results as the
+        numpy reference implementation, for global and glocal mapping
+        """
+        rng = np.random.RandomState(0xdeadbeef)
+        alphabet = 'ACGT'
+        scores, sequences = [], []
+        for _ in range(10):
+            nblock = rng.randint(50, 200)
+            scores.append(rng.normal(size=(nblock, 40)).astype('f4'))
+            sequences.append(''.join(rng.choice(list(alphabet), rng.randint(1, nblock // 2))))
+
+        for localpen in [-0.5, 0.0, 1.0, 1e30]:
+            batch = flipflop_remap.flipflop_remap_batch(
+                scores, sequences, alphabet=alphabet, localpen=localpen)
+            for sc, sequence, (batch_score, batch_path) in zip(scores, sequences, batch):
+                step_index, stay_index = flipflop_remap.flipflop_indices(sequence, alphabet)
+                # Scores in double precision so numpy accumulates as the
+                # compiled implementation does
+                score, path = flipflop_remap.map_to_crf_viterbi_numpy(
+                    sc.astype('f8'), step_index, stay_index, localpen=localpen)
+                score2, path2 = flipflop_remap.flipflop_remap(
+                    sc, sequence, alphabet=alphabet, localpen=localpen)
+                self.assertEqual(score, score2)
+                self.assertEqual(path.tolist(), path2.tolist())
+                self.assertEqual(score, batch_score)
+                self.assertEqual(path.tolist(), batch_path.tolist())
+
+    def test_banded_mapping_matches_full(self):
+        """Test banded mapping finds the same path as full mapping when the
+        scores favour a path away from the initial linear guess, so the band
+        must be widened
+        """
+        rng = np.random.RandomState(0xdeadbeef)
+        alphabet = 'ACGT'
+        sequence = ''.join(rng.choice(list(alphabet), 300))
+        step_index, stay_index = flipflop_remap.flipflop_indices(sequence, alphabet)
+        # Path moves quickly through first half of sequence then slowly
+        positions = np.concatenate([np.repeat(np.arange(150), 2),
+                                    np.repeat(np.arange(150, 300), 6)])
+        scores = rng.normal(size=(len(positions) - 1, 40)).astype('f4')
+        for n, (p, q) in enumerate(zip(positions[:-1], positions[1:])):
+            scores[n, stay_index[p] if p == q else step_index[p]] += 3.0
+
+        for localpen in [0.0, 1e30]:
+            score, path = flipflop_remap.flipflop_remap(
+                scores, sequence, alphabet=alphabet, localpen=localpen)
+            band_score, band_path = flipflop_remap.flipflop_remap(
+                scores, sequence, alphabet=alphabet, localpen=localpen, band_width=20)
+            self.assertEqual(score, band_score)
+            self.assertEqual(path.tolist(), band_path.tolist())
+
+            # Narrow band that is not widened constrains the path
+            band_start = flipflop_remap.linear_band_start(len(scores), len(sequence), 20)
+            _, narrow_path = flipflop_remap.decoding.map_to_crf_viterbi_banded(
+                scores, step_index, stay_index, band_start, 20, localpen)
+            self.assertTrue(flipflop_remap.path_touches_band_edge(
+                narrow_path, band_start, 20, len(sequence)))
+            self.assertFalse(flipflop_remap.path_touches_band_edge(
+                path, np.zeros(len(path), dtype=int), len(sequence), len(sequence)))
+
+    def test_banded_mapping_of_clipped_read_matches_full(self):
+        """Test banded mapping finds the same path as full mapping when the
+        signal at the start and end of the read is clipped, so the path lies
+        away from the initial guess without touching the edge of the band
+        """
+        rng = np.random.RandomState(0xdeadbeef)
+        alphabet = 'ACGT'
+        for _ in range(20):
+            sequence = ''.join(rng.choice(list(alphabet), rng.randint(50, 300)))
+            step_index, stay_index = flipflop_remap.flipflop_indices(sequence, alphabet)
+            positions = np.repeat(np.arange(len(sequence)),
+                                  rng.randint(1, 6, size=len(sequence)))
+            nclip = rng.randint(0, 200, size=2)
+            positions = np.concatenate([np.full(nclip[0], -1), positions,
+                                        np.full(nclip[1], -1)])
+            scores = rng.normal(size=(len(positions) - 1, 40)).astype('f4')
+            for n, (p, q) in enumerate(zip(positions[:-1], positions[1:])):
+                if p >= 0 and q >= 0:
+                    scores[n, stay_index[p] if p == q else step_index[p]] += 3.0
+
+            score, path = flipflop_remap.map_to_crf_viterbi(
+                scores, step_index, stay_index, localpen=0.0)
+            band_score, band_path = flipflop_remap.flipflop_remap(
+                scores, sequence, alphabet=alphabet, localpen=0.0, band_width=16)
+            self.assertEqual(score, band_score)
+            self.assertEqual(path.tolist(), band_path.tolist())
+
+    def test_full_width_band_matches_full_mapping(self):
+        """Test that a band covering the whole sequence gives identical results
+        """
+        rng = np.random.RandomState(0xdeadbeef)
+        alphabet = 'ACGT'
+        for localpen in [-0.5, 0.0, 1e30]:
+            sequence = ''.join(rng.choice(list(alphabet), 30))
+            scores = rng.normal(size=(100, 40)).astype('f4')
+            step_index, stay_index = flipflop_remap.flipflop_indices(sequence, alphabet)
+            score, path = flipflop_remap.map_to_crf_viterbi(
+                scores, step_index, stay_index, localpen=localpen)
+            band_score, band_path = flipflop_remap.decoding.map_to_crf_viterbi_banded(
+                scores, step_index, stay_index, np.zeros(101, dtype=int), 30, localpen)
+            self.assertEqual(score, band_score)
+            self.assertEqual(path.tolist(), band_path.tolist())
+
+    def test_low_memory_mapping_matches_full(self):
+        """Test checkpointed traceback gives identical paths and scores for a
+        range of segment lengths
+        """
+        rng = np.random.RandomState(0xdeadbeef)
+        alphabet = 'ACGT'
+        for nblock, nbase in [(0, 1), (1, 1), (37, 5), (200, 60)]:
+            sequence = ''.join(rng.choice(list(alphabet), nbase))
+            scores = rng.normal(size=(nblock, 40)).astype('f4')
+            step_index, stay_index = flipflop_remap.flipflop_indices(sequence, alphabet)
+            for localpen in [-0.5, 0.0, 1e30]:
+                score, path = flipflop_remap.map_to_crf_viterbi(
+                    scores, step_index, stay_index, localpen=localpen)
+                score2, path2 = flipflop_remap.map_to_crf_viterbi(
+                    scores, step_index, stay_index, localpen=localpen, low_memory=True)
+                self.assertEqual(score, score2)
+                self.assertEqual(path.tolist(), path2.tolist())
+                for segment_length in [1, 2, 10, 1000]:
+                    score2, path2 = flipflop_remap.decoding.map_to_crf_viterbi_checkpointed(
+                        scores, step_index, stay_index, localpen, segment_length)
+                    self.assertEqual(score, score2)
+                    self.assertEqual(path.tolist(), path2.tolist())
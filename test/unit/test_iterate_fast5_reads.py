@@ -1,8 +1,13 @@
+from contextlib import redirect_stdout
+import io
 import os
+import shutil
+import tempfile
 import unittest
 
 from . import DATA_DIR
-from taiyaki.fast5utils import iterate_fast5_reads
+from taiyaki.fast5utils import (Fast5ReadIndex, batch_file_reads, get_fast5_filepaths,
+                                iterate_fast5_reads, iterate_file_reads)
 
 
 class TestStrandList(unittest.TestCase):
@@ -19,37 +24,106 @@ class TestStrandList(unittest.TestCase):
     SEQUENCING_SUMMARY = os.path.join(
         DATA_DIR, "basecaller_output/sequencing_summary.txt")
 
+    def _iterate(self, path, **kwargs):
+        return iterate_fast5_reads(path, **kwargs)
+
     def _check_found_read_ids(self, found_reads):
         found_read_ids = sorted([rid for _, rid in found_reads])
         self.assertEqual(found_read_ids, self.EXPECTED_READ_IDS)
 
     def test_no_strand_list_multiread(self):
-        self._check_found_read_ids(iterate_fast5_reads(self.MULTIREAD_DIR))
+        self._check_found_read_ids(self._iterate(self.MULTIREAD_DIR))
 
     def test_no_strand_list_single_reads(self):
-        self._check_found_read_ids(iterate_fast5_reads(self.READ_DIR))
+        self._check_found_read_ids(self._iterate(self.READ_DIR))
 
     def test_sequencing_summary_multiread(self):
-        self._check_found_read_ids(iterate_fast5_reads(self.MULTIREAD_DIR, strand_list=self.SEQUENCING_SUMMARY))
+        self._check_found_read_ids(self._iterate(self.MULTIREAD_DIR, strand_list=self.SEQUENCING_SUMMARY))
 
     def test_strand_list_single_reads(self):
         strand_list = os.path.join(self.STRAND_LIST_DIR, "strand_list_single.txt")
-        self._check_found_read_ids(iterate_fast5_reads(self.READ_DIR, strand_list=strand_list))
+        self._check_found_read_ids(self._iterate(self.READ_DIR, strand_list=strand_list))
 
     def test_strand_list_multiread(self):
         strand_list = os.path.join(self.STRAND_LIST_DIR, "strand_list.txt")
-        self._check_found_read_ids(iterate_fast5_reads(self.MULTIREAD_DIR, strand_list=strand_list))
+        self._check_found_read_ids(self._iterate(self.MULTIREAD_DIR, strand_list=strand_list))
 
     def test_strand_list_no_filename_multiread(self):
         strand_list = os.path.join(self.STRAND_LIST_DIR, "strand_list_no_filename.txt")
-        self._check_found_read_ids(iterate_fast5_reads(self.MULTIREAD_DIR, strand_list=strand_list))
+        self._check_found_read_ids(self._iterate(self.MULTIREAD_DIR, strand_list=strand_list))
 
     def test_strand_list_no_filename_single_reads(self):
         strand_list = os.path.join(self.STRAND_LIST_DIR, "strand_list_no_filename.txt")
-        self._check_found_read_ids(iterate_fast5_reads(self.READ_DIR, strand_list=strand_list))
+        self._check_found_read_ids(self._iterate(self.READ_DIR, strand_list=strand_list))
 
     def test_strand_list_no_read_id_multiread(self):
         strand_list = os.path.join(self.STRAND_LIST_DIR, "strand_list_no_read_id.txt")
-        self._check_found_read_ids(iterate_fast5_reads(self.MULTIREAD_DIR, strand_list=strand_list))
+        self._check_found_read_ids(self._iterate(self.MULTIREAD_DIR, strand_list=strand_list))
 
     # TODO add recursive test (requires adding recursive data dir
+
+
+class TestStrandListWithReadIndex(TestStrandList):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.read_index = os.path.join(self.tmpdir, 'read_index.tsv')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _iterate(self, path, **kwargs):
+        found = list(iterate_fast5_reads(path, read_index=self.read_index, **kwargs))
+        #  Second iteration uses saved index
+        self.assertEqual(list(iterate_fast5_reads(path, read_index=self.read_index, **kwargs)),
+                         found)
+        return found
+
+    def test_index_records_reads(self):
+        filepaths = get_fast5_filepaths(self.MULTIREAD_DIR)
+        index = Fast5ReadIndex.load(self.read_index)
+        self.assertEqual(index.update(filepaths), 1)
+        index.save(self.read_index)
+        index = Fast5ReadIndex.load(self.read_index)
+        self.assertEqual(index.update(filepaths), 0)
+        self.assertEqual(sorted(index.reads), self.EXPECTED_READ_IDS)
+        for read_id, (filepath, group, siglen) in index.reads.items():
+            self.assertEqual(filepath, os.path.abspath(filepaths[0]))
+            self.assertEqual(group, '/read_' + read_id)
+            self.assertGreater(siglen, 0)
+
+    def test_limit(self):
+        found = self._iterate(self.READ_DIR, limit=2)
+        self.assertEqual(len(found), 2)
+
+    def test_verbose(self):
+        output = io.StringIO()
+        with redirect_stdout(output):
+            found = list(iterate_fast5_reads(self.READ_DIR, read_index=self.read_index,
+                                             verbose=1))
+        messages = output.getvalue().splitlines()
+        self.assertEqual(messages[1:], ['Reading {} from {}'.format(read_id, filepath)
+                                        for filepath, read_id in found])
+
+
+class TestFileBatches(unittest.TestCase):
+
+    def test_batch_file_reads(self):
+        read_tuples = [('a', 1), ('a', 2), ('a', 3), ('b', 4), ('a', 5)]
+        self.assertEqual(list(batch_file_reads(read_tuples, batch_size=2)),
+                         [('a', [1, 2]), ('a', [3]), ('b', [4]), ('a', [5])])
+        self.assertEqual(list(batch_file_reads([])), [])
+
+    def test_iterate_file_reads(self):
+        multiread_dir = TestStrandList.MULTIREAD_DIR
+        read_tuples = list(iterate_fast5_reads(multiread_dir))
+        filepath, read_ids = next(batch_file_reads(read_tuples))
+        self.assertEqual(len(read_ids), len(read_tuples))
+        found = list(iterate_file_reads(filepath, read_ids[::-1] + ['not_a_read']))
+        self.assertEqual([read_id for read_id, _ in found], read_ids[::-1] + ['not_a_read'])
+        for read_id, read in found[:-1]:
+            self.assertEqual(read.read_id, read_id)
+        self.assertIsNone(found[-1][1])
+        missing = list(iterate_file_reads(os.path.join(multiread_dir, 'missing.fast5'),
+                                          read_ids))
+        self.assertEqual(missing, [(read_id, None) for read_id in read_ids])
@@ -1,3 +1,5 @@
+from multiprocessing import Pool
+import threading
 import unittest
 import numpy as np
 
@@ -28,5 +30,20 @@ class IteratorsTest(unittest.TestCase):
         self.assertEqual(self.f(L, 6), [(1, 2, 3, 4), (1, 2, 3, 4, 5), (1, 2, 3, 4, 5, 6),
                                         (2, 3, 4, 5, 6, 7), (3, 4, 5, 6, 7), (4, 5, 6, 7), (5, 6, 7)])
 
+    def test_imap_pool_consumes_args_in_caller(self):
+        threads = set()
+
+        def args():
+            for i in range(20):
+                threads.add(threading.current_thread())
+                yield i
+
+        with Pool(2) as pool:
+            results = list(iterators.imap_pool(pool, pow, args(),
+                                               fix_kwargs={'exp': 2},
+                                               max_pending=3))
+        self.assertEqual(results, [i ** 2 for i in range(20)])
+        self.assertEqual(threads, {threading.current_thread()})
+
 if __name__ == '__main__':
     unittest.main()
@@ -6,7 +6,7 @@ import tempfile
 import torch
 import unittest
 
-from taiyaki import activation
+from taiyaki import activation, alphabet
 from taiyaki.config import taiyaki_dtype, torch_dtype, numpy_dtype
 from taiyaki.json import JsonEncoder
 import taiyaki.layers as nn
@@ -218,6 +218,69 @@ class LayerTest(metaclass=abc.ABCMeta):
         props = json.JSONDecoder().decode(json.dumps(self.layer.json(), cls=JsonEncoder))
         props2 = json.JSONDecoder().decode(json.dumps(self.layer.json(params=True), cls=JsonEncoder))
 
+    def test_004_output_shape(self):
+        if self._INPUTS is None:
+            raise NotImplementedError("Please specify layer inputs for testing, or explicitly skip this test.")
+        for x in self._INPUTS:
+            with torch.no_grad():
+                out = self.layer(torch.tensor(x, dtype=torch_dtype))
+            self.assertEqual(self.layer.output_shape(x.shape), tuple(out.shape))
+            self.assertGreater(self.layer.flops(x.shape), 0)
+            self.assertGreater(self.layer.activation_memory(x.shape), 0)
+
+
+class LayerContextTest(unittest.TestCase):
+    """Stride and context of layers against gradients of their output"""
+    _NSTEP = 60
+
+    def check_context(self, layer, insize=1):
+        x = torch.randn(self._NSTEP, 1, insize, requires_grad=True)
+        out = layer(x)
+        stride = layer.stride
+        before, after = layer.context
+        self.assertEqual(layer.output_shape(x.shape), tuple(out.shape))
+        self.assertEqual(nn.receptive_field(layer), before + stride + after)
+        #  Blocks whose context lies within the input
+        first = -(-before // stride)
+        last = (self._NSTEP - after) // stride - 1
+        self.assertLess(first, last)
+        for blk in range(first, last + 1):
+            grad, = torch.autograd.grad(out[blk].sum(), x, retain_graph=True)
+            depends = np.flatnonzero(grad.abs().sum((1, 2)).numpy())
+            self.assertEqual(depends[0], blk * stride - before)
+            self.assertEqual(depends[-1], (blk + 1) * stride - 1 + after)
+
+    def test_convolution(self):
+        self.check_context(nn.Convolution(1, 4, 7, stride=3))
+        self.check_context(nn.Convolution(2, 4, 4, stride=2, pad=(0, 3)), insize=2)
+
+    def test_serial(self):
+        layer = nn.Serial([nn.Convolution(1, 4, 5, stride=2),
+                           nn.Window(3),
+                           nn.Convolution(12, 4, 4, stride=3, pad=(1, 2)),
+                           nn.DeltaSample(),
+                           nn.FeedForward(4, 3, fun=activation.tanh)])
+        self.assertEqual(layer.stride, 6)
+        self.assertEqual(layer.context, (2 + 2 * (1 + 1), 1 + 2 * (1 + 0 + 3)))
+        self.check_context(layer)
+
+    def test_combinations(self):
+        self.check_context(nn.Reverse(nn.Convolution(1, 4, 4, pad=(3, 0))))
+        self.check_context(nn.Parallel([nn.Convolution(1, 4, 3), nn.Window(5)]))
+        self.check_context(nn.SoftChoice([nn.Convolution(1, 4, 3, pad=(2, 0)),
+                                          nn.Convolution(1, 4, 3, pad=(0, 2))]))
+        self.check_context(nn.Residual(nn.Convolution(3, 3, 5)), insize=3)
+
+    def test_recurrent(self):
+        self.assertEqual(nn.GruMod(4, 8).context, (np.inf, 0))
+        self.assertEqual(nn.Reverse(nn.Lstm(4, 8)).context, (0, np.inf))
+        network = nn.Serial([nn.Convolution(1, 4, 19, stride=5),
+                             nn.Reverse(nn.GruMod(4, 8)),
+                             nn.GlobalNormFlipFlop(8, 4)])
+        self.assertEqual(network.stride, 5)
+        self.assertEqual(nn.receptive_field(network), np.inf)
+        self.assertEqual(network.output_shape((720, 3, 1)), (144, 3, 40))
+
 
 class LstmTest(LayerTest, unittest.TestCase):
     _INPUTS = [np.zeros((10, 20, 12)),
@@ -312,3 +375,47 @@ class GlobalNormFlipFlopTest(LayerTest, unittest.TestCase):
         # rtol before softmax = atol after softmax. Therefore I've replaced
         # the atol with the default value for rtol.
         self.assertTrue(torch.allclose(x1.grad, x2.grad, atol=1e-05))
+
+    def test_compiled_and_pytorch_same(self):
+        layer = nn.GlobalNormFlipFlop(12, 4)
+        x1 = torch.randn((100, 4, 12), requires_grad=True)
+        self.assertTrue(layer._use_compiled(x1))
+        weights = torch.randn((100, 4, 40))
+        out1 = layer(x1)
+        (out1 * weights).sum().backward()
+
+        x2 = x1.detach().requires_grad_()
+        layer._never_use_cupy = True
+        self.assertFalse(layer._use_compiled(x2))
+        out2 = layer(x2)
+        (out2 * weights).sum().backward()
+
+        self.assertTrue(torch.allclose(out1, out2, atol=1e-05))
+        self.assertTrue(torch.allclose(x1.grad, x2.grad, atol=1e-05))
+
+        with torch.no_grad():
+            layer._never_use_cupy = False
+            self.assertTrue(torch.allclose(layer(x1), out2, atol=1e-05))
+
+
+class GlobalNormFlipFlopCatModTest(LayerTest, unittest.TestCase):
+    _INPUTS = [np.random.uniform(size=(100, 20, 12))]
+
+    def setUp(self):
+        alphabet_info = alphabet.AlphabetInfo('ACGTZ', 'ACGTC', ['5mC'])
+        self.layer = nn.GlobalNormFlipFlopCatMod(12, alphabet_info)
+
+    def test_compiled_and_pytorch_same(self):
+        x1 = torch.randn((100, 4, 12), requires_grad=True)
+        self.assertTrue(self.layer._use_compiled(x1))
+        out1 = self.layer(x1)
+        weights = torch.randn(out1.shape)
+        (out1 * weights).sum().backward()
+
+        x2 = x1.detach().requires_grad_()
+        self.layer._never_use_cupy = True
+        out2 = self.layer(x2)
+        (out2 * weights).sum().backward()
+
+        self.assertTrue(torch.allclose(out1, out2, atol=1e-05))
+        self.assertTrue(torch.allclose(x1.grad, x2.grad, atol=1e-05))
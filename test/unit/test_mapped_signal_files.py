@@ -1,5 +1,6 @@
 import numpy as np
 import os
+import pickle
 import unittest
 
 import matplotlib as mpl
@@ -166,3 +167,135 @@ class TestMappedReadFiles(unittest.TestCase):
             file_test_report = f.check()
             print("Test report (should fail):", file_test_report)
             self.assertNotEqual(file_test_report, "pass")
+
+    def test_lazy_read_matches_read(self):
+        """Check that a read loaded lazily gives the same data and chunks
+        as one loaded into memory.
+        """
+        read_dict = construct_mapped_read()
+        filepath = os.path.join(self.testset_work_dir, 'test_lazy_read_file.hdf5')
+        with mapped_signal_files.HDF5(filepath, "w") as f:
+            f.write_version_number()
+            f.write_read(read_dict['read_id'], mapped_signal_files.Read(read_dict))
+
+        with mapped_signal_files.HDF5(filepath, "r") as f:
+            read = f.get_multiple_reads("all")[0]
+            lazy_read = f.get_multiple_reads("all", lazy=True)[0]
+        self.assertIsInstance(lazy_read, mapped_signal_files.LazyRead)
+        # Arrays are not loaded until needed but behave as items of the read
+        self.assertFalse(dict.__contains__(lazy_read, 'Dacs'))
+        self.assertIn('Dacs', lazy_read)
+        self.assertNotIn('Missing', lazy_read)
+        self.assertIsNone(lazy_read.get('Missing'))
+        self.assertEqual(set(lazy_read.keys()), set(read.keys()))
+        self.assertEqual(len(lazy_read), len(read))
+        for copied in dict(lazy_read), {**lazy_read}, dict(lazy_read.items()):
+            self.assertEqual(copied.keys(), read.keys())
+        pickled = pickle.loads(pickle.dumps(lazy_read))
+        self.assertFalse(dict.__contains__(pickled, 'Dacs'))
+
+        for k in ['Dacs', 'Reference', 'Ref_to_signal']:
+            self.assertTrue(np.array_equal(lazy_read[k], read[k]))
+            self.assertTrue(np.array_equal(lazy_read.get(k), read[k]))
+            self.assertTrue(np.array_equal(pickled[k], read[k]))
+        mapped_signal_files.close_lazy_files()
+        # Files are reopened when next needed
+        self.assertTrue(np.array_equal(lazy_read['Dacs'], read['Dacs']))
+        self.assertEqual(lazy_read.get_mapped_dacs_region(),
+                         read.get_mapped_dacs_region())
+        for chunkstart in range(6):
+            chunk = read.get_chunk_with_sample_length(5, chunkstart)
+            lazy_chunk = lazy_read.get_chunk_with_sample_length(5, chunkstart)
+            self.assertEqual(chunk.keys(), lazy_chunk.keys())
+            for k in chunk:
+                self.assertTrue(np.array_equal(chunk[k], lazy_chunk[k]))
+        for chunkstart in range(4):
+            chunk = read.get_chunk_with_sequence_length(4, chunkstart)
+            lazy_chunk = lazy_read.get_chunk_with_sequence_length(4, chunkstart)
+            self.assertEqual(chunk.keys(), lazy_chunk.keys())
+            for k in chunk:
+                self.assertTrue(np.array_equal(chunk[k], lazy_chunk[k]))
+
+    def test_packed_HDF5_mapped_read_file(self):
+        """Check that reads written to a packed file, in more than one
+        session, are recovered unchanged and that the file passes checks.
+        """
+        filepath = os.path.join(self.testset_work_dir, 'test_packed_read_file.hdf5')
+        read_dicts = []
+        for n in range(5):
+            read_dict = construct_mapped_read()
+            read_dict['read_id'] = 'read_{}'.format(n)
+            read_dict['alphabet'] = DEFAULT_ALPHABET
+            read_dict['collapse_alphabet'] = DEFAULT_ALPHABET
+            read_dict['Dacs'] = read_dict['Dacs'] + n
+            read_dicts.append(read_dict)
+
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        with mapped_signal_files.open_mapped_signal_file(filepath, "w", layout="packed") as f:
+            self.assertIsInstance(f, mapped_signal_files.PackedHDF5)
+        with mapped_signal_files.PackedHDF5(filepath, "w", buffer_samples=30) as f:
+            f.write_version_number()
+            for read_dict in read_dicts[:3]:
+                f.write_read(read_dict['read_id'], mapped_signal_files.Read(read_dict))
+        with mapped_signal_files.open_mapped_signal_file(filepath, "a") as f:
+            self.assertIsInstance(f, mapped_signal_files.PackedHDF5)
+            for read_dict in read_dicts[3:]:
+                f.write_read(read_dict['read_id'], mapped_signal_files.Read(read_dict))
+            # Reads still buffered can be got
+            read = f.get_read(read_dicts[-1]['read_id'])
+            self.assertTrue(np.array_equal(read['Dacs'], read_dicts[-1]['Dacs']))
+
+        with mapped_signal_files.open_mapped_signal_file(filepath) as f:
+            self.assertIsInstance(f, mapped_signal_files.PackedHDF5)
+            self.assertEqual(f.get_version_number(), 8)
+            self.assertEqual(f.get_read_ids(), [d['read_id'] for d in read_dicts])
+            self.assertEqual(f.check(), "pass")
+            for name in 'Index', 'Attributes':
+                # Tables are appended to, not rewritten, on each flush
+                self.assertEqual(f.hdf5['Reads'][name].maxshape, (None,))
+                self.assertEqual(len(f.hdf5['Reads'][name]), len(read_dicts))
+            for read_dict in read_dicts:
+                for get_read in f.get_read, f.get_lazy_read:
+                    read = get_read(read_dict['read_id'])
+                    self.assertEqual(set(read.keys()), set(read_dict.keys()))
+                    for k, v in read_dict.items():
+                        self.assertTrue(np.array_equal(read[k], v))
+
+    def test_chunk_metadata(self):
+        """Check chunk metadata against direct calculation from the read and
+        that it is recovered after saving to file.
+        """
+        rng = np.random.RandomState(0xbeef)
+        read_dict = construct_mapped_read()
+        Nref = 1000
+        reftosig = np.concatenate([[-1], np.cumsum(rng.randint(0, 5, size=Nref))])
+        read_dict.update(Ref_to_signal=reftosig.astype(np.int32),
+                         Dacs=np.arange(reftosig[-1] + 3, dtype=np.int16),
+                         Reference=rng.randint(4, size=Nref).astype(np.int16))
+        read = mapped_signal_files.Read(read_dict)
+        metadata = read.get_chunk_metadata()
+
+        mapped = np.flatnonzero(reftosig >= 0)
+        self.assertEqual(metadata.mapped_reference_region, (mapped[0], mapped[-1] + 1))
+        self.assertEqual(metadata.mapped_dacs_region, (0, reftosig[-1] + 1))
+        for refloc in range(1, Nref):
+            slip = (reftosig[refloc] == reftosig[refloc + 1] or
+                    (refloc > 1 and reftosig[refloc] == reftosig[refloc - 1]))
+            self.assertEqual(read.check_for_slip_at_refloc(refloc), slip)
+        for start, end in [(0, 1), (3, 5), (10, 70), (63, 129), (64, 128),
+                           (100, 900), (0, Nref + 1)]:
+            self.assertEqual(read.get_max_dwell((start, end)),
+                             np.max(np.diff(reftosig[start:end]), initial=1))
+
+        filepath = os.path.join(self.testset_work_dir, 'test_chunk_metadata_file.hdf5')
+        with mapped_signal_files.HDF5(filepath, "w") as f:
+            f.write_version_number()
+            f.write_read(read_dict['read_id'], read)
+            f.write_chunk_metadata({read_dict['read_id']: metadata})
+        with mapped_signal_files.HDF5(filepath, "r") as f:
+            saved = f.get_multiple_reads("all")[0].chunk_metadata
+        self.assertEqual(saved.mapped_dacs_region, metadata.mapped_dacs_region)
+        self.assertEqual(saved.mapped_reference_region, metadata.mapped_reference_region)
+        np.testing.assert_array_equal(saved.slip_locations, metadata.slip_locations)
+        np.testing.assert_array_equal(saved.block_max_dwell, metadata.block_max_dwell)
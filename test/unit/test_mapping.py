@@ -0,0 +1,78 @@
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+
+from taiyaki import mapping, signal
+
+
+def loop_mapping_limits(signalpos_to_refpos, mapping_margin):
+    """Reference implementation of Mapping.mapping_limits"""
+    firstmapped, lastmapped = -1, -1
+    for untrimmed_dacloc, refloc in enumerate(signalpos_to_refpos):
+        if refloc >= 0:
+            if firstmapped < 0:
+                firstmapped = untrimmed_dacloc
+            lastmapped = untrimmed_dacloc
+    if firstmapped >= 0:
+        startloc = firstmapped + mapping_margin
+        endloc = lastmapped + 1 - mapping_margin
+        if startloc <= endloc - 1:
+            return startloc, endloc
+    return 0, 0
+
+
+class MappingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(0xdeadbeef)
+        self.sig = signal.Signal(dacs=self.rng.randint(300, 900, size=1000).astype(np.int16))
+        self.sig.offset = np.float64(12.0)
+        self.sig.range = np.float64(1441.4)
+        self.sig.digitisation = np.float64(8192.0)
+        self.reference = ''.join(self.rng.choice(list('ACGT'), size=100))
+
+    def make_mapping(self, start, end):
+        sigtoref = np.full(1000, -1, dtype=np.int32)
+        sigtoref[start:end] = np.sort(self.rng.randint(100, size=end - start))
+        return mapping.Mapping(self.sig, sigtoref, self.reference)
+
+    def test_mapping_limits(self):
+        for start, end in [(0, 1000), (10, 990), (500, 501), (0, 0), (998, 1000)]:
+            m = self.make_mapping(start, end)
+            for margin in [0, 1, 5, 600]:
+                self.assertEqual(m.mapping_limits(margin),
+                                 loop_mapping_limits(m.signalpos_to_refpos, margin))
+
+    def test_add_integer_reference(self):
+        m = self.make_mapping(0, 1000)
+        for alphabet in ['ACGT', 'TGCA', 'ACGTZ', list('ACGTA')]:
+            m.add_integer_reference(alphabet)
+            self.assertEqual(m.integer_reference.dtype, np.int16)
+            self.assertEqual(m.integer_reference.tolist(),
+                             [alphabet.index(b) for b in self.reference])
+        with self.assertRaises(ValueError):
+            m.add_integer_reference('ACG')
+
+    def test_to_ssv(self):
+        m = self.make_mapping(10, 990)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'mapping.ssv')
+            m.to_ssv(filename)
+            with open(filename) as fh:
+                lines = fh.read().split('\n')
+        finally:
+            shutil.rmtree(tmpdir)
+
+        expected = ['dac signal dactoref']
+        for dac, refpos in zip(self.sig.untrimmed_dacs, m.signalpos_to_refpos):
+            sig = (dac + self.sig.offset) * self.sig.range / self.sig.digitisation
+            expected.append(str(dac) + " " + str(sig) + " " + str(refpos))
+        expected.append('#' + self.reference)
+        self.assertEqual(lines, expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
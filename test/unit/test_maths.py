@@ -68,6 +68,46 @@ class MathsTest(unittest.TestCase):
         self.assertTrue(np.allclose(maths.mad(x, axis=2, keepdims=True),
                                     np.zeros((5, 6, 1))))
 
+    def test_008_med_mad_dacs_matches_med_mad(self):
+        for n in [1, 2, 7, 10, 101, 1000]:
+            for offset, pa_range, digitisation in [(0, 1, 1), (13.0, 1441.4, 8192.0),
+                                                   (-243.7, 355.0, 2048.0)]:
+                for dacs in [np.random.randint(400, 700, size=n),
+                             np.random.randint(-3, 3, size=n)]:
+                    dacs = dacs.astype(np.int16)
+                    current = (dacs + offset) * pa_range / digitisation
+                    self.assertEqual(maths.med_mad_dacs(dacs, offset, pa_range, digitisation),
+                                     maths.med_mad(current))
+
+    def test_009_med_mad_dacs_batch(self):
+        dacs_list = [np.random.randint(300, 900, size=n).astype(np.int16)
+                     for n in [0, 1, 2, 50, 51, 1000]]
+        offset = np.random.uniform(-20, 20, size=len(dacs_list))
+        loc, scale = maths.med_mad_dacs_batch(dacs_list, offset, 1441.4, 8192.0, factor=1)
+        self.assertTrue(np.isnan(loc[0]) and np.isnan(scale[0]))
+        for i in range(1, len(dacs_list)):
+            self.assertEqual((loc[i], scale[i]),
+                             maths.med_mad_dacs(dacs_list[i], offset[i], 1441.4, 8192.0,
+                                                factor=1))
+
+    def test_010_med_mad_dacs_batch_outlier(self):
+        dacs_list = [np.random.randint(300, 900, size=n).astype(np.int16)
+                     for n in [10, 51, 1000]]
+        dacs_list.insert(1, np.array([-32000, 32000, 500, 501], dtype=np.int16))
+        loc, scale = maths.med_mad_dacs_batch(dacs_list, 3.0, 1441.4, 8192.0)
+        for i, dacs in enumerate(dacs_list):
+            self.assertEqual((loc[i], scale[i]),
+                             maths.med_mad((dacs + 3.0) * 1441.4 / 8192.0))
+
+
+    def test_011_in_sorted(self):
+        values = np.array([2, 3, 7, 20])
+        x = np.arange(-1, 23)
+        np.testing.assert_array_equal(maths.in_sorted(values, x), np.isin(x, values))
+        self.assertTrue(maths.in_sorted(values, 7))
+        self.assertFalse(maths.in_sorted(values, 8))
+        np.testing.assert_array_equal(maths.in_sorted([], x), np.zeros(len(x), dtype=bool))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,76 @@
+import numpy as np
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from . import DATA_DIR
+from taiyaki import per_read_params
+from taiyaki.fileio import readtsv
+
+
+class PerReadParamsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.tsv_file = os.path.join(self.tmpdir, 'readparams.tsv')
+        shutil.copy(os.path.join(DATA_DIR, 'readparams.tsv'), self.tsv_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_matches_dict_from_readtsv(self):
+        table = readtsv(self.tsv_file, ['UUID', 'trim_start', 'trim_end', 'shift', 'scale'])
+        expected = {row['UUID']: {field: row[field] for field in per_read_params.PARAM_FIELDS}
+                    for row in table}
+        store = per_read_params.PerReadParams(self.tsv_file)
+        self.assertEqual(dict(store.items()), expected)
+        self.assertNotIn('no_such_read', store)
+        self.assertIsNone(store.get('no_such_read'))
+
+    def test_last_duplicate_kept(self):
+        with open(self.tsv_file, 'a') as fh:
+            fh.write('db6b45aa-5d21-45cf-a435-05fb8f12e839\t10\t20\t1.5\t2.5\n')
+        store = per_read_params.PerReadParams(self.tsv_file)
+        self.assertEqual(len(store), 5)
+        self.assertEqual(store['db6b45aa-5d21-45cf-a435-05fb8f12e839'],
+                         {'trim_start': 10, 'trim_end': 20, 'shift': 1.5, 'scale': 2.5})
+
+    def test_find_many(self):
+        read_ids = ['read{}'.format(i) for i in range(1000)]
+        with open(self.tsv_file, 'w') as fh:
+            fh.write('scale\tshift\tUUID\ttrim_start\ttrim_end\n')
+            for i, read_id in enumerate(read_ids):
+                fh.write('{}\t{}\t{}\t{}\t{}\n'.format(i + 0.5, i * 2.0, read_id, i, i + 1))
+        store = per_read_params.PerReadParams(self.tsv_file)
+        rows = store.find(read_ids[::-1] + ['read1000', 'read'])
+        np.testing.assert_array_equal(store.params['read_id'][rows[:-2]],
+                                      np.array(read_ids[::-1], dtype=bytes))
+        np.testing.assert_array_equal(rows[-2:], -1)
+        self.assertEqual(store['read17'],
+                         {'trim_start': 17, 'trim_end': 18, 'shift': 34.0, 'scale': 17.5})
+
+    def test_cache_reused_and_rebuilt(self):
+        per_read_params.PerReadParams(self.tsv_file)
+        params_file = self.tsv_file + per_read_params.PARAMS_SUFFIX
+        mtime = os.path.getmtime(params_file)
+        store = per_read_params.PerReadParams(self.tsv_file)
+        self.assertEqual(os.path.getmtime(params_file), mtime)
+        self.assertIsInstance(store.params, np.memmap)
+
+        with open(self.tsv_file, 'a') as fh:
+            fh.write('new_read\t1\t2\t3.0\t4.0\n')
+        os.utime(self.tsv_file, (mtime + 10, mtime + 10))
+        store = per_read_params.PerReadParams(self.tsv_file)
+        self.assertIn('new_read', store)
+
+    def test_pickle_does_not_contain_params(self):
+        store = per_read_params.PerReadParams(self.tsv_file)
+        unpickled = pickle.loads(pickle.dumps(store))
+        self.assertIsNone(unpickled._params)
+        self.assertEqual(dict(unpickled.items()), dict(store.items()))
+
+
+if __name__ == '__main__':
+    unittest.main()
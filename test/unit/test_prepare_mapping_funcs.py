@@ -0,0 +1,102 @@
+import unittest
+import numpy as np
+import torch
+
+from taiyaki import alphabet, layers, prepare_mapping_funcs, signal
+from taiyaki.activation import tanh
+
+
+class FailingModel(torch.nn.Module):
+    """ Model failing for batches of chunks with a given length """
+
+    def __init__(self, model, fail_length):
+        super().__init__()
+        self.model = model
+        self.fail_length = fail_length
+
+    def forward(self, x):
+        if x.shape[0] == self.fail_length:
+            raise RuntimeError('CUDA out of memory')
+        return self.model(x)
+
+
+class RemapPipelineTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        torch.manual_seed(0xdeadbeef)
+        rng = np.random.RandomState(0xdeadbeef)
+        self.stride = 2
+        self.model = layers.Serial([
+            layers.Convolution(1, 8, 5, stride=self.stride, fun=tanh),
+            layers.GlobalNormFlipFlop(8, 4)])
+        self.alphabet_info = alphabet.AlphabetInfo('ACGT', 'ACGT')
+        self.params = {'trim_start': 10, 'trim_end': 10, 'shift': 500.0,
+                       'scale': 50.0}
+        self.prepared = []
+        for i, n in enumerate(rng.randint(100, 600, size=12)):
+            sig = signal.Signal(dacs=rng.randint(300, 700, size=n))
+            sig.set_trim_absolute(self.params['trim_start'],
+                                  self.params['trim_end'])
+            ref = ''.join(rng.choice(list('ACGT'), size=n // 20))
+            self.prepared.append((sig, ref, self.params, 'read{}'.format(i)))
+
+    def whole_read_output(self, prepared):
+        sig, _, read_params, _ = prepared
+        signalArray = prepare_mapping_funcs.standardised_current(sig, read_params)
+        with torch.no_grad():
+            out = self.model(torch.tensor(signalArray[:, None, None]))
+        return out[:, 0].numpy()
+
+    def run_network(self, **kwargs):
+        reads = [(prepared, '') for prepared in self.prepared]
+        reads.insert(3, (None, prepare_mapping_funcs.NO_REF_FOUND_ERR_TEXT))
+        results = list(prepare_mapping_funcs.run_remap_network(
+            reads, self.model, self.stride, **kwargs))
+        self.assertEqual(len(results), len(reads))
+        failed = [mesg for remap_input, mesg in results if remap_input is None]
+        self.assertEqual(failed, [prepare_mapping_funcs.NO_REF_FOUND_ERR_TEXT])
+        return {remap_input[3]: remap_input for remap_input, _ in results
+                if remap_input is not None}
+
+    def test_whole_reads_match_per_read_network(self):
+        results = self.run_network(batch_size=4)
+        for prepared in self.prepared:
+            remap_input = results[prepared[3]]
+            np.testing.assert_allclose(remap_input[4],
+                                       self.whole_read_output(prepared),
+                                       rtol=1e-5, atol=1e-5)
+
+    def test_chunked_reads_have_whole_read_shape(self):
+        results = self.run_network(batch_size=4, chunk_size=100, overlap=20)
+        for prepared in self.prepared:
+            remap_input = results[prepared[3]]
+            self.assertEqual(remap_input[4].shape,
+                             self.whole_read_output(prepared).shape)
+
+    def test_network_failure_fails_reads_in_batch(self):
+        fail_read = self.prepared[5]
+        fail_length = fail_read[0].trimmed_length
+        self.model, model = FailingModel(self.model, fail_length), self.model
+        try:
+            reads = [(prepared, '') for prepared in self.prepared]
+            results = list(prepare_mapping_funcs.run_remap_network(
+                reads, self.model, self.stride, batch_size=4))
+        finally:
+            self.model = model
+        self.assertEqual(len(results), len(reads))
+        failed = [mesg for remap_input, mesg in results if remap_input is None]
+        nfail = sum(prepared[0].trimmed_length == fail_length
+                    for prepared in self.prepared)
+        self.assertEqual(failed, [prepare_mapping_funcs.REMAP_ERR_TEXT] * nfail)
+        self.assertNotIn(fail_read[3], [remap_input[3] for remap_input, _ in results
+                                        if remap_input is not None])
+
+    def test_remap_network_output_passes_on_failure(self):
+        failed = (None, prepare_mapping_funcs.NO_REF_FOUND_ERR_TEXT)
+        self.assertEqual(prepare_mapping_funcs.oneread_remap_network_output(
+            failed, self.alphabet_info, self.stride), failed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+
+from taiyaki import maths, signal
+
+
+class SignalTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0xdeadbeef)
+        self.sig = signal.Signal(dacs=rng.randint(300, 900, size=200000).astype(np.int16))
+        self.sig.offset = np.float64(12.0)
+        self.sig.range = np.float64(1441.4)
+        self.sig.digitisation = np.float64(8192.0)
+        self.sig.set_trim_absolute(200, 50)
+        dacs = self.sig.untrimmed_dacs[200:-50].copy()
+        self.current = (dacs + self.sig.offset) * self.sig.range / self.sig.digitisation
+
+    def test_dacs_is_readonly_view(self):
+        dacs = self.sig.dacs
+        self.assertTrue(np.shares_memory(dacs, self.sig.untrimmed_dacs))
+        self.assertEqual(len(dacs), self.sig.trimmed_length)
+        with self.assertRaises(ValueError):
+            dacs[0] = 0
+
+    def test_current(self):
+        np.testing.assert_array_equal(self.sig.current, self.current)
+
+    def test_standardised_current(self):
+        expected = ((self.current - 90.0) / 14.0).astype(np.float32)
+        np.testing.assert_array_equal(self.sig.standardised_current(90.0, 14.0), expected)
+
+    def test_standardised_current_by_med_mad(self):
+        med, mad = maths.med_mad(self.current)
+        self.assertEqual(self.sig.med_mad(), (med, mad))
+        expected = ((self.current - med) / mad).astype(np.float32)
+        np.testing.assert_array_equal(self.sig.standardised_current(), expected)
+
+    def test_standardised_current_into_buffer(self):
+        out = np.empty(self.sig.trimmed_length, dtype=np.float32)
+        result = self.sig.standardised_current(90.0, 14.0, out=out)
+        self.assertIs(result, out)
+        with self.assertRaises(ValueError):
+            self.sig.standardised_current(90.0, 14.0, out=out[1:])
+
+
+if __name__ == '__main__':
+    unittest.main()
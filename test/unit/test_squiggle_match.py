@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+import unittest
+
+from taiyaki.squiggle_match import squiggle_match
+
+
+class SquiggleMatchTest(unittest.TestCase):
+    """Squiggle matching loss and its gradient"""
+    SIGLEN = np.array([50, 30, 70], dtype=np.int32)
+    NPOS = 20
+    BACK_PROB = 0.1
+    DELTA = 1e-2
+
+    def setUp(self):
+        rng = np.random.RandomState(0xdeadbeef)
+        self.params = rng.normal(
+            size=(self.NPOS, len(self.SIGLEN), 3)).astype(np.float32)
+        self.signal = rng.normal(size=self.SIGLEN.sum()).astype(np.float32)
+
+    def cost_fn(self, params):
+        return squiggle_match.squiggle_match_cost(
+            params, self.signal, self.SIGLEN, self.BACK_PROB).numpy()
+
+    def test_squiggle_match_grad(self):
+        cost, grad = squiggle_match.squiggle_match_grad(
+            self.params, self.signal, self.SIGLEN, self.BACK_PROB)
+        np.testing.assert_array_equal(cost.numpy(), self.cost_fn(self.params))
+        grad = grad.numpy()
+
+        #  Laplace emission is not differentiable in location where it equals
+        #  a signal sample, so only check spread and movement rate
+        rng = np.random.RandomState(1)
+        for _ in range(30):
+            pos, batch = rng.randint(self.NPOS), rng.randint(len(self.SIGLEN))
+            param = rng.randint(1, 3)
+            p = self.params.copy()
+            p[pos, batch, param] += self.DELTA
+            fplus = self.cost_fn(p)[batch]
+            p[pos, batch, param] -= 2 * self.DELTA
+            fminus = self.cost_fn(p)[batch]
+            fdiff = (fplus - fminus) / (2 * self.DELTA)
+            self.assertAlmostEqual(grad[pos, batch, param], fdiff,
+                                   delta=1e-2 * max(1.0, abs(fdiff)))
+
+    def test_squiggle_match_loss(self):
+        cost, grad = squiggle_match.squiggle_match_grad(
+            self.params, self.signal, self.SIGLEN, self.BACK_PROB)
+        cost, grad = cost.numpy(), grad.numpy()
+        weights = np.array([1.0, 2.0, 3.0], dtype=np.float32)
+
+        def loss_fn(params):
+            return squiggle_match.squiggle_match_loss(
+                params, torch.tensor(self.signal), torch.tensor(self.SIGLEN),
+                self.BACK_PROB)
+
+        params = torch.tensor(self.params, requires_grad=True)
+        loss = loss_fn(params)
+        (loss * torch.tensor(weights)).sum().backward()
+        np.testing.assert_array_equal(loss.detach().numpy(), cost)
+        np.testing.assert_allclose(params.grad.numpy(),
+                                   grad * weights[:, None], rtol=1e-6)
+
+        with torch.no_grad():
+            loss = loss_fn(params)
+        self.assertFalse(loss.requires_grad)
+        np.testing.assert_array_equal(loss.numpy(), cost)
+
+
+if __name__ == '__main__':
+    unittest.main()
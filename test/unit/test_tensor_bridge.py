@@ -0,0 +1,51 @@
+import numpy as np
+import torch
+import unittest
+
+from taiyaki import tensor_bridge
+
+
+class TensorBridgeTest(unittest.TestCase):
+
+    def test_cpu_array_shares_memory(self):
+        x = torch.arange(12, dtype=torch.float32).reshape(3, 4).requires_grad_()
+        arr = tensor_bridge.cpu_array(x)
+        self.assertTrue(arr.flags.c_contiguous)
+        with torch.no_grad():
+            x[1, 2] = -1.0
+        self.assertEqual(arr[1, 2], -1.0)
+
+        arr = np.arange(5, dtype=np.int32)
+        self.assertIs(tensor_bridge.cpu_array(arr, np.int32), arr)
+
+    def test_cpu_array_copies_when_needed(self):
+        x = torch.arange(12, dtype=torch.float32).reshape(3, 4)
+        for y, dtype in [(x.t(), np.float32), (x, np.int32), (x.double(), np.float32)]:
+            arr = tensor_bridge.cpu_array(y, dtype)
+            self.assertTrue(arr.flags.c_contiguous)
+            self.assertEqual(arr.dtype, dtype)
+            np.testing.assert_array_equal(arr, y.numpy().astype(dtype))
+            self.assertFalse(np.shares_memory(arr, x.numpy()))
+
+    def test_output_tensor(self):
+        out, arr = tensor_bridge.output_tensor((2, 3))
+        self.assertEqual(out.shape, (2, 3))
+        self.assertEqual(out.dtype, torch.float32)
+        arr[:] = 7.0
+        self.assertTrue(torch.all(out == 7.0))
+
+        buf = torch.zeros(2, 3, dtype=torch.int64)
+        out, arr = tensor_bridge.output_tensor((2, 3), torch.int64, out=buf)
+        self.assertIs(out, buf)
+        arr[1, 1] = 5
+        self.assertEqual(buf[1, 1], 5)
+
+    def test_output_tensor_rejects_unsuitable(self):
+        for out in [torch.zeros(3, 2), torch.zeros(2, 3, dtype=torch.float64),
+                    torch.zeros(3, 2).t()]:
+            with self.assertRaises(ValueError):
+                tensor_bridge.output_tensor((2, 3), out=out)
+
+
+if __name__ == '__main__':
+    unittest.main()